@@ -1,9 +1,18 @@
 from argparse import Namespace
+from dataclasses import dataclass, replace
 from enum import Enum
 import os, logging, sys
 import subprocess
 from typing import Optional
 
+import numpy as np
+import polars as pl
+
+from myutil.genotype import read_bim, read_fam
+from myutil.permutation import DEFAULT_PERMUTATION_SEED
+from myutil.scheduler import MEBIBYTE, MemoryAwareScheduler, plink_resource_args
+from myutil.vcf import chunked_vcf_conversion, is_bgzf
+
 
 class FileManagement(object):
     def __init__(self, args: Namespace) -> None:
@@ -52,6 +61,25 @@ class FileManagement(object):
         self.alpha: int = args.alpha
         self.calc_perm: int | None = args.perm
         self.ld_correct_bonferroni: bool = args.ld_correct
+        self.qc_engine: str = args.qc_engine
+        self.assoc_engine: str = args.assoc_engine
+        self.perm_mode: str = args.perm_mode
+        self.perm_seed: int = args.perm_seed if args.perm_seed is not None \
+            else DEFAULT_PERMUTATION_SEED
+        self.materialise_groups: bool = args.materialise_groups
+        self.vcf_conversion: str = args.vcf_conversion
+        self.phenotype_matrix: bool = args.phenotype_matrix
+        self.stage_cache: bool = not args.no_stage_cache
+        self.resume: bool = args.resume
+        self.output_format: str = args.output_format
+        self.phenotype_store: Optional[str] = None if args.no_phenotype_store \
+            else os.path.realpath(args.phenotype_store)
+        self.linear: bool = args.linear
+        self.covariate_file_path: Optional[str] = os.path.realpath(args.covar) if args.covar is not None else None
+        self.pca: int | None = args.pca
+        self.pca_engine: str = args.pca_engine
+        self.threads: int | None = args.threads
+        self.memory_budget: int | None = args.memory * MEBIBYTE if args.memory is not None else None
         pass
 
     def source_standardisation(self) -> str:
@@ -60,10 +88,25 @@ class FileManagement(object):
         It will generate a `.bed`, a `.fam` and a `.bim` file (or symlink).
         """
 
-        if self.original_ext in [".vcf", ".vcf.gz"]:
+        if self.original_ext == ".vcf.gz" and self.vcf_conversion == "chunked" \
+                and is_bgzf(self.file_name_root + self.original_ext):
+            logging.info("Converting .vcf.gz to plink binary format in parallel chunks...")
+            scheduler = MemoryAwareScheduler(memory_budget=self.memory_budget, max_threads=self.threads)
+            if not chunked_vcf_conversion(
+                self.plink,
+                self.file_name_root + self.original_ext,
+                self.output_name_temp_root + "_standardised",
+                scheduler,
+            ):
+                logging.error("An error occurred when converting .vcf.gz to plink binary file.")
+                sys.exit(-2)
+            logging.info("Conversion completed.")
+
+        elif self.original_ext in [".vcf", ".vcf.gz"]:
             logging.info("Converting .vcf to plink binary format... This may take a long time.")
             command = [
                 self.plink,
+                *plink_resource_args(),
                 "--vcf", self.file_name_root + self.original_ext,
                 "--make-bed",
                 "--vcf-half-call", "missing",
@@ -95,6 +138,9 @@ class FileManagement(object):
                 for ext in [".bed", ".fam", ".bim"]:
                     if not os.path.isfile(os.path.realpath(self.file_name_root + ext)):
                         raise Exception(f"`{self.file_name_root}{ext}` does not exist!")
+                    # replace the symlink of a previous run
+                    if os.path.lexists(self.output_name_temp_root + "_standardised" + ext):
+                        os.remove(self.output_name_temp_root + "_standardised" + ext)
                     os.symlink(self.file_name_root + ext,
                             self.output_name_temp_root + "_standardised" + ext)
                     if not os.path.isfile(os.path.realpath(f"{self.output_name_temp_root}_standardised{ext}")):
@@ -112,6 +158,7 @@ class FileManagement(object):
                     process = subprocess.run(
                         [
                             self.plink,
+                            *plink_resource_args(),
                             "--file", self.file_name_root + self.original_ext,
                             "--make-bed",
                             "--out", self.output_name_temp_root
@@ -186,3 +233,201 @@ class Gender(Enum):
             return Gender.UNKNOWN
         else:
             raise ValueError(f"Invalid gender string: {gender_str}")
+
+
+@dataclass(frozen=True)
+class VirtualSubset:
+    """A population group kept as index files over one plink binary fileset,
+    instead of a copy of its genotypes.
+
+    Attributes:
+        bfile (str): Path of the underlying plink fileset (without extension).
+        name (str): Path prefix of the group. Files derived from the group (plink `--out`,
+            visualisations, ...) are named after it.
+        keep_path (str | None): plink `--keep` file of the samples in the group. All
+            samples of `bfile` if None.
+        extract_path (str | None): plink `--extract` file of the SNPs in the group. All
+            SNPs of `bfile` if None.
+        update_sex_path (str | None): plink `--update-sex` file to apply on top of the
+            `.fam` of `bfile`.
+
+    `str()` and `os.fspath()` of a subset give `name`, so it can be used wherever a
+    fileset prefix is used to name output files.
+    """
+
+    bfile: str
+    name: str
+    keep_path: str | None = None
+    extract_path: str | None = None
+    update_sex_path: str | None = None
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __fspath__(self) -> str:
+        return self.name
+
+    def plink_args(self) -> list[str]:
+        """Arguments selecting this subset in a plink command."""
+        return ["--bfile", self.bfile] + (
+            ["--keep", self.keep_path] if self.keep_path is not None else []
+        ) + (
+            ["--extract", self.extract_path] if self.extract_path is not None else []
+        ) + (
+            ["--update-sex", self.update_sex_path] if self.update_sex_path is not None else []
+        )
+
+    def derive(
+        self,
+        name: str,
+        *,
+        keep_path: str | None = None,
+        extract_path: str | None = None,
+    ) -> "VirtualSubset":
+        """
+        Create a narrower subset of the same fileset. The given `--keep`/`--extract`
+        files replace the current ones, so they are expected to list only samples/SNPs
+        of this subset.
+        """
+        return replace(
+            self,
+            name=name,
+            keep_path=keep_path if keep_path is not None else self.keep_path,
+            extract_path=extract_path if extract_path is not None else self.extract_path,
+        )
+
+    def fam(self) -> pl.DataFrame:
+        """Rows of the `.fam` in this subset (with sex updated), in `.fam` order."""
+        fam = read_fam(self.bfile)
+        if self.update_sex_path is not None:
+            sex = pl.read_csv(
+                self.update_sex_path, separator="\t", has_header=True, infer_schema=False
+            )
+            sex.columns = ["FID", "IID", "new_sex"]
+            fam = fam.join(sex, on=["FID", "IID"], how="left", maintain_order="left").select(
+                "FID", "IID", "PID", "MID",
+                pl.col("new_sex").fill_null(pl.col("Sex")).alias("Sex"),
+                "Phenotype",
+            )
+        index = self.sample_index()
+        return fam if index is None else fam[index]
+
+    def sample_index(self) -> np.ndarray | None:
+        """Row numbers of the samples in the `.fam` of `bfile`, or None for all samples."""
+        if self.keep_path is None:
+            return None
+        keep = pl.read_csv(
+            self.keep_path, separator="\t", has_header=False, infer_schema=False,
+            columns=[0, 1], new_columns=["FID", "IID"],
+        )
+        return read_fam(self.bfile).select("FID", "IID").with_row_index().join(
+            keep, on=["FID", "IID"], how="semi"
+        )["index"].sort().to_numpy().astype(np.int64)
+
+    def variant_index(self) -> np.ndarray | None:
+        """Row numbers of the SNPs in the `.bim` of `bfile`, or None for all SNPs."""
+        if self.extract_path is None:
+            return None
+        extract = pl.read_csv(
+            self.extract_path, has_header=False, infer_schema=False, new_columns=["SNP"]
+        )
+        return read_bim(self.bfile).select("SNP").with_row_index().join(
+            extract, on="SNP", how="semi"
+        )["index"].sort().to_numpy().astype(np.int64)
+
+    def n_variants(self) -> int:
+        """Number of SNPs in this subset."""
+        index = self.variant_index()
+        return read_bim(self.bfile).height if index is None else len(index)
+
+    def materialise(self, plink_path: str, save_path_name: str | None = None) -> str:
+        """
+        Write the subset as a real plink binary fileset.
+
+        Args:
+            plink_path (str): Path to plink executable.
+            save_path_name (str | None): Output path (without extension). Defaults to `name`.
+
+        Returns:
+            str: Path of the written fileset (without extension).
+        """
+        save_path_name = self.name if save_path_name is None else save_path_name
+        subprocess.run(
+            [plink_path, *self.plink_args(), *plink_resource_args(), "--make-bed", "--out", save_path_name],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+            check=True,
+        )
+        return save_path_name
+
+
+def as_subset(input_name: "str | VirtualSubset") -> VirtualSubset:
+    """Wrap a plink fileset path into a `VirtualSubset` covering the whole fileset."""
+    if isinstance(input_name, VirtualSubset):
+        return input_name
+    return VirtualSubset(bfile=input_name, name=input_name)
+
+
+def bfile_args(input_name: "str | VirtualSubset") -> list[str]:
+    """plink arguments reading a fileset given either as a path or as a `VirtualSubset`."""
+    return as_subset(input_name).plink_args()
+
+
+@dataclass(frozen=True)
+class PhenotypeColumn:
+    """One phenotype of a phenotype matrix, i.e. a plink `--pheno` file with a
+    `FID IID <phenotype> ...` header and one column per phenotype.
+
+    Attributes:
+        path (str): Path of the phenotype matrix.
+        name (str): Header of the phenotype column.
+
+    `str()` and `os.fspath()` give `path`; use `pheno_args` to select the column in a
+    plink command.
+    """
+
+    path: str
+    name: str
+
+    def __str__(self) -> str:
+        return self.path
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def plink_args(self) -> list[str]:
+        """Arguments selecting this phenotype in a plink command."""
+        return ["--pheno", self.path, "--pheno-name", self.name]
+
+
+def pheno_args(phenotype_info_path: "str | PhenotypeColumn") -> list[str]:
+    """plink arguments reading a phenotype given either as a file path or as a `PhenotypeColumn`."""
+    if isinstance(phenotype_info_path, PhenotypeColumn):
+        return phenotype_info_path.plink_args()
+    return ["--pheno", phenotype_info_path]
+
+
+def group_matrix_columns(
+    phenotype_info_paths: "list[str | PhenotypeColumn]",
+) -> tuple[list[tuple[int, str]], dict[str, list[tuple[int, str]]]]:
+    """
+    Split phenotypes into phenotype files and columns of phenotype matrices grouped by
+    matrix, so that every matrix can be read once for all its columns.
+
+    Args:
+        phenotype_info_paths (list[str | PhenotypeColumn]): Phenotype file path or matrix
+            column of every phenotype.
+
+    Returns:
+        tuple[list[tuple[int, str]], dict[str, list[tuple[int, str]]]]: (index, path) of
+            every phenotype file, and {matrix path: [(index, column name)]}, in the order
+            of `phenotype_info_paths`.
+    """
+    files: list[tuple[int, str]] = []
+    matrix_columns: dict[str, list[tuple[int, str]]] = {}
+    for index, path in enumerate(phenotype_info_paths):
+        if isinstance(path, PhenotypeColumn):
+            matrix_columns.setdefault(path.path, []).append((index, path.name))
+        else:
+            files.append((index, path))
+    return files, matrix_columns
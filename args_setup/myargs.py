@@ -30,6 +30,14 @@ def setup():
         "--plink-path", type=str,
         help="`plink` executable file path. If not assigned, one in PATH will be used. Note: This programme is only designed for plink v1.90."
     )
+    parser.add_argument(
+        "--vcf-conversion", type=str, choices=["chunked", "plink"], default="chunked",
+        help="\
+How a bgzipped .vcf.gz source file is converted to plink binary format. `chunked` splits the file into regions \
+(at the records of its tabix/CSI index if present, at its compressed blocks otherwise), converts them in parallel \
+and concatenates the results; `plink` runs a single `plink --vcf --make-bed`. Other .vcf files are always converted \
+with `plink`. Default is `chunked`."
+    )
     ### designate phenotype file path.
     phenotype_group = parser.add_argument_group(
         title="Phenotype relating options",
@@ -44,6 +52,12 @@ def setup():
         "--phenotypes-folder", type=str, default=None,
         help="Folder containing files, each of which contains single phenotype data. Default is None."
     )
+    phenotype_group.add_argument(
+        "--phenotype-matrix", action="store_true",
+        help="\
+Split `--phenotype` into a single phenotype matrix (FID, IID, one column per phenotype, -9 for missing) \
+and an index of its columns, instead of one file per phenotype."
+    )
 
     ### designate ethnic info file path.
     ethnic_group = parser.add_argument_group(
@@ -81,6 +95,86 @@ def setup():
         help="Whether or not to divide population by gender."
     )
 
+    parser.add_argument(
+        "--materialise-groups", action="store_true",
+        help="\
+Write a plink fileset for every gender/ethnic group and QC step. \
+By default groups are kept as `--keep`/`--extract` index files over the standardised fileset."
+    )
+
+    store_exclusive_group = parser.add_mutually_exclusive_group()
+    store_exclusive_group.add_argument(
+        "--phenotype-store", type=str, default="./phenotype_store",
+        help="\
+Folder of the Parquet store of phenotype, ethnic and gender tables. \
+Each input table is converted once and found again by its content hash. Default is ./phenotype_store."
+    )
+    store_exclusive_group.add_argument(
+        "--no-phenotype-store", action="store_true",
+        help="Read phenotype, ethnic and gender tables directly instead of through the Parquet store."
+    )
+
+    parser.add_argument(
+        "--no-stage-cache", action="store_true",
+        help="\
+Run every stage again. By default a stage is skipped when the hash of its input files and parameters \
+matches a previous run (recorded in ./temp/stage_cache) and its outputs are unchanged."
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="\
+Resume an interrupted run with the same arguments from the stages recorded in ./temp/run_manifest.jsonl. \
+Stages whose outputs are missing run again."
+    )
+    parser.add_argument(
+        "--output-format", type=str, choices=["tsv", "parquet"], default="tsv",
+        help="\
+Format of the summary tables. `parquet` writes every summary as a Parquet dataset (a `.parquet` folder) \
+partitioned by gender, ethnic group and phenotype, with row group statistics on P, \
+which can be read with `polars.scan_parquet(path, hive_partitioning=True)`. Default is `tsv`."
+    )
+
+    resource_group = parser.add_argument_group(
+        title="Resource options",
+        description="Limit the threads and memory used by the programme and by every plink process it runs."
+    )
+    resource_group.add_argument(
+        "--threads", type=int, default=None,
+        help="Maximum number of threads shared by all concurrent jobs. Default is the number of CPUs."
+    )
+    resource_group.add_argument(
+        "--memory", type=int, default=None,
+        help="\
+Memory budget in MiB shared by all concurrent jobs. Jobs are started only while their estimated memory fits into the budget. \
+Default is 80%% of the available memory."
+    )
+
+    qc_group = parser.add_argument_group(
+        title="Quality control options"
+    )
+    qc_group.add_argument(
+        "--qc-engine", type=str, choices=["native", "plink"], default="native",
+        help="\
+How missingness, HWE and MAF filters are applied. `native` streams the genotypes once and writes a single filtered fileset; \
+`plink` chains three `plink --make-bed` runs. Default is `native`."
+    )
+
+    pca_group = parser.add_argument_group(
+        title="Principal component analysis options"
+    )
+    pca_group.add_argument(
+        "--pca", type=int, default=None, const=10, nargs="?",
+        help="\
+Whether or not to compute principal components of every group from its LD-pruned SNPs, and how many. \
+If no value is assigned with it, the default is 10. Results are written to the `PCA` folder."
+    )
+    pca_group.add_argument(
+        "--pca-engine", type=str, choices=["native", "plink"], default="native",
+        help="\
+How principal components are computed. `native` runs a randomised eigendecomposition streaming the genotypes in blocks, \
+in bounded memory; `plink` runs `plink --pca`, which holds the whole relationship matrix in memory. Default is `native`."
+    )
+
     assoc_group = parser.add_argument_group(
         title="Association calculation options"
     )
@@ -94,6 +188,34 @@ def setup():
 Whether or not to perform permutation test, and how many times permutation is performed. If no value is assigned with it, the default is 1_000_000. \
 Note that this procedure is computationally intensive (yet the implementation is efficient)."
     )
+    assoc_group.add_argument(
+        "--perm-mode", type=str, choices=["maxt", "adaptive"], default="maxt",
+        help="\
+How permutation tests are run. `maxt` performs `--perm` max(T) permutations on every SNP (EMP1 and family-wise EMP2); \
+`adaptive` stops permuting a SNP once its empirical p-value is clearly above or below the Bonferroni threshold, \
+so `--perm` is the maximum number of permutations per SNP (EMP1 and the number of permutations). Default is `maxt`."
+    )
+    assoc_group.add_argument(
+        "--perm-seed", type=int, default=None,
+        help="Random seed of permutation tests, so that reruns give the same empirical p-values. A fixed default seed is used if not given."
+    )
+    assoc_group.add_argument(
+        "--assoc-engine", type=str, choices=["plink", "native"], default="plink",
+        help="\
+How quantitative association is calculated. `plink` runs `plink --assoc qt-means`; \
+`native` computes the same `.qassoc`, `.qassoc.means` (and `.qassoc.mperm`) files in-process. Default is `plink`."
+    )
+    assoc_group.add_argument(
+        "--linear", action="store_true",
+        help="\
+Also test every phenotype with a regression adjusting for sex, the principal components of `--pca` and `--covar`: \
+linear regression for quantitative phenotypes (`.assoc.linear`) and logistic regression for binary (1/2 coded) phenotypes (`.assoc.logistic`). \
+Results (ADD rows) are written next to the `--assoc` results, with the engine of `--assoc-engine`."
+    )
+    assoc_group.add_argument(
+        "--covar", type=str, default=None,
+        help="plink `--covar` file (FID, IID and one column per covariate, e.g. age) used by `--linear`. Default is None."
+    )
     assoc_group.add_argument(
         "--alpha", type=float, default=0.05,
         help="Bonferroni / permutation corrected alpha value, used for filtering positive SNPs."
@@ -145,6 +267,17 @@ def check(parser: ArgumentParser):
             parser.error("plink executable not found in PATH!")
     logging.info("plink executable path: %s", plink_path)
 
+    ### check resource options
+    if args.threads is not None and args.threads < 1:
+        parser.error("`--threads` must be a positive integer!")
+    if args.memory is not None and args.memory < 1:
+        parser.error("`--memory` must be a positive integer (MiB)!")
+
+    if args.covar is not None and not os.path.isfile(args.covar):
+        parser.error(f"Covariate file does not exist. Given: {args.covar}")
+    if args.pca is not None and args.pca < 1:
+        parser.error("`--pca` must be a positive integer!")
+
     ### check gender options
     match (args.gender, args.gender_reference):
         case (None, str() as path):
@@ -18,23 +18,25 @@ import polars as pl
 
 ## self-defined libraries
 ### Self defined logger
-from myutil import mds, small_tools
+from myutil import small_tools
 from myutil import complements
-from myutil.summarization import QassocResult, generate_quantitative_summary
+from myutil.summarization import QassocResult, SummaryWriter, generate_quantitative_summary
 logger = small_tools.create_logger("MainLogger", level=logging.WARN)
 
 from args_setup import myargs
 from Classes import FileManagement, Gender
-from myutil import association_analysis, group_division, quality_control, small_tools
+from myutil import association_analysis, group_division, small_tools
 from myutil.complements import extract_phenotype_info
-import myutil.visualisations as vislz
+from myutil.pipeline import GroupResult, group_pipeline
+from myutil.run_manifest import RunManifest
+from myutil.scheduler import MemoryAwareScheduler, set_plink_resources
+from myutil.stage_cache import (
+    DEFAULT_CACHE_DIR, StageCache, fileset_files, phenotype_digests, plink_version, prefix_files
+)
 
 ## multiprocessing libraries
 from queue import Queue
 import multiprocessing as mp
-from multiprocessing import cpu_count
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from concurrent.futures._base import Future as FutureClass
 
 ### Note: the logging library should be gradually replaced with self-defined logger
 
@@ -61,477 +63,263 @@ if __name__ == "__main__":
     # file management
     fm = FileManagement(args)
 
+    # every job, and every plink process it runs, is limited to a share of the
+    # configured threads and memory
+    scheduler = MemoryAwareScheduler(memory_budget=fm.memory_budget, max_threads=fm.threads)
+    set_plink_resources(scheduler.resources())
+
+    # stages whose inputs and parameters did not change since the last run are skipped
+    cache = StageCache(
+        DEFAULT_CACHE_DIR if fm.stage_cache else None,
+        salt=f"{__version__} {plink_version(fm.plink)}",
+    )
+    # finished stages are journalled so that an interrupted run can be resumed
+    manifest = RunManifest(
+        resume=fm.resume,
+        run_args={key: value for key, value in vars(args).items() if key != "resume"},
+    )
+
     # progress bar
     progress_bar = small_tools.ProgressBar()
 
     # standardise source file
-    print("Standardising source file...")
-    logger.info("Standardising source file...")
-    output = fm.source_standardisation()
+    if (state := manifest.restore("standardisation")) is not None:
+        output = state["output"]
+    else:
+        print("Standardising source file...")
+        logger.info("Standardising source file...")
+        source_files = [fm.absolute_path] + {
+            ".bed": [f"{fm.file_name_root}.bim", f"{fm.file_name_root}.fam"],
+            ".ped": [f"{fm.file_name_root}.map"],
+        }.get(fm.original_ext, [])
+        output = cache.call(
+            cache.key("standardisation", source_files, fm.original_ext),
+            fileset_files,
+            fm.source_standardisation,
+        )
+        manifest.record("standardisation", {"output": output}, fileset_files(output))
+    fm.set_working_file(output)
     outputs1: list[tuple[Gender, str]] = []
     # output_cache: list = []
     output_queue = Queue()
 
-    # complete gender information in .fam and divide population into male and female groups.
-    print(fm.gender_info_file_path,
-          fm.gender_reference_path, fm.divide_pop_by_gender)
-    match (fm.gender_info_file_path, fm.gender_reference_path, fm.divide_pop_by_gender):
-        case (str(), str(), True):
-            print("Dividing population by gender...")
-            logger.info(
-                "Completing gender information and divide population by gender..."
-            )
-            outputs1 = group_division.divide_pop_by_gender(
-                fm.plink, output, fm.gender_reference_path, fm.gender_info_file_path
-            )
-        case (str(), str(), False):
-            # Complete gender information but do not divide pop by gender
-            logger.info("Completing gender information...")
-            print("Completing gender information...")
-            outputs1 = complements.gender_complement(
-                fm.plink,
-                output,
-                fm.gender_info_file_path,
-                fm.gender_reference_path
-            )
-            pass
-        case _:
-            print("Gender information is not provided. Skip gender complement.")
-            outputs1 = [(Gender.UNKNOWN, output)]
-
-    # if args.gender:
-    #     print("Completing gender information...")
-    #     logger.info("Completing gender information...")
-    #     outputs = group_division.divide_pop_by_gender(
-    #         fm.plink,
-    #         output,
-    #         fm.gender_reference_path,
-    #         fm.gender_info_file_path
-    #     )
-    #     print("Gender information complement finished.")
-    # else:
-    #     logging.warning("No gender information provided, skipping gender complement.")
-
-    # divide population into ethnic groups
-    match (fm.ethnic_info_file_path, fm.ethnic_reference_path):
-        case (str(), str()):
-            print("Dividing population into ethnic groups...")
-            output_cache: list[tuple[Gender, str, str]] = []
-            for output in outputs1:
-                progress_bar.print_progress(
-                    f"Divide {os.path.relpath(
-                        output[1])} into ethnic groups...",
-                    len(outputs1),
-                    outputs1.index(output) + 1,
-                )
-                result = group_division.divide_pop_by_ethnic(
-                    fm.plink,
-                    output[1],
-                    fm.ethnic_info_file_path,
-                    fm.ethnic_reference_path,
-                    output[0],
-                    fm.loose_ethnic_filter,
-                )
-                output_cache.extend(result)
-            print("")
-            logger.info("Division finished.")
-        case _:
-            print("No ethnic information provided, skipping ethnic complement.")
-            output_cache = [(output[0], "all ethnic groups", output[1])
-                            for output in outputs1]
-    outputs: list[tuple[Gender, str, str]] = output_cache
-
-    # QC
-    ## 1. filter high missingness
-    ### visualisation
-    print("Visualising missingness...")
-    logger.info("Visualising missingness...")
-    os.makedirs("missingness_visualisations", exist_ok=True)
-    with ProcessPoolExecutor() as pool:
-        futures: list[FutureClass] = []
-        for output in outputs:
-            progress_bar.print_progress(
-                f"Visualising missingness for {os.path.relpath(output[1])}...",
-                len(outputs),
-                outputs.index(output) + 1
-            )
-            futures.append(
-                pool.submit(
-                    vislz.minor_allele_frequency,
-                    fm,
-                    output[2],
-                    os.path.join(os.path.dirname(
-                        output[2]), "../", "missingness_visualisations", os.path.basename(output[2])),
-                    gender=output[0], ethnic=output[1]
-                )
-            )
-    print("")
-    logging.info("Visualising missingness finished.")
-
-    ### Filtering
-    """
-    Current format of `outputs` is [[gender, ethnic, file_name],]
-    """
-    print("Filtering high missingness...")
-
-    with ProcessPoolExecutor() as pool:
-        futures: list[FutureClass] = []
-        output_cache = []
-        for output in outputs:
-            progress_bar.print_progress(
-                f"Filtering high missingness for {
-                    os.path.relpath(output[2])}...",
-                len(outputs),
-                outputs.index(output) + 1  # type: ignore
-            )
-            futures.append(
-                pool.submit(
-                    quality_control.filter_high_missingness,
-                    fm,
-                    output[2],
-                    f"{output[2]}_no_miss",
-                    output[0],
-                    output[1],
-                    missingness_threshold=0.02
-                )
-            )
-        output_cache = [
-            future.result()
-            for future in as_completed(futures)
-            if future.result() is not None
-        ]
-    print()
-    logger.info("Filtering high missingness finished.")
-    outputs = output_cache
-    output_cache = []
-
-    ## 2. filter HWE
-    print("Visualising HWE...")
-    os.makedirs("./hwe_visualisation")
-    with ProcessPoolExecutor() as pool:
-        for output in outputs:
-            progress_bar.print_progress(
-                f"Visualising HWE for {os.path.relpath(output[2])}...",
-                len(outputs),
-                outputs.index(output) + 1
-            )
-            pool.submit(
-                vislz.hardy_weinberg,
-                fm,
-                output[2],
-                os.path.join(os.path.dirname(
-                    output[2]), "../", "hwe_visualisation", os.path.basename(output[2])+"hwe"),
-                output[1],
-                output[0]
-            )
-    print("\nFiltering HWE...")
-    with ProcessPoolExecutor() as pool:
-        futures: list[FutureClass] = []
-        for output in outputs:
-            progress_bar.print_progress(
-                f"Filtering HWE for {os.path.relpath(output[2])}...",
-                len(outputs),
-                outputs.index(output) + 1
-            )
-            futures.append(
-                pool.submit(
-                    quality_control.filter_hwe,
-                    fm,
-                    output[2],
-                    f"{output[2]}_hwe",
-                    output[0],
-                    output[1],
+    if (state := manifest.restore("groups")) is not None:
+        outputs = state["outputs"]
+    else:
+        # complete gender information in .fam and divide population into male and female groups.
+        print(fm.gender_info_file_path,
+              fm.gender_reference_path, fm.divide_pop_by_gender)
+        match (fm.gender_info_file_path, fm.gender_reference_path, fm.divide_pop_by_gender):
+            case (str(), str(), True):
+                print("Dividing population by gender...")
+                logger.info(
+                    "Completing gender information and divide population by gender..."
                 )
-            )
-        output_cache = [future.result() for future in as_completed(
-            futures) if future.result() is not None]
-    outputs = output_cache
-    output_cache = []
-    logger.info("Filtering HWE finished.")
-    print()
-
-    ## 3. filter MAF
-    ### visualisation
-    print("Visualising MAF...")
-    os.makedirs("./maf_visualisation")
-    with ProcessPoolExecutor() as pool:
-        for output in outputs:
-            progress_bar.print_progress(
-                f"Visualising MAF for {os.path.relpath(output[2])}...",
-                len(outputs),
-                outputs.index(output) + 1
-            )
-            pool.submit(
-                vislz.minor_allele_frequency,
-                fm,
-                output[2],
-                os.path.join(os.path.dirname(
-                    output[2]), "../", "maf_visualisation", os.path.basename(output[2])+"_maf"),
-                gender=output[0], ethnic=output[1]
-            )
-    logger.info("MAF visualisation finished.")
-    print()
-    ### filter MAF
-    print("Filtering MAF...")
-    with ProcessPoolExecutor() as pool:
-        futures: list[FutureClass] = []
-        for output in outputs:
-            progress_bar.print_progress(
-                f"Filtering MAF for {os.path.relpath(output[2])}...",
-                len(outputs),
-                outputs.index(output) + 1
-            )
-            futures.append(
-                pool.submit(
-                    quality_control.filter_maf,
-                    fm,
-                    output[2],
-                    f"{output[2]}_maf",
-                    output[0], output[1],
-                    maf_threshold=0.01
+                outputs1 = cache.call(
+                    cache.key(
+                        "gender_division",
+                        fileset_files(output) + [fm.gender_info_file_path, fm.gender_reference_path],
+                        output, fm.materialise_groups,
+                    ),
+                    lambda result: [path for _, group in result for path in fileset_files(group)],
+                    group_division.divide_pop_by_gender,
+                    fm.plink, output, fm.gender_reference_path, fm.gender_info_file_path,
+                    materialise=fm.materialise_groups,
                 )
-            )
-        output_cache = [future.result() for future in as_completed(
-            futures) if future.result() is not None]
-    outputs = output_cache
-    output_cache = []
-    print()
-    logger.info("Filtering MAF finished.")
-
-    ### Calculate LD
-    # get (independent) SNPs
-    print("Getting SNP number...")
-    logger.info("Getting independent SNPs...")
-    os.makedirs("ld_pruning", exist_ok=True)
-
-    if fm.ld_correct_bonferroni:
-        with ProcessPoolExecutor(max_workers=cpu_count()) as pool:
-            futures_dict = {
-                f"{gender}-{ethnic}": pool.submit(
-                    quality_control.ld_pruning,
+            case (str(), str(), False):
+                # Complete gender information but do not divide pop by gender
+                logger.info("Completing gender information...")
+                print("Completing gender information...")
+                outputs1 = cache.call(
+                    cache.key(
+                        "gender_complement",
+                        fileset_files(output) + [fm.gender_info_file_path, fm.gender_reference_path],
+                        output, fm.materialise_groups,
+                    ),
+                    lambda result: [path for _, group in result for path in fileset_files(group)],
+                    complements.gender_complement,
                     fm.plink,
-                    file_prefix,
-                    f"ld_pruning/indepSNP_{gender}-{ethnic}",
-                    window_size=500
-                ) for gender, ethnic, file_prefix in outputs
-            }
-            indep_in_paths = {
-                key: f"{prefix.result()}.prune.in"
-                for key, prefix in futures_dict.items()
-            }
-            indep_snp_sums = {
-                key: small_tools.count_line(f"{prefix.result()}.prune.in")
-                for key, prefix in futures_dict.items()
-            }
-    else:
-        snp_sums = {
-            f"{gender}-{ethnic}": small_tools.count_line(f"{prefix}.bim")
-            for gender, ethnic, prefix in outputs
-        }
-
-
-    # ## 4. Multi-dimensional scaling
-    # ### LD pruning
-    # logger.info("Executing LD pruning...")
-    # os.mkdir("LD_pruning")
-    # # (gender, ethnic, plink file, LD pruning result)
-    # ld_pruning_outputs: list[tuple[Gender, str, str, str]] = []
-    # for index, output in enumerate(outputs):
-    #     progress_bar.print_progress(
-    #         f"LD pruning for {os.path.relpath(output[2])}...",
-    #         len(outputs),
-    #         index
-    #     )
-    #     ld_pruning_output = quality_control.ld_pruning(
-    #         fm.plink,
-    #         output[2],
-    #         os.path.join("LD_pruning", f"{os.path.basename(output[2])}_indep-SNP"),
-    #         output[0],
-    #         output[1],
-    #     )
-    #     if ld_pruning_output is not None:
-    #         ld_pruning_outputs.append((*output, ld_pruning_output))
-
-    """OOM will occur in the PCA process!"""
-    # ### PCA
-    # logger.info("Executing PCA...")
-    # os.mkdir("PCA")
-    # # (gender, ethnic, plink file, PCA result)
-    # pca_outputs: list[tuple[Gender, str, str, str]] = []
-    # for index, output in enumerate(ld_pruning_outputs):
-    #     progress_bar.print_progress(
-    #         f"PCA for {os.path.relpath(output[2])}...",
-    #         len(outputs),
-    #         index
-    #     )
-    #     pca_output = mds.principle_component_analysis(
-    #         fm.plink,
-    #         output[2],
-    #         output[3],
-    #         os.path.join("PCA", f"{os.path.basename(output[2])}_PCA"),
-    #         output[0],
-    #         output[1],
-    #     )
-    #     if pca_output is not None:
-    #         pca_outputs.append((output[0], output[1], pca_output, pca_output))
+                    output,
+                    fm.gender_info_file_path,
+                    fm.gender_reference_path,
+                    materialise=fm.materialise_groups,
+                    store_dir=fm.phenotype_store,
+                )
+                pass
+            case _:
+                print("Gender information is not provided. Skip gender complement.")
+                outputs1 = [(Gender.UNKNOWN, output)]
+
+        # if args.gender:
+        #     print("Completing gender information...")
+        #     logger.info("Completing gender information...")
+        #     outputs = group_division.divide_pop_by_gender(
+        #         fm.plink,
+        #         output,
+        #         fm.gender_reference_path,
+        #         fm.gender_info_file_path
+        #     )
+        #     print("Gender information complement finished.")
+        # else:
+        #     logging.warning("No gender information provided, skipping gender complement.")
+
+        # divide population into ethnic groups
+        match (fm.ethnic_info_file_path, fm.ethnic_reference_path):
+            case (str(), str()):
+                print("Dividing population into ethnic groups...")
+                output_cache: list[tuple[Gender, str, str]] = []
+                for output in outputs1:
+                    progress_bar.print_progress(
+                        f"Divide {os.path.relpath(
+                            output[1])} into ethnic groups...",
+                        len(outputs1),
+                        outputs1.index(output) + 1,
+                    )
+                    result = cache.call(
+                        cache.key(
+                            "ethnic_division",
+                            fileset_files(output[1]) + [fm.ethnic_info_file_path, fm.ethnic_reference_path],
+                            output, fm.loose_ethnic_filter, fm.materialise_groups,
+                        ),
+                        lambda result: [path for *_, group in result for path in fileset_files(group)],
+                        group_division.divide_pop_by_ethnic,
+                        fm.plink,
+                        output[1],
+                        fm.ethnic_info_file_path,
+                        fm.ethnic_reference_path,
+                        output[0],
+                        fm.loose_ethnic_filter,
+                        materialise=fm.materialise_groups,
+                        store_dir=fm.phenotype_store,
+                    )
+                    output_cache.extend(result)
+                print("")
+                logger.info("Division finished.")
+            case _:
+                print("No ethnic information provided, skipping ethnic complement.")
+                output_cache = [(output[0], "all ethnic groups", output[1])
+                                for output in outputs1]
+        outputs: list[tuple[Gender, str, str]] = output_cache
+        manifest.record(
+            "groups", {"outputs": outputs},
+            [path for *_, group in outputs for path in fileset_files(group)],
+        )
 
     # Future: Additional covariants can be added here (say, age, BMI, ethnic, etc.).
     #         Note that in this programme, sex is forcely included as an covariate.
     #
 
-    # Now we have finished all QC processes.
-    # Next, we shall first split the phenotype source files and then perform the GWAS analysis.
-
+    # The phenotypes are split before the analysis, so that every group can flow through
+    # its whole pipeline on its own.
     print("Splitting phenotype source files...")
-    match fm.phenotype_file_path, fm.phenotype_folder_path:
-        case str() as path, None:
-            pheno_files = extract_phenotype_info(
-                fm.output_name_temp_root + "_standardised", path
-            )
-        case None, str() as path:
-            pheno_files = [(file, os.path.splitext(os.path.basename(file))[0])
-                           for file in os.listdir(path) if file.endswith(".txt")]
-        case _:
-            logger.fatal("Theoratically impossible!")
-            sys.exit(1)
-
-    # Association analysis
-
-    print("")
-    print("Performing GWAS analysis & visualisation...")
-    os.makedirs("assoc_pictures")
-    print("Phenotype files:", pheno_files)
-    os.mkdir("assoc_results")
-
-    output_cache2: list[tuple[Gender, str, str, str]] = []
-
-    ## The following implementation does not support covariates and will be deprecated.
-
-
-    for pheno_index, pheno_file in enumerate(pheno_files):
-        for(file_index, (gender, ethnic, file)) in enumerate(outputs):
-            progress_bar.print_progress(
-                f"Calc assoc with perm between {
-                    os.path.basename(pheno_file[0])
-                } and {os.path.basename(file)}",
-                len(outputs) * len(pheno_files),
-                pheno_index * len(outputs) + file_index + 1
-            )
-            output_name = os.path.join(
-                "assoc_results",
-                f"{os.path.basename(file)}_{
-                    pheno_file[0]}",
-            )
-            res = association_analysis.quantitative_association(
-                fm.plink,
-                file,
-                pheno_file[0],
-                pheno_file[1],
-                output_name,
-                gender=gender,
-                ethnic=ethnic,
-                mperm=fm.calc_perm
-            )
-            if res:
-                output_cache2.append(
-                    (gender, ethnic, pheno_file[0], output_name,)
-                )
-        # with ProcessPoolExecutor(max_workers=2) as pool:
-        #             futures = []
-        #             for pheno_index, pheno_file in enumerate(pheno_files):
-        #                 for(file_index, (gender, ethnic, file)) in enumerate(outputs):
-        #                     pool.submit(
-        #                         progress_bar.print_progress,
-        #                             f"Calc assoc with perm between {
-        #                                 os.path.basename(pheno_file[0])
-        #                             } and {os.path.basename(file)}",
-        #                             len(outputs) * len(pheno_files),
-        #                             pheno_index * len(outputs) + file_index + 1
-        #                         )
-        #                     output_name = os.path.join(
-        #                         "assoc_results",
-        #                         f"{os.path.basename(file)}_{
-        #                             pheno_file[0]}",
-        #                     )
-        #                     future = pool.submit(
-        #                         association_analysis.assoc_perm,
-        #                         fm.plink,
-        #                         file,
-        #                         pheno_file[1],
-        #                         output_name,
-        #                         mperm=mperm
-        #                     )
-        #                     futures.append(future)
-        #                     # if res:
-        #                     output_cache2.append(
-        #                         (gender, ethnic, pheno_file[0], output_name,)
-        #                     )
-        #             output_cache2 = [output_cache2[i] for i, future in enumerate(futures) if future.result()==True]
-
-
-    outputs2 = output_cache2
-    output_cache2 = []
-
-    print("")
-    print("Visualising association result")
-    with ProcessPoolExecutor(max_workers=int(cpu_count() * 2 / 3)) as pool:
-        for output in outputs2:
-            ## Visualise association
-            pool.submit(
-                progress_bar.print_progress,
-                f"Visualising association of {output[2]}...",
-                len(outputs2) + 1,
-                outputs2.index(output)
-            )
-            if fm.calc_perm:
-                pool.submit(
-                    vislz.assoc_mperm_visualisation,
-                    f"{output[3]}",
-                    os.path.join("assoc_pictures", os.path.basename(output[3])),
-                    gender=output[0],
-                    ethnic_name=output[1],
-                    phenotype_name=output[2],
-                    n=indep_snp_sums[f"{output[0]}-{output[1]}"] # type: ignore
-                        if fm.ld_correct_bonferroni
-                        else snp_sums[f"{output[0]}-{output[1]}"], # type: ignore
-                    alpha=fm.alpha,
-                )
-            else:
-                pool.submit(
-                    vislz.assoc_visualisation,
-                    f"{output[3]}.qassoc",
-                    os.path.join(
-                        "assoc_pictures", f"{os.path.basename(output[3])}_assoc"
+    if (state := manifest.restore("phenotypes")) is not None:
+        pheno_files = state["pheno_files"]
+    else:
+        match fm.phenotype_file_path, fm.phenotype_folder_path:
+            case str() as path, None:
+                pheno_files = cache.call(
+                    cache.key(
+                        "phenotype_extraction",
+                        [path, f"{fm.output_name_temp_root}_standardised.fam"],
+                        fm.phenotype_matrix,
                     ),
-                    *output[0:3],
-                    n=indep_snp_sums[f"{output[0]}-{output[1]}"] # type: ignore
-                        if fm.ld_correct_bonferroni
-                        else snp_sums[f"{output[0]}-{output[1]}"], # type: ignore
-                    alpha=fm.alpha,
+                    lambda result: {os.fspath(file) for _, file in result},
+                    extract_phenotype_info,
+                    fm.output_name_temp_root + "_standardised", path,
+                    store_dir=fm.phenotype_store, matrix=fm.phenotype_matrix,
                 )
+            case None, str() as path:
+                pheno_files = [(os.path.splitext(file)[0], os.path.join(path, file))
+                               for file in os.listdir(path) if file.endswith(".txt")]
+            case _:
+                logger.fatal("Theoratically impossible!")
+                sys.exit(1)
+        manifest.record("phenotypes", {"pheno_files": pheno_files}, [file for _, file in pheno_files])
 
-    ## 4. Generate summary
     print("")
-    print("Generating summary...")
-    os.mkdir("summary")
+    print("Performing QC, GWAS analysis & visualisation...")
+    for folder in (
+        "missingness_visualisations", "hwe_visualisation", "maf_visualisation",
+        "assoc_pictures", "assoc_results",
+    ):
+        os.makedirs(folder, exist_ok=True)
+    print("Phenotype files:", pheno_files)
+
+    pheno_digests = phenotype_digests(pheno_files) if fm.stage_cache else {}
+    pheno_types = association_analysis.classify_phenotype_types(pheno_files, has_header=True) \
+        if fm.linear else {}
 
-    generate_quantitative_summary(
-        [
+    def qassoc_results(result: GroupResult) -> list[QassocResult]:
+        return [
             QassocResult(
                 f"{out_prefix}.qassoc",
                 f"{out_prefix}.qassoc.means",
-                f"{out_prefix}.qassoc.mperm" if fm.calc_perm is not None else None,
+                None if fm.calc_perm is None
+                    else f"{out_prefix}.qassoc.perm" if fm.perm_mode == "adaptive"
+                    else f"{out_prefix}.qassoc.mperm",
                 gender,
                 ethnic,
                 phenotype,
-                bonferroni_n=indep_snp_sums[f"{output[0]}-{output[1]}"] # type: ignore
-                    if fm.ld_correct_bonferroni
-                    else snp_sums[f"{output[0]}-{output[1]}"], # type: ignore
-            ) for (gender, ethnic, phenotype, out_prefix) in outputs2
-        ],
-        alpha=fm.alpha,
-        output_prefix="summary"
-    )
+                bonferroni_n=result.bonferroni_n,
+            ) for (gender, ethnic, phenotype, out_prefix) in result.association_outputs
+        ]
+
+    # every group flows through quality control, association and visualisation on its
+    # own, so that a slow group does not hold the others back; the groups only join at
+    # the summary
+    summary_writer: Optional[SummaryWriter] = None
+    if (state := manifest.restore("analysis")) is not None:
+        group_results = [GroupResult(**result) for result in state["results"]]
+    else:
+        # the summary grows as the groups finish, rather than after all of them
+        os.makedirs("summary", exist_ok=True)
+        summary_writer = SummaryWriter(fm.alpha, "summary", output_format=fm.output_format)
+        restored = manifest.restore_items("analysis")
+        pipelines = [
+            group_pipeline(fm, cache, manifest, restored, group, pheno_files, pheno_digests, pheno_types)
+            for group in outputs
+        ]
+        results: dict[int, GroupResult] = {}
+        for count, (index, result) in enumerate(scheduler.run_pipelines(pipelines)):
+            progress_bar.print_progress(
+                f"Analysed {os.path.relpath(outputs[index][2])}...",
+                len(outputs),
+                count + 1
+            )
+            if result is not None:
+                results[index] = result
+                for qassoc_result in qassoc_results(result):
+                    summary_writer.add(qassoc_result)
+        print()
+        logger.info("Analysis of %d groups finished.", len(results))
+        group_results = [results[index] for index in sorted(results)]
+        manifest.record("analysis", {"results": [vars(result) for result in group_results]}, [
+            path for result in group_results for *_, out_prefix in result.association_outputs
+            for path in prefix_files(f"{out_prefix}.")
+        ])
+
+    ## 4. Generate summary
+    if manifest.restore("summary") is not None:
+        print("The summary of this run has already been generated.")
+    else:
+        print("")
+        if summary_writer is not None:
+            summary_writer.close()
+            summary_files = summary_writer.outputs
+        else:
+            print("Generating summary...")
+            os.makedirs("summary", exist_ok=True)
+            summary_files = generate_quantitative_summary(
+                [
+                    qassoc_result for result in group_results
+                    for qassoc_result in qassoc_results(result)
+                ],
+                alpha=fm.alpha,
+                output_prefix="summary",
+                cache=cache,
+                output_format=fm.output_format,
+            )
+        manifest.record("summary", {}, summary_files)
 
     '''for pheno_file in pheno_files:
         for output in outputs:
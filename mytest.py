@@ -447,6 +447,1383 @@ class Test05Summarization(unittest.TestCase):
             shutil.rmtree(os.path.join("test_data", "summary"))
 
 
+def write_synthetic_fileset(prefix: str, dosage, chromosomes=None) -> None:
+    """Write a small plink binary fileset from a (variants, samples) dosage matrix.
+
+    Missing genotypes are coded as -9, like `myutil.genotype.MISSING_GENOTYPE`.
+    """
+    import numpy as np
+
+    dosage = np.asarray(dosage)
+    n_variants, n_samples = dosage.shape
+    codes = np.select(
+        [dosage == 2, dosage == 1, dosage == 0], [0, 2, 3], default=1
+    ).astype(np.uint8)
+    padded = np.ones((n_variants, (n_samples + 3) // 4 * 4), dtype=np.uint8)
+    padded[:, :n_samples] = codes
+    padded = padded.reshape(n_variants, -1, 4)
+    packed = (
+        padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+    ).astype(np.uint8)
+
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    with open(f"{prefix}.bed", "wb") as writer:
+        writer.write(b"\x6c\x1b\x01")
+        writer.write(packed.tobytes())
+    with open(f"{prefix}.bim", "w") as writer:
+        for i in range(n_variants):
+            chromosome = 1 if chromosomes is None else chromosomes[i]
+            writer.write(f"{chromosome}\tsnp{i}\t0\t{1000 + i}\tA\tG\n")
+    with open(f"{prefix}.fam", "w") as writer:
+        for i in range(n_samples):
+            writer.write(f"fam{i} ind{i} 0 0 {1 + i % 2} -9\n")
+
+
+class Test06GenotypeAccess(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        import numpy as np
+
+        rng = np.random.default_rng(2024)
+        cls.dosage = rng.choice([0, 1, 2, -9], size=(37, 23), p=[0.4, 0.35, 0.2, 0.05])
+        cls.prefix = os.path.join("test_data", "genotype", "synthetic")
+        write_synthetic_fileset(cls.prefix, cls.dosage)
+
+    @timing_decorator
+    def test_01_decode_whole_file(self):
+        import numpy as np
+        from myutil.genotype import BedReader
+
+        reader = BedReader(self.prefix)
+        self.assertEqual((reader.n_variants, reader.n_samples), self.dosage.shape)
+        decoded = reader.read_variants(slice(0, reader.n_variants))
+        self.assertEqual(decoded.dtype, np.int8)
+        np.testing.assert_array_equal(decoded, self.dosage)
+
+    @timing_decorator
+    def test_02_chunks_and_subsets(self):
+        import numpy as np
+        from myutil.genotype import BedReader
+
+        reader = BedReader(self.prefix)
+        sample_index = np.array([22, 0, 5, 6, 7, 13])
+        variant_index = np.array([1, 2, 3, 10, 36])
+
+        blocks = list(reader.iter_chunks(2, variant_index=variant_index, sample_index=sample_index))
+        self.assertEqual(len(blocks), 3)
+        np.testing.assert_array_equal(np.concatenate([index for index, _ in blocks]), variant_index)
+        np.testing.assert_array_equal(
+            np.vstack([block for _, block in blocks]),
+            self.dosage[variant_index][:, sample_index],
+        )
+
+        blocks = list(reader.iter_chunks(10))
+        np.testing.assert_array_equal(np.vstack([block for _, block in blocks]), self.dosage)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(os.path.join("test_data", "genotype"))
+
+
+class Test07FusedQualityControl(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        import numpy as np
+
+        rng = np.random.default_rng(7)
+        n_samples = 400
+        p = rng.uniform(0.2, 0.5, size=(100, 1))
+        dosage = rng.binomial(2, p, size=(100, n_samples))
+        dosage[0, :] = 0                        # monomorphic -> MAF filter
+        dosage[1, :] = 1                        # all heterozygous -> HWE filter
+        dosage[2, rng.choice(n_samples, 40, replace=False)] = -9  # SNP missingness 10%
+        dosage[3:, 5] = -9                      # sample missingness > 2%
+        cls.dosage = dosage
+        cls.input_prefix = os.path.join("test_data", "genotype", "qc_input")
+        cls.output_prefix = os.path.join("test_data", "genotype", "qc_output")
+        write_synthetic_fileset(cls.input_prefix, dosage)
+
+    @timing_decorator
+    def test_01_fused_quality_control(self):
+        import numpy as np
+        from myutil.genotype import BedReader
+        from myutil.quality_control import fused_quality_control
+
+        res = fused_quality_control(
+            None,  # type: ignore
+            self.input_prefix,
+            self.output_prefix,
+            Gender.MALE,
+            "British",
+        )
+        self.assertEqual(res, (Gender.MALE, "British", self.output_prefix))
+
+        with open(f"{self.output_prefix}.extract") as reader:
+            kept_snps = [line.strip() for line in reader]
+        self.assertEqual(kept_snps, [f"snp{i}" for i in range(3, 100)])
+        with open(f"{self.output_prefix}.keep") as reader:
+            kept_samples = [line.split()[1] for line in reader]
+        self.assertNotIn("ind5", kept_samples)
+        self.assertEqual(len(kept_samples), self.dosage.shape[1] - 1)
+
+        sample_mask = np.ones(self.dosage.shape[1], dtype=bool)
+        sample_mask[5] = False
+        filtered = BedReader(self.output_prefix)
+        np.testing.assert_array_equal(
+            filtered.read_variants(slice(0, filtered.n_variants)),
+            self.dosage[3:][:, sample_mask],
+        )
+
+    @timing_decorator
+    def test_02_virtual_subset(self):
+        import numpy as np
+        from Classes import VirtualSubset, as_subset
+        from myutil.genotype import BedReader
+        from myutil.quality_control import fused_quality_control
+
+        # every other sample, without sample 5
+        keep_path = f"{self.input_prefix}_even.keep"
+        with open(keep_path, "w") as writer:
+            writer.writelines(f"fam{i}\tind{i}\n" for i in range(0, self.dosage.shape[1], 2))
+        subset = as_subset(self.input_prefix).derive(
+            f"{self.input_prefix}_even", keep_path=keep_path
+        )
+        self.assertEqual(
+            subset.plink_args(), ["--bfile", self.input_prefix, "--keep", keep_path]
+        )
+        np.testing.assert_array_equal(
+            subset.sample_index(), np.arange(0, self.dosage.shape[1], 2)
+        )
+
+        res = fused_quality_control(
+            None,  # type: ignore
+            subset,
+            f"{self.output_prefix}_even",
+            Gender.MALE,
+            "British",
+            make_bed=False,
+        )
+        self.assertIsNotNone(res)
+        qc_subset = res[2]  # type: ignore
+        self.assertIsInstance(qc_subset, VirtualSubset)
+        self.assertEqual(str(qc_subset), f"{self.output_prefix}_even")
+        self.assertEqual(qc_subset.bfile, self.input_prefix)
+        self.assertFalse(os.path.exists(f"{self.output_prefix}_even.bed"))
+
+        # sample 5 is not in the subset, so snp2 is the only SNP dropped for missingness
+        variant_index = qc_subset.variant_index()
+        np.testing.assert_array_equal(variant_index, np.arange(3, 100))
+        self.assertEqual(qc_subset.n_variants(), 97)
+        np.testing.assert_array_equal(
+            qc_subset.sample_index(), np.arange(0, self.dosage.shape[1], 2)
+        )
+        np.testing.assert_array_equal(
+            BedReader(self.input_prefix).read_variants(variant_index, qc_subset.sample_index()),
+            self.dosage[3:, ::2],
+        )
+
+
+class Test08NativeQuantitativeAssociation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        import numpy as np
+
+        rng = np.random.default_rng(11)
+        n_samples = 300
+        dosage = rng.binomial(2, 0.3, size=(20, n_samples))
+        dosage[rng.random(dosage.shape) < 0.03] = -9
+        dosage[4, :] = 0                        # monomorphic -> NA
+        cls.dosage = dosage
+        cls.input_prefix = os.path.join("test_data", "genotype", "qassoc_input")
+        write_synthetic_fileset(cls.input_prefix, dosage)
+
+        phenotypes = rng.normal(25, 5, size=(n_samples, 2))
+        phenotypes[:, 0] += 4 * np.clip(dosage[0], 0, None)
+        phenotypes[rng.random(phenotypes.shape) < 0.1] = -9
+        cls.phenotypes = phenotypes
+        cls.pheno_paths = []
+        for column in range(phenotypes.shape[1]):
+            path = f"{cls.input_prefix}_pheno{column}.tsv"
+            with open(path, "w") as writer:
+                writer.write(f"FID\tIID\tpheno{column}\n")
+                writer.writelines(
+                    f"fam{i}\tind{i}\t{value}\n" for i, value in enumerate(phenotypes[:, column])
+                )
+            cls.pheno_paths.append(path)
+
+    @timing_decorator
+    def test_01_qassoc_files(self):
+        import numpy as np
+        from myutil.qassoc import quantitative_association
+        from myutil.summarization import _parse_qassoc_file, _parse_qt_means_file
+
+        output_names = [f"{self.input_prefix}_out{i}" for i in range(len(self.pheno_paths))]
+        quantitative_association(self.input_prefix, self.pheno_paths, output_names, chunk_size=7)
+
+        for column, output_name in enumerate(output_names):
+            qassoc_df = _parse_qassoc_file(f"{output_name}.qassoc")
+            self.assertEqual(count_line(f"{output_name}.qassoc"), self.dosage.shape[0] + 1)
+            # the monomorphic SNP has NA statistics and is dropped by the parser
+            self.assertEqual(qassoc_df.height, self.dosage.shape[0] - 1)
+            self.assertNotIn("snp4", qassoc_df["SNP"].to_list())
+
+            for row in qassoc_df.iter_rows(named=True):
+                variant = int(row["SNP"][3:])
+                mask = (self.dosage[variant] >= 0) & (self.phenotypes[:, column] != -9)
+                x = self.dosage[variant][mask].astype(float)
+                y = self.phenotypes[:, column][mask]
+                self.assertEqual(row["NMISS"], mask.sum())
+                self.assertAlmostEqual(row["BETA"], np.polyfit(x, y, 1)[0], delta=abs(row["BETA"]) * 1e-3)
+                self.assertAlmostEqual(row["R2"], np.corrcoef(x, y)[0, 1] ** 2, delta=row["R2"] * 1e-3 + 1e-9)
+
+            means_df = _parse_qt_means_file(f"{output_name}.qassoc.means")
+            self.assertEqual(means_df.height, 5 * self.dosage.shape[0])
+            snp0 = means_df.filter(means_df["SNP"] == "snp0")
+            self.assertEqual(snp0["VALUE"].to_list(), ["GENO", "COUNTS", "FREQ", "MEAN", "SD"])
+            self.assertEqual(snp0.row(0)[3:], ("A/A", "A/G", "G/G"))
+
+        qassoc_df = _parse_qassoc_file(f"{output_names[0]}.qassoc")
+        p_snp0 = qassoc_df.filter(qassoc_df["SNP"] == "snp0")["P"][0]
+        self.assertLess(p_snp0, 1e-6)
+
+    @timing_decorator
+    def test_02_batch_association(self):
+        from myutil.qassoc import quantitative_association
+
+        phenotype_files = [(f"pheno{i}", path) for i, path in enumerate(self.pheno_paths)]
+        output_names = [f"{self.input_prefix}_batch{i}" for i in range(len(self.pheno_paths))]
+        res = association_analysis.batch_quantitative_association(
+            "plink", self.input_prefix, phenotype_files, output_names,
+            Gender.MALE, "British", engine="native",
+        )
+        self.assertEqual(res, [
+            (Gender.MALE, "British", f"pheno{i}", output_names[i])
+            for i in range(len(self.pheno_paths))
+        ])
+
+        # same result as one phenotype at a time
+        for path, output_name in zip(self.pheno_paths, output_names):
+            quantitative_association(self.input_prefix, [path], [f"{output_name}_single"])
+            for extension in [".qassoc", ".qassoc.means"]:
+                with open(f"{output_name}{extension}") as batch, \
+                        open(f"{output_name}_single{extension}") as single:
+                    self.assertEqual(batch.read(), single.read())
+
+    @timing_decorator
+    def test_03_max_t_permutation(self):
+        from myutil.qassoc import quantitative_association
+        from myutil.summarization import _parse_mperm_file
+
+        output_names = [f"{self.input_prefix}_mperm{i}" for i in range(len(self.pheno_paths))]
+        quantitative_association(
+            self.input_prefix, self.pheno_paths, output_names,
+            mperm=200, seed=5, n_workers=3, chunk_size=6,
+        )
+        mperm_df = _parse_mperm_file(f"{output_names[0]}.qassoc.mperm")
+        self.assertEqual(mperm_df.height, self.dosage.shape[0])
+        self.assertTrue(((mperm_df["EMP1"] > 0) & (mperm_df["EMP1"] <= 1)).all())
+        self.assertTrue((mperm_df["EMP2"] >= mperm_df["EMP1"]).all())
+        snp0 = mperm_df.filter(mperm_df["SNP"] == "snp0")
+        self.assertAlmostEqual(snp0["EMP1"][0], 1 / 201, places=4)
+        self.assertEqual(mperm_df.filter(mperm_df["SNP"] == "snp4")["EMP2"][0], 1)
+
+        # same seed, different thread count and SNP blocks -> same result
+        quantitative_association(
+            self.input_prefix, self.pheno_paths, [f"{name}_rerun" for name in output_names],
+            mperm=200, seed=5, n_workers=1,
+        )
+        for output_name in output_names:
+            with open(f"{output_name}.qassoc.mperm") as first, \
+                    open(f"{output_name}_rerun.qassoc.mperm") as second:
+                self.assertEqual(first.read(), second.read())
+
+    @timing_decorator
+    def test_04_adaptive_permutation(self):
+        from myutil.qassoc import quantitative_association
+        from myutil.summarization import QassocResult, _concat_qassoc_mperm_mean, _parse_perm_file
+
+        output_name = f"{self.input_prefix}_aperm"
+        quantitative_association(
+            self.input_prefix, self.pheno_paths[:1], [output_name],
+            mperm=5000, perm_mode="adaptive", alpha=0.01, seed=5,
+        )
+        perm_df = _parse_perm_file(f"{output_name}.qassoc.perm")
+        self.assertEqual(perm_df.height, self.dosage.shape[0])
+        # clearly associated and clearly null SNPs both stop early
+        self.assertLess(perm_df.filter(perm_df["SNP"] == "snp0")["NP"][0], 5000)
+        self.assertLess(perm_df.filter(perm_df["SNP"] == "snp0")["EMP1"][0], 0.01)
+        self.assertLess(perm_df["NP"].median(), 5000)  # type: ignore
+        self.assertEqual(perm_df.filter(perm_df["SNP"] == "snp4")["NP"][0], 0)
+
+        summary_df, _ = _concat_qassoc_mperm_mean(QassocResult(
+            f"{output_name}.qassoc", f"{output_name}.qassoc.means",
+            f"{output_name}.qassoc.perm", Gender.MALE, "British", "pheno0", bonferroni_n=20,
+        ))
+        self.assertIn("PERM_P_1", summary_df.columns)
+        self.assertIn("PERM_N", summary_df.columns)
+        self.assertNotIn("PERM_P_2", summary_df.columns)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(os.path.join("test_data", "genotype"), ignore_errors=True)
+
+
+class Test09MemoryAwareScheduler(unittest.TestCase):
+
+    @timing_decorator
+    def test_01_plink_resources(self):
+        from myutil.scheduler import (
+            MEBIBYTE, Job, MemoryAwareScheduler, plink_resource_args
+        )
+
+        scheduler = MemoryAwareScheduler(memory_budget=1024 * MEBIBYTE, max_threads=4)
+        jobs = [Job(plink_resource_args, memory=memory * MEBIBYTE) for memory in (100, 300, 2048)]
+        results = dict(scheduler.run(jobs))
+        self.assertEqual(sorted(results), [0, 1, 2])
+        # every job gets an equal share of the threads and its own memory estimate
+        self.assertEqual(results[0], ["--threads", "1", "--memory", "100"])
+        self.assertEqual(results[1], ["--threads", "1", "--memory", "300"])
+        # a job larger than the budget runs on its own, limited to the budget
+        self.assertEqual(results[2], ["--threads", "1", "--memory", "1024"])
+        # the resources are only set inside the workers
+        self.assertEqual(plink_resource_args(), [])
+
+    @timing_decorator
+    def test_02_estimate_plink_memory(self):
+        from myutil.scheduler import PLINK_BASE_MEMORY, estimate_plink_memory
+
+        bfile = os.path.join("test_data", "scheduler_input")
+        with open(f"{bfile}.bim", "w") as writer:
+            writer.writelines(f"1\tsnp{i}\t0\t{i}\tA\tG\n" for i in range(1000))
+        with open(f"{bfile}.fam", "w") as writer:
+            writer.writelines(f"F{i} I{i} 0 0 1 -9\n" for i in range(400))
+        # without a .bed file the genotype size is derived from the .bim/.fam sizes
+        estimate = estimate_plink_memory(bfile)
+        self.assertGreater(estimate, PLINK_BASE_MEMORY + 1000 * 400 // 4 // 2)
+        with open(f"{bfile}.bed", "wb") as writer:
+            writer.write(bytes(3 + 1000 * 100))
+        self.assertEqual(
+            estimate_plink_memory(bfile),
+            PLINK_BASE_MEMORY + 3 + 1000 * 100
+            + 2 * (os.path.getsize(f"{bfile}.bim") + os.path.getsize(f"{bfile}.fam")),
+        )
+        for ext in (".bed", ".bim", ".fam"):
+            os.remove(f"{bfile}{ext}")
+
+    @timing_decorator
+    def test_03_run_pipelines(self):
+        from myutil.scheduler import MEBIBYTE, Job, MemoryAwareScheduler, plink_resource_args
+
+        def increment(value):
+            # a branch which is a pipeline itself
+            result = yield Job(sum, ([value, 1],))
+            return result
+
+        def pipeline(value):
+            squared = yield Job(pow, (value, 2))
+            # branches run concurrently and their results come back in order
+            cube, incremented = yield [Job(pow, (value, 3)), increment(squared)]
+            nothing = yield []
+            return squared, cube, incremented, nothing
+
+        def cached():
+            return "cached"
+            yield
+
+        scheduler = MemoryAwareScheduler(memory_budget=1024 * MEBIBYTE, max_threads=4)
+        results = dict(scheduler.run_pipelines([pipeline(2), cached(), pipeline(3)]))
+        self.assertEqual(results, {0: (4, 8, 5, []), 1: "cached", 2: (9, 27, 10, [])})
+
+        # a job starting on its own gets all threads
+        def resources():
+            return (yield Job(plink_resource_args, memory=100 * MEBIBYTE))
+        self.assertEqual(
+            dict(scheduler.run_pipelines([resources()])),
+            {0: ["--threads", "4", "--memory", "100"]},
+        )
+
+
+    @timing_decorator
+    def test_04_association_batch_size(self):
+        import numpy as np
+        from myutil.association_analysis import association_batch_size, estimate_association_memory
+
+        bfile = os.path.join("test_data", "genotype", "batch_size_input")
+        write_synthetic_fileset(bfile, np.zeros((5, 40), dtype=int))
+        mperm = 1_000_000
+        budget = estimate_association_memory(bfile, 30, "native", mperm)
+        size = association_batch_size(bfile, budget, "native", mperm)
+        self.assertEqual(size, 30)
+        self.assertLessEqual(estimate_association_memory(bfile, size, "native", mperm), budget)
+        self.assertGreater(estimate_association_memory(bfile, size + 1, "native", mperm), budget)
+        # a single phenotype always runs, even over budget
+        self.assertEqual(association_batch_size(bfile, 1, "native", mperm), 1)
+        # every permutation thread holds its own blocks
+        self.assertLess(
+            estimate_association_memory(bfile, 30, "native", mperm, n_workers=1),
+            estimate_association_memory(bfile, 30, "native", mperm, n_workers=8),
+        )
+        self.assertEqual(association_batch_size(
+            bfile, estimate_association_memory(bfile, 30, "native", mperm, n_workers=2),
+            "native", mperm, n_workers=2,
+        ), 30)
+
+
+class Test10RandomisedPCA(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        import numpy as np
+
+        rng = np.random.default_rng(3)
+        n_samples, n_variants = 240, 1200
+        # three populations with diverged allele frequencies
+        population = np.repeat(np.arange(3), n_samples // 3)
+        frequencies = rng.uniform(0.1, 0.9, size=(3, n_variants))
+        frequencies[1] = np.clip(frequencies[0] + rng.normal(0, 0.1, n_variants), 0.05, 0.95)
+        dosage = rng.binomial(2, frequencies[population].T)
+        dosage[rng.random(dosage.shape) < 0.01] = -9
+        dosage[7, :] = 1                        # monomorphic -> dropped
+        cls.dosage = dosage
+        cls.input_prefix = os.path.join("test_data", "genotype", "pca_input")
+        write_synthetic_fileset(cls.input_prefix, dosage)
+        cls.prune_in = f"{cls.input_prefix}.prune.in"
+        with open(cls.prune_in, "w") as writer:
+            writer.writelines(f"snp{i}\n" for i in range(0, n_variants, 2))
+
+    @timing_decorator
+    def test_01_matches_exact_eigendecomposition(self):
+        import numpy as np
+        from myutil.mds import _standardised_block, randomised_principal_component_analysis
+
+        output_name = f"{self.input_prefix}_PCA"
+        result = randomised_principal_component_analysis(
+            self.input_prefix, self.prune_in, output_name, Gender.BOTH_GENDER, "all",
+            n_components=4, chunk_size=97,
+        )
+        self.assertEqual(result, f"{output_name}.eigenvec")
+
+        standardised = _standardised_block(self.dosage[::2]).T
+        relationship = standardised @ standardised.T / standardised.shape[1]
+        exact_values, exact_vectors = np.linalg.eigh(relationship)
+        exact_values, exact_vectors = exact_values[::-1], exact_vectors[:, ::-1]
+
+        eigenvalues = np.loadtxt(f"{output_name}.eigenval")
+        self.assertEqual(len(eigenvalues), 4)
+        with open(f"{output_name}.eigenvec") as reader:
+            rows = [line.split() for line in reader]
+        self.assertEqual(len(rows), self.dosage.shape[1])
+        self.assertEqual(rows[0][:2], ["fam0", "ind0"])
+        eigenvectors = np.array([row[2:] for row in rows], dtype=np.float64)
+        # the two components separating the populations are recovered up to sign
+        np.testing.assert_allclose(eigenvalues[:2], exact_values[:2], rtol=1e-3)
+        for component in range(2):
+            similarity = abs(eigenvectors[:, component] @ exact_vectors[:, component]) \
+                / np.linalg.norm(eigenvectors[:, component])
+            self.assertGreater(similarity, 0.999)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(os.path.join("test_data", "genotype"), ignore_errors=True)
+
+
+class Test11LinearRegression(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        import numpy as np
+
+        rng = np.random.default_rng(5)
+        n_samples = 300
+        dosage = rng.binomial(2, 0.35, size=(15, n_samples))
+        dosage[rng.random(dosage.shape) < 0.05] = -9
+        dosage[2, :] = 1                        # monomorphic -> NA
+        cls.dosage = dosage
+        cls.input_prefix = os.path.join("test_data", "genotype", "linear_input")
+        write_synthetic_fileset(cls.input_prefix, dosage)
+
+        cls.covariates = rng.normal(size=(n_samples, 2))
+        cls.covariates[3, 1] = np.nan
+        cls.sex = 1 + np.arange(n_samples) % 2
+        phenotype = rng.normal(size=n_samples) + 0.8 * cls.covariates[:, 0] \
+            + 0.5 * (cls.sex == 1) + 0.6 * np.clip(dosage[0], 0, None)
+        phenotype[rng.random(n_samples) < 0.1] = np.nan
+        cls.phenotype = phenotype
+
+        cls.pheno_path = f"{cls.input_prefix}.pheno"
+        with open(cls.pheno_path, "w") as writer:
+            writer.writelines(
+                f"fam{i} ind{i} {-9 if np.isnan(value) else value}\n"
+                for i, value in enumerate(phenotype)
+            )
+        cls.covar_path = f"{cls.input_prefix}.covar"
+        with open(cls.covar_path, "w") as writer:
+            writer.write("FID IID age bmi\n")
+            writer.writelines(
+                f"fam{i} ind{i} {row[0]} {'NA' if np.isnan(row[1]) else row[1]}\n"
+                for i, row in enumerate(cls.covariates)
+            )
+
+    @timing_decorator
+    def test_01_matches_full_model(self):
+        import numpy as np
+        from myutil.linear import linear_association
+        from myutil.stat_tools import t_two_sided_p
+
+        output_name = f"{self.input_prefix}_pheno"
+        linear_association(
+            self.input_prefix, [self.pheno_path], [output_name], [self.covar_path], chunk_size=4
+        )
+        with open(f"{output_name}.assoc.linear") as reader:
+            header, *rows = [line.split() for line in reader]
+        self.assertEqual(header, ["CHR", "SNP", "BP", "A1", "TEST", "NMISS", "BETA", "STAT", "P"])
+        self.assertEqual(len(rows), self.dosage.shape[0])
+        self.assertTrue(all(row[4] == "ADD" for row in rows))
+        self.assertEqual(rows[2][6:], ["NA", "NA", "NA"])
+
+        for variant, row in enumerate(rows):
+            if variant == 2:
+                continue
+            genotype = self.dosage[variant]
+            kept = ~np.isnan(self.phenotype) & ~np.isnan(self.covariates).any(axis=1) & (genotype >= 0)
+            design = np.column_stack([
+                np.ones(kept.sum()), genotype[kept], self.covariates[kept], self.sex[kept] == 1
+            ])
+            coefficients, *_ = np.linalg.lstsq(design, self.phenotype[kept], rcond=None)
+            residuals = self.phenotype[kept] - design @ coefficients
+            df = kept.sum() - design.shape[1]
+            se = np.sqrt(np.linalg.inv(design.T @ design)[1, 1] * (residuals @ residuals) / df)
+            self.assertEqual(int(row[5]), kept.sum())
+            np.testing.assert_allclose(
+                np.array(row[6:9], dtype=np.float64),
+                [coefficients[1], coefficients[1] / se, t_two_sided_p(coefficients[1] / se, df)],
+                rtol=1e-3,
+            )
+        self.assertLess(float(rows[0][8]), 1e-3)
+
+    @timing_decorator
+    def test_02_collinear_sex_and_merged_covariates(self):
+        import numpy as np
+        from Classes import VirtualSubset
+        from myutil.linear import linear_association, merge_covariate_files, read_covariate_file
+
+        # only males: sex is constant and has to be dropped from the model
+        keep_path = f"{self.input_prefix}_male.keep"
+        with open(keep_path, "w") as writer:
+            writer.writelines(f"fam{i}\tind{i}\n" for i in range(0, self.dosage.shape[1], 2))
+        males = VirtualSubset(self.input_prefix, f"{self.input_prefix}_male", keep_path=keep_path)
+        output_name = f"{self.input_prefix}_male_pheno"
+        linear_association(males, [self.pheno_path], [output_name], [self.covar_path])
+        with open(f"{output_name}.assoc.linear") as reader:
+            rows = [line.split() for line in reader][1:]
+        self.assertNotEqual(rows[0][6], "NA")
+
+        merged_path = merge_covariate_files(
+            [self.covar_path, self.covar_path.replace(".covar", ".pheno")], f"{self.input_prefix}_merged.covar"
+        )
+        merged = read_covariate_file(merged_path)
+        self.assertEqual(merged.columns[:4], ["FID", "IID", "age", "bmi"])
+        self.assertEqual(merged.height, self.dosage.shape[1])
+        self.assertTrue(np.isnan(merged["bmi"].fill_null(np.nan)[3]))
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(os.path.join("test_data", "genotype"), ignore_errors=True)
+
+
+class Test12LogisticRegression(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        import numpy as np
+
+        rng = np.random.default_rng(8)
+        n_samples = 800
+        dosage = rng.binomial(2, 0.3, size=(12, n_samples))
+        dosage[rng.random(dosage.shape) < 0.03] = -9
+        dosage[5, :] = 0                        # monomorphic -> NA
+        cls.dosage = dosage
+        cls.input_prefix = os.path.join("test_data", "genotype", "logistic_input")
+        write_synthetic_fileset(cls.input_prefix, dosage)
+
+        cls.covariates = rng.normal(size=(n_samples, 1))
+        cls.sex = 1 + np.arange(n_samples) % 2
+        eta = -0.4 + 0.8 * cls.covariates[:, 0] + 0.3 * (cls.sex == 1) + 0.7 * np.clip(dosage[0], 0, None)
+        status = 1 + (rng.random(n_samples) < 1 / (1 + np.exp(-eta)))
+        status[rng.random(n_samples) < 0.05] = -9
+        cls.status = status
+
+        cls.pheno_path = f"{cls.input_prefix}_disease.tsv"
+        with open(cls.pheno_path, "w") as writer:
+            writer.write("FID\tIID\tdisease\n")
+            writer.writelines(f"fam{i}\tind{i}\t{value}\n" for i, value in enumerate(status))
+        cls.covar_path = f"{cls.input_prefix}.covar"
+        with open(cls.covar_path, "w") as writer:
+            writer.writelines(f"fam{i} ind{i} {value}\n" for i, value in enumerate(cls.covariates[:, 0]))
+
+    def _reference_fit(self, variant: int):
+        """Per SNP Newton-Raphson fit of the full model: (NMISS, OR, Wald z)."""
+        import numpy as np
+
+        genotype = self.dosage[variant]
+        kept = (self.status > 0) & (genotype >= 0)
+        design = np.column_stack([
+            np.ones(kept.sum()), genotype[kept], self.covariates[kept], self.sex[kept] == 1
+        ])
+        outcome = self.status[kept] - 1
+        coefficients = np.zeros(design.shape[1])
+        for _ in range(50):
+            mu = 1 / (1 + np.exp(-design @ coefficients))
+            hessian = design.T @ (design * (mu * (1 - mu))[:, None])
+            coefficients += np.linalg.solve(hessian, design.T @ (outcome - mu))
+        se = np.sqrt(np.linalg.inv(hessian)[1, 1])
+        return kept.sum(), np.exp(coefficients[1]), coefficients[1] / se
+
+    @timing_decorator
+    def test_01_binary_phenotype_detected(self):
+        self.assertEqual(
+            association_analysis.classify_phenotype_type(self.pheno_path, has_header=True), "binary"
+        )
+
+    @timing_decorator
+    def test_02_refitted_snps_match_full_model(self):
+        import numpy as np
+        from myutil.logistic import logistic_association
+
+        # refit every SNP
+        output_name = f"{self.input_prefix}_all_refitted"
+        logistic_association(
+            self.input_prefix, [self.pheno_path], [output_name], [self.covar_path],
+            score_p_threshold=1.0, chunk_size=5,
+        )
+        with open(f"{output_name}.assoc.logistic") as reader:
+            header, *rows = [line.split() for line in reader]
+        self.assertEqual(header, ["CHR", "SNP", "BP", "A1", "TEST", "NMISS", "OR", "STAT", "P"])
+        self.assertEqual(rows[5][6:], ["NA", "NA", "NA"])
+        self.assertEqual({row[4] for row in rows}, {"ADD"})
+        for variant, row in enumerate(rows):
+            if variant == 5:
+                continue
+            nmiss, odds_ratio, z = self._reference_fit(variant)
+            self.assertEqual(int(row[5]), nmiss)
+            np.testing.assert_allclose([float(row[6]), float(row[7])], [odds_ratio, z], rtol=1e-3)
+
+    @timing_decorator
+    def test_03_score_test_screening(self):
+        import numpy as np
+        from myutil.logistic import logistic_association
+
+        output_name = f"{self.input_prefix}_screened"
+        logistic_association(
+            self.input_prefix, [self.pheno_path], [output_name], [self.covar_path],
+            score_p_threshold=1e-3,
+        )
+        with open(f"{output_name}.assoc.logistic") as reader:
+            rows = [line.split() for line in reader][1:]
+        # the associated SNP passes the screening and gets the exact fit
+        nmiss, odds_ratio, z = self._reference_fit(0)
+        np.testing.assert_allclose([float(rows[0][6]), float(rows[0][7])], [odds_ratio, z], rtol=1e-3)
+        self.assertEqual(rows[0][4], "ADD")
+        # the others keep their score test, close to the Wald test under the null
+        for variant in (1, 2, 3):
+            _, odds_ratio, z = self._reference_fit(variant)
+            self.assertEqual(rows[variant][4], "ADD_SCORE")
+            self.assertAlmostEqual(float(rows[variant][7]), z, delta=0.05)
+            self.assertAlmostEqual(float(rows[variant][6]), odds_ratio, delta=0.01)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(os.path.join("test_data", "genotype"), ignore_errors=True)
+
+
+class Test13PhenotypeSplitter(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        import numpy as np
+
+        rng = np.random.default_rng(13)
+        cls.n_samples = 50
+        cls.input_prefix = os.path.join("test_data", "genotype", "split_input")
+        write_synthetic_fileset(cls.input_prefix, rng.binomial(2, 0.3, size=(3, cls.n_samples)))
+
+        cls.table_path = os.path.join("test_data", "genotype", "split_phenotypes.csv")
+        with open(cls.table_path, "w") as writer:
+            writer.write("f.eid,f.21001.0.0,f.21001.1.0,f.50.0.0,f.20116.0.0,other\n")
+            # samples missing from the .fam are dropped by the join
+            for i in range(cls.n_samples + 5):
+                bmi = "NA" if i % 10 == 3 else f"{20 + i / 10}"
+                height = "" if i % 7 == 0 else f"{150 + i}"
+                smoking = "Never" if i % 2 else "1"     # mostly non-numeric -> not a phenotype
+                writer.write(f"ind{i},{bmi},{21 + i},{height},{smoking},x\n")
+
+    @timing_decorator
+    def test_01_split_once(self):
+        import polars as pl
+        from myutil.complements import extract_phenotype_info
+
+        generated = dict(extract_phenotype_info(self.input_prefix, self.table_path, store_dir=None))
+        # the later instance f.21001.1.0 and the non-numeric f.20116.0.0 are not split
+        self.assertEqual(sorted(generated), ["f.21001.0.0", "f.50.0.0"])
+
+        bmi = pl.read_csv(generated["f.21001.0.0"], separator="\t", infer_schema=False)
+        self.assertEqual(bmi.columns, ["FID", "IID", "f.21001.0.0"])
+        expected = [i for i in range(self.n_samples) if i % 10 != 3]
+        self.assertEqual(bmi["IID"].to_list(), [f"ind{i}" for i in expected])
+        self.assertEqual(bmi["FID"].to_list(), [f"fam{i}" for i in expected])
+        self.assertEqual(bmi["f.21001.0.0"].to_list(), [f"{20 + i / 10}" for i in expected])
+
+        height = pl.read_csv(generated["f.50.0.0"], separator="\t", infer_schema=False)
+        self.assertEqual(height.height, len([i for i in range(self.n_samples) if i % 7 != 0]))
+
+    @timing_decorator
+    def test_02_phenotype_store(self):
+        import polars as pl
+        from myutil.complements import extract_phenotype_info
+        from myutil.phenotype_store import scan_table
+
+        store_dir = os.path.join("test_data", "genotype", "phenotype_store")
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+        def entries():
+            return [name for name in os.listdir(store_dir) if name.endswith(".parquet")]
+
+        direct = scan_table(self.table_path, store_dir=None).collect()
+        stored = scan_table(self.table_path, store_dir=store_dir).collect()
+        self.assertTrue(stored.equals(direct))
+        self.assertEqual(set(stored.schema.values()), {pl.String})
+        self.assertEqual(len(entries()), 1)
+
+        # the same content is found again, also once the file was rewritten; another
+        # separator is another entry
+        scan_table(self.table_path, store_dir=store_dir)
+        self.assertEqual(len(entries()), 1)
+        os.utime(self.table_path, ns=(0, 0))
+        scan_table(self.table_path, store_dir=store_dir)
+        self.assertEqual(len(entries()), 1)
+        scan_table(self.table_path, separator=";", store_dir=store_dir)
+        self.assertEqual(len(entries()), 2)
+
+        expected = {
+            header: pl.read_csv(path, separator="\t", infer_schema=False)
+            for header, path in extract_phenotype_info(self.input_prefix, self.table_path, store_dir=None)
+        }
+        for header, path in extract_phenotype_info(self.input_prefix, self.table_path, store_dir=store_dir):
+            self.assertTrue(pl.read_csv(path, separator="\t", infer_schema=False).equals(expected[header]))
+
+        with self.assertRaises(FileNotFoundError):
+            scan_table(self.table_path + ".missing", store_dir=store_dir)
+
+    @timing_decorator
+    def test_03_phenotype_matrix(self):
+        import numpy as np
+        import polars as pl
+        from Classes import PhenotypeColumn, as_subset, pheno_args
+        from myutil import qassoc
+        from myutil.association_analysis import classify_phenotype_types
+        from myutil.complements import extract_phenotype_info
+
+        split = extract_phenotype_info(self.input_prefix, self.table_path, store_dir=None)
+        columns = extract_phenotype_info(self.input_prefix, self.table_path, store_dir=None, matrix=True)
+        matrix_path = f"{self.input_prefix}_phenotypes.tsv"
+        self.assertEqual(columns, [(name, PhenotypeColumn(matrix_path, name)) for name, _ in split])
+        self.assertEqual(
+            pheno_args(columns[0][1]), ["--pheno", matrix_path, "--pheno-name", "f.21001.0.0"]
+        )
+
+        matrix = pl.read_csv(matrix_path, separator="\t", infer_schema=False)
+        self.assertEqual(matrix.columns, ["FID", "IID", "f.21001.0.0", "f.50.0.0"])
+        self.assertEqual(matrix.height, self.n_samples)
+        self.assertEqual(matrix["f.21001.0.0"][3], "-9")
+        self.assertEqual(matrix["f.50.0.0"][0], "-9")
+        index = pl.read_csv(f"{self.input_prefix}_phenotypes.index.tsv", separator="\t")
+        self.assertEqual(index["phenotype"].to_list(), ["f.21001.0.0", "f.50.0.0"])
+        self.assertEqual(index["column"].to_list(), [3, 4])
+        self.assertEqual(index["mpheno"].to_list(), [1, 2])
+
+        # the same values are read from the matrix as from the split files
+        fam = as_subset(self.input_prefix).fam()
+        np.testing.assert_array_equal(
+            qassoc.read_phenotype_matrix(fam, [path for _, path in columns]),
+            qassoc.read_phenotype_matrix(fam, [path for _, path in split]),
+        )
+        self.assertEqual(classify_phenotype_types(columns), classify_phenotype_types(split))
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(os.path.join("test_data", "genotype"), ignore_errors=True)
+
+
+class Test14StageCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.directory = os.path.join("test_data", "genotype", "stage_cache")
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        os.makedirs(cls.directory)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @timing_decorator
+    def test_01_key_and_lookup(self):
+        import json
+        from myutil.stage_cache import StageCache
+
+        cache = StageCache(self._path("cache"), salt="PLINK v1.9")
+        with open(self._path("input.txt"), "w") as writer:
+            writer.write("a")
+        key = cache.key("stage", [self._path("input.txt")], 0.01, Gender.MALE)
+        self.assertEqual(key, cache.key("stage", [self._path("input.txt")], 0.01, Gender.MALE))
+        self.assertNotEqual(key, cache.key("stage", [self._path("input.txt")], 0.02, Gender.MALE))
+        self.assertNotEqual(
+            key, StageCache(self._path("cache"), salt="PLINK v2").key(
+                "stage", [self._path("input.txt")], 0.01, Gender.MALE
+            )
+        )
+        self.assertEqual(cache.lookup(key), (False, None))
+
+        with open(self._path("output.txt"), "w") as writer:
+            writer.write("result")
+        cache.store(key, (Gender.MALE, "output"), [self._path("output.txt")])
+        # the remembered digests are journalled and shared with later runs, which fold
+        # the journal into the digests file
+        journal_path = os.path.join(self._path("cache"), "file_digests.jsonl")
+        self.assertTrue(os.path.exists(journal_path))
+        self.assertEqual(StageCache(self._path("cache")).lookup(key), (True, (Gender.MALE, "output")))
+        self.assertFalse(os.path.exists(journal_path))
+        with open(os.path.join(self._path("cache"), "file_digests.json")) as reader:
+            self.assertIn(os.path.realpath(self._path("output.txt")), json.load(reader))
+
+        # changed input -> another key; changed output -> the entry is stale
+        with open(self._path("input.txt"), "w") as writer:
+            writer.write("ab")
+        self.assertNotEqual(key, cache.key("stage", [self._path("input.txt")], 0.01, Gender.MALE))
+        with open(self._path("output.txt"), "w") as writer:
+            writer.write("modified")
+        self.assertEqual(cache.lookup(key), (False, None))
+
+        disabled = StageCache(None)
+        disabled.store(disabled.key("stage", [self._path("input.txt")]), 1, [])
+        self.assertEqual(disabled.lookup(""), (False, None))
+
+    @timing_decorator
+    def test_02_run_only_pending_jobs(self):
+        from myutil.scheduler import Job, MemoryAwareScheduler
+        from myutil.stage_cache import StageCache
+
+        cache = StageCache(self._path("cache"))
+        scheduler = MemoryAwareScheduler(max_threads=2)
+        sources = [self._path(f"source{i}.txt") for i in range(3)]
+        for index, source in enumerate(sources):
+            with open(source, "w") as writer:
+                writer.write(str(index))
+
+        def jobs(names):
+            return [Job(shutil.copyfile, (source, self._path(f"copy_{source[-5]}.txt"))) for source in names]
+
+        keys = [cache.key("copy", [source]) for source in sources]
+        results = dict(cache.run(scheduler, jobs(sources), keys, lambda _, result: [result]))
+        self.assertEqual(results[2], self._path("copy_2.txt"))
+
+        # cached jobs are not run again: a missing source would raise
+        os.remove(sources[0])
+        with open(sources[2], "w") as writer:
+            writer.write("changed")
+        keys = [cache.key("copy", [source]) for source in sources[1:]]
+        cached, pending = cache.partition(keys)
+        self.assertEqual((list(cached), pending), ([0], [1]))
+        results = dict(cache.run(scheduler, jobs(sources[1:]), keys, lambda _, result: [result]))
+        self.assertEqual(results, {0: self._path("copy_1.txt"), 1: self._path("copy_2.txt")})
+        with open(self._path("copy_2.txt")) as reader:
+            self.assertEqual(reader.read(), "changed")
+
+    @timing_decorator
+    def test_03_phenotype_digests(self):
+        from Classes import PhenotypeColumn
+        from myutil.stage_cache import phenotype_digests
+
+        matrix_path = self._path("matrix.tsv")
+        with open(matrix_path, "w") as writer:
+            writer.write("FID\tIID\tP1\tP2\n" + "".join(f"F{i}\tI{i}\t{i}\t{i % 2}\n" for i in range(10)))
+        before = phenotype_digests([("P1", PhenotypeColumn(matrix_path, "P1"))])
+        # adding a phenotype to the matrix does not change the digest of the others
+        with open(matrix_path, "w") as writer:
+            writer.write(
+                "FID\tIID\tP1\tP2\tP3\n"
+                + "".join(f"F{i}\tI{i}\t{i}\t{i % 2}\t{i * 2}\n" for i in range(10))
+            )
+        after = phenotype_digests([
+            ("P1", PhenotypeColumn(matrix_path, "P1")), ("P3", PhenotypeColumn(matrix_path, "P3")),
+        ])
+        self.assertEqual(before["P1"], after["P1"])
+        self.assertNotEqual(after["P1"], after["P3"])
+
+    @timing_decorator
+    def test_04_cached_summary(self):
+        import numpy as np
+        from myutil import qassoc
+        from myutil.stage_cache import StageCache
+        from myutil.summarization import QassocResult, generate_quantitative_summary
+
+        rng = np.random.default_rng(14)
+        prefix = self._path("summary_input")
+        write_synthetic_fileset(prefix, rng.binomial(2, 0.3, size=(20, 60)))
+        outputs = []
+        for name in ("A", "B"):
+            with open(self._path(f"{name}.pheno"), "w") as writer:
+                writer.writelines(f"fam{i} ind{i} {rng.normal():.4f}\n" for i in range(60))
+            outputs.append(self._path(f"assoc_{name}"))
+        qassoc.quantitative_association(prefix, [self._path("A.pheno"), self._path("B.pheno")], outputs)
+        results = [
+            QassocResult(f"{output}.qassoc", f"{output}.qassoc.means", None,
+                         Gender.BOTH_GENDER, "all", name, bonferroni_n=20)
+            for name, output in zip(("A", "B"), outputs)
+        ]
+
+        generate_quantitative_summary(results, 0.05, self._path("plain"))
+        cache = StageCache(self._path("cache"))
+        modified = []
+        for _ in range(2):
+            generate_quantitative_summary(results, 0.05, self._path("cached"), cache=cache)
+            for suffix in ("-q.tsv", "-qt_means.tsv"):
+                with open(self._path(f"plain{suffix}")) as plain, open(self._path(f"cached{suffix}")) as cached:
+                    self.assertEqual(plain.read(), cached.read())
+            modified.append(os.stat(self._path("cached-q.tsv")).st_mtime_ns)
+        # the unchanged summary is not written again
+        self.assertEqual(modified[0], modified[1])
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(cls.directory, ignore_errors=True)
+
+
+class Test15RunManifest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.directory = os.path.join("test_data", "genotype", "run_manifest")
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        os.makedirs(cls.directory)
+        for name in ("a.bed", "b.bed"):
+            with open(os.path.join(cls.directory, name), "w") as writer:
+                writer.write(name)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @timing_decorator
+    def test_01_restore_stages(self):
+        from Classes import PhenotypeColumn, VirtualSubset
+        from myutil.run_manifest import RunManifest
+
+        path = self._path("restore.jsonl")
+        outputs = [(Gender.MALE, "Han", VirtualSubset("base", "base_male", keep_path="male.keep"))]
+        pheno_files = [("A", PhenotypeColumn("matrix.tsv", "A")), ("B", "B.txt")]
+        manifest = RunManifest(path, run_args={"file": "x", "alpha": 0.05})
+        self.assertIsNone(manifest.restore("groups"))
+        manifest.record("groups", {"outputs": outputs}, [self._path("a.bed")])
+        manifest.record("phenotypes", {"pheno_files": pheno_files}, [self._path("b.bed")])
+        # a line being written when the run was killed
+        with open(path, "a") as writer:
+            writer.write('{"stage": "association", "sta')
+
+        manifest = RunManifest(path, resume=True, run_args={"file": "x", "alpha": 0.05})
+        self.assertEqual(manifest.restore("groups"), {"outputs": outputs})
+        self.assertEqual(manifest.restore("phenotypes"), {"pheno_files": pheno_files})
+        self.assertIsNone(manifest.restore("association"))
+        # stages after the first one which has to run again are not restored
+        self.assertIsNone(manifest.restore("groups"))
+
+        # different arguments start a new run
+        manifest = RunManifest(path, resume=True, run_args={"file": "x", "alpha": 0.01})
+        self.assertIsNone(manifest.restore("groups"))
+
+    @timing_decorator
+    def test_02_missing_files(self):
+        from myutil.run_manifest import RunManifest
+
+        path = self._path("missing.jsonl")
+        manifest = RunManifest(path)
+        manifest.record("groups", {"outputs": []}, [self._path("a.bed")])
+        manifest.record("quality_control", {"outputs": []}, [self._path("removed.bed")])
+        manifest.record("snp_counts", {"snp_sums": {"male-Han": 3}}, [self._path("b.bed")])
+
+        manifest = RunManifest(path, resume=True)
+        self.assertEqual(manifest.restore("groups"), {"outputs": []})
+        self.assertIsNone(manifest.restore("quality_control"))
+        self.assertIsNone(manifest.restore("snp_counts"))
+        # the outdated records after the stage run again are dropped from the journal
+        manifest.record("quality_control", {"outputs": [1]}, [self._path("a.bed")])
+        manifest = RunManifest(path, resume=True)
+        self.assertEqual(manifest.restore("groups"), {"outputs": []})
+        self.assertEqual(manifest.restore("quality_control"), {"outputs": [1]})
+        self.assertIsNone(manifest.restore("snp_counts"))
+
+    @timing_decorator
+    def test_03_restore_items(self):
+        from myutil.run_manifest import RunManifest
+
+        path = self._path("items.jsonl")
+        manifest = RunManifest(path)
+        manifest.record("phenotypes", {"pheno_files": []})
+        output = (Gender.FEMALE, "Han", "A", "assoc_results/female_A")
+        manifest.record_item("association", "female-Han-A", output, [self._path("a.bed")])
+        manifest.record_item("association", "female-Han-B", output, [self._path("removed.bed")])
+
+        manifest = RunManifest(path, resume=True)
+        self.assertEqual(manifest.restore("phenotypes"), {"pheno_files": []})
+        self.assertIsNone(manifest.restore("association"))
+        self.assertEqual(manifest.restore_items("association"), {"female-Han-A": output})
+        self.assertEqual(manifest.restore_items("regression"), {})
+
+        # the finished items are kept when the run is interrupted again
+        manifest = RunManifest(path, resume=True)
+        self.assertEqual(manifest.restore("phenotypes"), {"pheno_files": []})
+        self.assertIsNone(manifest.restore("association"))
+        self.assertEqual(manifest.restore_items("association"), {"female-Han-A": output})
+
+    @timing_decorator
+    def test_04_group_journal(self):
+        from myutil.pipeline import _GroupJournal
+        from myutil.run_manifest import RunManifest
+
+        path = self._path("journal.jsonl")
+        manifest = RunManifest(path)
+        journal = _GroupJournal(manifest, "analysis", "male-Han", {})
+        for step in ("quality_control", "snp_counts"):
+            self.assertIsNone(journal.restore(step))
+        journal.record("quality_control", {"group": None}, [self._path("a.bed")])
+        journal.record("snp_counts", {"bonferroni_n": 3}, [self._path("removed.bed")])
+        journal.record_result("association", "A", ("male", "Han", "A", "out_A"), [self._path("b.bed")])
+        journal.record("association", {"outputs": []}, [self._path("b.bed")])
+        _GroupJournal(manifest, "analysis", "female-Han", {}).record(
+            "association", {"outputs": []}, [self._path("b.bed")]
+        )
+
+        # snp_counts runs again, so the later association of the group is outdated
+        manifest = RunManifest(path, resume=True)
+        restored = manifest.restore_items("analysis")
+        journal = _GroupJournal(manifest, "analysis", "male-Han", restored)
+        self.assertEqual(journal.restore("quality_control"), {"group": None})
+        self.assertIsNone(journal.restore("snp_counts"))
+        self.assertIsNone(journal.restore("association"))
+        self.assertEqual(
+            sorted(RunManifest(path, resume=True).restore_items("analysis")),
+            ["association/female-Han", "quality_control/male-Han"],
+        )
+
+        # the finished phenotypes of the step which runs again are kept
+        manifest = RunManifest(path)
+        journal = _GroupJournal(manifest, "analysis", "male-Han", {})
+        journal.restore("quality_control")
+        journal.record("quality_control", {"group": None}, [])
+        journal.record_result("association", "A", ("male", "Han", "A", "out_A"), [])
+        journal = _GroupJournal(manifest, "analysis", "male-Han", RunManifest(path, resume=True).restore_items("analysis"))
+        self.assertEqual(journal.restore("quality_control"), {"group": None})
+        self.assertIsNone(journal.restore("association"))
+        self.assertEqual(journal.results("association"), {"A": ("male", "Han", "A", "out_A")})
+        self.assertEqual(journal.results("regression"), {})
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(cls.directory, ignore_errors=True)
+
+
+def write_bgzf(path: str, data: bytes, block_size: int) -> list[tuple[int, int]]:
+    """Write `data` as BGZF blocks of `block_size` uncompressed bytes, followed by the EOF block.
+
+    Returns:
+        (compressed offset, uncompressed offset) of every data block.
+    """
+    import struct
+    import zlib
+
+    blocks = []
+    with open(path, "wb") as writer:
+        for start in [*range(0, len(data), block_size), len(data)]:
+            chunk = data[start:start + block_size]
+            if len(chunk) == 0 and start < len(data):
+                continue
+            if len(chunk) > 0:
+                blocks.append((writer.tell(), start))
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            compressed = compressor.compress(chunk) + compressor.flush()
+            writer.write(struct.pack(
+                "<4sIBBHBBHH", b"\x1f\x8b\x08\x04", 0, 0, 255, 6, ord("B"), ord("C"), 2,
+                18 + len(compressed) + 8 - 1,
+            ))
+            writer.write(compressed)
+            writer.write(struct.pack("<II", zlib.crc32(chunk), len(chunk)))
+    return blocks
+
+
+class Test16ChunkedVcfConversion(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        import numpy as np
+
+        cls.directory = os.path.join("test_data", "genotype", "vcf_chunks")
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        os.makedirs(cls.directory)
+        rng = np.random.default_rng(18)
+        cls.header = (
+            b"##fileformat=VCFv4.2\n"
+            + b"".join(b"##contig=<ID=%d>\n" % chromosome for chromosome in (1, 2))
+            + b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"
+            + b"\t".join(b"ind%d" % i for i in range(8)) + b"\n"
+        )
+        cls.records = [
+            b"%d\t%d\tsnp%d\tA\tG\t.\tPASS\t%s\tGT\t" % (1 + i // 100, 1000 + i, i, b"X" * int(rng.integers(1, 60)))
+            + b"\t".join(rng.choice([b"0/0", b"0/1", b"1/1", b"./."], size=8)) + b"\n"
+            for i in range(200)
+        ]
+        cls.path = os.path.join(cls.directory, "input.vcf.gz")
+        cls.blocks = write_bgzf(cls.path, cls.header + b"".join(cls.records), block_size=97)
+
+    def _reconstruct(self, chunks) -> bytes:
+        from myutil.vcf import _chunk_data
+
+        return b"".join(b"".join(_chunk_data(self.path, *chunk)) for chunk in chunks)
+
+    @timing_decorator
+    def test_01_split_at_blocks(self):
+        import gzip
+        from myutil.vcf import is_bgzf, read_vcf_header, split_vcf
+
+        self.assertTrue(is_bgzf(self.path))
+        with open(os.path.join(self.directory, "plain.vcf.gz"), "wb") as writer:
+            writer.write(gzip.compress(self.header))
+        self.assertFalse(is_bgzf(os.path.join(self.directory, "plain.vcf.gz")))
+
+        header, _ = read_vcf_header(self.path)
+        self.assertEqual(header, self.header)
+        for n_chunks in (1, 3, 7, 50, 1000):
+            chunks = split_vcf(self.path, n_chunks)
+            self.assertLessEqual(len(chunks), n_chunks)
+            # every record is in exactly one chunk, in order
+            self.assertEqual(self._reconstruct(chunks), b"".join(self.records))
+        self.assertGreater(len(split_vcf(self.path, 7)), 1)
+
+    @timing_decorator
+    def test_02_split_at_index(self):
+        import gzip
+        import struct
+        from myutil.vcf import split_vcf
+
+        def virtual_offset(position: int) -> int:
+            block_offset, block_start = [block for block in self.blocks if block[1] <= position][-1]
+            return (block_offset << 16) | (position - block_start)
+
+        starts = [len(self.header) + sum(map(len, self.records[:i])) for i in range(len(self.records))]
+        # a tabix index with one chromosome, one bin and a linear index of every 10th record
+        linear = [virtual_offset(start) for start in starts[::10]]
+        index = b"TBI\x01" + struct.pack("<7i", 1, 2, 1, 2, 0, ord("#"), 0)
+        index += struct.pack("<i", 2) + b"1\x00"
+        index += struct.pack("<iIi2Q", 1, 4681, 1, linear[0], linear[-1])
+        index += struct.pack(f"<i{len(linear)}Q", len(linear), *linear)
+        with open(f"{self.path}.tbi", "wb") as writer:
+            writer.write(gzip.compress(index))
+        try:
+            chunks = split_vcf(self.path, 7)
+        finally:
+            os.remove(f"{self.path}.tbi")
+        self.assertGreater(len(chunks), 1)
+        for start, _, aligned_start, aligned_end in chunks:
+            self.assertIn(start, linear)
+            self.assertTrue(aligned_start and aligned_end)
+        self.assertEqual(self._reconstruct(chunks), b"".join(self.records))
+
+    @timing_decorator
+    def test_03_concatenate_filesets(self):
+        import numpy as np
+        from myutil.vcf import concatenate_filesets
+
+        dosage = np.random.default_rng(3).integers(0, 3, size=(20, 10))
+        write_synthetic_fileset(os.path.join(self.directory, "full"), dosage)
+        write_synthetic_fileset(os.path.join(self.directory, "part0"), dosage[:7])
+        write_synthetic_fileset(os.path.join(self.directory, "part1"), dosage[7:])
+        concatenate_filesets(
+            [os.path.join(self.directory, "part0"), os.path.join(self.directory, "part1")],
+            os.path.join(self.directory, "merged"),
+        )
+        for ext in (".bed", ".fam"):
+            with open(os.path.join(self.directory, f"full{ext}"), "rb") as full, \
+                    open(os.path.join(self.directory, f"merged{ext}"), "rb") as merged:
+                self.assertEqual(full.read(), merged.read())
+        self.assertEqual(count_line(os.path.join(self.directory, "merged.bim")), 20)
+
+        write_synthetic_fileset(os.path.join(self.directory, "other"), dosage[:, :5])
+        with self.assertRaises(ValueError):
+            concatenate_filesets(
+                [os.path.join(self.directory, "part0"), os.path.join(self.directory, "other")],
+                os.path.join(self.directory, "merged"),
+            )
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(cls.directory, ignore_errors=True)
+
+
+class Test17PlinkTable(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.directory = os.path.join("test_data", "genotype", "plink_table")
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        os.makedirs(cls.directory)
+        # aligned like plink writes it
+        cls.qassoc = os.path.join(cls.directory, "test.qassoc")
+        with open(cls.qassoc, "w") as writer:
+            writer.write(
+                " CHR         SNP         BP    NMISS       BETA         SE         R2        T            P \n"
+                "   1        snp1       1000      200     0.1234    0.05678   0.004512    2.173      0.03097 \n"
+                "   1        snp2       1500      198         NA         NA         NA       NA           NA \n"
+                "  22   rs1234567   16050075      199    -0.0042     0.0911  1.08e-05 -0.04611       0.9633 \n"
+            )
+
+    def test_01_normalise_whitespace(self):
+        from myutil.plink_table import normalise_whitespace
+
+        self.assertEqual(normalise_whitespace(b""), b"")
+        self.assertEqual(normalise_whitespace(b"   "), b"")
+        self.assertEqual(normalise_whitespace(b" \t "), b"")
+        self.assertEqual(
+            normalise_whitespace(b"  A   B\tC \n \t1  2 3\t\r\n4 5 6  "),
+            b"A B C\n1 2 3\r\n4 5 6",
+        )
+
+    def test_02_read_plink_table(self):
+        import polars as pl
+        from myutil.plink_table import read_plink_table
+        from myutil.summarization import _parse_qassoc_file
+
+        table = read_plink_table(self.qassoc, dtypes={"BP": pl.Int64, "P": pl.Float64})
+        self.assertEqual(table.columns, ["CHR", "SNP", "BP", "NMISS", "BETA", "SE", "R2", "T", "P"])
+        self.assertEqual(table["SNP"].to_list(), ["snp1", "snp2", "rs1234567"])
+        self.assertEqual(table["BP"].to_list(), [1000, 1500, 16050075])
+        self.assertEqual(table["P"].to_list(), [0.03097, None, 0.9633])
+        self.assertEqual(table["R2"].to_list(), ["0.004512", None, "1.08e-05"])
+
+        qassoc = _parse_qassoc_file(self.qassoc)
+        self.assertEqual(qassoc["SNP"].to_list(), ["snp1", "rs1234567"])
+        self.assertEqual(qassoc["R2"].to_list(), [0.004512, 1.08e-05])
+        self.assertEqual(qassoc.schema["NMISS"], pl.UInt32)
+
+        with self.assertRaises(ValueError):
+            read_plink_table(self.qassoc, new_columns=["CHR", "SNP", "EMP1", "EMP2"])
+        with self.assertRaises(FileNotFoundError):
+            read_plink_table(os.path.join(self.directory, "missing.qassoc"))
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(cls.directory, ignore_errors=True)
+
+
+class Test18SummaryWriter(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        import numpy as np
+        from myutil import qassoc
+        from myutil.summarization import QassocResult
+
+        cls.directory = os.path.join("test_data", "genotype", "summary_writer")
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        os.makedirs(cls.directory)
+        rng = np.random.default_rng(20)
+        dosage = rng.binomial(2, 0.3, size=(30, 80))
+        prefix = os.path.join(cls.directory, "input")
+        write_synthetic_fileset(prefix, dosage)
+        names, outputs = ["A", "B", "C"], []
+        for name in names:
+            pheno = os.path.join(cls.directory, f"{name}.pheno")
+            # the first SNP is associated with every phenotype
+            values = dosage[0] + rng.normal(scale=0.5, size=80)
+            with open(pheno, "w") as writer:
+                writer.writelines(f"fam{i} ind{i} {value:.4f}\n" for i, value in enumerate(values))
+            outputs.append(os.path.join(cls.directory, f"assoc_{name}"))
+        qassoc.quantitative_association(
+            prefix, [os.path.join(cls.directory, f"{name}.pheno") for name in names], outputs
+        )
+        cls.results = [
+            QassocResult(f"{output}.qassoc", f"{output}.qassoc.means", None,
+                         Gender.BOTH_GENDER, "all", name, bonferroni_n=30)
+            for name, output in zip(names, outputs)
+        ]
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def test_01_incremental(self):
+        import polars as pl
+        from myutil.summarization import SummaryWriter, _concat_qassoc_mperm_mean
+
+        with open(self._path("out-q-significant.tsv"), "w") as writer:
+            writer.write("stale\n")
+        with SummaryWriter(0.05, self._path("out")) as summary:
+            self.assertFalse(os.path.exists(self._path("out-q-significant.tsv")))
+            for count, result in enumerate(self.results):
+                summary.add(result)
+                # every added result can be read at once
+                self.assertEqual(
+                    pl.read_csv(self._path("out-q.tsv"), separator="\t")["phenotype"].unique().len(),
+                    count + 1,
+                )
+
+        expected = pl.concat([_concat_qassoc_mperm_mean(result)[0] for result in self.results])
+        written = pl.read_csv(self._path("out-q.tsv"), separator="\t", schema=expected.schema)
+        self.assertTrue(written.equals(expected))
+        significant = pl.read_csv(self._path("out-q-significant.tsv"), separator="\t")
+        self.assertEqual(significant.height, expected.filter(pl.col("P'") < 0.05).height)
+        self.assertGreater(significant.height, 0)
+        means = pl.read_csv(self._path("out-qt_means-significant.tsv"), separator="\t")
+        self.assertEqual(means.height, 5 * significant.height)
+
+    def test_03_parquet(self):
+        import polars as pl
+        from myutil.summarization import generate_quantitative_summary
+
+        generate_quantitative_summary(self.results, 0.05, self._path("tsv"))
+        outputs = generate_quantitative_summary(
+            self.results, 0.05, self._path("parquet"), output_format="parquet"
+        )
+        self.assertEqual(outputs, [
+            self._path(f"parquet{suffix}.parquet")
+            for suffix in ("-q", "-q-significant", "-qt_means", "-qt_means-significant")
+        ])
+        self.assertTrue(os.path.isfile(self._path(
+            os.path.join("parquet-q.parquet", "gender=both%20gender", "ethnic=all", "phenotype=B", "1.parquet")
+        )))
+
+        for suffix in ("-q", "-q-significant"):
+            scanned = pl.scan_parquet(self._path(f"parquet{suffix}.parquet"), hive_partitioning=True)
+            tsv = pl.read_csv(
+                self._path(f"tsv{suffix}.tsv"), separator="\t", schema=scanned.collect_schema()
+            )
+            self.assertTrue(
+                scanned.select(tsv.columns).collect().sort("phenotype", "SNP")
+                .equals(tsv.sort("phenotype", "SNP"), null_equal=True)
+            )
+        one = pl.scan_parquet(self._path("parquet-q.parquet"), hive_partitioning=True) \
+            .filter(pl.col("phenotype") == "C", pl.col("P'") < 0.05).collect()
+        self.assertEqual(one["phenotype"].unique().to_list(), ["C"])
+        self.assertGreater(one.height, 0)
+
+    def test_02_no_results(self):
+        from myutil.summarization import generate_quantitative_summary
+
+        generate_quantitative_summary([], 0.05, self._path("empty"))
+        self.assertFalse(os.path.exists(self._path("empty-q.tsv")))
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if CLEAN_UP:
+            shutil.rmtree(cls.directory, ignore_errors=True)
+
+
 if __name__ == "__main__":
 
     # CLEAN_UP = True
@@ -1,18 +1,43 @@
-from io import StringIO
 import logging
 import os
-import re
 import subprocess
 from typing_extensions import deprecated
-from Classes import Gender
-from myutil import small_tools
+from Classes import (
+    Gender, PhenotypeColumn, VirtualSubset, as_subset, bfile_args, group_matrix_columns, pheno_args
+)
+from myutil.genotype import DEFAULT_CHUNK_BYTES
+from myutil.permutation import DEFAULT_PERMUTATION_SEED
+from myutil.plink_table import read_plink_table
+from myutil.scheduler import estimate_plink_memory, job_threads, plink_resource_args
+from myutil import linear, logistic, qassoc, small_tools
 from typing import Literal
 import pandas as pd
 import polars as pl
 
 
+_PHENOTYPE_NULL_VALUES = ["Na", "NaN", "NA", "NAN", "na", "nan", ""]
+
+
+def _classify_phenotype_column(phenotype: pl.Series) -> Literal["binary", "quantitative"]:
+    """Binary if every value is -9, 0, 1 or 2, quantitative otherwise."""
+    is_binary_sum = pl.select(
+        pl.when(
+            phenotype.cast(pl.Float32, strict=False).is_in([-9., 0., 1., 2.])
+        ).then(
+            0
+        ).otherwise(
+            1
+        ).alias("is_binary_df")
+    ).to_series().sum()
+
+    if is_binary_sum > 0:
+        return "quantitative"
+    else:
+        return "binary"
+
+
 def classify_phenotype_type(
-    phenotype_info_path: str,
+    phenotype_info_path: str | PhenotypeColumn,
     has_header=False
 ) -> Literal["binary", "quantitative"]:
     """
@@ -24,8 +49,9 @@ def classify_phenotype_type(
         Phenotype
 
     Args:
-        phenotype_info_path (str):
-            Path to the phenotype information file.
+        phenotype_info_path (str | PhenotypeColumn):
+            Path to the phenotype information file, or a column of a phenotype matrix
+            (which always has a header).
         has_header (bool):
             Whether the phenotype information file has a header.
 
@@ -33,6 +59,8 @@ def classify_phenotype_type(
         Literal["binary", "quantitative"]:
             The phenotype type.
     """
+    if isinstance(phenotype_info_path, PhenotypeColumn):
+        return classify_phenotype_types([phenotype_info_path])[phenotype_info_path.name]
 
     # Read the phenotype information file
     df = pl.read_csv(
@@ -40,7 +68,7 @@ def classify_phenotype_type(
         separator="\t",
         has_header=has_header,
         infer_schema=False,
-        null_values=["Na", "NaN", "NA", "NAN", "na", "nan", ""]
+        null_values=_PHENOTYPE_NULL_VALUES
     )
 
     if df.width != 3:
@@ -48,32 +76,48 @@ def classify_phenotype_type(
             f"Expected 3 columns in phenotype information file, got {df.width}: {df.columns}"
         )
 
-    df.columns = ["FID", "IID", "Phenotype"]
+    return _classify_phenotype_column(df.to_series(2))
 
-    df = df.cast({"Phenotype": pl.Float32}, strict=False)
 
-    is_binary_sr = df.select(
-        pl.when(
-            pl.col("Phenotype").is_in([-9., 0., 1., 2.])
-        ).then(
-            0
-        ).otherwise(
-            1
-        ).alias("is_binary_df")
-    ).to_series()
+def classify_phenotype_types(
+    phenotype_files: list[tuple[str, str | PhenotypeColumn]],
+    has_header=True
+) -> dict[str, Literal["binary", "quantitative"]]:
+    """
+    Classify many phenotypes, reading every phenotype matrix once.
 
-    is_binary_sum = is_binary_sr.sum()
+    Args:
+        phenotype_files (list[tuple[str, str | PhenotypeColumn]]):
+            (phenotype name, phenotype file path or matrix column) of every phenotype.
+        has_header (bool):
+            Whether the (three-column) phenotype information files have a header.
 
-    if is_binary_sum > 0:
-        return "quantitative"
-    else:
-        return "binary"
+    Returns:
+        dict[str, Literal["binary", "quantitative"]]:
+            The type of every phenotype, by phenotype name.
+    """
+    pheno_types: dict[str, Literal["binary", "quantitative"]] = {}
+    files, matrix_columns = group_matrix_columns([path for _, path in phenotype_files])
+    for index, path in files:
+        pheno_types[phenotype_files[index][0]] = classify_phenotype_type(path, has_header=has_header)
+    for matrix_path, columns in matrix_columns.items():
+        df = pl.read_csv(
+            matrix_path,
+            separator="\t",
+            has_header=True,
+            infer_schema=False,
+            null_values=_PHENOTYPE_NULL_VALUES,
+            columns=list(dict.fromkeys(name for _, name in columns)),
+        )
+        for index, name in columns:
+            pheno_types[phenotype_files[index][0]] = _classify_phenotype_column(df[name])
+    return pheno_types
 
 
 def binary_association(
     plink_path: str,
-    input_name: str,
-    phenotype_info_path: str,
+    input_name: str | VirtualSubset,
+    phenotype_info_path: str | PhenotypeColumn,
     output_prefix: str,
     mperm: int | None = None,
 ) -> bool:
@@ -106,8 +150,9 @@ def binary_association(
     logging.info("Performing binary association analysis...")
     command = [
         plink_path,
-        "--bfile", input_name,
-        "--pheno", phenotype_info_path,
+        *bfile_args(input_name),
+        *plink_resource_args(),
+        *pheno_args(phenotype_info_path),
         "--assoc",
     ] + (
         [] if mperm is None
@@ -127,9 +172,9 @@ def binary_association(
 
 def quantitative_association(
     plink_path: str,
-    input_name: str,
+    input_name: str | VirtualSubset,
     phenotype_name: str,
-    phenotype_info_path: str,
+    phenotype_info_path: str | PhenotypeColumn,
     output_name: str,
     gender: Gender,
     ethnic: str,
@@ -163,22 +208,23 @@ def quantitative_association(
         command = (
             [
                 plink_path,
-                "--bfile",
-                input_name,
-                "--pheno",
-                phenotype_info_path,
+                *bfile_args(input_name),
+                *plink_resource_args(),
+                *pheno_args(phenotype_info_path),
                 "--assoc",
                 "qt-means",
             ]
             + ([f"mperm={mperm}"] if mperm is not None else [])
-            + ["--out", output_name]
+            + ["--out", str(output_name)]
         )
 
         match mperm:
             case int():
-                assert len(command) == 10
+                assert len(command) == 6 + len(bfile_args(input_name)) + len(plink_resource_args()) \
+                    + len(pheno_args(phenotype_info_path))
             case None:
-                assert len(command) == 9
+                assert len(command) == 5 + len(bfile_args(input_name)) + len(plink_resource_args()) \
+                    + len(pheno_args(phenotype_info_path))
 
         subprocess.run(
             command,
@@ -196,14 +242,238 @@ def quantitative_association(
     logging.info("Quantitative association analysis completed.")
     return gender, ethnic, phenotype_name, output_name
 
+def batch_quantitative_association(
+    plink_path: str,
+    input_name: str | VirtualSubset,
+    phenotype_files: list[tuple[str, str | PhenotypeColumn]],
+    output_names: list[str],
+    gender: Gender,
+    ethnic: str,
+    mperm: int | None = None,
+    engine: Literal["plink", "native"] = "plink",
+    seed: int = DEFAULT_PERMUTATION_SEED,
+    perm_mode: Literal["maxt", "adaptive"] = "maxt",
+    alpha: float = 0.05,
+    n_workers: int | None = None,
+) -> list[tuple[Gender, str, str, str]]:
+    """
+    Quantitative association of one population fileset with many phenotypes, reading the
+    genotypes once instead of once per phenotype.
+
+    With the `plink` engine all phenotypes are merged into a single `--pheno` file and
+    tested with `--all-pheno`; with the `native` engine they are tested in-process by
+    `myutil.qassoc`. Either way the result of every phenotype is named
+    `output_name.qassoc` (`.qassoc.means`, `.qassoc.mperm` or `.qassoc.perm`), as
+    `quantitative_association` names it. The merged phenotype file of the `plink` engine
+    is written next to the first output file.
+
+    Args:
+        plink_path (str):
+            Path to the plink executable file.
+        input_name (str | VirtualSubset):
+            Name of the input file.
+        phenotype_files (list[tuple[str, str | PhenotypeColumn]]):
+            (phenotype name, path to the phenotype information file or column of the
+            phenotype matrix) of every phenotype.
+        output_names (list[str]):
+            Name of the output file of every phenotype.
+        mperm (int | None):
+            Number of permutations (maximum number per SNP in adaptive mode).
+        engine ("plink" | "native"):
+            How the association is calculated.
+        seed (int):
+            Random seed of the permutations, so that reruns give the same EMP1/EMP2.
+        perm_mode ("maxt" | "adaptive"):
+            `maxt` runs max(T) permutations (`.qassoc.mperm` with EMP1 and EMP2);
+            `adaptive` stops permuting a SNP once its empirical p-value is clearly above
+            or below `alpha` (`.qassoc.perm` with EMP1 and NP).
+        alpha (float):
+            Significance threshold of adaptive permutation.
+        n_workers (int | None):
+            Threads of the `native` permutations, as given to `estimate_association_memory`;
+            at most the threads granted to the job. Defaults to the threads granted to
+            the job.
+
+    Returns:
+        list (list[tuple[Gender, str, str, str]]):
+            (gender, ethnic, phenotype name, path name of the output file) of every
+            phenotype calculated successfully.
+    """
+    if len(phenotype_files) != len(output_names):
+        raise ValueError("One output name is required for every phenotype file.")
+    if len(phenotype_files) == 0:
+        return []
+    granted = job_threads()
+    if granted is not None:
+        n_workers = granted if n_workers is None else min(n_workers, granted)
+
+    if engine == "native":
+        try:
+            qassoc.quantitative_association(
+                input_name, [path for _, path in phenotype_files], output_names,
+                mperm=mperm, perm_mode=perm_mode, alpha=alpha, seed=seed,
+                n_workers=n_workers,
+            )
+        except Exception as e:
+            logging.error(f"Error occurred while calculating association of {input_name}: {e}")
+            return []
+        return [
+            (gender, ethnic, phenotype_name, output_name)
+            for (phenotype_name, _), output_name in zip(phenotype_files, output_names)
+        ]
+
+    # merge phenotypes into a single headerless file, so that plink names the outputs
+    # `.P1`, `.P2`, ...
+    batch_prefix = os.path.join(
+        os.path.dirname(output_names[0]), f"{os.path.basename(input_name)}_all-pheno"
+    )
+    pheno_dfs: list[pl.DataFrame] = []
+    files, matrix_columns = group_matrix_columns([path for _, path in phenotype_files])
+    for index, path in files:
+        pheno_dfs.append(qassoc.read_phenotype_file(path).rename({"phenotype": f"P{index + 1}"}))
+    # columns of a phenotype matrix are read together
+    for matrix_path, columns in matrix_columns.items():
+        pheno_dfs.append(
+            qassoc.read_phenotype_columns(matrix_path, [name for _, name in columns]).select(
+                "FID", "IID", *(pl.col(name).alias(f"P{index + 1}") for index, name in columns)
+            )
+        )
+    merged: pl.DataFrame | None = None
+    for pheno_df in pheno_dfs:
+        pheno_df = pheno_df.unique(subset=["FID", "IID"], keep="first")
+        merged = pheno_df if merged is None else merged.join(
+            pheno_df, on=["FID", "IID"], how="full", coalesce=True
+        )
+    assert merged is not None
+    # plink numbers the phenotypes by column position
+    merged.select(
+        "FID", "IID", *(f"P{index + 1}" for index in range(len(phenotype_files)))
+    ).fill_null(-9).write_csv(
+        f"{batch_prefix}.pheno", separator="\t", include_header=False
+    )
+
+    command = [
+        plink_path,
+        *bfile_args(input_name),
+        *plink_resource_args(),
+        "--pheno", f"{batch_prefix}.pheno",
+        "--all-pheno",
+        "--assoc", "qt-means",
+    ]
+    match mperm, perm_mode:
+        case None, _:
+            pass
+        case int(), "adaptive":
+            # --aperm <min> <max> <alpha> <beta>
+            command += ["perm", "--aperm", "5", str(mperm), str(alpha), "1e-4", "--seed", str(seed)]
+        case int(), _:
+            command += [f"mperm={mperm}", "--seed", str(seed)]
+    command += ["--out", batch_prefix]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=None)
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Error occurred while running plink: {e}")
+        return []
+
+    results: list[tuple[Gender, str, str, str]] = []
+    for index, ((phenotype_name, _), output_name) in enumerate(zip(phenotype_files, output_names)):
+        if not os.path.exists(f"{batch_prefix}.P{index + 1}.qassoc"):
+            logging.warning(f"plink produced no result for {phenotype_name} of {input_name}.")
+            continue
+        for extension in [".qassoc", ".qassoc.means", ".qassoc.mperm", ".qassoc.perm"]:
+            if os.path.exists(f"{batch_prefix}.P{index + 1}{extension}"):
+                os.replace(f"{batch_prefix}.P{index + 1}{extension}", f"{output_name}{extension}")
+        results.append((gender, ethnic, phenotype_name, output_name))
+    return results
+
+
+def estimate_association_memory(
+    input_name: str | VirtualSubset,
+    n_phenotypes: int,
+    engine: Literal["plink", "native"] = "plink",
+    mperm: int | None = None,
+    perm_mode: Literal["maxt", "adaptive"] = "maxt",
+    n_workers: int | None = None,
+) -> int:
+    """
+    Rough upper bound of the memory taken by `batch_quantitative_association`, in bytes.
+
+    Args:
+        input_name (str | VirtualSubset):
+            Name of the input file.
+        n_phenotypes (int):
+            Number of phenotypes tested at once.
+        engine ("plink" | "native"):
+            How the association is calculated.
+        mperm (int | None):
+            Number of permutations.
+        perm_mode ("maxt" | "adaptive"):
+            Permutation mode.
+        n_workers (int | None):
+            Threads of the permutations, each holding its own blocks. Defaults to the
+            threads granted to the current job (the whole run in the main process).
+
+    Returns:
+        int: Estimated peak memory.
+    """
+    bfile = as_subset(input_name).bfile
+    n_samples = small_tools.count_line(f"{bfile}.fam")
+    phenotype_bytes = 4 * 8 * n_samples * max(n_phenotypes, 1)
+    if engine == "native":
+        # one decoded block plus its float64 copies, see `qassoc.quantitative_association`,
+        # and the maximum statistic of every permutation
+        permutation_bytes = 0 if mperm is None else \
+            2 * DEFAULT_CHUNK_BYTES * (n_workers or job_threads() or os.cpu_count() or 1)
+        if mperm is not None and perm_mode == "maxt":
+            permutation_bytes += 8 * mperm * max(n_phenotypes, 1)
+        return phenotype_bytes + 2 * DEFAULT_CHUNK_BYTES + permutation_bytes
+    return phenotype_bytes + estimate_plink_memory(bfile)
+
+
+def association_batch_size(
+    input_name: str | VirtualSubset,
+    memory: int,
+    engine: Literal["plink", "native"] = "plink",
+    mperm: int | None = None,
+    perm_mode: Literal["maxt", "adaptive"] = "maxt",
+    n_workers: int | None = None,
+) -> int:
+    """
+    Largest number of phenotypes `batch_quantitative_association` can test at once
+    within `memory`, according to `estimate_association_memory`; at least 1.
+
+    The max(T) permutation statistics alone take 8 bytes per permutation and phenotype,
+    e.g. 4 GB for 1e6 permutations of 500 phenotypes, so a large batch has to be split.
+
+    Args:
+        input_name (str | VirtualSubset): Name of the input file.
+        memory (int): Memory available to one job, in bytes.
+        engine ("plink" | "native"): How the association is calculated.
+        mperm (int | None): Number of permutations.
+        perm_mode ("maxt" | "adaptive"): Permutation mode.
+        n_workers (int | None): Threads of the permutations.
+
+    Returns:
+        int: Number of phenotypes per job.
+    """
+    one = estimate_association_memory(input_name, 1, engine, mperm, perm_mode, n_workers)
+    per_phenotype = estimate_association_memory(
+        input_name, 2, engine, mperm, perm_mode, n_workers
+    ) - one
+    if per_phenotype <= 0 or one > memory:
+        return 1
+    return 1 + (memory - one) // per_phenotype
+
+
 def logistic_regression(
     plink_path: str,
-    input_prefix: str,
-    phenotype_info_file: str,
+    input_prefix: str | VirtualSubset,
+    phenotype_info_file: str | PhenotypeColumn,
     output_prefix: str,
     *,
     covariates: str | None = None,
     mperm: int | None = None,
+    include_sex: bool = True,
 ) -> bool:
     """
     Perform a logistic regression analysis on the given input plink file and phenotype file.
@@ -222,6 +492,9 @@ Args:
         Covariates files to include in the analysis. Defaults to None.
     mperm (int | None, optional):
         Number of permutations to perform. Defaults to None.
+    include_sex (bool, optional):
+        Add sex as a covariate; it is constant within a single gender group. Defaults
+        to True.
 
 Returns:
     bool:
@@ -230,12 +503,13 @@ Returns:
 
     command = [
         plink_path,
-        "--bfile", input_prefix,
-        # force sex to be included as an covariant; include intercept in the report
-        "--logistic", "intercept", "sex", "hide-covar"
+        *bfile_args(input_prefix),
+        *plink_resource_args(),
+        # include intercept in the report
+        "--logistic", "intercept", *(["sex"] if include_sex else []), "hide-covar"
     ] + (["--mperm", str(mperm)] if mperm else []) + \
     (["--covar", covariates, "keep-pheno-on-missing-cov"] if covariates else []) + \
-    ["--pheno", phenotype_info_file] + \
+    pheno_args(phenotype_info_file) + \
     ["--out", output_prefix]
 
     try:
@@ -319,29 +593,15 @@ def result_filter(
     if os.path.exists(f"{input_path}.qassoc"):
 
         logging.info("Get {input_path}.qassoc, which is a .qassoc file")
-        # purge duplicated whitespace
-        with open(f"{input_path}.qassoc") as reader:
-            content = reader.read().strip()
-            content = re.sub(r" {2,}", " ", content)
-            content = re.sub(r" +\n +", "\n", content)
-
-        with StringIO() as memory_file:
-            memory_file.write(content)
-            memory_file.seek(0)
-
-    # Warning! Preprocess input file rrequired!
-            qassoc_df = pl.read_csv(
-                memory_file,
-                separator=" ",
-                has_header=True,
-                null_values=["NA", "Na", "na", "", "NaN", "nan", "NAN", "Nan"]
-            ).with_columns(
-                pl.col.P.cast(pl.Float64, strict=False)
-            ).drop_nulls()
-
-            if len(qassoc_df) == 0:
-                logging.warning("No valid data found in .qassoc file")
-                return None
+        qassoc_df = read_plink_table(
+            f"{input_path}.qassoc", infer_schema=True
+        ).with_columns(
+            pl.col.P.cast(pl.Float64, strict=False)
+        ).drop_nulls()
+
+        if len(qassoc_df) == 0:
+            logging.warning("No valid data found in .qassoc file")
+            return None
 
         # qassoc_df.columns = [x.strip() for x in qassoc_df.columns]
 
@@ -365,21 +625,7 @@ def result_filter(
 
         logging.info("Get {input_path}.assoc, which is a .assoc file")
 
-        with open(f"{input_path}.assoc") as reader:
-            content = reader.read().strip()
-            content = re.sub(r"[ \t]{2,}", " ", content)
-            content = re.sub(r"[ \t]+\n[ \t]+", "\n", content)
-
-        with StringIO() as memory_file:
-            memory_file.write(content)
-            memory_file.seek(0)
-
-            assoc_df = pl.read_csv(
-                memory_file,
-                separator=" ",
-                has_header=True,
-                null_values="NA"
-            )
+        assoc_df = read_plink_table(f"{input_path}.assoc", null_values=["NA"], infer_schema=True)
 
         # qassoc_df.columns = [x.strip() for x in qassoc_df.columns]
 
@@ -432,22 +678,26 @@ def result_filter_old(
 
 def linear_regression(
     plink_path: str,
-    input_name: str,
+    input_name: str | VirtualSubset,
     phenotype_name: str,
-    phenotype_info_path: str,
+    phenotype_info_path: str | PhenotypeColumn,
     output_name: str,
     gender: Gender = Gender.UNKNOWN,
     ethnic: str | None = None,
+    covariate_paths: list[str] | None = None,
+    engine: Literal["plink", "native"] = "native",
 ) -> str | None:
     """
-    Perform a linear regression analysis using PLINK for a quantitive phenotype.
+    Perform a linear regression analysis for a quantitive phenotype, adjusting for sex and
+    the given covariates.
 
-    It will generate a `.assoc.linear` file, which contains the results of the linear regression analysis.
+    It will generate a `.assoc.linear` file, which contains the ADD rows of the linear
+    regression analysis.
 
     Args:
         plink_path (str):
             The path to the PLINK executable.
-        input_name (str):
+        input_name (str | VirtualSubset):
             The name of the input file.
         phenotype_name (str):
             The name of the phenotype.
@@ -459,6 +709,11 @@ def linear_regression(
             The gender of the individuals. Defaults to None.
         ethnic (str | None, optional):
             The ethnicity of the individuals. Defaults to None.
+        covariate_paths (list[str] | None):
+            plink `--covar` files, e.g. `.eigenvec` files of `mds`.
+        engine ("plink" | "native"):
+            `plink` runs `plink --linear hide-covar sex`; `native` computes the same
+            statistics in-process with `myutil.linear`.
     Returns:
         str | None:
             The name of the output file (extension excluded).
@@ -466,23 +721,186 @@ def linear_regression(
         %(output_name)s.assoc.linear
     """
     logging.info(
-        "Performing a linear regression analysis using PLINK for a quantitive phenotype `%s`\
+        "Performing a linear regression analysis for a quantitive phenotype `%s`\
 within %s %s population...", phenotype_name, gender.value, ethnic
     )
+    covariate_paths = covariate_paths or []
+    # sex is constant within a single gender group
+    include_sex = gender not in (Gender.MALE, Gender.FEMALE)
+
+    if engine == "native":
+        try:
+            linear.linear_association(
+                input_name, [phenotype_info_path], [output_name], covariate_paths,
+                include_sex=include_sex,
+            )
+        except Exception as e:
+            logging.error(f"Error occurred while calculating linear regression of {output_name}: {e}")
+            return None
+        return output_name
+
+    command = [
+        plink_path,
+        *bfile_args(input_name),
+        *plink_resource_args(),
+        *pheno_args(phenotype_info_path),
+        "--linear", "hide-covar", *(["sex"] if include_sex else []),
+    ]
+    if len(covariate_paths) > 0:
+        # plink takes a single covariate file
+        covariate_path = f"{output_name}.covar"
+        linear.merge_covariate_files(covariate_paths, covariate_path)
+        command += ["--covar", covariate_path]
+    command += ["--out", output_name]
     try:
-        command = [
-            plink_path,
-            "--bfile"
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error occurred while running plink: {e}")
+        return None
+    return output_name
+
+def batch_linear_regression(
+    plink_path: str,
+    input_name: str | VirtualSubset,
+    phenotype_files: list[tuple[str, str | PhenotypeColumn]],
+    output_names: list[str],
+    gender: Gender,
+    ethnic: str,
+    covariate_paths: list[str] | None = None,
+    engine: Literal["plink", "native"] = "native",
+) -> list[tuple[Gender, str, str, str]]:
+    """
+    Linear regression of many phenotypes on one population fileset. With the `native`
+    engine the genotypes are scanned once for all phenotypes; with `plink` one
+    `linear_regression` is run per phenotype.
+
+    Args:
+        plink_path (str):
+            Path to the plink executable.
+        input_name (str | VirtualSubset):
+            Name of the input file.
+        phenotype_files (list[tuple[str, str | PhenotypeColumn]]):
+            (phenotype name, phenotype file path or matrix column) of every phenotype.
+        output_names (list[str]):
+            Name of the output file of every phenotype, in the same order.
+        gender (Gender):
+            Gender of the population.
+        ethnic (str):
+            Ethnic group of the population.
+        covariate_paths (list[str] | None):
+            plink `--covar` files.
+        engine ("plink" | "native"):
+            How the regression is calculated.
+
+    Returns:
+        list (list[tuple[Gender, str, str, str]]):
+            (gender, ethnic, phenotype name, path name of the output file) of every
+            phenotype calculated successfully.
+    """
+    if len(phenotype_files) != len(output_names):
+        raise ValueError("One output name is required for every phenotype file.")
+
+    if engine == "native":
+        try:
+            linear.linear_association(
+                input_name, [path for _, path in phenotype_files], output_names,
+                covariate_paths, include_sex=gender not in (Gender.MALE, Gender.FEMALE),
+            )
+        except Exception as e:
+            logging.error(f"Error occurred while calculating linear regression of {input_name}: {e}")
+            return []
+        return [
+            (gender, ethnic, phenotype_name, output_name)
+            for (phenotype_name, _), output_name in zip(phenotype_files, output_names)
         ]
-    except:
-        pass
-    pass
+
+    results = []
+    for (phenotype_name, phenotype_path), output_name in zip(phenotype_files, output_names):
+        if linear_regression(
+            plink_path, input_name, phenotype_name, phenotype_path, output_name,
+            gender, ethnic, covariate_paths, engine,
+        ) is not None:
+            results.append((gender, ethnic, phenotype_name, output_name))
+    return results
+
+
+def batch_logistic_regression(
+    plink_path: str,
+    input_name: str | VirtualSubset,
+    phenotype_files: list[tuple[str, str | PhenotypeColumn]],
+    output_names: list[str],
+    gender: Gender,
+    ethnic: str,
+    covariate_paths: list[str] | None = None,
+    engine: Literal["plink", "native"] = "native",
+) -> list[tuple[Gender, str, str, str]]:
+    """
+    Logistic regression of many case/control phenotypes on one population fileset. With
+    the `native` engine the genotypes are scanned once for all phenotypes and only SNPs
+    passing a score test are fully refitted (`myutil.logistic`); with `plink` one
+    `logistic_regression` is run per phenotype.
+
+    Args:
+        plink_path (str):
+            Path to the plink executable.
+        input_name (str | VirtualSubset):
+            Name of the input file.
+        phenotype_files (list[tuple[str, str | PhenotypeColumn]]):
+            (phenotype name, phenotype file path or matrix column) of every binary phenotype.
+        output_names (list[str]):
+            Name of the output file of every phenotype, in the same order.
+        gender (Gender):
+            Gender of the population.
+        ethnic (str):
+            Ethnic group of the population.
+        covariate_paths (list[str] | None):
+            plink `--covar` files.
+        engine ("plink" | "native"):
+            How the regression is calculated.
+
+    Returns:
+        list (list[tuple[Gender, str, str, str]]):
+            (gender, ethnic, phenotype name, path name of the output file) of every
+            phenotype calculated successfully.
+    """
+    if len(phenotype_files) != len(output_names):
+        raise ValueError("One output name is required for every phenotype file.")
+    # sex is constant within a single gender group
+    include_sex = gender not in (Gender.MALE, Gender.FEMALE)
+
+    if engine == "native":
+        try:
+            logistic.logistic_association(
+                input_name, [path for _, path in phenotype_files], output_names,
+                covariate_paths, include_sex=include_sex,
+            )
+        except Exception as e:
+            logging.error(f"Error occurred while calculating logistic regression of {input_name}: {e}")
+            return []
+        return [
+            (gender, ethnic, phenotype_name, output_name)
+            for (phenotype_name, _), output_name in zip(phenotype_files, output_names)
+        ]
+
+    results = []
+    for (phenotype_name, phenotype_path), output_name in zip(phenotype_files, output_names):
+        covariate_path = None
+        if covariate_paths:
+            # plink takes a single covariate file
+            covariate_path = linear.merge_covariate_files(covariate_paths, f"{output_name}.covar")
+        if logistic_regression(
+            plink_path, input_name, phenotype_path, output_name, covariates=covariate_path,
+            include_sex=include_sex,
+        ):
+            results.append((gender, ethnic, phenotype_name, output_name))
+    return results
+
 
 def multidimensional_scaling(
     plink_path: str,
     input_name: str,
     phenotype_name: str | None,
-    phenotype_info_path: str,
+    phenotype_info_path: str | PhenotypeColumn,
     output_path: str,
     dimension_count: int = 10
 ):
@@ -502,14 +920,17 @@ def multidimensional_scaling(
             Path to the output file. (path including the extension)
         dimension_count (int):
             Number of dimensions to use for the multidimensional scaling analysis. Defaults to 10.
+    Returns:
+        str: Path to the `--covar` file of the MDS components (FID, IID, C1, C2, ...).
     Generate File:
         %(output_path)
     """
     logging.info("Perform a multidimensional scaling analysis using PLINK for a quantitive or binary phenotype")
     command = [
         plink_path,
-        "--bfile", input_name,
-        "--pheno", phenotype_info_path,
+        *bfile_args(input_name),
+        *plink_resource_args(),
+        *pheno_args(phenotype_info_path),
         "--cluster",
         "--mds-plot", str(dimension_count),
         "--out", f"{input_name}_{phenotype_name}",
@@ -526,14 +947,13 @@ def multidimensional_scaling(
         input_name
     )
     logging.debug("Transferring file to `--covar`` format")
-    mds_result_lf = pl.scan_csv(
-        f"{input_name}_{phenotype_name}.mds",
-        separator="\t",
-        infer_schema=False,
-        null_values="NA"
+    # `.mds` is space aligned: FID IID SOL C1 C2 ...
+    mds_result_df = pd.read_csv(
+        f"{input_name}_{phenotype_name}.mds", sep=r"\s+", dtype=str
     )
-
-    pass
+    covariate_path = f"{input_name}_{phenotype_name}.mds.covar"
+    mds_result_df.drop(columns="SOL").to_csv(covariate_path, sep="\t", index=False)
+    return covariate_path
 
 # def linear_regression(
 #     plink_path: str,
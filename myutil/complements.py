@@ -2,12 +2,15 @@ import subprocess
 import os, sys, logging
 from typing import Literal, Sequence
 
-from Classes import FileManagement, Gender
+from Classes import FileManagement, Gender, PhenotypeColumn, VirtualSubset, as_subset, bfile_args
+from myutil.phenotype_store import DEFAULT_STORE_DIR, scan_table
+from myutil.scheduler import plink_resource_args
 from myutil.small_tools import ProgressBar, create_logger
 from deprecated.sphinx import deprecated
 
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 # from concurrent.futures import ProcessPoolExecutor, as_completed
 # from multiprocessing import Manager
 # from concurrent.futures._base import Future as FutureClass
@@ -179,13 +182,19 @@ def _work_thread(
 
 def extract_phenotype_info(
     input_name: str,
-    pheno_info_path: str
-) -> list[tuple[str, str]]:
+    pheno_info_path: str,
+    store_dir: str | None = DEFAULT_STORE_DIR,
+    matrix: bool = False,
+) -> list[tuple[str, str | PhenotypeColumn]]:
     """
     Extract phenotype information from a file,
     generate csvs, containing [FID, IID, phenotype_value].
     Return a dict of [phenotype_name, generated_csv_path]
 
+    With `matrix`, a single phenotype matrix [FID, IID, phenotype_1, phenotype_2, ...]
+    is written instead, with -9 for missing values, together with an index of its
+    columns; every phenotype is then returned as a `PhenotypeColumn` of the matrix.
+
     Assert phenotype name with format `f.[number].[number].[number]`,
     Only the smallest version of first number is used.
 
@@ -194,14 +203,22 @@ def extract_phenotype_info(
             name of plink file (without extension).
         pheno_info_path (str):
             path to phenotype information file.
+        store_dir (str | None):
+            directory of the Parquet phenotype store, None to read the file directly.
+        matrix (bool):
+            write one phenotype matrix instead of one file per phenotype.
     Returns:
-        List (list[tuple[str,str]]):
-            list of [phenotype name, generated split phenotype info file path]
+        List (list[tuple[str, str | PhenotypeColumn]]):
+            list of [phenotype name, generated split phenotype info file path or
+            column of the phenotype matrix]
     Note:
         Generate Files:
-            %(input_name)s_%(f.*.*).txt"""
+            %(input_name)s_%(f.*.*).tsv
+            or, with `matrix`:
+            %(input_name)s_phenotypes.tsv
+            %(input_name)s_phenotypes.index.tsv (phenotype, column, mpheno)"""
 
-    generated_files: list[tuple[str,str]] = []
+    generated_files: list[tuple[str, str | PhenotypeColumn]] = []
 
     progress_bar = ProgressBar()
 
@@ -212,28 +229,8 @@ def extract_phenotype_info(
     if not os.path.exists(pheno_info_path):
         logger.error("Phenotype info file does not exist. Given: %s", pheno_info_path)
         sys.exit(1)
-    if pheno_info_path.endswith('.csv'):
-        headers = pl.read_csv(
-            pheno_info_path,
-            n_rows=0,
-            separator=",",
-            has_header=True,
-            infer_schema=False,
-            ignore_errors=True,
-            truncate_ragged_lines=True
-        ).columns
-    elif pheno_info_path.endswith('.tsv'):
-        headers = pl.read_csv(
-            pheno_info_path,
-            n_rows=0,
-            separator="\t",
-            has_header=True,
-            infer_schema=False,
-            ignore_errors=True,
-            truncate_ragged_lines=True
-        ).columns
-    else:
-        headers = pl.read_csv(pheno_info_path, n_rows=0, has_header=True, infer_schema=False).columns
+    pheno_lf = scan_table(pheno_info_path, store_dir=store_dir)
+    headers = pheno_lf.collect_schema().names()
     logger.debug("headers: %s", headers)
     accepted_headers: list[str] = []
     count = 0
@@ -285,77 +282,72 @@ def extract_phenotype_info(
         sys.exit(4)
     logger.info("Accepted phenotype names: %r", accepted_headers)
 
-    fam_df = pl.read_csv(
-        f"{input_name}.fam",
-        columns=[0,1],
-        separator=" ",
-        infer_schema=False,
-        new_columns=["FID", "IID"]
+    fam_df = as_subset(input_name).fam().select("FID", "IID")
+
+    # Scan the table once, keeping only the IID and accepted phenotype columns
+    pheno_df = pheno_lf.select(iid_header, *accepted_headers).filter(
+        pl.col(iid_header).is_not_null()
+    ).collect()
+
+    # Ratio of non-numeric values among the available ("NA" and empty excluded) values
+    # of every phenotype, over the whole table
+    available = {header: pl.col(header).is_not_null() & (pl.col(header) != "NA") for header in accepted_headers}
+    ratio_df = pheno_df.select(
+        (
+            1 - (available[header] & pl.col(header).cast(pl.Float32, strict=False).is_not_null()).sum()
+            / available[header].sum()
+        ).alias(header)
+        for header in accepted_headers
     )
 
-    # Split into multiple files, each of wich contains
-    pattern = r"^-*\d+\.?\d*$"
-    count = 0
-    for header in accepted_headers:
-        progress_bar.print_progress(
-            f"Processing {header}",
-            len(accepted_headers),
-            count := count + 1
-        )
-        if pheno_info_path.endswith(".tsv"):
-            pheno_df = pl.read_csv(
-                pheno_info_path,
-                separator="\t",
-                columns=[iid_header, header],
-                infer_schema=False,
-                ignore_errors=True
-            )
-        elif pheno_info_path.endswith(".csv"):
-            pheno_df = pl.read_csv(
-                pheno_info_path,
-                separator=",",
-                columns=[iid_header, header],
-                infer_schema=False,
-                ignore_errors=True
-            )
-        else:
-            pheno_df = pl.read_csv(
-                pheno_info_path,
-                columns=[iid_header, header],
-                infer_schema=False
-            )
-
-        # remove "NA" cells
-        pheno_df = pheno_df.filter(
-            pl.col(header) != "NA"
-        )
-        pheno_df = pheno_df.drop_nulls()
+    pheno_df = fam_df.join(pheno_df, how="inner", left_on="IID", right_on=iid_header)
 
-        pheno_df = pheno_df.with_columns(
-            pl.col(header).cast(pl.Float32, strict=False).alias(f"{header}_casted")
-        )
-
-        null_ratio = 1 - pheno_df.drop_nulls().height / pheno_df.height
-        # High null_ratio indicates that this column might not describe phenotype.
-        if null_ratio > 0.1:
-            logger.warning(f"{header} is not a phenotype column: null ratio = %s", null_ratio)
-            continue
-
-        pheno_df = pheno_df.drop_nulls().drop(f"{header}_casted")
-
-        pheno_to_save = fam_df.join(
-            pheno_df,
-            how="inner",
-            left_on="IID", right_on=iid_header
-        ).select("FID", "IID", header)
-
-        pheno_to_save.write_csv(
+    def write_phenotype(header: str) -> str:
+        pheno_df.filter(
+            available[header] & pl.col(header).cast(pl.Float32, strict=False).is_not_null()
+        ).select("FID", "IID", header).write_csv(
             f"{input_name}_{header}.tsv",
             separator="\t",
             include_header=True,
         )
+        return f"{input_name}_{header}.tsv"
 
-        generated_files.append((header, f"{input_name}_{header}.tsv"))
+    # Split into multiple files, each of wich contains [FID, IID, phenotype]
+    kept_headers: list[str] = []
+    for header in accepted_headers:
+        null_ratio = ratio_df[header][0]
+        # High null_ratio indicates that this column might not describe phenotype.
+        if null_ratio is None or null_ratio > 0.1:
+            logger.warning(f"{header} is not a phenotype column: null ratio = %s", null_ratio)
+            continue
+        kept_headers.append(header)
+
+    if matrix:
+        matrix_path = f"{input_name}_phenotypes.tsv"
+        pheno_df.select(
+            "FID", "IID",
+            *(
+                pl.when(available[header] & pl.col(header).cast(pl.Float32, strict=False).is_not_null())
+                  .then(pl.col(header))
+                  .otherwise(pl.lit("-9"))
+                  .alias(header)
+                for header in kept_headers
+            ),
+        ).write_csv(matrix_path, separator="\t", include_header=True)
+        # column: 1-based column in the matrix; mpheno: plink `--mpheno` number
+        pl.DataFrame({
+            "phenotype": kept_headers,
+            "column": [index + 3 for index in range(len(kept_headers))],
+            "mpheno": [index + 1 for index in range(len(kept_headers))],
+        }).write_csv(f"{input_name}_phenotypes.index.tsv", separator="\t", include_header=True)
+        return [(header, PhenotypeColumn(matrix_path, header)) for header in kept_headers]
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        for count, (header, path) in enumerate(
+            zip(kept_headers, pool.map(write_phenotype, kept_headers))
+        ):
+            progress_bar.print_progress(f"Writing {header}", len(kept_headers), count + 1)
+            generated_files.append((header, path))
 
     return generated_files
 
@@ -436,26 +428,33 @@ def extract_phenotype_info(
 
 def gender_complement(
     plink_path: str,
-    input_name: str,
+    input_name: str | VirtualSubset,
     gender_info_path: str,
-    gender_reference_path: str
-) -> list[tuple[Gender, str]]:
+    gender_reference_path: str,
+    materialise: bool = False,
+    store_dir: str | None = DEFAULT_STORE_DIR,
+) -> list[tuple[Gender, str | VirtualSubset]]:
     """
     complement plink-format file with gender information.
 
     Args:
         plink (str):
             path to plink executable
-        input_path (str):
-            input plink-format file name (path without extension)
+        input_path (str | VirtualSubset):
+            input plink-format file name (path without extension), or a virtual subset
         gender_info_path (str):
             path to the file which contains gender info of all population
         gender_reference_path (str):
             Path to gender reference file, which offers reference of gender codings to their meanings.
             The file should be in .csv/.tsv/.xlsx/.xls format.
+        materialise (bool):
+            write the complemented plink fileset. Otherwise the gender information is
+            applied through plink `--update-sex` on a `VirtualSubset`.
+        store_dir (str | None):
+            directory of the Parquet phenotype store, None to read the files directly.
     Returns:
-        list (Sequence[tuple[Gender, str]]):
-            list of tuples, where each tuple is (Gender, file_path)
+        list (Sequence[tuple[Gender, str | VirtualSubset]]):
+            list of tuples, where each tuple is (Gender, file_path or VirtualSubset)
     Raises:
         ValueError:
             if gender_info_path is not a valid path
@@ -468,24 +467,16 @@ def gender_complement(
 
     logger.info("Reading gender reference file...")
     match os.path.splitext(gender_reference_path)[-1]:
-        case ".csv":
-            gender_ref_df = pl.read_csv(gender_reference_path, separator=",", infer_schema=False)
-        case ".tsv":
-            gender_ref_df = pl.read_csv(gender_reference_path, separator="\t", infer_schema=False)
-        case ".xlsx":
-            gender_ref_df = pl.read_excel(gender_reference_path, infer_schema_length=0)
+        case ".csv" | ".tsv" | ".xlsx":
+            gender_ref_df = scan_table(gender_reference_path, store_dir=store_dir)
         case _:
             logger.error("Unsupported file format: %s", os.path.splitext(gender_reference_path))
             sys.exit(3)
 
     logger.info("Reading gender info file...")
     match os.path.splitext(gender_info_path)[-1]:
-        case ".csv":
-            gender_info_df = pl.read_csv(gender_info_path, separator=",", infer_schema=False)
-        case ".tsv":
-            gender_info_df = pl.read_csv(gender_info_path, separator="\t", infer_schema=False)
-        case ".xlsx":
-            gender_info_df = pl.read_excel(gender_info_path, infer_schema_length=0)
+        case ".csv" | ".tsv" | ".xlsx":
+            gender_info_df = scan_table(gender_info_path, store_dir=store_dir)
         case _:
             logger.error("Unsupported file format: %s", os.path.splitext(gender_info_path))
             sys.exit(3)
@@ -494,7 +485,7 @@ def gender_complement(
 
     # rename "coding" column in `gender_info_df` to "original_gender_coding"
     pattern = r".*sex.*|.*gender.*"
-    for col_name in gender_info_df.columns:
+    for col_name in gender_info_df.collect_schema().names():
         if re.match(pattern, col_name, re.IGNORECASE):
             gender_info_df = gender_info_df.rename(
                 {col_name: "original_gender_coding"}
@@ -505,7 +496,7 @@ def gender_complement(
         sys.exit(1)
     # rename "id" column in gender_info_df to "iid"
     pattern = r".*id.*"
-    for col_name in gender_info_df.columns:
+    for col_name in gender_info_df.collect_schema().names():
         if re.match(pattern, col_name, re.IGNORECASE):
             gender_info_df = gender_info_df.rename(
                 {col_name: "iid"}
@@ -517,7 +508,7 @@ def gender_complement(
 
     # rename "coding" column in `gender_ref_df` to "gender_coding"
     pattern = r"^.*sex.*$|^.*gender.*$|^coding$|^code$"
-    for col_name in gender_ref_df.columns:
+    for col_name in gender_ref_df.collect_schema().names():
         if re.match(pattern, col_name, re.IGNORECASE):
             gender_ref_df = gender_ref_df.rename(
                 {col_name: "gender_coding"}
@@ -527,12 +518,12 @@ def gender_complement(
         logger.error(
             "No column named 'sex' or 'gender' in %s. Colnames: %s",
             gender_reference_path,
-            ", ".join(gender_ref_df.columns)
+            ", ".join(gender_ref_df.collect_schema().names())
         )
         sys.exit(1)
     # rename "original_coding" in `gender_ref_df` to "original_gender_coding"
     pattern = r".*original.*"
-    for col_name in gender_ref_df.columns:
+    for col_name in gender_ref_df.collect_schema().names():
         if re.match(pattern, col_name, re.IGNORECASE):
             gender_ref_df = gender_ref_df.rename(
                 {col_name: "original_gender_coding"}
@@ -545,27 +536,17 @@ def gender_complement(
     # merge gender_serial_reference and gender_info
     # print(gender_info_df)
     # print(gender_ref_df)
-    merged_gender_info = gender_info_df.join(
-        gender_ref_df,
+    merged_gender_info = gender_info_df.select("iid", "original_gender_coding").join(
+        gender_ref_df.select("original_gender_coding", "gender_coding"),
         left_on="original_gender_coding",
         right_on="original_gender_coding",
         how="inner"
     ).drop(
         "original_gender_coding"
-    )
+    ).collect()
 
     # merge merged_gender_info and .fam and replace the original one
-    ## determine the separator of .fam
-    with open(f"{input_name}.fam", 'r') as f:
-        first_line = f.readline()
-        if first_line.count("\t") > first_line.count(" "):
-            separator = "\t"
-            logger.info("Detected tab as separator in .fam")
-        else:
-            separator = " "
-            logger.info("Detected space as separator in .fam")
-
-    fam_df = pl.read_csv(f"{input_name}.fam", separator=separator, infer_schema=False)
+    fam_df = as_subset(input_name).fam()
     fam_df.columns = ["FID", "IID", "PID", "MID", "gender", "pheno"]
     merged_fam = fam_df.join(
         merged_gender_info,
@@ -582,10 +563,24 @@ def gender_complement(
     logger.info("Successfully complemented gender information")
 
     # complement gender information by plink `--update-sex`
-    output_file_names: list[tuple[Gender, str]] = []
+    output_file_names: list[tuple[Gender, str | VirtualSubset]] = []
+    if not materialise:
+        output_file_names.append((
+            Gender.BOTH_GENDER,
+            VirtualSubset(
+                bfile=as_subset(input_name).bfile,
+                name=f"{input_name}_both-gender",
+                keep_path=as_subset(input_name).keep_path,
+                extract_path=as_subset(input_name).extract_path,
+                update_sex_path=f"{input_name}_gender.tsv",
+            ),
+        ))
+        return output_file_names
+
     plink_cmd = [
         plink_path,
-        "--bfile", input_name,
+        *bfile_args(input_name),
+        *plink_resource_args(),
         "--update-sex", f"{input_name}_gender.tsv",
         "--make-bed",
         "--out", f"{input_name}_both-gender"
@@ -0,0 +1,285 @@
+import logging
+import os
+from typing import Iterator
+
+import numpy as np
+import polars as pl
+
+from myutil.small_tools import create_logger
+
+logger = create_logger("GenotypeLogger", level=logging.WARN)
+
+BED_MAGIC = b"\x6c\x1b\x01"
+"""Leading bytes of a SNP-major plink 1 `.bed` file."""
+
+MISSING_GENOTYPE = -9
+"""Dosage value used for missing genotype calls."""
+
+BIM_COLUMNS = ["CHR", "SNP", "CM", "BP", "A1", "A2"]
+FAM_COLUMNS = ["FID", "IID", "PID", "MID", "Sex", "Phenotype"]
+
+# 2-bit plink codes -> count of A1 alleles.
+#   00: homozygous A1, 01: missing, 10: heterozygous, 11: homozygous A2
+_CODE_TO_DOSAGE = np.array([2, MISSING_GENOTYPE, 1, 0], dtype=np.int8)
+# Every possible packed byte -> its four decoded genotypes, in sample order.
+_BYTE_TO_DOSAGE = _CODE_TO_DOSAGE[
+    (np.arange(256, dtype=np.uint8)[:, None] >> (2 * np.arange(4, dtype=np.uint8))) & 3
+]
+
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def _detect_separator(file_path: str) -> str:
+    """Guess whether a plink text file is tab or space delimited from its first line."""
+    with open(file_path, "r") as reader:
+        first_line = reader.readline()
+    return "\t" if first_line.count("\t") > first_line.count(" ") else " "
+
+
+def read_bim(input_name: str) -> pl.DataFrame:
+    """
+    Read the `.bim` file of a plink binary fileset.
+
+    Args:
+        input_name (str): Path of the plink fileset (without extension).
+
+    Returns:
+        pl.DataFrame: Columns CHR, SNP, CM, BP, A1, A2, one row per variant in file order.
+    """
+    bim_path = f"{input_name}.bim"
+    if not os.path.exists(bim_path):
+        raise FileNotFoundError(f"File '{bim_path}' not found.")
+    return pl.read_csv(
+        bim_path,
+        separator=_detect_separator(bim_path),
+        has_header=False,
+        new_columns=BIM_COLUMNS,
+        schema_overrides={"CHR": pl.String, "SNP": pl.String, "BP": pl.Int64,
+                          "A1": pl.String, "A2": pl.String},
+    )
+
+
+def read_fam(input_name: str) -> pl.DataFrame:
+    """
+    Read the `.fam` file of a plink binary fileset.
+
+    Args:
+        input_name (str): Path of the plink fileset (without extension).
+
+    Returns:
+        pl.DataFrame: Columns FID, IID, PID, MID, Sex, Phenotype (all strings), one row
+            per sample in file order.
+    """
+    fam_path = f"{input_name}.fam"
+    if not os.path.exists(fam_path):
+        raise FileNotFoundError(f"File '{fam_path}' not found.")
+    return pl.read_csv(
+        fam_path,
+        separator=_detect_separator(fam_path),
+        has_header=False,
+        new_columns=FAM_COLUMNS,
+        infer_schema=False,
+    )
+
+
+class BedReader(object):
+    """
+    Memory-mapped reader of a SNP-major plink binary fileset.
+
+    The `.bed` file is never loaded as a whole; genotypes are decoded lazily into
+    `np.int8` dosage matrices (count of A1 alleles, `MISSING_GENOTYPE` for missing
+    calls) of shape `(n_variants, n_samples)`, one block of variants at a time.
+
+    Example:
+        >>> reader = BedReader(fm.source_standardisation())
+        >>> for variant_index, dosage in reader.iter_chunks():
+        ...     allele_counts = np.where(dosage >= 0, dosage, 0).sum(axis=1)
+    """
+
+    def __init__(self, input_name: str) -> None:
+        """
+        Args:
+            input_name (str): Path of the plink fileset (without extension).
+        """
+        self.input_name = input_name
+        self.bim = read_bim(input_name)
+        self.fam = read_fam(input_name)
+        self.n_variants: int = self.bim.height
+        self.n_samples: int = self.fam.height
+        self.bytes_per_variant: int = (self.n_samples + 3) // 4
+
+        bed_path = f"{input_name}.bed"
+        if not os.path.exists(bed_path):
+            raise FileNotFoundError(f"File '{bed_path}' not found.")
+        with open(bed_path, "rb") as reader:
+            magic = reader.read(len(BED_MAGIC))
+        if magic != BED_MAGIC:
+            raise ValueError(
+                f"{bed_path} is not a SNP-major plink 1 .bed file (leading bytes {magic!r})."
+            )
+        expected_size = len(BED_MAGIC) + self.n_variants * self.bytes_per_variant
+        if os.path.getsize(bed_path) != expected_size:
+            raise ValueError(
+                f"{bed_path} has {os.path.getsize(bed_path)} bytes; expected {expected_size} "
+                f"for {self.n_variants} variants and {self.n_samples} samples."
+            )
+
+        logger.debug(
+            "Memory-mapping %s: %d variants, %d samples.",
+            bed_path, self.n_variants, self.n_samples
+        )
+        self._bed: np.ndarray
+        if self.n_variants == 0 or self.n_samples == 0:
+            self._bed = np.zeros((self.n_variants, self.bytes_per_variant), dtype=np.uint8)
+        else:
+            self._bed = np.memmap(
+                bed_path,
+                dtype=np.uint8,
+                mode="r",
+                offset=len(BED_MAGIC),
+                shape=(self.n_variants, self.bytes_per_variant),
+            )
+
+    def read_variants(
+        self,
+        variant_index: slice | np.ndarray,
+        sample_index: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """
+        Decode a block of variants.
+
+        Args:
+            variant_index (slice | np.ndarray): Variants to decode, as a slice or an
+                integer index array into the `.bim` order.
+            sample_index (np.ndarray | None): Integer index array of samples to keep, in
+                `.fam` order. All samples are decoded if None.
+
+        Returns:
+            np.ndarray: `np.int8` dosage matrix of shape `(n_selected_variants, n_selected_samples)`.
+        """
+        packed = self._bed[variant_index]
+        if sample_index is None:
+            decoded = _BYTE_TO_DOSAGE[packed].reshape(packed.shape[0], -1)
+            return decoded[:, :self.n_samples]
+        # only touch the bytes holding the requested samples
+        sample_index = np.asarray(sample_index, dtype=np.int64)
+        codes = (packed[:, sample_index >> 2] >> ((sample_index & 3) * 2).astype(np.uint8)) & 3
+        return _CODE_TO_DOSAGE[codes]
+
+    def default_chunk_size(self, n_selected_samples: int | None = None) -> int:
+        """Number of variants per block so that one decoded block takes about 64 MiB."""
+        width = max(self.n_samples if n_selected_samples is None else n_selected_samples, 1)
+        return max(1, DEFAULT_CHUNK_BYTES // (4 * width))
+
+    def iter_chunks(
+        self,
+        chunk_size: int | None = None,
+        *,
+        variant_index: np.ndarray | None = None,
+        sample_index: np.ndarray | None = None,
+    ) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """
+        Iterate over decoded blocks of consecutive variants.
+
+        Args:
+            chunk_size (int | None): Number of variants per block. Defaults to
+                `default_chunk_size()`.
+            variant_index (np.ndarray | None): Integer index array of variants to visit, in
+                `.bim` order. All variants are visited if None.
+            sample_index (np.ndarray | None): Integer index array of samples to keep.
+
+        Yields:
+            tuple[np.ndarray, np.ndarray]: (indices of the variants in this block,
+                `np.int8` dosage matrix of the block).
+        """
+        if chunk_size is None:
+            chunk_size = self.default_chunk_size(
+                None if sample_index is None else len(sample_index)
+            )
+        if variant_index is None:
+            for start in range(0, self.n_variants, chunk_size):
+                stop = min(start + chunk_size, self.n_variants)
+                yield (
+                    np.arange(start, stop),
+                    self.read_variants(slice(start, stop), sample_index),
+                )
+        else:
+            variant_index = np.asarray(variant_index, dtype=np.int64)
+            for start in range(0, len(variant_index), chunk_size):
+                block_index = variant_index[start:start + chunk_size]
+                yield block_index, self.read_variants(block_index, sample_index)
+
+    def write_subset(
+        self,
+        save_path_name: str,
+        *,
+        variant_index: np.ndarray | None = None,
+        sample_index: np.ndarray | None = None,
+        chunk_size: int | None = None,
+        fam: pl.DataFrame | None = None,
+    ) -> str:
+        """
+        Write a subset of this fileset as a new plink binary fileset, one block at a time.
+
+        Args:
+            save_path_name (str): Path of the output fileset (without extension).
+            variant_index (np.ndarray | None): Integer index array of variants to keep.
+                All variants are kept if None.
+            sample_index (np.ndarray | None): Integer index array of samples to keep.
+                All samples are kept if None.
+            chunk_size (int | None): Number of variants per block.
+            fam (pl.DataFrame | None): Sample table to write instead of the selected rows
+                of `self.fam`, e.g. with updated sex codes. Must match `sample_index`.
+
+        Returns:
+            str: `save_path_name`.
+
+        Generate Files:
+            %(save_path_name)s.bed, %(save_path_name)s.bim, %(save_path_name)s.fam
+        """
+        if variant_index is None:
+            variant_index = np.arange(self.n_variants)
+        variant_index = np.asarray(variant_index, dtype=np.int64)
+        if chunk_size is None:
+            chunk_size = self.default_chunk_size(
+                None if sample_index is None else len(sample_index)
+            )
+
+        with open(f"{save_path_name}.bed", "wb") as writer:
+            writer.write(BED_MAGIC)
+            for start in range(0, len(variant_index), chunk_size):
+                block_index = variant_index[start:start + chunk_size]
+                if sample_index is None:
+                    # packed bytes can be copied as they are
+                    writer.write(np.ascontiguousarray(self._bed[block_index]).tobytes())
+                else:
+                    writer.write(pack_dosage(self.read_variants(block_index, sample_index)).tobytes())
+
+        self.bim[variant_index].write_csv(
+            f"{save_path_name}.bim", separator="\t", include_header=False
+        )
+        if fam is None:
+            fam = self.fam if sample_index is None else self.fam[np.asarray(sample_index, dtype=np.int64)]
+        fam.write_csv(f"{save_path_name}.fam", separator=" ", include_header=False)
+        return save_path_name
+
+
+def pack_dosage(dosage: np.ndarray) -> np.ndarray:
+    """
+    Encode a dosage matrix into packed 2-bit plink codes. This is the inverse of
+    `BedReader.read_variants()`.
+
+    Args:
+        dosage (np.ndarray): Dosage matrix of shape `(n_variants, n_samples)`.
+
+    Returns:
+        np.ndarray: `np.uint8` array of shape `(n_variants, ceil(n_samples / 4))`.
+    """
+    n_variants, n_samples = dosage.shape
+    codes = np.zeros((n_variants, (n_samples + 3) // 4 * 4), dtype=np.uint8)
+    view = codes[:, :n_samples]
+    view[dosage == MISSING_GENOTYPE] = 1
+    view[dosage == 1] = 2
+    view[dosage == 0] = 3
+    codes = codes.reshape(n_variants, -1, 4)
+    return codes[:, :, 0] | (codes[:, :, 1] << 2) | (codes[:, :, 2] << 4) | (codes[:, :, 3] << 6)
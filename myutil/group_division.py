@@ -6,49 +6,58 @@ import matplotlib.pyplot as plt
 from threading import Thread
 import logging, os, sys
 from multiprocessing import Process
-from Classes import FileManagement, Gender
+from Classes import FileManagement, Gender, VirtualSubset, as_subset, bfile_args
 from typing import Optional
 
+from myutil.phenotype_store import DEFAULT_STORE_DIR, scan_table
+from myutil.scheduler import plink_resource_args
 from myutil.small_tools import create_logger
 
 logger = create_logger("GroupDivisionLogger", level=logging.WARN)
 
 def divide_pop_by_ethnic(
         plink_path: str,
-        input_name: str,
+        input_name: str | VirtualSubset,
         ethnic_info_path: str,
         reference_path: str = "./myutil/ethnic_serial_reference.tsv",
         original_gender: Gender = Gender.BOTH_GENDER,
-        loose_filter: bool = True
-    ) -> list[tuple[Gender, str, str]]:
+        loose_filter: bool = True,
+        materialise: bool = False,
+        store_dir: str | None = DEFAULT_STORE_DIR,
+    ) -> list[tuple[Gender, str, str | VirtualSubset]]:
     """
     Divide population by ethnicity.
 
     Parameters
-    input_name: str
-        The name of input plink files (without extension).
+    input_name: str | VirtualSubset
+        The name of input plink files (without extension), or a virtual subset.
     ethnic_info_path: str
         The path of ethnic information file.
     reference_path: str
         The path of ethnic reference file.
+    materialise: bool
+        Write a plink fileset for every ethnic group. Otherwise every group is a
+        `VirtualSubset` over the input fileset.
+    store_dir: str | None
+        Directory of the Parquet phenotype store, None to read the files directly.
 
     Returns
     -------
-    list[list[Gender, str, str]]
-        [`Gender`, `ethnic_name`, `file_path`].
+    list[list[Gender, str, str | VirtualSubset]]
+        [`Gender`, `ethnic_name`, `file_path` or `VirtualSubset`].
     """
     # read files
     try:
-        eth_ref = pl.read_csv(reference_path, separator="\t", infer_schema=False)
+        eth_ref = scan_table(reference_path, separator="\t", store_dir=store_dir).collect()
         #eth_ref = pd.read_csv(reference_path, sep="\t", dtype=pd.StringDtype())
         if ethnic_info_path.endswith(".tsv"):
-            eth_info = pl.read_csv(ethnic_info_path, separator="\t", infer_schema=False)
+            eth_info = scan_table(ethnic_info_path, separator="\t", store_dir=store_dir)
             #eth_info = pd.read_csv(ethnic_info_path, sep=r"\s+")
         elif ethnic_info_path.endswith(".csv"):
-            eth_info = pl.read_csv(ethnic_info_path, separator=";", infer_schema=False)
+            eth_info = scan_table(ethnic_info_path, separator=";", store_dir=store_dir)
             #eth_info = pd.read_csv(ethnic_info_path, sep=",")
         elif ethnic_info_path.endswith(".xlsx") or ethnic_info_path.endswith(".xls"):
-            eth_info = pl.read_excel(ethnic_info_path, infer_schema_length=0)
+            eth_info = scan_table(ethnic_info_path, store_dir=store_dir)
             #eth_info = pd.read_excel(ethnic_info_path, dtype=pd.StringDtype())
         else:
             logger.error("Unsupported file format: %s", os.path.splitext(ethnic_info_path)[-1])
@@ -61,7 +70,7 @@ def divide_pop_by_ethnic(
     ## Firstly, recognise 'ethnic_coding' column in ethnic information file
     ##  and standardise column name.
     pattern = r".*ethnic.*|.*coding.*|.*code.*"
-    for col_name in eth_info.columns:
+    for col_name in eth_info.collect_schema().names():
         if re.match(pattern, col_name, re.IGNORECASE):
             #eth_info_coding_col_name = col_name
             eth_info = eth_info.rename({col_name: "eth_info_eth_coding"})
@@ -72,7 +81,7 @@ def divide_pop_by_ethnic(
     ###eth_info.rename(columns={eth_col_name: "ethnic_coding"}, inplace=True)
     ## rename ID to IID
     pattern = r".*id.*"
-    for col_name in eth_info.columns:
+    for col_name in eth_info.collect_schema().names():
         if re.match(pattern, col_name, re.IGNORECASE):
             #eth_info_iid_col_name = col_name
             eth_info = eth_info.rename({col_name: "IID"})
@@ -117,36 +126,18 @@ def divide_pop_by_ethnic(
 
     ## Join two dataframes by 'ethnic_coding' colomn.
     logger.info("Joining %s.fam with ethnic information...", input_name)
-    merged_eth = eth_info.join(
-        eth_ref2, how="inner",
+    merged_eth = eth_info.select("IID", "eth_info_eth_coding").join(
+        eth_ref2.lazy(), how="inner",
         left_on="eth_info_eth_coding",
         right_on="target_coding"
-    )
+    ).collect()
 
     ## Divide population by ethnicity.
     group_list: list[tuple[Gender, str, str]] = []
     ### Divide population into small ethnic groups and save list of individuals in each group.
     ethnic_names = set(eth_ref2.select("meaning").to_series().to_list())
 
-    try:
-        fam = pl.read_csv(
-            f"{input_name}.fam",
-            separator=" ",
-            has_header=False,
-            columns=[0, 1],
-            new_columns=["FID", "IID"],
-            infer_schema=False,
-        )
-    except Exception:
-        fam = pl.read_csv(
-                f"{input_name}.fam",
-                separator="\t",
-                has_header=False,
-                columns=[0, 1],
-                new_columns=["FID", "IID"],
-                infer_schema=False,
-        )
-
+    fam = as_subset(input_name).fam().select("FID", "IID")
 
     merged_fam = fam.join(
         merged_eth,
@@ -165,26 +156,14 @@ def divide_pop_by_ethnic(
             separator="\t",
             include_header=True,
         )
-        ## use plink `--keep` parameter to filter individuals.
-        plink_cmd = [
-            plink_path,
-            "--bfile", input_name,
-            "--keep", f"{input_name}_{ethnic_name}.tsv",
-            "--make-bed",
-            "--out", f"{input_name}_{ethnic_name}"
-        ]
-        '''return_code = os.system(" ".join(plink_cmd))
-        if return_code != 0:
-            sys.exit(return_code)'''
-        subprocess.run(
-            plink_cmd,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.STDOUT,
-            check=True,
+        group = as_subset(input_name).derive(
+            f"{input_name}_{ethnic_name}", keep_path=f"{input_name}_{ethnic_name}.tsv"
         )
+        if materialise:
+            ## use plink `--keep` parameter to filter individuals.
+            group = group.materialise(plink_path)
 
-
-        group_list.append((original_gender, ethnic_name, f"{input_name}_{ethnic_name}"))
+        group_list.append((original_gender, ethnic_name, group))
         logger.info("Successfully divided population by ethnicity: %s", ethnic_name)
 
     return group_list
@@ -192,10 +171,11 @@ def divide_pop_by_ethnic(
 
 def divide_pop_by_gender(
     plink_path: str,
-    input_name: str,
+    input_name: str | VirtualSubset,
     gender_reference_path: str,
-    gender_info_path: str
-) -> list[tuple[Gender, str]]:
+    gender_info_path: str,
+    materialise: bool = False,
+) -> list[tuple[Gender, str | VirtualSubset]]:
     """
     Divide population by gender.
 
@@ -209,9 +189,11 @@ def divide_pop_by_gender(
 
     **gender_info_path** (str): _Path of gender info file, containing gender information of each individual.
 
+    **materialise** (bool): _Write a plink fileset for each gender. Otherwise each gender is a `VirtualSubset` over the input fileset._
+
     # Returns:
 
-    list[tuple[Gender, str]]: _A list of tuples, containing (`Gender`, `relating file path`)._
+    list[tuple[Gender, str | VirtualSubset]]: _A list of tuples, containing (`Gender`, `relating file path` or `VirtualSubset`)._
     """
 
      # generate a .csv file, containing [FID, IID, Sex] columns.
@@ -277,8 +259,7 @@ def divide_pop_by_gender(
 
     #$ print("merged_sex_info:\n", merged_sex_info)
     ## merge merged_gender_info and .fam and replace the original one
-    fam_df = pd.read_csv(f"{input_name}.fam", sep=r"\s+", dtype=pd.StringDtype(), header=None)
-    fam_df.columns = pd.Index(["FID",'IID','PID','MID','Sex',"Phenotype"])
+    fam_df = as_subset(input_name).fam().to_pandas()
     merged_fam = pd.merge(
         fam_df, merged_sex_info, how='inner',
         left_on='IID', right_on="id_info")
@@ -289,39 +270,42 @@ def divide_pop_by_gender(
     )
 
     # divide plink file by gender
-    output_file_names: list[tuple[Gender, str]] = []
-    logger.info("Filter males...")
-    plink_cmd = [
-        plink_path,
-        "--bfile", input_name,
-        "--update-sex", f"{input_name}_gender.csv",
-        "--filter-males",
-        "--make-bed",
-        "--out", f"{input_name}_male"
-    ]
-    subprocess.run(
-        plink_cmd,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.STDOUT,
-        check=True,
-    )
-    logger.info("Successfully filtered males.")
-    output_file_names.append((Gender.MALE, f"{input_name}_male"))
-    logger.info("Filter females...")
-    plink_cmd = [
-        plink_path,
-        "--bfile", input_name,
-        "--update-sex", f"{input_name}_gender.csv",
-        "--filter-females",
-        "--make-bed",
-        "--out", f"{input_name}_female"
-    ]
-    subprocess.run(
-        plink_cmd,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.STDOUT,
-        check=True,
-    )
-    logger.info("Successfully filtered females.")
-    output_file_names.append((Gender.FEMALE, f"{input_name}_female"))
-    return output_file_names # place holder for mypy check
+    output_file_names: list[tuple[Gender, str | VirtualSubset]] = []
+    for gender, sex_coding, plink_filter in [
+        (Gender.MALE, "1", "--filter-males"),
+        (Gender.FEMALE, "2", "--filter-females"),
+    ]:
+        logger.info("Filter %ss...", gender.value)
+        if materialise:
+            plink_cmd = [
+                plink_path,
+                *bfile_args(input_name),
+                *plink_resource_args(),
+                "--update-sex", f"{input_name}_gender.csv",
+                plink_filter,
+                "--make-bed",
+                "--out", f"{input_name}_{gender.value}"
+            ]
+            subprocess.run(
+                plink_cmd,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.STDOUT,
+                check=True,
+            )
+            output_file_names.append((gender, f"{input_name}_{gender.value}"))
+        else:
+            merged_fam.loc[merged_fam["sex_coding"] == sex_coding, ["FID", "IID"]].to_csv(
+                f"{input_name}_{gender.value}.keep", sep="\t", index=False, header=False
+            )
+            output_file_names.append((
+                gender,
+                VirtualSubset(
+                    bfile=as_subset(input_name).bfile,
+                    name=f"{input_name}_{gender.value}",
+                    keep_path=f"{input_name}_{gender.value}.keep",
+                    extract_path=as_subset(input_name).extract_path,
+                    update_sex_path=f"{input_name}_gender.csv",
+                ),
+            ))
+        logger.info("Successfully filtered %ss.", gender.value)
+    return output_file_names
@@ -0,0 +1,354 @@
+import logging
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from Classes import PhenotypeColumn, VirtualSubset, as_subset
+from myutil.genotype import MISSING_GENOTYPE, BedReader
+from myutil.qassoc import _format_number, read_phenotype_matrix
+from myutil.small_tools import create_logger
+from myutil.stat_tools import t_two_sided_p
+
+logger = create_logger("LinearLogger", level=logging.WARN)
+
+LINEAR_HEADERS = ["CHR", "SNP", "BP", "A1", "TEST", "NMISS", "BETA", "STAT", "P"]
+
+# relative size of a QR diagonal below which a covariate is taken as collinear
+_RANK_TOLERANCE = 1e-8
+
+
+@dataclass
+class LinearStatistics:
+    """
+    Per SNP statistics of the additive (ADD) term of `plink --linear` for one phenotype.
+    Every array has shape `(n_variants,)`.
+
+    Attributes:
+        nmiss (np.ndarray): Number of samples with genotype, phenotype and covariates.
+        beta (np.ndarray): Regression coefficient of the A1 allele count.
+        se (np.ndarray): Standard error of `beta`.
+        t (np.ndarray): Wald t statistic.
+        p (np.ndarray): Two-sided p-value of `t`.
+    """
+
+    nmiss: np.ndarray
+    beta: np.ndarray
+    se: np.ndarray
+    t: np.ndarray
+    p: np.ndarray
+
+
+def read_covariate_file(covariate_path: str) -> pl.DataFrame:
+    """
+    Read a plink `--covar` file, e.g. a `.eigenvec` file.
+
+    The file is whitespace delimited with FID, IID and one column per covariate,
+    optionally preceded by a `FID IID ...` header line; columns are named
+    `<file name>_COV1`, `<file name>_COV2`, ... otherwise. `-9` and non-numeric values
+    are missing.
+
+    Args:
+        covariate_path (str): Path to the covariate file.
+
+    Returns:
+        pl.DataFrame: Columns FID, IID (strings) and one Float64 column per covariate,
+            null if missing.
+    """
+    if not os.path.exists(covariate_path):
+        raise FileNotFoundError(f"File '{covariate_path}' not found.")
+    covar_df = pd.read_csv(covariate_path, sep=r"\s+", header=None, dtype=str)
+    if len(covar_df) > 0 and covar_df.iloc[0, 0] == "FID":
+        covar_df.columns = pd.Index(covar_df.iloc[0])
+        covar_df = covar_df.iloc[1:]
+    else:
+        stem = os.path.splitext(os.path.basename(covariate_path))[0]
+        covar_df.columns = pd.Index(
+            ["FID", "IID"] + [f"{stem}_COV{i + 1}" for i in range(covar_df.shape[1] - 2)]
+        )
+    names = list(covar_df.columns[2:])
+    return pl.from_pandas(covar_df).with_columns(
+        pl.col(names).cast(pl.Float64, strict=False)
+    ).with_columns(
+        pl.when(pl.col(name) == -9).then(None).otherwise(pl.col(name)).alias(name)
+        for name in names
+    )
+
+
+def read_covariate_matrix(
+    fam: pl.DataFrame,
+    covariate_paths: list[str],
+    include_sex: bool = True,
+) -> tuple[np.ndarray, list[str]]:
+    """
+    Align covariate files with the samples of a fileset.
+
+    Args:
+        fam (pl.DataFrame): Samples of the fileset, with columns FID, IID and Sex.
+        covariate_paths (list[str]): plink `--covar` files.
+        include_sex (bool): Add sex (male 1, female 0) as a covariate, like the `sex`
+            modifier of `plink --linear`.
+
+    Returns:
+        tuple[np.ndarray, list[str]]: Float64 matrix of shape `(n_samples, n_covariates)`,
+            NaN if missing, and the covariate names.
+    """
+    samples = fam.select("FID", "IID")
+    columns: list[np.ndarray] = []
+    names: list[str] = []
+    for path in covariate_paths:
+        covar_df = read_covariate_file(path).unique(subset=["FID", "IID"], keep="first")
+        aligned = samples.join(covar_df, on=["FID", "IID"], how="left", maintain_order="left")
+        for name in covar_df.columns[2:]:
+            columns.append(aligned[name].fill_null(np.nan).to_numpy().astype(np.float64))
+            names.append(name)
+    if include_sex:
+        sex = fam["Sex"].to_numpy()
+        columns.append(np.where(sex == "1", 1.0, np.where(sex == "2", 0.0, np.nan)))
+        names.append("SEX")
+    if len(columns) == 0:
+        return np.empty((fam.height, 0)), names
+    return np.column_stack(columns), names
+
+
+def merge_covariate_files(covariate_paths: list[str], output_path: str) -> str:
+    """
+    Merge several plink `--covar` files into one, since plink only takes one.
+
+    Args:
+        covariate_paths (list[str]): plink `--covar` files.
+        output_path (str): Path of the merged file.
+
+    Returns:
+        str: `output_path`.
+
+    Generate Files:
+        %(output_path)s: FID, IID and every covariate with a header line, -9 if missing.
+    """
+    merged: pl.DataFrame | None = None
+    for path in covariate_paths:
+        covar_df = read_covariate_file(path).unique(
+            subset=["FID", "IID"], keep="first", maintain_order=True
+        )
+        merged = covar_df if merged is None else merged.join(
+            covar_df, on=["FID", "IID"], how="full", coalesce=True, maintain_order="left_right"
+        )
+    if merged is None:
+        raise ValueError("At least one covariate file is required.")
+    merged.fill_null(-9).write_csv(output_path, separator="\t")
+    return output_path
+
+
+def covariate_design(covariates: np.ndarray) -> np.ndarray:
+    """
+    Design matrix of a covariate-only model: an intercept followed by the covariates,
+    without the covariates that are collinear with the preceding columns (e.g. sex
+    within a single gender group).
+
+    Args:
+        covariates (np.ndarray): Covariate matrix of shape `(n_samples, n_covariates)`
+            without missing values.
+
+    Returns:
+        np.ndarray: Design matrix of shape `(n_samples, rank)`.
+    """
+    design = np.column_stack([np.ones(covariates.shape[0]), covariates])
+    _, r = np.linalg.qr(design)
+    diagonal = np.abs(np.diag(r))
+    independent = diagonal > _RANK_TOLERANCE * max(diagonal.max(initial=0.0), 1.0)
+    return design[:, independent]
+
+
+class _NullModel(object):
+    """
+    Phenotype and covariates of one phenotype, projected once onto an orthonormal basis
+    of the covariates (intercept included), for the samples having both.
+    """
+
+    def __init__(self, phenotype: np.ndarray, covariates: np.ndarray) -> None:
+        """
+        Args:
+            phenotype (np.ndarray): Phenotype of every sample, NaN if missing.
+            covariates (np.ndarray): Covariate matrix of shape `(n_samples, n_covariates)`,
+                NaN if missing.
+        """
+        self.samples: np.ndarray = np.flatnonzero(
+            ~np.isnan(phenotype) & ~np.isnan(covariates).any(axis=1)
+        )
+        self.n: int = len(self.samples)
+        design = covariate_design(covariates[self.samples])
+        self.q: np.ndarray = np.linalg.qr(design)[0]
+        self.rank: int = self.q.shape[1]
+
+        y = phenotype[self.samples]
+        self.y: np.ndarray = y - y.mean() if self.n > 0 else y
+        self.qy: np.ndarray = self.q.T @ self.y
+        self.yy: float = float(self.y @ self.y)
+
+    def statistics(self, dosage: np.ndarray) -> LinearStatistics:
+        """
+        ADD statistics of a block of SNPs.
+
+        The genotype of every SNP is residualised against the covariates with the
+        precomputed basis, so every SNP only costs a few dot products. Samples with a
+        missing genotype are dropped from the covariate projection of that SNP as well,
+        which gives the same estimates as fitting the full model on the remaining samples.
+
+        Args:
+            dosage (np.ndarray): `np.int8` dosage matrix of shape `(n_variants, n_samples)`
+                over all samples of the fileset (or subset).
+
+        Returns:
+            LinearStatistics: Statistics of every SNP of the block.
+        """
+        genotypes = dosage[:, self.samples]
+        missing = genotypes == MISSING_GENOTYPE
+        g = np.where(missing, 0, genotypes).astype(np.float64)
+
+        qg = g @ self.q
+        gg = np.einsum("ij,ij->i", g, g)
+        gy = g @ self.y
+        # residual sums of squares and products, with all samples observed
+        rgg = gg - np.einsum("ij,ij->i", qg, qg)
+        rgy = gy - qg @ self.qy
+        ryy = np.full(len(g), self.yy - float(self.qy @ self.qy))
+
+        incomplete = np.flatnonzero(missing.any(axis=1))
+        if len(incomplete) > 0:
+            # projection restricted to the observed samples of every incomplete SNP
+            dropped = missing[incomplete].astype(np.float64)
+            gram = np.eye(self.rank) - np.einsum(
+                "sn,nk,nl->skl", dropped, self.q, self.q, optimize=True
+            )
+            qy = self.qy - dropped @ (self.q * self.y[:, None])
+            yy = self.yy - dropped @ (self.y * self.y)
+            right = np.stack([qy, qg[incomplete]], axis=2)
+            try:
+                solved = np.linalg.solve(gram, right)
+            except np.linalg.LinAlgError:
+                # a covariate is constant over the observed samples of some SNP
+                solved = np.linalg.pinv(gram) @ right
+            rgg[incomplete] = gg[incomplete] - np.einsum("ij,ij->i", qg[incomplete], solved[:, :, 1])
+            rgy[incomplete] = gy[incomplete] - np.einsum("ij,ij->i", qg[incomplete], solved[:, :, 0])
+            ryy[incomplete] = yy - np.einsum("ij,ij->i", qy, solved[:, :, 0])
+
+        nmiss = self.n - missing.sum(axis=1)
+        df = nmiss - self.rank - 1
+        with np.errstate(invalid="ignore", divide="ignore"):
+            valid = (df > 0) & (rgg > _RANK_TOLERANCE * np.maximum(gg, 1.0))
+            beta = np.where(valid, rgy / rgg, np.nan)
+            sse = np.maximum(ryy - beta * rgy, 0.0)
+            se = np.where(valid, np.sqrt(sse / df / rgg), np.nan)
+            t = beta / se
+        p = t_two_sided_p(t, df)
+        return LinearStatistics(nmiss=nmiss.astype(np.int64), beta=beta, se=se, t=t, p=p)
+
+
+class LinearWriter(object):
+    """
+    Block-wise writer of the ADD rows of `.assoc.linear` files in plink's fixed width
+    layout (as with `--linear hide-covar`).
+    """
+
+    def __init__(self, output_name: str, snp_width: int) -> None:
+        """
+        Args:
+            output_name (str): Output path (without extension).
+            snp_width (int): Width of the SNP column, usually the length of the longest SNP ID.
+        """
+        self.output_name = output_name
+        self.snp_width = max(snp_width, 4)
+        with open(f"{output_name}.assoc.linear", "w") as writer:
+            writer.write(
+                f" CHR {'SNP':>{self.snp_width}} {'BP':>10} {'A1':>4} {'TEST':>10} "
+                f"{'NMISS':>8} {'BETA':>10} {'STAT':>12} {'P':>12} \n"
+            )
+
+    def write_block(self, bim: pl.DataFrame, statistics: LinearStatistics) -> None:
+        """
+        Append the results of a block of SNPs.
+
+        Args:
+            bim (pl.DataFrame): `.bim` rows of the block (CHR, SNP, BP, A1).
+            statistics (LinearStatistics): Statistics of the block.
+        """
+        w = self.snp_width
+        with open(f"{self.output_name}.assoc.linear", "a") as writer:
+            writer.writelines(
+                f"{chrom:>4} {snp:>{w}} {bp:>10} {a1:>4} {'ADD':>10} {nmiss:>8} "
+                f"{_format_number(beta):>10} {_format_number(t):>12} {_format_number(p):>12} \n"
+                for chrom, snp, bp, a1, nmiss, beta, t, p in zip(
+                    bim["CHR"], bim["SNP"], bim["BP"], bim["A1"], statistics.nmiss,
+                    statistics.beta, statistics.t, statistics.p,
+                )
+            )
+
+
+def linear_association(
+    input_name: str | VirtualSubset,
+    phenotype_info_paths: list[str | PhenotypeColumn],
+    output_names: list[str],
+    covariate_paths: list[str] | None = None,
+    *,
+    include_sex: bool = True,
+    chunk_size: int | None = None,
+) -> list[str]:
+    """
+    In-process equivalent of `plink --linear hide-covar [sex] --covar ...` for many
+    phenotypes at once.
+
+    For every phenotype the covariates (intercept included) are factored once with a QR
+    decomposition; genotypes are then streamed once, one block of SNPs at a time, and
+    residualised against that basis with matrix products. Collinear covariates are
+    dropped.
+
+    Args:
+        input_name (str | VirtualSubset): Path of the plink fileset (without extension),
+            or a virtual subset of one.
+        phenotype_info_paths (list[str | PhenotypeColumn]): plink `--pheno` files, one per
+            phenotype, or columns of phenotype matrices.
+        output_names (list[str]): Output path (without extension) of every phenotype.
+        covariate_paths (list[str] | None): plink `--covar` files, e.g. `.eigenvec` files.
+        include_sex (bool): Add sex as a covariate.
+        chunk_size (int | None): Number of SNPs per block.
+
+    Returns:
+        list[str]: `output_names`.
+
+    Generate Files:
+        %(output_name)s.assoc.linear for every output name.
+    """
+    if len(phenotype_info_paths) != len(output_names):
+        raise ValueError("One output name is required for every phenotype file.")
+
+    subset = as_subset(input_name)
+    reader = BedReader(subset.bfile)
+    sample_index = subset.sample_index()
+    variant_index = subset.variant_index()
+    if variant_index is None:
+        variant_index = np.arange(reader.n_variants)
+    fam = subset.fam()
+    phenotypes = read_phenotype_matrix(fam, phenotype_info_paths)
+    covariates, covariate_names = read_covariate_matrix(fam, covariate_paths or [], include_sex)
+    models = [_NullModel(phenotypes[:, column], covariates) for column in range(phenotypes.shape[1])]
+    logger.info(
+        "Testing %d SNPs of %s against %d phenotypes, adjusting for %s.",
+        len(variant_index), input_name, len(phenotype_info_paths), covariate_names
+    )
+
+    snp_width = int(reader.bim[variant_index]["SNP"].str.len_chars().max() or 0)  # type: ignore
+    writers = [LinearWriter(name, snp_width) for name in output_names]
+    if chunk_size is None:
+        # several float64 copies of every block are alive at once
+        chunk_size = max(1, reader.default_chunk_size(fam.height) // 8)
+
+    for block_index, dosage in reader.iter_chunks(
+        chunk_size, variant_index=variant_index, sample_index=sample_index
+    ):
+        bim = reader.bim[block_index]
+        for model, writer in zip(models, writers):
+            writer.write_block(bim, model.statistics(dosage))
+
+    return output_names
@@ -0,0 +1,362 @@
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+import polars as pl
+
+from Classes import PhenotypeColumn, VirtualSubset, as_subset
+from myutil.genotype import MISSING_GENOTYPE, BedReader
+from myutil.linear import covariate_design, read_covariate_matrix
+from myutil.qassoc import _format_number, read_phenotype_matrix
+from myutil.small_tools import create_logger
+from myutil.stat_tools import chi2_1df_p
+
+logger = create_logger("LogisticLogger", level=logging.WARN)
+
+LOGISTIC_HEADERS = ["CHR", "SNP", "BP", "A1", "TEST", "NMISS", "OR", "STAT", "P"]
+
+SCORE_TEST = "ADD_SCORE"
+"""TEST value of the rows that were not refitted (one-step OR and score statistic)."""
+
+DEFAULT_SCORE_P_THRESHOLD = 1e-3
+"""Score test p-value below which a SNP is refitted with Newton-Raphson."""
+
+_MAX_ITERATIONS = 25
+_CONVERGENCE_TOLERANCE = 1e-8
+# candidates refitted at once; bounds the (candidates × samples × covariates) buffers
+_NEWTON_BATCH = 64
+
+
+@dataclass
+class LogisticStatistics:
+    """
+    Per SNP statistics of the additive (ADD) term of `plink --logistic` for one phenotype.
+    Every array has shape `(n_variants,)`.
+
+    Attributes:
+        nmiss (np.ndarray): Number of samples with genotype, phenotype and covariates.
+        odds_ratio (np.ndarray): Odds ratio of one more A1 allele.
+        stat (np.ndarray): Wald z statistic (signed square root of the score statistic
+            for SNPs that were not refitted).
+        p (np.ndarray): Two-sided p-value.
+        refitted (np.ndarray): Whether the SNP was refitted with Newton-Raphson.
+    """
+
+    nmiss: np.ndarray
+    odds_ratio: np.ndarray
+    stat: np.ndarray
+    p: np.ndarray
+    refitted: np.ndarray
+
+
+def _expit(eta: np.ndarray) -> np.ndarray:
+    """Logistic function, without overflow warnings for large |eta|."""
+    return 0.5 * (1.0 + np.tanh(0.5 * eta))
+
+
+def binary_phenotypes(phenotypes: np.ndarray) -> np.ndarray:
+    """
+    Recode plink case/control phenotypes (1 control, 2 case; 0 and -9 missing) as 0/1.
+
+    Args:
+        phenotypes (np.ndarray): Phenotype matrix, NaN if missing.
+
+    Returns:
+        np.ndarray: Matrix of the same shape with 1 for cases, 0 for controls and NaN
+            otherwise.
+    """
+    return np.where(phenotypes == 2, 1.0, np.where(phenotypes == 1, 0.0, np.nan))
+
+
+class _NullModel(object):
+    """
+    Covariate-only logistic model of one phenotype, fitted once, with everything the
+    score test of a SNP needs.
+    """
+
+    def __init__(self, phenotype: np.ndarray, covariates: np.ndarray) -> None:
+        """
+        Args:
+            phenotype (np.ndarray): 0/1 phenotype of every sample, NaN if missing.
+            covariates (np.ndarray): Covariate matrix of shape `(n_samples, n_covariates)`,
+                NaN if missing.
+        """
+        self.samples: np.ndarray = np.flatnonzero(
+            ~np.isnan(phenotype) & ~np.isnan(covariates).any(axis=1)
+        )
+        self.n: int = len(self.samples)
+        self.y: np.ndarray = phenotype[self.samples]
+        self.design: np.ndarray = covariate_design(covariates[self.samples])
+        self.coefficients: np.ndarray = self._fit()
+
+        self.mu: np.ndarray = _expit(self.design @ self.coefficients)
+        self.weights: np.ndarray = self.mu * (1 - self.mu)
+        self.residuals: np.ndarray = self.y - self.mu
+        # orthonormal basis of the weighted design, scaled back so that
+        # ||g @ self.projection||² is the part of gᵀWg explained by the covariates
+        sqrt_weights = np.sqrt(self.weights)
+        self.projection: np.ndarray = \
+            sqrt_weights[:, None] * np.linalg.qr(sqrt_weights[:, None] * self.design)[0]
+
+    def _fit(self) -> np.ndarray:
+        """Newton-Raphson fit of the covariate-only model."""
+        coefficients = np.zeros(self.design.shape[1])
+        for _ in range(_MAX_ITERATIONS):
+            mu = _expit(self.design @ coefficients)
+            hessian = self.design.T @ ((mu * (1 - mu))[:, None] * self.design)
+            step = np.linalg.lstsq(hessian, self.design.T @ (self.y - mu), rcond=None)[0]
+            coefficients += step
+            if np.abs(step).max(initial=0.0) < _CONVERGENCE_TOLERANCE:
+                break
+        return coefficients
+
+    def score_test(self, genotypes: np.ndarray, missing: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Score test of a block of SNPs against the null model. Missing genotypes are
+        replaced by the mean genotype of the SNP.
+
+        Args:
+            genotypes (np.ndarray): Dosage matrix of the model samples, shape
+                `(n_variants, n)`.
+            missing (np.ndarray): Mask of the missing genotypes.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Score `U` and its variance `V`; `U / V` is the
+                one-step estimate of the log odds ratio and `U² / V` the score statistic.
+        """
+        called = (~missing).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(missing, 0, genotypes).sum(axis=1) / called
+        g = np.where(missing, np.nan_to_num(mean)[:, None], genotypes).astype(np.float64)
+        score = g @ self.residuals
+        explained = g @ self.projection
+        variance = (g * g) @ self.weights - np.einsum("ij,ij->i", explained, explained)
+        return score, variance
+
+    def newton_raphson(
+        self, genotypes: np.ndarray, missing: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Full fit of the model with a SNP for a batch of SNPs at once, on the samples with
+        a genotype call, starting from the null model.
+
+        Args:
+            genotypes (np.ndarray): Dosage matrix of the model samples, shape
+                `(n_variants, n)`.
+            missing (np.ndarray): Mask of the missing genotypes.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Log odds ratio of the SNP and its standard
+                error; NaN if the fit did not converge.
+        """
+        observed = (~missing).astype(np.float64)
+        g = np.where(missing, 0, genotypes).astype(np.float64)
+        n_snps, rank = g.shape[0], self.design.shape[1]
+        coefficients = np.zeros((n_snps, rank + 1))
+        coefficients[:, :rank] = self.coefficients
+        converged = np.zeros(n_snps, dtype=bool)
+        hessian = np.empty((n_snps, rank + 1, rank + 1))
+
+        for _ in range(_MAX_ITERATIONS):
+            mu = _expit(coefficients[:, :rank] @ self.design.T + coefficients[:, rank, None] * g)
+            weights = mu * (1 - mu) * observed
+            residuals = (self.y - mu) * observed
+
+            gradient = np.empty((n_snps, rank + 1))
+            gradient[:, :rank] = residuals @ self.design
+            gradient[:, rank] = np.einsum("ij,ij->i", residuals, g)
+            hessian[:, :rank, :rank] = np.einsum(
+                "in,nk,nl->ikl", weights, self.design, self.design, optimize=True
+            )
+            hessian[:, :rank, rank] = (weights * g) @ self.design
+            hessian[:, rank, :rank] = hessian[:, :rank, rank]
+            hessian[:, rank, rank] = np.einsum("ij,ij->i", weights * g, g)
+
+            with np.errstate(invalid="ignore"):
+                try:
+                    step = np.linalg.solve(hessian, gradient[:, :, None])[:, :, 0]
+                except np.linalg.LinAlgError:
+                    # e.g. a SNP that is monomorphic among its called samples
+                    step = (np.linalg.pinv(hessian) @ gradient[:, :, None])[:, :, 0]
+            step[converged] = 0.0
+            coefficients += step
+            converged |= np.abs(step).max(axis=1) < _CONVERGENCE_TOLERANCE
+            if converged.all():
+                break
+
+        with np.errstate(invalid="ignore"):
+            try:
+                variance = np.linalg.inv(hessian)[:, rank, rank]
+            except np.linalg.LinAlgError:
+                variance = np.linalg.pinv(hessian)[:, rank, rank]
+        valid = converged & np.isfinite(coefficients[:, rank]) & (variance > 0)
+        with np.errstate(invalid="ignore"):
+            return (
+                np.where(valid, coefficients[:, rank], np.nan),
+                np.where(valid, np.sqrt(variance), np.nan),
+            )
+
+    def statistics(
+        self, dosage: np.ndarray, score_p_threshold: float = DEFAULT_SCORE_P_THRESHOLD
+    ) -> LogisticStatistics:
+        """
+        ADD statistics of a block of SNPs: a score test of every SNP, and a full
+        Newton-Raphson fit (Wald test) of the SNPs whose score test p-value is below
+        `score_p_threshold`.
+
+        Args:
+            dosage (np.ndarray): `np.int8` dosage matrix of shape `(n_variants, n_samples)`
+                over all samples of the fileset (or subset).
+            score_p_threshold (float): Score test p-value below which a SNP is refitted.
+
+        Returns:
+            LogisticStatistics: Statistics of every SNP of the block.
+        """
+        genotypes = dosage[:, self.samples]
+        missing = genotypes == MISSING_GENOTYPE
+        nmiss = self.n - missing.sum(axis=1)
+
+        score, variance = self.score_test(genotypes, missing)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            valid = variance > 1e-8 * np.maximum(nmiss, 1)
+            log_odds = np.where(valid, score / variance, np.nan)
+            stat = np.where(valid, score / np.sqrt(variance), np.nan)
+        p = chi2_1df_p(stat * stat)
+
+        refitted = valid & (p < score_p_threshold)
+        candidates = np.flatnonzero(refitted)
+        for start in range(0, len(candidates), _NEWTON_BATCH):
+            batch = candidates[start:start + _NEWTON_BATCH]
+            beta, se = self.newton_raphson(genotypes[batch], missing[batch])
+            log_odds[batch] = beta
+            stat[batch] = beta / se
+            p[batch] = chi2_1df_p(stat[batch] * stat[batch])
+
+        return LogisticStatistics(
+            nmiss=nmiss.astype(np.int64), odds_ratio=np.exp(log_odds), stat=stat, p=p,
+            refitted=refitted,
+        )
+
+
+class LogisticWriter(object):
+    """
+    Block-wise writer of the ADD rows of `.assoc.logistic` files in plink's fixed width
+    layout (as with `--logistic hide-covar`). Rows refitted with Newton-Raphson are
+    written with TEST `ADD` like plink; the others, whose OR and STAT come from the score
+    test, with TEST `ADD_SCORE`.
+    """
+
+    def __init__(self, output_name: str, snp_width: int) -> None:
+        """
+        Args:
+            output_name (str): Output path (without extension).
+            snp_width (int): Width of the SNP column, usually the length of the longest SNP ID.
+        """
+        self.output_name = output_name
+        self.snp_width = max(snp_width, 4)
+        with open(f"{output_name}.assoc.logistic", "w") as writer:
+            writer.write(
+                f" CHR {'SNP':>{self.snp_width}} {'BP':>10} {'A1':>4} {'TEST':>10} "
+                f"{'NMISS':>8} {'OR':>10} {'STAT':>12} {'P':>12} \n"
+            )
+
+    def write_block(self, bim: pl.DataFrame, statistics: LogisticStatistics) -> None:
+        """
+        Append the results of a block of SNPs.
+
+        Args:
+            bim (pl.DataFrame): `.bim` rows of the block (CHR, SNP, BP, A1).
+            statistics (LogisticStatistics): Statistics of the block.
+        """
+        w = self.snp_width
+        # NA rows (no test at all) keep plink's ADD
+        tests = np.where(statistics.refitted | np.isnan(statistics.p), "ADD", SCORE_TEST)
+        with open(f"{self.output_name}.assoc.logistic", "a") as writer:
+            writer.writelines(
+                f"{chrom:>4} {snp:>{w}} {bp:>10} {a1:>4} {test:>10} "
+                f"{nmiss:>8} {_format_number(odds):>10} {_format_number(stat):>12} "
+                f"{_format_number(p):>12} \n"
+                for chrom, snp, bp, a1, test, nmiss, odds, stat, p in zip(
+                    bim["CHR"], bim["SNP"], bim["BP"], bim["A1"], tests, statistics.nmiss,
+                    statistics.odds_ratio, statistics.stat, statistics.p,
+                )
+            )
+
+
+def logistic_association(
+    input_name: str | VirtualSubset,
+    phenotype_info_paths: list[str | PhenotypeColumn],
+    output_names: list[str],
+    covariate_paths: list[str] | None = None,
+    *,
+    include_sex: bool = True,
+    score_p_threshold: float = DEFAULT_SCORE_P_THRESHOLD,
+    chunk_size: int | None = None,
+) -> list[str]:
+    """
+    In-process logistic regression of many case/control phenotypes, reporting like
+    `plink --logistic hide-covar [sex] --covar ...`.
+
+    The covariate-only model of every phenotype is fitted once. Genotypes are then
+    streamed once, one block of SNPs at a time, and every SNP gets a score test against
+    the null model with a few matrix products. Only SNPs whose score test p-value is
+    below `score_p_threshold` are refitted with Newton-Raphson, so that their odds ratio
+    and Wald test match plink; for the others OR is the one-step estimate `exp(U / V)`
+    and STAT the signed square root of the score statistic, and their TEST is
+    `ADD_SCORE` instead of `ADD`.
+
+    Args:
+        input_name (str | VirtualSubset): Path of the plink fileset (without extension),
+            or a virtual subset of one.
+        phenotype_info_paths (list[str | PhenotypeColumn]): plink `--pheno` files (or
+            columns of phenotype matrices) with 1 for controls and 2 for cases, one per
+            phenotype.
+        output_names (list[str]): Output path (without extension) of every phenotype.
+        covariate_paths (list[str] | None): plink `--covar` files, e.g. `.eigenvec` files.
+        include_sex (bool): Add sex as a covariate.
+        score_p_threshold (float): Score test p-value below which a SNP is refitted.
+        chunk_size (int | None): Number of SNPs per block.
+
+    Returns:
+        list[str]: `output_names`.
+
+    Generate Files:
+        %(output_name)s.assoc.logistic for every output name.
+    """
+    if len(phenotype_info_paths) != len(output_names):
+        raise ValueError("One output name is required for every phenotype file.")
+
+    subset = as_subset(input_name)
+    reader = BedReader(subset.bfile)
+    sample_index = subset.sample_index()
+    variant_index = subset.variant_index()
+    if variant_index is None:
+        variant_index = np.arange(reader.n_variants)
+    fam = subset.fam()
+    phenotypes = binary_phenotypes(read_phenotype_matrix(fam, phenotype_info_paths))
+    covariates, covariate_names = read_covariate_matrix(fam, covariate_paths or [], include_sex)
+    models = [_NullModel(phenotypes[:, column], covariates) for column in range(phenotypes.shape[1])]
+    logger.info(
+        "Testing %d SNPs of %s against %d binary phenotypes, adjusting for %s.",
+        len(variant_index), input_name, len(phenotype_info_paths), covariate_names
+    )
+
+    snp_width = int(reader.bim[variant_index]["SNP"].str.len_chars().max() or 0)  # type: ignore
+    writers = [LogisticWriter(name, snp_width) for name in output_names]
+    if chunk_size is None:
+        # several float64 copies of every block are alive at once
+        chunk_size = max(1, reader.default_chunk_size(fam.height) // 8)
+
+    n_refitted = np.zeros(len(models), dtype=np.int64)
+    for block_index, dosage in reader.iter_chunks(
+        chunk_size, variant_index=variant_index, sample_index=sample_index
+    ):
+        bim = reader.bim[block_index]
+        for column, (model, writer) in enumerate(zip(models, writers)):
+            statistics = model.statistics(dosage, score_p_threshold)
+            writer.write_block(bim, statistics)
+            n_refitted[column] += statistics.refitted.sum()
+
+    for output_name, count in zip(output_names, n_refitted):
+        logger.info("%s: %d SNPs refitted with Newton-Raphson.", output_name, count)
+    return output_names
@@ -2,14 +2,18 @@ import logging
 import subprocess
 import sys
 
-from Classes import Gender
+import numpy as np
+
+from Classes import Gender, VirtualSubset, as_subset
+from myutil.genotype import DEFAULT_CHUNK_BYTES, MISSING_GENOTYPE, BedReader
+from myutil.scheduler import PLINK_BASE_MEMORY, plink_resource_args
 from myutil.small_tools import create_logger
 
 logger = create_logger("GroupDivisionLogger", level=logging.WARN)
 
 def principle_component_analysis(
     plink_path: str,
-    input_name: str,
+    input_name: str | VirtualSubset,
     indep_snp_path: str,
     output_name: str,
     gender: Gender,
@@ -48,9 +52,10 @@ def principle_component_analysis(
 
     command = [
         plink_path,
-        "--bfile", input_name,
-        "--extract", indep_snp_path,
-        "--pca", n_components,
+        # the pruned SNPs are a subset of the SNPs of `input_name`
+        *as_subset(input_name).derive(str(input_name), extract_path=indep_snp_path).plink_args(),
+        *plink_resource_args(),
+        "--pca", str(n_components),
         "--out", output_name,
     ]
     try:
@@ -63,3 +68,169 @@ def principle_component_analysis(
         sys.exit(1)
 
     return f"{output_name}.eigenvec"
+
+
+def _standardised_block(dosage: np.ndarray) -> np.ndarray:
+    """
+    Standardise a block of genotypes the way `plink --pca` does: centre every variant on
+    twice its A1 frequency, scale by `sqrt(2p(1 - p))` and set missing calls to 0 (the
+    mean). Monomorphic variants are dropped.
+
+    Args:
+        dosage (np.ndarray): Dosage matrix of shape `(n_variants, n_samples)`.
+
+    Returns:
+        np.ndarray: `np.float64` matrix of shape `(n_polymorphic_variants, n_samples)`.
+    """
+    called = dosage != MISSING_GENOTYPE
+    values = np.where(called, dosage, 0).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        frequency = values.sum(axis=1) / (2 * called.sum(axis=1))
+        scale = np.sqrt(2 * frequency * (1 - frequency))
+    polymorphic = scale > 0
+    values = values[polymorphic]
+    values -= 2 * frequency[polymorphic, None]
+    values /= scale[polymorphic, None]
+    values[~called[polymorphic]] = 0.0
+    return values
+
+
+def randomised_principal_component_analysis(
+    input_name: str | VirtualSubset,
+    indep_snp_path: str,
+    output_name: str,
+    gender: Gender,
+    ethnicity: str,
+    n_components: int = 10,
+    *,
+    oversampling: int = 10,
+    n_power_iterations: int = 4,
+    seed: int = 0,
+    chunk_size: int | None = None,
+) -> str | None:
+    """
+    Same as `principle_component_analysis`, computed in-process in bounded memory.
+
+    The genotype relationship matrix `X Xᵀ / M` of the standardised genotypes `X`
+    (samples × M pruned variants) is never formed. Its leading eigenvectors are found by
+    a randomised range finder with power iterations, which only needs products of the
+    matrix with `n_components + oversampling` vectors; each product streams the pruned
+    variants of the memory-mapped `.bed` once, one block at a time.
+
+    Args:
+        input_name (str | VirtualSubset):
+            Name of the input data.
+        indep_snp_path (str):
+            Path to the `.prune.in` file generated from `--indep-pairwise` process.
+        output_name (str):
+            Name of the output data.
+        gender (Gender):
+            Gender of the individuals.
+        ethnicity (str):
+            Ethnicity of the individuals.
+        n_components (int):
+            Number of components to retain.
+        oversampling (int):
+            Number of extra random vectors of the range finder.
+        n_power_iterations (int):
+            Number of power iterations; more iterations give more accurate components
+            at the cost of one more pass over the genotypes each.
+        seed (int):
+            Seed of the random start vectors.
+        chunk_size (int | None):
+            Number of variants decoded at once.
+
+    Returns:
+        str | None:
+            If analysis succeeds, path to the eigenvec file (with
+            .eigenvec extension) will be returned.
+
+    Generate Files:
+        %(output_name)s.eigenvec: FID, IID and one column per component, no header.
+        %(output_name)s.eigenval: One eigenvalue per line.
+    """
+    logger.info(
+        "Performing randomised principle component analysis for %s %s %s. SNP set: %s...",
+        input_name, gender, ethnicity, indep_snp_path)
+
+    try:
+        subset = as_subset(input_name).derive(str(input_name), extract_path=indep_snp_path)
+        reader = BedReader(subset.bfile)
+        sample_index = subset.sample_index()
+        variant_index = subset.variant_index()
+        fam = subset.fam()
+    except (FileNotFoundError, ValueError) as e:
+        logger.error("Cannot read %s: %s", input_name, e)
+        return None
+
+    n_samples = fam.height
+    rank = min(n_components + oversampling, n_samples)
+    if n_components > n_samples:
+        logger.error(
+            "Cannot compute %d components from %d samples of %s.", n_components, n_samples, input_name
+        )
+        return None
+
+    def relationship_product(vectors: np.ndarray) -> tuple[np.ndarray, int]:
+        """`X Xᵀ vectors` and the number of variants used, in one pass over the genotypes."""
+        product = np.zeros_like(vectors)
+        n_used = 0
+        for _, dosage in reader.iter_chunks(
+            chunk_size, variant_index=variant_index, sample_index=sample_index
+        ):
+            block = _standardised_block(dosage)
+            product += block.T @ (block @ vectors)
+            n_used += block.shape[0]
+        return product, n_used
+
+    rng = np.random.default_rng(seed)
+    basis, n_used = relationship_product(rng.standard_normal((n_samples, rank)))
+    if n_used == 0:
+        logger.error("No polymorphic SNP of %s in %s.", input_name, indep_snp_path)
+        return None
+    for _ in range(n_power_iterations):
+        basis, _ = relationship_product(np.linalg.qr(basis)[0])
+    basis = np.linalg.qr(basis)[0]
+
+    # project the relationship matrix onto the basis and diagonalise the small matrix
+    projected, _ = relationship_product(basis)
+    small = basis.T @ projected / n_used
+    eigenvalues, eigenvectors = np.linalg.eigh((small + small.T) / 2)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    eigenvalues = eigenvalues[order]
+    eigenvectors = basis @ eigenvectors[:, order]
+
+    with open(f"{output_name}.eigenvec", "w") as writer:
+        for fid, iid, vector in zip(fam["FID"], fam["IID"], eigenvectors):
+            writer.write(" ".join([fid, iid, *(f"{value:g}" for value in vector)]) + "\n")
+    with open(f"{output_name}.eigenval", "w") as writer:
+        writer.writelines(f"{value:g}\n" for value in eigenvalues)
+
+    logger.info("Principle component analysis of %s used %d SNPs.", input_name, n_used)
+    return f"{output_name}.eigenvec"
+
+
+def estimate_pca_memory(
+    input_name: str | VirtualSubset,
+    n_components: int = 10,
+    oversampling: int = 10,
+) -> int:
+    """
+    Rough upper bound of the memory taken by `randomised_principal_component_analysis`,
+    in bytes.
+
+    Args:
+        input_name (str | VirtualSubset):
+            Name of the input data.
+        n_components (int):
+            Number of components to retain.
+        oversampling (int):
+            Number of extra random vectors of the range finder.
+
+    Returns:
+        int: Estimated peak memory.
+    """
+    n_samples = as_subset(input_name).fam().height
+    # one decoded block and its float64 copies, plus a few samples × rank matrices
+    return PLINK_BASE_MEMORY + 10 * DEFAULT_CHUNK_BYTES \
+        + 4 * 8 * n_samples * (n_components + oversampling)
@@ -0,0 +1,373 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from myutil.genotype import DEFAULT_CHUNK_BYTES
+from myutil.small_tools import create_logger
+from myutil.stat_tools import regression_from_sums
+
+logger = create_logger("PermutationLogger", level=logging.WARN)
+
+DEFAULT_PERMUTATION_SEED = 20240601
+"""Seed used when none is given, so that reruns give the same empirical p-values."""
+
+# permuted statistics within this relative distance of the observed one count as ties
+_TIE_TOLERANCE = 1e-9
+
+# adaptive permutation: size of the first permutation block, which doubles afterwards
+_ADAPTIVE_FIRST_BLOCK = 64
+# adaptive permutation: z of the confidence interval of the empirical p-value (two-sided 1e-4)
+_ADAPTIVE_Z = 3.8906
+
+
+class SamplePermutation(object):
+    """
+    Permutations of the samples shared by all SNPs and phenotypes of a population.
+
+    Blocks of permutations are generated from `seed` and the block number, so every block
+    of SNPs (and every phenotype) sees the same permutations without storing them, and
+    the result only depends on `seed` and the block sizes, not on the number of threads.
+    Each phenotype is permuted among its samples with a non-missing value, as plink does.
+    """
+
+    def __init__(
+        self,
+        phenotypes: np.ndarray,
+        n_permutations: int,
+        *,
+        seed: int = DEFAULT_PERMUTATION_SEED,
+        n_workers: int | None = None,
+        block_size: int | None = None,
+    ) -> None:
+        """
+        Args:
+            phenotypes (np.ndarray): Phenotype matrix of shape `(n_samples, n_phenotypes)`,
+                NaN if missing.
+            n_permutations (int): (Maximum) number of permutations.
+            seed (int): Seed of the permutations.
+            n_workers (int | None): Number of threads. Defaults to the number of CPUs.
+            block_size (int | None): (Maximum) number of permutations per block.
+        """
+        if n_permutations < 1:
+            raise ValueError("At least one permutation is required.")
+        self.n_permutations = n_permutations
+        self.seed = seed
+        self.n_workers = (os.cpu_count() or 1) if n_workers is None else n_workers
+
+        self.observed = ~np.isnan(phenotypes)
+        with np.errstate(invalid="ignore"):
+            centre = np.nan_to_num(np.nanmean(phenotypes, axis=0))
+        self.y = np.where(self.observed, phenotypes - centre, 0.0)
+        self.n_samples, self.n_phenotypes = phenotypes.shape
+        self.observed_index = [np.flatnonzero(self.observed[:, j]) for j in range(self.n_phenotypes)]
+
+        if block_size is None:
+            # the permuted phenotypes and four (SNP, permutation) products of a block
+            block_size = DEFAULT_CHUNK_BYTES // (8 * 5 * max(self.n_samples, 1))
+        self.block_size = int(min(max(block_size, 1), n_permutations))
+
+    def block_bounds(self, block_number: int) -> tuple[int, int]:
+        """First and last (exclusive) permutation of a block."""
+        start = block_number * self.block_size
+        return start, min(start + self.block_size, self.n_permutations)
+
+    @property
+    def n_blocks(self) -> int:
+        """Number of permutation blocks."""
+        return -(-self.n_permutations // self.block_size)
+
+    def permutation_block(self, block_number: int) -> np.ndarray:
+        """
+        Sample orders of a block of permutations.
+
+        Args:
+            block_number (int): Number of the block.
+
+        Returns:
+            np.ndarray: Array of shape `(n_permutations_in_block, n_samples)`, each row a
+                permutation of the sample indices.
+        """
+        start, stop = self.block_bounds(block_number)
+        rng = np.random.default_rng([self.seed, block_number])
+        return rng.permuted(
+            np.broadcast_to(np.arange(self.n_samples), (stop - start, self.n_samples)), axis=1
+        )
+
+    def _permuted_phenotype(self, order: np.ndarray, column: int) -> np.ndarray:
+        """
+        Permuted values of one phenotype, shape `(n_samples, n_permutations_in_block)`.
+        Restricting a uniform permutation of all samples to the samples with a value gives
+        a uniform permutation of those samples.
+        """
+        observed = self.observed[:, column]
+        index = self.observed_index[column]
+        source = order[observed[order]].reshape(order.shape[0], len(index))
+        permuted = np.zeros((self.n_samples, order.shape[0]))
+        permuted[index, :] = self.y[source, column].T
+        return permuted
+
+    def _permuted_t(
+        self,
+        genotypes: tuple[np.ndarray, np.ndarray, np.ndarray],
+        sums: tuple[np.ndarray, np.ndarray, np.ndarray],
+        order: np.ndarray,
+        column: int,
+    ) -> np.ndarray:
+        """
+        |T| of a block of SNPs under a block of permutations of one phenotype.
+
+        Args:
+            genotypes: (hom A1, het, called) indicator matrices of the SNPs.
+            sums: (n, sum of x, sum of x²) of the SNPs for this phenotype, which do not
+                change under permutation.
+            order: Sample orders of the permutations.
+            column: Phenotype column.
+
+        Returns:
+            np.ndarray: Array of shape `(n_variants, n_permutations_in_block)`.
+        """
+        hom_a1, het, called = genotypes
+        n, sx, sxx = sums
+        y = self._permuted_phenotype(order, column)
+        _, _, _, t = regression_from_sums(
+            n[:, None], sx[:, None], sxx[:, None],
+            called @ y, called @ (y * y), het @ y + 2 * (hom_a1 @ y),
+        )
+        return np.abs(t)
+
+
+def _block_sums(dosage: np.ndarray, statistics):
+    """Genotype indicator matrices and per phenotype (n, sum x, sum x²) of a SNP block."""
+    genotypes = (
+        (dosage == 2).astype(np.float64),
+        (dosage == 1).astype(np.float64),
+        (dosage >= 0).astype(np.float64),
+    )
+    counts = statistics.counts.astype(np.float64)
+    n = counts.sum(axis=2)
+    sx = counts[:, :, 1] + 2 * counts[:, :, 0]
+    sxx = counts[:, :, 1] + 4 * counts[:, :, 0]
+    return genotypes, n, sx, sxx
+
+
+class MaxTPermutation(SamplePermutation):
+    """
+    Vectorised max(T) permutation test of quantitative trait association, the in-process
+    equivalent of plink `--assoc mperm=N`.
+
+    For every block of SNPs and permutations the permuted |T| of all SNPs are obtained
+    from four matrix products; permutation blocks run on a thread pool.
+
+    Example:
+        >>> permutation = MaxTPermutation(phenotypes, 100_000)
+        >>> for _, dosage in reader.iter_chunks():
+        ...     permutation.add_block(dosage, qassoc_block(dosage, phenotypes))
+        >>> emp1, emp2 = permutation.empirical_p_values()
+    """
+
+    def __init__(self, phenotypes: np.ndarray, n_permutations: int, **kwargs) -> None:
+        """
+        Args:
+            phenotypes (np.ndarray): Phenotype matrix of shape `(n_samples, n_phenotypes)`,
+                NaN if missing.
+            n_permutations (int): Number of permutations.
+            **kwargs: `seed`, `n_workers` and `block_size` of `SamplePermutation`.
+        """
+        super().__init__(phenotypes, n_permutations, **kwargs)
+        self.max_t = np.full((n_permutations, self.n_phenotypes), -np.inf)
+        self._observed_t: list[np.ndarray] = []
+        self._exceed_counts: list[np.ndarray] = []
+
+    def add_block(self, dosage: np.ndarray, statistics) -> None:
+        """
+        Run all permutations on a block of SNPs.
+
+        Args:
+            dosage (np.ndarray): `np.int8` dosage matrix of shape `(n_variants, n_samples)`.
+            statistics (qassoc.QassocStatistics): Observed statistics of the block.
+        """
+        genotypes, n, sx, sxx = _block_sums(dosage, statistics)
+        observed_t = np.abs(statistics.t)
+        threshold = observed_t * (1 - _TIE_TOLERANCE)
+
+        def run(block_number: int) -> tuple[int, np.ndarray, np.ndarray]:
+            order = self.permutation_block(block_number)
+            exceed = np.zeros(observed_t.shape, dtype=np.int64)
+            block_max = np.full((order.shape[0], self.n_phenotypes), -np.inf)
+            for j in range(self.n_phenotypes):
+                t = self._permuted_t(genotypes, (n[:, j], sx[:, j], sxx[:, j]), order, j)
+                with np.errstate(invalid="ignore"):
+                    exceed[:, j] = (t >= threshold[:, j, None]).sum(axis=1)
+                defined = ~np.isnan(t)
+                if defined.any():
+                    block_max[:, j] = np.max(np.where(defined, t, -np.inf), axis=0)
+            return block_number, exceed, block_max
+
+        exceed_total = np.zeros(observed_t.shape, dtype=np.int64)
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            for block_number, exceed, block_max in pool.map(run, range(self.n_blocks)):
+                start, stop = self.block_bounds(block_number)
+                exceed_total += exceed
+                np.maximum(self.max_t[start:stop], block_max, out=self.max_t[start:stop])
+
+        self._observed_t.append(observed_t)
+        self._exceed_counts.append(exceed_total)
+
+    def empirical_p_values(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Empirical p-values of all SNPs added so far.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: (EMP1, EMP2), each of shape
+                `(n_variants, n_phenotypes)`. EMP1 is the pointwise p-value
+                `(R + 1) / (N + 1)`, EMP2 the family-wise p-value from the maximum |T| of
+                every permutation. Both are 1 for SNPs without a statistic.
+        """
+        if len(self._observed_t) == 0:
+            empty = np.empty((0, self.n_phenotypes))
+            return empty, empty
+        observed_t = np.concatenate(self._observed_t)
+        exceed = np.concatenate(self._exceed_counts)
+        emp1 = (exceed + 1) / (self.n_permutations + 1)
+
+        emp2 = np.empty_like(emp1)
+        for j in range(self.n_phenotypes):
+            sorted_max = np.sort(self.max_t[:, j])
+            threshold = np.nan_to_num(observed_t[:, j] * (1 - _TIE_TOLERANCE), nan=np.inf)
+            n_exceed = self.n_permutations - np.searchsorted(sorted_max, threshold, side="left")
+            emp2[:, j] = (n_exceed + 1) / (self.n_permutations + 1)
+
+        undefined = np.isnan(observed_t)
+        emp1[undefined] = 1.0
+        emp2[undefined] = 1.0
+        return emp1, emp2
+
+
+class AdaptivePermutation(SamplePermutation):
+    """
+    Adaptive permutation test of quantitative trait association, the in-process
+    equivalent of plink `--assoc perm`.
+
+    Permutations are run in blocks of growing size. After every block, a SNP stops being
+    permuted for a phenotype once the confidence interval of its empirical p-value lies
+    entirely above or below `alpha`, so that only borderline SNPs get up to
+    `n_permutations` permutations. Phenotypes of a block run on a thread pool; the result
+    does not depend on the number of threads.
+
+    Example:
+        >>> permutation = AdaptivePermutation(phenotypes, 1_000_000, alpha=0.05 / n_snps)
+        >>> for _, dosage in reader.iter_chunks():
+        ...     permutation.add_block(dosage, qassoc_block(dosage, phenotypes))
+        >>> emp1, n_permutations = permutation.empirical_p_values()
+    """
+
+    def __init__(
+        self,
+        phenotypes: np.ndarray,
+        n_permutations: int,
+        *,
+        alpha: float = 0.05,
+        min_permutations: int = 5,
+        **kwargs,
+    ) -> None:
+        """
+        Args:
+            phenotypes (np.ndarray): Phenotype matrix of shape `(n_samples, n_phenotypes)`,
+                NaN if missing.
+            n_permutations (int): Maximum number of permutations of a SNP.
+            alpha (float): Significance threshold the empirical p-values are compared with.
+            min_permutations (int): Minimum number of permutations before a SNP may stop.
+            **kwargs: `seed`, `n_workers` and `block_size` of `SamplePermutation`.
+        """
+        super().__init__(phenotypes, n_permutations, **kwargs)
+        self.alpha = alpha
+        self.min_permutations = min_permutations
+
+        self._block_starts = [0]
+        size = min(_ADAPTIVE_FIRST_BLOCK, self.block_size)
+        while self._block_starts[-1] < n_permutations:
+            self._block_starts.append(min(self._block_starts[-1] + size, n_permutations))
+            size = min(2 * size, self.block_size)
+
+        self._observed_t: list[np.ndarray] = []
+        self._exceed_counts: list[np.ndarray] = []
+        self._permutation_counts: list[np.ndarray] = []
+
+    def block_bounds(self, block_number: int) -> tuple[int, int]:
+        """First and last (exclusive) permutation of a block."""
+        return self._block_starts[block_number], self._block_starts[block_number + 1]
+
+    @property
+    def n_blocks(self) -> int:
+        """Number of permutation blocks."""
+        return len(self._block_starts) - 1
+
+    def add_block(self, dosage: np.ndarray, statistics) -> None:
+        """
+        Permute a block of SNPs until every SNP stops or reaches `n_permutations`.
+
+        Args:
+            dosage (np.ndarray): `np.int8` dosage matrix of shape `(n_variants, n_samples)`.
+            statistics (qassoc.QassocStatistics): Observed statistics of the block.
+        """
+        genotypes, n, sx, sxx = _block_sums(dosage, statistics)
+        observed_t = np.abs(statistics.t)
+        threshold = observed_t * (1 - _TIE_TOLERANCE)
+        exceed = np.zeros(observed_t.shape, dtype=np.int64)
+        done = np.zeros(observed_t.shape, dtype=np.int64)
+        active = ~np.isnan(observed_t)
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            for block_number in range(self.n_blocks):
+                if not active.any():
+                    break
+                order = self.permutation_block(block_number)
+
+                def run(j: int) -> tuple[int, np.ndarray, np.ndarray]:
+                    rows = np.flatnonzero(active[:, j])
+                    t = self._permuted_t(
+                        tuple(genotype[rows] for genotype in genotypes),  # type: ignore
+                        (n[rows, j], sx[rows, j], sxx[rows, j]),
+                        order,
+                        j,
+                    )
+                    with np.errstate(invalid="ignore"):
+                        return j, rows, (t >= threshold[rows, j, None]).sum(axis=1)
+
+                columns = [j for j in range(self.n_phenotypes) if active[:, j].any()]
+                for j, rows, n_exceed in pool.map(run, columns):
+                    exceed[rows, j] += n_exceed
+                    done[rows, j] += order.shape[0]
+
+                p_hat = (exceed + 1) / (done + 1)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    margin = _ADAPTIVE_Z * np.sqrt(p_hat * (1 - p_hat) / done)
+                settled = (done >= self.min_permutations) & (
+                    (p_hat - margin > self.alpha) | (p_hat + margin < self.alpha)
+                )
+                active &= ~settled
+
+        self._observed_t.append(observed_t)
+        self._exceed_counts.append(exceed)
+        self._permutation_counts.append(done)
+
+    def empirical_p_values(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Empirical p-values of all SNPs added so far.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: (EMP1, NP), each of shape
+                `(n_variants, n_phenotypes)`. EMP1 is the pointwise p-value
+                `(R + 1) / (NP + 1)`, NP the number of permutations the SNP received.
+                EMP1 is 1 and NP 0 for SNPs without a statistic.
+        """
+        if len(self._observed_t) == 0:
+            empty = np.empty((0, self.n_phenotypes))
+            return empty, empty.astype(np.int64)
+        observed_t = np.concatenate(self._observed_t)
+        done = np.concatenate(self._permutation_counts)
+        emp1 = (np.concatenate(self._exceed_counts) + 1) / (done + 1)
+        emp1[np.isnan(observed_t)] = 1.0
+        return emp1, done
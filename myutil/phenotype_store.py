@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import os
+
+import polars as pl
+
+from myutil.small_tools import create_logger
+
+logger = create_logger("PhenotypeStoreLogger", level=logging.WARN)
+
+DEFAULT_STORE_DIR = "./phenotype_store"
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+EXCEL_EXTENSIONS = (".xlsx", ".xls")
+
+_DIGESTS_FILE = "file_digests.json"
+# digests hashed since the digests file was last written, one JSON line each
+_DIGESTS_JOURNAL = "file_digests.jsonl"
+
+
+def content_hash(path: str, *options: str) -> str:
+    """
+    Hash the content of a file together with the options used to read it.
+
+    Args:
+        path (str): Path of the file.
+        *options (str): Reader options which change the parsed table, e.g. the separator.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as reader:
+        while block := reader.read(_HASH_BLOCK_SIZE):
+            digest.update(block)
+    for option in options:
+        digest.update(b"\0" + option.encode())
+    return digest.hexdigest()
+
+
+class FileDigests(object):
+    """
+    Content hashes of files, remembered by real path, size and modification time, so that
+    a file is only read again once it changed.
+
+    The digests are kept in `file_digests.json` under a directory. New digests are
+    appended to a journal as they are hashed, which is folded into the digests file
+    when the digests are loaded again.
+    """
+
+    def __init__(self, directory: str | None) -> None:
+        """
+        Args:
+            directory (str | None): Directory of the digests file. None keeps the digests
+                in memory only.
+        """
+        self.directory = directory
+        # {real path: [size, mtime_ns, digest]}
+        self._digests: dict[str, list] = {}
+        if directory is None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        digests_path = os.path.join(directory, _DIGESTS_FILE)
+        if os.path.exists(digests_path):
+            try:
+                with open(digests_path) as reader:
+                    self._digests = json.load(reader)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring unreadable %s: %s", digests_path, e)
+        journal_path = os.path.join(directory, _DIGESTS_JOURNAL)
+        if os.path.exists(journal_path):
+            with open(journal_path) as reader:
+                for line in reader:
+                    try:
+                        real_path, *entry = json.loads(line)
+                    except ValueError:
+                        # the line being written when the run was killed
+                        continue
+                    self._digests[real_path] = entry
+            self.save()
+
+    def digest(self, path: str | os.PathLike) -> str:
+        """
+        Digest of the content of a file, see `content_hash`.
+
+        Raises:
+            FileNotFoundError: if `path` does not exist.
+        """
+        real_path = os.path.realpath(path)
+        stat = os.stat(real_path)
+        match self._digests.get(real_path):
+            case [size, mtime_ns, str() as digest] if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+                return digest
+        digest = content_hash(real_path)
+        self._digests[real_path] = [stat.st_size, stat.st_mtime_ns, digest]
+        if self.directory is not None:
+            with open(os.path.join(self.directory, _DIGESTS_JOURNAL), "a") as writer:
+                writer.write(json.dumps([real_path, *self._digests[real_path]]) + "\n")
+        return digest
+
+    def save(self) -> None:
+        """Write all remembered digests to the digests file and empty the journal."""
+        if self.directory is None:
+            return
+        temp_path = os.path.join(self.directory, f"{_DIGESTS_FILE}.{os.getpid()}.tmp")
+        with open(temp_path, "w") as writer:
+            json.dump(self._digests, writer)
+        os.replace(temp_path, os.path.join(self.directory, _DIGESTS_FILE))
+        journal_path = os.path.join(self.directory, _DIGESTS_JOURNAL)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
+
+def _default_separator(path: str) -> str:
+    return "\t" if path.endswith(".tsv") else ","
+
+
+def _read_raw_table(path: str, separator: str) -> pl.LazyFrame:
+    """Read a csv/tsv/xls(x) table with every column as string."""
+    if path.endswith(EXCEL_EXTENSIONS):
+        return pl.read_excel(path, infer_schema_length=0).lazy()
+    return pl.scan_csv(
+        path, separator=separator, infer_schema=False, truncate_ragged_lines=True
+    )
+
+
+def scan_table(
+    path: str,
+    separator: str | None = None,
+    store_dir: str | None = DEFAULT_STORE_DIR,
+) -> pl.LazyFrame:
+    """
+    Lazily read a phenotype, ethnic or gender table through the Parquet store.
+
+    The first time a file is read it is converted to Parquet under `store_dir`, keyed
+    by the hash of its content and the separator; later reads of the same content scan
+    the Parquet file, so only the selected columns and the rows matching the filters
+    are loaded. The content is only hashed again once the size or modification time of
+    the file changed (see `FileDigests`). Every column is read as string, as the csv
+    readers do with `infer_schema=False`.
+
+    Args:
+        path (str): Path of a .csv/.tsv/.xls(x) file. Other extensions are read as csv.
+        separator (str | None): Field separator of csv files. Defaults to tab for .tsv
+            files and comma otherwise.
+        store_dir (str | None): Directory of the Parquet store. None reads the file
+            directly without converting it.
+
+    Returns:
+        pl.LazyFrame: The table.
+
+    Raises:
+        FileNotFoundError: if `path` does not exist.
+
+    Generate Files:
+        %(store_dir)s/%(hash)s.parquet
+        %(store_dir)s/file_digests.json
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Table {path} does not exist.")
+    separator = _default_separator(path) if separator is None else separator
+    if store_dir is None:
+        return _read_raw_table(path, separator)
+
+    # the file is only hashed again when its size or modification time changed
+    key = hashlib.blake2b(digest_size=16)
+    key.update(f"{FileDigests(store_dir).digest(path)}\0{separator}".encode())
+    store_path = os.path.join(store_dir, f"{key.hexdigest()}.parquet")
+    if os.path.exists(store_path):
+        logger.debug("Reading %s from the phenotype store: %s", path, store_path)
+        return pl.scan_parquet(store_path)
+
+    logger.info("Converting %s into the phenotype store: %s", path, store_path)
+    os.makedirs(store_dir, exist_ok=True)
+    # write to a temporary file first so that concurrent readers never see a partial file
+    temp_path = f"{store_path}.{os.getpid()}.tmp"
+    table = _read_raw_table(path, separator)
+    try:
+        if path.endswith(EXCEL_EXTENSIONS):
+            table.collect().write_parquet(temp_path)
+        else:
+            table.sink_parquet(temp_path)
+        os.replace(temp_path, store_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return pl.scan_parquet(store_path)
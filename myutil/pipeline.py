@@ -0,0 +1,512 @@
+import functools
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any
+
+from Classes import FileManagement, Gender, PhenotypeColumn, VirtualSubset, as_subset
+from myutil import association_analysis, mds, quality_control, small_tools
+import myutil.visualisations as vislz
+from myutil.genotype import DEFAULT_CHUNK_BYTES
+from myutil.run_manifest import RunManifest
+from myutil.scheduler import (
+    PLINK_BASE_MEMORY, Job, Pipeline, estimate_plink_memory, job_memory, job_threads
+)
+from myutil.stage_cache import StageCache, fileset_files, prefix_files
+from myutil.small_tools import create_logger
+
+logger = create_logger("PipelineLogger", level=logging.WARN)
+
+GROUP_STEPS = (
+    "quality_control", "snp_counts", "pca", "association", "regression", "association_visualisation"
+)
+"""Steps every population group goes through, in order."""
+
+
+@dataclass
+class GroupResult:
+    """
+    Result of the pipeline of one population group.
+
+    Attributes:
+        group (tuple[Gender, str, str | VirtualSubset]): (gender, ethnic, fileset) of the
+            group after quality control.
+        bonferroni_n (int): Number of tests of the Bonferroni correction: the number of
+            independent SNPs with `--ld-correct`, of all SNPs otherwise.
+        pca_output (str | None): `.eigenvec` file of the group, if PCA was performed.
+        association_outputs (list[tuple[Gender, str, str, str]]):
+            (gender, ethnic, phenotype, output prefix) of every association result.
+        regression_outputs (list[tuple[Gender, str, str, str]]):
+            (gender, ethnic, phenotype, output prefix) of every regression result.
+    """
+    group: tuple[Gender, str, str | VirtualSubset]
+    bonferroni_n: int
+    pca_output: str | None = None
+    association_outputs: list[tuple[Gender, str, str, str]] = field(default_factory=list)
+    regression_outputs: list[tuple[Gender, str, str, str]] = field(default_factory=list)
+
+
+class _GroupJournal(object):
+    """
+    Steps of one group recorded as items of a run manifest stage.
+
+    A step is restored as long as every earlier step of the group was restored; the
+    records of the later steps of a group whose step runs again are discarded.
+    """
+
+    def __init__(self, manifest: RunManifest, stage: str, group_key: str, restored: dict[str, Any]) -> None:
+        self.manifest = manifest
+        self.stage = stage
+        self.group_key = group_key
+        self.restored = restored
+        # step which runs again, None while every step was restored
+        self.rerun_step: str | None = None
+
+    def _key(self, step: str, phenotype: str | None = None) -> str:
+        return f"{step}/{self.group_key}" if phenotype is None else f"{step}/{self.group_key}/{phenotype}"
+
+    def restore(self, step: str) -> Any | None:
+        """Recorded state of a step, or None if the step has to run."""
+        if self.rerun_step is not None:
+            return None
+        if (state := self.restored.get(self._key(step))) is not None:
+            return state
+        self.rerun_step = step
+        for key in self.restored:
+            key_step, group_key, *phenotype = key.split("/", 2)
+            if group_key != self.group_key:
+                continue
+            # the finished phenotypes of the step which runs again are kept
+            if GROUP_STEPS.index(key_step) > GROUP_STEPS.index(step) or \
+                    (key_step == step and len(phenotype) == 0):
+                self.manifest.discard_item(self.stage, key)
+        return None
+
+    def results(self, step: str) -> dict[str, Any]:
+        """Recorded results of the phenotypes of the step which runs again, by phenotype."""
+        if step != self.rerun_step:
+            return {}
+        prefix = f"{self._key(step)}/"
+        return {
+            key.removeprefix(prefix): item for key, item in self.restored.items() if key.startswith(prefix)
+        }
+
+    def record(self, step: str, state: Any, files: list[str]) -> None:
+        self.manifest.record_item(self.stage, self._key(step), state, files)
+
+    def record_result(self, step: str, phenotype: str, output: Any, files: list[str]) -> None:
+        self.manifest.record_item(self.stage, self._key(step, phenotype), output, files)
+
+
+def _visualisation(
+    cache: StageCache, stage: str, group: tuple, save_path: str, function, *args: Any, **kwargs: Any
+) -> Pipeline:
+    return cache.job(
+        cache.key(stage, fileset_files(group[2]), group, save_path),
+        lambda _: prefix_files(save_path),
+        Job(function, args, kwargs, memory=estimate_plink_memory(as_subset(group[2]).bfile)),
+        allow_none=True,
+    )
+
+
+def _save_path(group: tuple, folder: str, suffix: str = "") -> str:
+    return os.path.join(
+        os.path.dirname(group[2]), "../", folder, os.path.basename(group[2]) + suffix
+    )
+
+
+def _quality_control(fm: FileManagement, cache: StageCache, group: tuple) -> Pipeline:
+    """Visualise and filter missingness, HWE and MAF; the filtered group, None if it failed."""
+    gender, ethnic, file = group
+
+    def filtering(stage: str, function, out: str, *params: Any, **kwargs: Any) -> Pipeline:
+        return cache.job(
+            cache.key(stage, fileset_files(group[2]), group, *params),
+            lambda result: fileset_files(result[2]),
+            Job(
+                function, (fm, group[2], out, group[0], group[1]), kwargs,
+                memory=estimate_plink_memory(as_subset(group[2]).bfile),
+            ),
+        )
+
+    if fm.qc_engine != "plink":
+        # fused filtering of missingness, HWE and MAF; every visualisation shows the input
+        save_paths = [
+            _save_path(group, "missingness_visualisations"),
+            _save_path(group, "hwe_visualisation", "hwe"),
+            _save_path(group, "maf_visualisation", "_maf"),
+        ]
+        *_, group = yield [
+            _visualisation(
+                cache, "missingness_visualisation", group, save_paths[0],
+                vislz.minor_allele_frequency, fm, file, save_paths[0], gender=gender, ethnic=ethnic,
+            ),
+            _visualisation(
+                cache, "hwe_visualisation", group, save_paths[1],
+                vislz.hardy_weinberg, fm, file, save_paths[1], ethnic, gender,
+            ),
+            _visualisation(
+                cache, "maf_visualisation", group, save_paths[2],
+                vislz.minor_allele_frequency, fm, file, save_paths[2], gender=gender, ethnic=ethnic,
+            ),
+            cache.job(
+                cache.key(
+                    "fused_quality_control", fileset_files(file), group,
+                    0.02, 1e-6, 0.01, fm.materialise_groups,
+                ),
+                lambda result: fileset_files(result[2]),
+                Job(
+                    quality_control.fused_quality_control,
+                    (fm, file, f"{file}_qc", gender, ethnic),
+                    dict(
+                        missingness_threshold=0.02,
+                        hwe_threshold=1e-6,
+                        maf_threshold=0.01,
+                        make_bed=fm.materialise_groups,
+                    ),
+                    # the genotypes are streamed in blocks of `DEFAULT_CHUNK_BYTES`
+                    memory=PLINK_BASE_MEMORY + 4 * DEFAULT_CHUNK_BYTES,
+                ),
+            ),
+        ]
+        return group
+
+    # every filter runs alongside the visualisation of its input
+    save_path = _save_path(group, "missingness_visualisations")
+    _, group = yield [
+        _visualisation(
+            cache, "missingness_visualisation", group, save_path,
+            vislz.minor_allele_frequency, fm, group[2], save_path, gender=group[0], ethnic=group[1],
+        ),
+        filtering(
+            "missingness_filter", quality_control.filter_high_missingness, f"{group[2]}_no_miss",
+            0.02, missingness_threshold=0.02,
+        ),
+    ]
+    if group is None:
+        return None
+    save_path = _save_path(group, "hwe_visualisation", "hwe")
+    _, group = yield [
+        _visualisation(
+            cache, "hwe_visualisation", group, save_path,
+            vislz.hardy_weinberg, fm, group[2], save_path, group[1], group[0],
+        ),
+        filtering("hwe_filter", quality_control.filter_hwe, f"{group[2]}_hwe"),
+    ]
+    if group is None:
+        return None
+    save_path = _save_path(group, "maf_visualisation", "_maf")
+    _, group = yield [
+        _visualisation(
+            cache, "maf_visualisation", group, save_path,
+            vislz.minor_allele_frequency, fm, group[2], save_path, gender=group[0], ethnic=group[1],
+        ),
+        filtering(
+            "maf_filter", quality_control.filter_maf, f"{group[2]}_maf", 0.01, maf_threshold=0.01,
+        ),
+    ]
+    return group
+
+
+def _batch_jobs(
+    cache: StageCache,
+    journal: _GroupJournal,
+    step: str,
+    keys: list[str],
+    phenotypes: list[str],
+    make_job,
+    batch_size: int | None = None,
+) -> Pipeline:
+    """
+    Run the phenotypes of a batch whose results are neither cached nor recorded in the
+    journal as one job, or as concurrent jobs of at most `batch_size` phenotypes; the
+    results of all phenotypes.
+    """
+    finished = journal.results(step)
+    cached, pending = cache.partition(keys)
+    cached.update(
+        (index, finished[phenotypes[index]]) for index in pending if phenotypes[index] in finished
+    )
+    pending = [index for index in pending if index not in cached]
+    outputs = list(cached.values())
+    if len(pending) == 0:
+        return outputs
+    if batch_size is None or len(pending) <= batch_size:
+        result = yield make_job(pending)
+    else:
+        results = yield [
+            make_job(pending[start:start + batch_size])
+            for start in range(0, len(pending), batch_size)
+        ]
+        result = [output for batch_result in results for output in batch_result]
+    pending_keys = {phenotypes[index]: keys[index] for index in pending}
+    for output in result:
+        result_files = prefix_files(f"{output[3]}.")
+        cache.store(pending_keys[output[2]], output, result_files)
+        journal.record_result(step, output[2], output, result_files)
+    return outputs + result
+
+
+def group_pipeline(
+    fm: FileManagement,
+    cache: StageCache,
+    manifest: RunManifest,
+    restored: dict[str, Any],
+    group: tuple[Gender, str, str | VirtualSubset],
+    pheno_files: list[tuple[str, str | PhenotypeColumn]],
+    pheno_digests: dict[str, str],
+    pheno_types: dict[str, str],
+) -> Pipeline:
+    """
+    Pipeline of one population group: quality control, LD pruning, PCA, association,
+    regression and visualisation of the association results.
+
+    Every step is cached by `cache` and recorded in `manifest` as an item of the
+    "analysis" stage, so that an interrupted run resumes from the last finished step of
+    every group.
+
+    Args:
+        fm (FileManagement): Settings of the run.
+        cache (StageCache): Cache of the jobs.
+        manifest (RunManifest): Journal of the run.
+        restored (dict[str, Any]): Items of the "analysis" stage restored from `manifest`.
+        group (tuple[Gender, str, str | VirtualSubset]): (gender, ethnic, fileset) of the group.
+        pheno_files (list[tuple[str, str | PhenotypeColumn]]):
+            (phenotype name, phenotype file or matrix column) of every phenotype.
+        pheno_digests (dict[str, str]): Digest of every phenotype, see
+            `stage_cache.phenotype_digests`; empty if the cache is disabled.
+        pheno_types (dict[str, str]): "quantitative" or "binary" type of every phenotype;
+            only used with `fm.linear`.
+
+    Returns:
+        GroupResult | None: Result of the group, None if its quality control failed.
+    """
+    gender, ethnic, _ = group
+    journal = _GroupJournal(manifest, "analysis", f"{gender}-{ethnic}", restored)
+
+    if (state := journal.restore("quality_control")) is not None:
+        group = state["group"]
+    else:
+        group = yield from _quality_control(fm, cache, group)
+        journal.record("quality_control", {"group": group}, [] if group is None else fileset_files(group[2]))
+    if group is None:
+        logger.error("Quality control of %s-%s failed.", gender, ethnic)
+        return None
+    gender, ethnic, file = group
+
+    # the pruned SNP set is both the N of Bonferroni correction and the input of PCA
+    if (state := journal.restore("snp_counts")) is not None:
+        indep_in_path, bonferroni_n = state["indep_in_path"], state["bonferroni_n"]
+    else:
+        indep_in_path = None
+        if fm.ld_correct_bonferroni or fm.pca is not None:
+            os.makedirs("ld_pruning", exist_ok=True)
+            prefix = yield from cache.job(
+                cache.key("ld_pruning", fileset_files(file), file, gender, ethnic, 500),
+                lambda prefix: [f"{prefix}.prune.in", f"{prefix}.prune.out"],
+                Job(
+                    quality_control.ld_pruning,
+                    (fm.plink, file, f"ld_pruning/indepSNP_{gender}-{ethnic}"),
+                    dict(window_size=500),
+                    memory=estimate_plink_memory(as_subset(file).bfile),
+                ),
+            )
+            if prefix is None:
+                logger.error("LD pruning of %s-%s failed.", gender, ethnic)
+                return None
+            indep_in_path = f"{prefix}.prune.in"
+        bonferroni_n = small_tools.count_line(indep_in_path) if fm.ld_correct_bonferroni \
+            else as_subset(file).n_variants()
+        journal.record(
+            "snp_counts", {"indep_in_path": indep_in_path, "bonferroni_n": bonferroni_n},
+            [] if indep_in_path is None else [indep_in_path],
+        )
+
+    pca_output = None
+    if fm.pca is not None:
+        if (state := journal.restore("pca")) is not None:
+            pca_output = state["pca_output"]
+        else:
+            os.makedirs("PCA", exist_ok=True)
+            out = os.path.join("PCA", f"{os.path.basename(file)}_PCA")
+            pca_output = yield from cache.job(
+                cache.key(
+                    "pca", fileset_files(file) + [indep_in_path], file, gender, ethnic, fm.pca, fm.pca_engine,
+                ),
+                lambda eigenvec: [eigenvec, f"{os.path.splitext(eigenvec)[0]}.eigenval"],
+                Job(
+                    mds.randomised_principal_component_analysis,
+                    (file, indep_in_path, out, gender, ethnic, fm.pca),
+                    memory=mds.estimate_pca_memory(file, fm.pca),
+                ) if fm.pca_engine == "native" else Job(
+                    mds.principle_component_analysis,
+                    (fm.plink, file, indep_in_path, out, gender, ethnic, fm.pca),
+                    # plink holds the samples × samples relationship matrix
+                    memory=estimate_plink_memory(as_subset(file).bfile)
+                        + 8 * as_subset(file).fam().height ** 2,
+                ),
+            )
+            journal.record(
+                "pca", {"pca_output": pca_output},
+                [] if pca_output is None else [pca_output, f"{os.path.splitext(pca_output)[0]}.eigenval"],
+            )
+
+    # every population fileset is scanned once for all phenotypes whose results are not
+    # cached yet or finished before the run was interrupted
+    engine = fm.assoc_engine
+    if (state := journal.restore("association")) is not None:
+        association_outputs = state["outputs"]
+    else:
+        alpha = fm.alpha / bonferroni_n
+        output_names = [
+            os.path.join("assoc_results", f"{os.path.basename(file)}_{phenotype_name}")
+            for phenotype_name, _ in pheno_files
+        ]
+        keys = [
+            cache.key(
+                "association", fileset_files(file), file, gender, ethnic,
+                phenotype_name, pheno_digests.get(phenotype_name), output_name,
+                fm.calc_perm, engine, fm.perm_seed, fm.perm_mode, alpha,
+            ) for (phenotype_name, _), output_name in zip(pheno_files, output_names)
+        ]
+        # the permutation threads of a job are fixed here, so that its memory estimate
+        # holds whatever share of the threads it is granted
+        n_workers = job_threads() or os.cpu_count() or 1
+        # e.g. the max(T) statistics of all phenotypes may not fit in the budget at once
+        budget = job_memory()
+        batch_size = None if budget is None else association_analysis.association_batch_size(
+            file, budget, engine, fm.calc_perm, fm.perm_mode, n_workers
+        )
+        association_outputs = yield from _batch_jobs(
+            cache, journal, "association", keys, [phenotype_name for phenotype_name, _ in pheno_files],
+            lambda pending: Job(
+                association_analysis.batch_quantitative_association,
+                (
+                    fm.plink,
+                    file,
+                    [pheno_files[index] for index in pending],
+                    [output_names[index] for index in pending],
+                    gender,
+                    ethnic,
+                ),
+                dict(
+                    mperm=fm.calc_perm,
+                    engine=engine,
+                    seed=fm.perm_seed,
+                    perm_mode=fm.perm_mode,
+                    alpha=alpha,
+                    n_workers=n_workers,
+                ),
+                memory=association_analysis.estimate_association_memory(
+                    file, len(pending), engine, fm.calc_perm, fm.perm_mode, n_workers
+                ),
+            ),
+            batch_size=batch_size,
+        )
+        journal.record("association", {"outputs": association_outputs}, [
+            path for *_, out_prefix in association_outputs for path in prefix_files(f"{out_prefix}.")
+        ])
+
+    ## Covariate-adjusted regression: linear for quantitative, logistic for binary phenotypes
+    regression_outputs = []
+    if fm.linear:
+        if (state := journal.restore("regression")) is not None:
+            regression_outputs = state["outputs"]
+        else:
+            covariate_paths = [
+                path for path in (pca_output, fm.covariate_file_path) if path is not None
+            ]
+
+            def regression_job(batch_function, typed_pheno_files, output_names, pending) -> Job:
+                return Job(
+                    batch_function,
+                    (
+                        fm.plink,
+                        file,
+                        [typed_pheno_files[index] for index in pending],
+                        [output_names[index] for index in pending],
+                        gender,
+                        ethnic,
+                        covariate_paths,
+                        engine,
+                    ),
+                    memory=association_analysis.estimate_association_memory(
+                        file, len(pending), engine
+                    ),
+                )
+
+            batches = []
+            for pheno_type, batch_function in (
+                ("quantitative", association_analysis.batch_linear_regression),
+                ("binary", association_analysis.batch_logistic_regression),
+            ):
+                typed_pheno_files = [
+                    (phenotype_name, path) for phenotype_name, path in pheno_files
+                    if pheno_types[phenotype_name] == pheno_type
+                ]
+                output_names = [
+                    os.path.join("assoc_results", f"{os.path.basename(file)}_{phenotype_name}")
+                    for phenotype_name, _ in typed_pheno_files
+                ]
+                keys = [
+                    cache.key(
+                        "regression", fileset_files(file) + covariate_paths, file, gender, ethnic,
+                        phenotype_name, pheno_digests.get(phenotype_name), output_name, engine,
+                    ) for (phenotype_name, _), output_name in zip(typed_pheno_files, output_names)
+                ]
+                batches.append(_batch_jobs(
+                    cache, journal, "regression", keys,
+                    [phenotype_name for phenotype_name, _ in typed_pheno_files],
+                    functools.partial(regression_job, batch_function, typed_pheno_files, output_names),
+                ))
+            for outputs in (yield batches):
+                regression_outputs.extend(outputs)
+            journal.record("regression", {"outputs": regression_outputs}, [
+                path for *_, out_prefix in regression_outputs for path in prefix_files(f"{out_prefix}.")
+            ])
+
+    if journal.restore("association_visualisation") is None:
+        jobs = []
+        for output in association_outputs:
+            if fm.calc_perm and fm.perm_mode == "maxt":
+                jobs.append(Job(
+                    vislz.assoc_mperm_visualisation,
+                    (
+                        f"{output[3]}",
+                        os.path.join("assoc_pictures", os.path.basename(output[3])),
+                    ),
+                    dict(
+                        gender=output[0],
+                        ethnic_name=output[1],
+                        phenotype_name=output[2],
+                        n=bonferroni_n,
+                        alpha=fm.alpha,
+                    ),
+                ))
+            else:
+                jobs.append(Job(
+                    vislz.assoc_visualisation,
+                    (
+                        f"{output[3]}.qassoc",
+                        os.path.join(
+                            "assoc_pictures", f"{os.path.basename(output[3])}_assoc"
+                        ),
+                        *output[0:3],
+                    ),
+                    dict(n=bonferroni_n, alpha=fm.alpha),
+                ))
+        # a visualisation is saved under its second argument
+        yield [
+            cache.job(
+                cache.key("association_visualisation", prefix_files(f"{output[3]}."), job.args, job.kwargs),
+                lambda _, job=job: prefix_files(job.args[1]),
+                job,
+                allow_none=True,
+            ) for output, job in zip(association_outputs, jobs)
+        ]
+        journal.record(
+            "association_visualisation", {},
+            [path for job in jobs for path in prefix_files(job.args[1])],
+        )
+
+    return GroupResult(group, bonferroni_n, pca_output, association_outputs, regression_outputs)
@@ -0,0 +1,105 @@
+import logging
+import os
+
+import numpy as np
+import polars as pl
+
+from myutil.small_tools import create_logger
+
+logger = create_logger("PlinkTableLogger", level=logging.WARN)
+
+PLINK_NULL_VALUES = ["NA", "Na", "na", "", "NaN", "nan", "NAN", "Nan"]
+"""Values plink writes for statistics which cannot be calculated."""
+
+_SPACE, _TAB, _NEWLINE, _CARRIAGE_RETURN = (ord(character) for character in " \t\n\r")
+
+
+def normalise_whitespace(data: bytes) -> bytes:
+    """
+    Turn the whitespace-aligned columns of a plink text output into single-space
+    separated ones: runs of spaces and tabs become one space, and blanks at the start and
+    end of lines are removed.
+
+    The bytes are processed as a NumPy array in a few vectorised passes, without
+    splitting the lines.
+
+    Args:
+        data (bytes): Content of the file.
+
+    Returns:
+        bytes: Normalised content.
+    """
+    if len(data) == 0:
+        return data
+    text = np.frombuffer(data, dtype=np.uint8)
+    blank = (text == _SPACE) | (text == _TAB)
+    # a blank is kept only as the first of a run which does not start a line
+    after_separator = np.empty_like(blank)
+    after_separator[0] = True
+    after_separator[1:] = blank[:-1] | (text[:-1] == _NEWLINE)
+    text = np.where(blank, _SPACE, text).astype(np.uint8)[~blank | ~after_separator]
+    if len(text) == 0:
+        # only blanks
+        return b""
+    # and not at the end of a line
+    before_end = np.empty(len(text), dtype=bool)
+    before_end[-1] = True
+    before_end[:-1] = (text[1:] == _NEWLINE) | (text[1:] == _CARRIAGE_RETURN)
+    return text[~((text == _SPACE) & before_end)].tobytes()
+
+
+def read_plink_table(
+    path: str,
+    new_columns: list[str] | None = None,
+    dtypes: dict[str, pl.DataType] | None = None,
+    null_values: list[str] = PLINK_NULL_VALUES,
+    infer_schema: bool = False,
+) -> pl.DataFrame:
+    """
+    Read a whitespace-aligned plink text output with a header line, e.g. `.qassoc`,
+    `.qassoc.mperm`, `.qassoc.perm`, `.qassoc.means` or `.assoc`.
+
+    The content is normalised with `normalise_whitespace` and tokenised by the polars
+    csv reader straight into columns, which are then cast to their types.
+
+    Args:
+        path (str): Path of the file.
+        new_columns (list[str] | None): Names of the columns, replacing those of the
+            header line. The file must have exactly these many columns.
+        dtypes (dict[str, pl.DataType] | None): Types of columns; values which cannot be
+            cast become null.
+        null_values (list[str]): Values read as null.
+        infer_schema (bool): Infer the types of the other columns, which are read as
+            strings otherwise.
+
+    Returns:
+        pl.DataFrame: The table.
+
+    Raises:
+        FileNotFoundError: if `path` does not exist.
+        ValueError: if the number of columns differs from `new_columns`.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"File '{path}' not found.")
+    logger.debug("Reading plink table %s", path)
+    with open(path, "rb") as reader:
+        content = normalise_whitespace(reader.read())
+    table = pl.read_csv(
+        content,
+        separator=" ",
+        has_header=True,
+        quote_char=None,
+        null_values=null_values,
+        infer_schema=infer_schema,
+    )
+    if new_columns is not None:
+        if table.width != len(new_columns):
+            raise ValueError(
+                f"Expected {len(new_columns)} columns in '{path}', found {table.width}: {table.columns}"
+            )
+        table.columns = new_columns
+    if dtypes:
+        table = table.with_columns(
+            pl.col(name).cast(dtype, strict=False) for name, dtype in dtypes.items()
+        )
+    return table
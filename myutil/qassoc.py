@@ -0,0 +1,466 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from Classes import PhenotypeColumn, VirtualSubset, as_subset, group_matrix_columns
+from myutil.genotype import BedReader
+from myutil.small_tools import create_logger
+from myutil.permutation import DEFAULT_PERMUTATION_SEED, AdaptivePermutation, MaxTPermutation
+from myutil.stat_tools import regression_from_sums, t_two_sided_p
+
+logger = create_logger("QassocLogger", level=logging.WARN)
+
+QASSOC_HEADERS = ["CHR", "SNP", "BP", "NMISS", "BETA", "SE", "R2", "T", "P"]
+QASSOC_MEANS_HEADERS = ["CHR", "SNP", "VALUE", "G11", "G12", "G22"]
+MPERM_HEADERS = ["CHR", "SNP", "EMP1", "EMP2"]
+
+# genotype classes of the `.qassoc.means` columns G11, G12, G22, as A1 dosages
+_MEANS_DOSAGES = (2, 1, 0)
+
+
+@dataclass
+class QassocStatistics:
+    """
+    Per SNP and phenotype statistics of `plink --assoc` on a quantitative trait.
+    Every array has shape `(n_variants, n_phenotypes)`.
+
+    Attributes:
+        nmiss (np.ndarray): Number of samples with both genotype and phenotype.
+        beta (np.ndarray): Regression coefficient of the A1 allele count.
+        se (np.ndarray): Standard error of `beta`.
+        r2 (np.ndarray): Coefficient of determination.
+        t (np.ndarray): Wald t statistic.
+        p (np.ndarray): Two-sided p-value of `t` with `nmiss - 2` degrees of freedom.
+        counts (np.ndarray): Samples per genotype class (G11, G12, G22), of shape
+            `(n_variants, n_phenotypes, 3)`.
+        means (np.ndarray): Phenotype mean per genotype class, same shape as `counts`.
+        sds (np.ndarray): Phenotype standard deviation per genotype class, same shape as
+            `counts`.
+    """
+
+    nmiss: np.ndarray
+    beta: np.ndarray
+    se: np.ndarray
+    r2: np.ndarray
+    t: np.ndarray
+    p: np.ndarray
+    counts: np.ndarray
+    means: np.ndarray
+    sds: np.ndarray
+
+
+def _missing_phenotypes(columns: list[str]) -> list[pl.Expr]:
+    """Cast phenotype columns to Float64, `-9` and non-numeric values being null."""
+    return [
+        pl.when(pl.col(column).cast(pl.Float64, strict=False) == -9).then(None)
+        .otherwise(pl.col(column).cast(pl.Float64, strict=False)).alias(column)
+        for column in columns
+    ]
+
+
+def read_phenotype_columns(matrix_path: str, names: list[str]) -> pl.DataFrame:
+    """
+    Read some phenotypes of a phenotype matrix.
+
+    The matrix is whitespace delimited with a `FID IID <phenotype> ...` header line.
+
+    Args:
+        matrix_path (str): Path to the phenotype matrix.
+        names (list[str]): Headers of the phenotype columns to read.
+
+    Returns:
+        pl.DataFrame: Columns FID, IID (strings) and `names` (Float64, null if missing).
+    """
+    if not os.path.exists(matrix_path):
+        raise FileNotFoundError(f"File '{matrix_path}' not found.")
+    names = list(dict.fromkeys(names))
+    pheno_df = pd.read_csv(
+        matrix_path, sep=r"\s+", header=0, dtype=str, usecols=["FID", "IID", *names]
+    )[["FID", "IID", *names]]
+    return pl.from_pandas(pheno_df).with_columns(*_missing_phenotypes(names))
+
+
+def read_phenotype_file(phenotype_info_path: str | PhenotypeColumn) -> pl.DataFrame:
+    """
+    Read a plink `--pheno` file.
+
+    The file is whitespace delimited with FID, IID and the phenotype in its first three
+    columns, optionally preceded by a `FID IID ...` header line. `-9` and non-numeric
+    values are missing, as in plink.
+
+    Args:
+        phenotype_info_path (str | PhenotypeColumn): Path to the phenotype file, or a
+            column of a phenotype matrix.
+
+    Returns:
+        pl.DataFrame: Columns FID, IID (strings) and phenotype (Float64, null if missing).
+    """
+    if isinstance(phenotype_info_path, PhenotypeColumn):
+        return read_phenotype_columns(
+            phenotype_info_path.path, [phenotype_info_path.name]
+        ).rename({phenotype_info_path.name: "phenotype"})
+    if not os.path.exists(phenotype_info_path):
+        raise FileNotFoundError(f"File '{phenotype_info_path}' not found.")
+    pheno_df = pd.read_csv(
+        phenotype_info_path, sep=r"\s+", header=None, dtype=str, usecols=[0, 1, 2]
+    )
+    pheno_df.columns = pd.Index(["FID", "IID", "phenotype"])
+    if len(pheno_df) > 0 and pheno_df.iloc[0]["FID"] == "FID":
+        pheno_df = pheno_df.iloc[1:]
+    return pl.from_pandas(pheno_df).with_columns(*_missing_phenotypes(["phenotype"]))
+
+
+def read_phenotype_matrix(
+    fam: pl.DataFrame, phenotype_info_paths: list[str | PhenotypeColumn]
+) -> np.ndarray:
+    """
+    Align phenotype files with the samples of a fileset.
+
+    Samples with ambiguous sex have all phenotypes set to missing, as plink does without
+    `--allow-no-sex`. Columns of the same phenotype matrix are read with one pass over
+    the matrix.
+
+    Args:
+        fam (pl.DataFrame): Samples of the fileset, with columns FID, IID and Sex.
+        phenotype_info_paths (list[str | PhenotypeColumn]): plink `--pheno` files, one
+            per phenotype, or columns of phenotype matrices.
+
+    Returns:
+        np.ndarray: Float64 matrix of shape `(n_samples, n_phenotypes)`, NaN if missing.
+    """
+    samples = fam.select("FID", "IID")
+    phenotypes = np.full((fam.height, len(phenotype_info_paths)), np.nan)
+
+    def align(pheno_df: pl.DataFrame) -> pl.DataFrame:
+        return samples.join(
+            pheno_df.unique(subset=["FID", "IID"], keep="first", maintain_order=True),
+            on=["FID", "IID"],
+            how="left",
+            maintain_order="left",
+        )
+
+    files, matrix_columns = group_matrix_columns(phenotype_info_paths)
+    for column, path in files:
+        phenotypes[:, column] = align(read_phenotype_file(path))["phenotype"] \
+            .fill_null(np.nan).to_numpy()
+    for matrix_path, columns in matrix_columns.items():
+        aligned = align(read_phenotype_columns(matrix_path, [name for _, name in columns]))
+        for column, name in columns:
+            phenotypes[:, column] = aligned[name].fill_null(np.nan).to_numpy()
+    known_sex = fam["Sex"].is_in(["1", "2"]).to_numpy()
+    phenotypes[~known_sex, :] = np.nan
+    return phenotypes
+
+
+def qassoc_block(dosage: np.ndarray, phenotypes: np.ndarray) -> QassocStatistics:
+    """
+    Quantitative trait association of a block of SNPs with many phenotypes at once.
+
+    Missing genotypes and phenotypes are dropped pairwise, as a separate plink run per
+    phenotype would. All sums are obtained from three matrix products per genotype class.
+
+    Args:
+        dosage (np.ndarray): `np.int8` dosage matrix of shape `(n_variants, n_samples)`.
+        phenotypes (np.ndarray): Phenotype matrix of shape `(n_samples, n_phenotypes)`,
+            NaN if missing.
+
+    Returns:
+        QassocStatistics: Statistics of every (SNP, phenotype) pair.
+    """
+    observed = ~np.isnan(phenotypes)
+    # centring keeps the sums of squares well conditioned
+    with np.errstate(invalid="ignore"):
+        centre = np.nan_to_num(np.nanmean(np.where(observed, phenotypes, np.nan), axis=0))
+    y = np.where(observed, phenotypes - centre, 0.0)
+    y2 = y * y
+    observed = observed.astype(np.float64)
+
+    counts = np.empty((dosage.shape[0], phenotypes.shape[1], 3))
+    sums = np.empty_like(counts)
+    squares = np.empty_like(counts)
+    for k, genotype in enumerate(_MEANS_DOSAGES):
+        indicator = (dosage == genotype).astype(np.float64)
+        counts[:, :, k] = indicator @ observed
+        sums[:, :, k] = indicator @ y
+        squares[:, :, k] = indicator @ y2
+
+    return _statistics_from_sums(counts, sums, squares, centre)
+
+
+def _statistics_from_sums(
+    counts: np.ndarray,
+    sums: np.ndarray,
+    squares: np.ndarray,
+    centre: np.ndarray,
+) -> QassocStatistics:
+    """Regression and genotype means from per genotype class counts and phenotype sums."""
+    n = counts.sum(axis=2)
+    beta, se, r2, t = regression_from_sums(
+        n,
+        counts[:, :, 1] + 2 * counts[:, :, 0],
+        counts[:, :, 1] + 4 * counts[:, :, 0],
+        sums.sum(axis=2),
+        squares.sum(axis=2),
+        sums[:, :, 1] + 2 * sums[:, :, 0],
+    )
+    p = t_two_sided_p(t, n - 2)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(counts > 0, sums / counts, np.nan)
+        sds = np.sqrt(np.maximum(squares - sums * means, 0.0) / (counts - 1))
+        sds = np.where(counts == 1, 0.0, np.where(counts > 1, sds, np.nan))
+    means = means + centre[None, :, None]
+
+    return QassocStatistics(
+        nmiss=n.astype(np.int64), beta=beta, se=se, r2=r2, t=t, p=p,
+        counts=counts.astype(np.int64), means=means, sds=sds,
+    )
+
+
+def _format_number(value: float) -> str:
+    """Format a number the way plink does (4 significant digits, NA if not finite)."""
+    return "NA" if np.isnan(value) else f"{value:.4g}"
+
+
+class QassocWriter(object):
+    """
+    Block-wise writer of `.qassoc` and `.qassoc.means` files in plink's fixed width layout,
+    so that they can be read by `summarization._parse_qassoc_file()` and
+    `summarization._parse_qt_means_file()`.
+    """
+
+    def __init__(self, output_name: str, snp_width: int, qt_means: bool = True) -> None:
+        """
+        Args:
+            output_name (str): Output path (without extension).
+            snp_width (int): Width of the SNP column, usually the length of the longest SNP ID.
+            qt_means (bool): Also write `{output_name}.qassoc.means`.
+        """
+        self.output_name = output_name
+        self.snp_width = max(snp_width, 4)
+        self.qt_means = qt_means
+
+        with open(f"{output_name}.qassoc", "w") as writer:
+            writer.write(
+                f" CHR {'SNP':>{self.snp_width}} {'BP':>10} {'NMISS':>8} {'BETA':>10} "
+                f"{'SE':>10} {'R2':>10} {'T':>8} {'P':>12} \n"
+            )
+        if qt_means:
+            with open(f"{output_name}.qassoc.means", "w") as writer:
+                writer.write(
+                    f" CHR {'SNP':>{self.snp_width}}  VALUE {'G11':>8} {'G12':>8} {'G22':>8}\n"
+                )
+
+    def write_block(self, bim: pl.DataFrame, statistics: QassocStatistics, column: int) -> None:
+        """
+        Append the results of a block of SNPs.
+
+        Args:
+            bim (pl.DataFrame): `.bim` rows of the block (CHR, SNP, BP, A1, A2).
+            statistics (QassocStatistics): Statistics of the block.
+            column (int): Phenotype column of `statistics` to write.
+        """
+        w = self.snp_width
+        with open(f"{self.output_name}.qassoc", "a") as writer:
+            writer.writelines(
+                f"{chrom:>4} {snp:>{w}} {bp:>10} {nmiss:>8} {_format_number(beta):>10} "
+                f"{_format_number(se):>10} {_format_number(r2):>10} {_format_number(t):>8} "
+                f"{_format_number(p):>12} \n"
+                for chrom, snp, bp, nmiss, beta, se, r2, t, p in zip(
+                    bim["CHR"], bim["SNP"], bim["BP"],
+                    statistics.nmiss[:, column], statistics.beta[:, column],
+                    statistics.se[:, column], statistics.r2[:, column],
+                    statistics.t[:, column], statistics.p[:, column],
+                )
+            )
+        if not self.qt_means:
+            return
+
+        lines: list[str] = []
+        for i, (chrom, snp, a1, a2) in enumerate(
+            zip(bim["CHR"], bim["SNP"], bim["A1"], bim["A2"])
+        ):
+            counts = statistics.counts[i, column]
+            total = counts.sum()
+            prefix = f"{chrom:>4} {snp:>{w}}"
+            lines.append(f"{prefix}   GENO {f'{a1}/{a1}':>8} {f'{a1}/{a2}':>8} {f'{a2}/{a2}':>8}\n")
+            lines.append(f"{prefix} COUNTS {counts[0]:>8} {counts[1]:>8} {counts[2]:>8}\n")
+            freqs = [_format_number(c / total) if total > 0 else "NA" for c in counts]
+            lines.append(f"{prefix}   FREQ {freqs[0]:>8} {freqs[1]:>8} {freqs[2]:>8}\n")
+            means = [_format_number(m) for m in statistics.means[i, column]]
+            lines.append(f"{prefix}   MEAN {means[0]:>8} {means[1]:>8} {means[2]:>8}\n")
+            sds = [_format_number(s) for s in statistics.sds[i, column]]
+            lines.append(f"{prefix}     SD {sds[0]:>8} {sds[1]:>8} {sds[2]:>8}\n")
+        with open(f"{self.output_name}.qassoc.means", "a") as writer:
+            writer.writelines(lines)
+
+
+def write_mperm(
+    output_name: str,
+    bim: pl.DataFrame,
+    emp1: np.ndarray,
+    emp2: np.ndarray,
+    snp_width: int | None = None,
+) -> str:
+    """
+    Write max(T) permutation results in the layout of plink `.qassoc.mperm` files, so
+    that they can be read by `summarization._parse_mperm_file()`.
+
+    Args:
+        output_name (str): Output path (without extension).
+        bim (pl.DataFrame): `.bim` rows of the SNPs (CHR, SNP).
+        emp1 (np.ndarray): Pointwise empirical p-value of every SNP.
+        emp2 (np.ndarray): Family-wise corrected empirical p-value of every SNP.
+        snp_width (int | None): Width of the SNP column. Defaults to the longest SNP ID.
+
+    Returns:
+        str: Path of the written file.
+
+    Generate Files:
+        %(output_name)s.qassoc.mperm
+    """
+    if snp_width is None:
+        snp_width = int(bim["SNP"].str.len_chars().max() or 0)  # type: ignore
+    w = max(snp_width, 4)
+    with open(f"{output_name}.qassoc.mperm", "w") as writer:
+        writer.write(f" CHR {'SNP':>{w}} {'EMP1':>12} {'EMP2':>12} \n")
+        writer.writelines(
+            f"{chrom:>4} {snp:>{w}} {_format_number(p1):>12} {_format_number(p2):>12} \n"
+            for chrom, snp, p1, p2 in zip(bim["CHR"], bim["SNP"], emp1, emp2)
+        )
+    return f"{output_name}.qassoc.mperm"
+
+
+def write_perm(
+    output_name: str,
+    bim: pl.DataFrame,
+    emp1: np.ndarray,
+    n_permutations: np.ndarray,
+    snp_width: int | None = None,
+) -> str:
+    """
+    Write adaptive permutation results in the layout of plink `.qassoc.perm` files.
+
+    Args:
+        output_name (str): Output path (without extension).
+        bim (pl.DataFrame): `.bim` rows of the SNPs (CHR, SNP).
+        emp1 (np.ndarray): Pointwise empirical p-value of every SNP.
+        n_permutations (np.ndarray): Number of permutations every SNP received.
+        snp_width (int | None): Width of the SNP column. Defaults to the longest SNP ID.
+
+    Returns:
+        str: Path of the written file.
+
+    Generate Files:
+        %(output_name)s.qassoc.perm
+    """
+    if snp_width is None:
+        snp_width = int(bim["SNP"].str.len_chars().max() or 0)  # type: ignore
+    w = max(snp_width, 4)
+    with open(f"{output_name}.qassoc.perm", "w") as writer:
+        writer.write(f" CHR {'SNP':>{w}} {'EMP1':>12} {'NP':>12} \n")
+        writer.writelines(
+            f"{chrom:>4} {snp:>{w}} {_format_number(p1):>12} {count:>12} \n"
+            for chrom, snp, p1, count in zip(bim["CHR"], bim["SNP"], emp1, n_permutations)
+        )
+    return f"{output_name}.qassoc.perm"
+
+
+def quantitative_association(
+    input_name: str | VirtualSubset,
+    phenotype_info_paths: list[str | PhenotypeColumn],
+    output_names: list[str],
+    *,
+    qt_means: bool = True,
+    mperm: int | None = None,
+    perm_mode: Literal["maxt", "adaptive"] = "maxt",
+    alpha: float = 0.05,
+    seed: int = DEFAULT_PERMUTATION_SEED,
+    n_workers: int | None = None,
+    chunk_size: int | None = None,
+) -> list[str]:
+    """
+    In-process equivalent of `plink --assoc qt-means` for many phenotypes at once.
+
+    Genotypes are streamed once, one block of SNPs at a time, and every block is tested
+    against all phenotypes with batched matrix products. Genotypes are treated as diploid
+    on every chromosome.
+
+    Args:
+        input_name (str | VirtualSubset): Path of the plink fileset (without extension),
+            or a virtual subset of one.
+        phenotype_info_paths (list[str | PhenotypeColumn]): plink `--pheno` files, one per
+            phenotype, or columns of phenotype matrices.
+        output_names (list[str]): Output path (without extension) of every phenotype.
+        qt_means (bool): Also write the `.qassoc.means` files.
+        mperm (int | None): Number of permutations (maximum number per SNP in adaptive
+            mode). No permutation test if None.
+        perm_mode ("maxt" | "adaptive"): `maxt` runs `mperm` max(T) permutations on every
+            SNP (`permutation.MaxTPermutation`); `adaptive` stops permuting a SNP once its
+            empirical p-value is clearly above or below `alpha`
+            (`permutation.AdaptivePermutation`).
+        alpha (float): Significance threshold of adaptive permutation.
+        seed (int): Seed of the permutations.
+        n_workers (int | None): Number of threads running permutation blocks.
+        chunk_size (int | None): Number of SNPs per block.
+
+    Returns:
+        list[str]: `output_names`.
+
+    Generate Files:
+        %(output_name)s.qassoc, %(output_name)s.qassoc.means for every output name.
+        %(output_name)s.qassoc.mperm (max(T)) or %(output_name)s.qassoc.perm (adaptive)
+            for every output name, if `mperm` is given.
+    """
+    if len(phenotype_info_paths) != len(output_names):
+        raise ValueError("One output name is required for every phenotype file.")
+
+    subset = as_subset(input_name)
+    reader = BedReader(subset.bfile)
+    sample_index = subset.sample_index()
+    variant_index = subset.variant_index()
+    if variant_index is None:
+        variant_index = np.arange(reader.n_variants)
+    phenotypes = read_phenotype_matrix(subset.fam(), phenotype_info_paths)
+    logger.info(
+        "Testing %d SNPs of %s against %d phenotypes.",
+        len(variant_index), input_name, len(phenotype_info_paths)
+    )
+
+    snp_width = int(reader.bim[variant_index]["SNP"].str.len_chars().max() or 0)  # type: ignore
+    writers = [QassocWriter(name, snp_width, qt_means) for name in output_names]
+    if chunk_size is None:
+        # several float64 copies of every block are alive at once
+        chunk_size = max(1, reader.default_chunk_size(phenotypes.shape[0]) // 8)
+
+    permutation: MaxTPermutation | AdaptivePermutation | None = None
+    if mperm is not None and perm_mode == "adaptive":
+        permutation = AdaptivePermutation(
+            phenotypes, mperm, alpha=alpha, seed=seed, n_workers=n_workers
+        )
+    elif mperm is not None:
+        permutation = MaxTPermutation(phenotypes, mperm, seed=seed, n_workers=n_workers)
+
+    for block_index, dosage in reader.iter_chunks(
+        chunk_size, variant_index=variant_index, sample_index=sample_index
+    ):
+        statistics = qassoc_block(dosage, phenotypes)
+        bim = reader.bim[block_index]
+        for column, writer in enumerate(writers):
+            writer.write_block(bim, statistics, column)
+        if permutation is not None:
+            permutation.add_block(dosage, statistics)
+
+    if permutation is not None:
+        bim = reader.bim[variant_index]
+        emp1, emp2_or_counts = permutation.empirical_p_values()
+        write = write_perm if isinstance(permutation, AdaptivePermutation) else write_mperm
+        for column, output_name in enumerate(output_names):
+            write(output_name, bim, emp1[:, column], emp2_or_counts[:, column], snp_width)
+
+    return output_names
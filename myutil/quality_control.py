@@ -3,12 +3,19 @@ import sys
 import logging
 import subprocess
 from typing import Optional, Literal
-from Classes import FileManagement, Gender
+
+import numpy as np
+
+from Classes import FileManagement, Gender, VirtualSubset, as_subset, bfile_args
+from myutil.genotype import BedReader, MISSING_GENOTYPE
+from myutil.scheduler import plink_resource_args
+
+AUTOSOMES = {str(i) for i in range(1, 23)}
 
 
 def filter_high_missingness(
     fm: FileManagement,
-    input_path_name: str,
+    input_path_name: str | VirtualSubset,
     save_path_name: str,
     gender: Gender,
     ethnic: Optional[str],
@@ -35,7 +42,8 @@ def filter_high_missingness(
         )
         command: list = [
             fm.plink,
-            "--bfile", input_path_name,
+            *bfile_args(input_path_name),
+            *plink_resource_args(),
             "--geno", str(missingness_threshold),
             "--mind", str(missingness_threshold),
             "--make-bed",
@@ -60,7 +68,7 @@ def filter_high_missingness(
 
 def filter_maf(
     fm: FileManagement,
-    input_path_name: str,
+    input_path_name: str | VirtualSubset,
     save_path_name: str,
     /,
     gender: Gender,
@@ -86,7 +94,8 @@ def filter_maf(
     try:
         command = [
             fm.plink,
-            "--bfile", input_path_name,
+            *bfile_args(input_path_name),
+            *plink_resource_args(),
             "--maf", str(maf_threshold),
             "--make-bed",
             "--out", save_path_name
@@ -112,7 +121,7 @@ def filter_maf(
 
 def filter_hwe(
     fm: FileManagement,
-    input_path_name: str,
+    input_path_name: str | VirtualSubset,
     save_path_name: str,
     gender: Gender,
     ethnic: Optional[str],
@@ -139,7 +148,8 @@ def filter_hwe(
     try:
         command = [
             fm.plink,
-            "--bfile", input_path_name,
+            *bfile_args(input_path_name),
+            *plink_resource_args(),
             "--hwe", str(hwe_threshold), "midp",
             "--make-bed",
             "--out", save_path_name
@@ -161,9 +171,213 @@ def filter_hwe(
     return gender, ethnic, save_path_name
 
 
+def fused_quality_control(
+    fm: FileManagement,
+    input_path_name: str | VirtualSubset,
+    save_path_name: str,
+    gender: Gender,
+    ethnic: Optional[str],
+    *,
+    missingness_threshold: float = 0.02,
+    hwe_threshold: float = 1e-6,
+    maf_threshold: float = 0.01,
+    make_bed: bool = True,
+) -> tuple[Gender, Optional[str], str | VirtualSubset] | None:
+    """
+    Filter samples and SNPs by missingness, HWE mid-p and MAF while streaming the
+    genotypes once, instead of chaining `filter_high_missingness`, `filter_hwe` and
+    `filter_maf` (three full plink read + write passes).
+
+    Filters are applied in the same order as the plink chain: samples with missing
+    call rate above `missingness_threshold` are removed first, then call rate, HWE
+    mid-p and MAF of every SNP are computed over the remaining samples. If some
+    samples are removed, only their genotypes are read a second time and subtracted
+    from the SNP counts. HWE is only tested on autosomes.
+
+    Args:
+        fm: FileManagement object containing parameters from argparse.
+        input_path_name: Path to the input PLINK binary fileset (without extension),
+            or a `VirtualSubset` of one.
+        save_path_name: Path prefix for the output files.
+        gender: Gender information to be returned with results.
+        ethnic: Ethnicity information to be returned with results.
+        missingness_threshold: Threshold of missing rate of samples and SNPs.
+        hwe_threshold: HWE mid-p threshold.
+        maf_threshold: Threshold of minor allele frequency.
+        make_bed: Whether to write the filtered fileset. Otherwise the result is a
+            `VirtualSubset` selecting the kept samples and SNPs of the input fileset.
+
+    Returns:
+        Tuple containing (Gender, ethnic, output_path or VirtualSubset) if successful,
+        None otherwise.
+
+    Generate Files:
+        %(save_path_name)s.keep: FID and IID of the kept samples (plink `--keep` format).
+        %(save_path_name)s.extract: IDs of the kept SNPs (plink `--extract` format).
+        %(save_path_name)s.{bed,bim,fam}: the filtered fileset, if `make_bed` is True.
+    """
+    logging.info(
+        "Filtering %s with missingness %s, HWE %s and MAF %s in a single pass.",
+        input_path_name, missingness_threshold, hwe_threshold, maf_threshold
+    )
+    try:
+        subset = as_subset(input_path_name)
+        reader = BedReader(subset.bfile)
+        fam = subset.fam()
+        sample_index = subset.sample_index()
+        variant_index = subset.variant_index()
+        if variant_index is None:
+            variant_index = np.arange(reader.n_variants)
+        bim = reader.bim[variant_index]
+        n_variants, n_samples = len(variant_index), fam.height
+
+        # counts are indexed by position within the subset
+        variant_position = np.full(reader.n_variants, -1, dtype=np.int64)
+        variant_position[variant_index] = np.arange(n_variants)
+        variant_counts = np.zeros((n_variants, 4), dtype=np.int64)
+        sample_missing = np.zeros(n_samples, dtype=np.int64)
+
+        for block_index, dosage in reader.iter_chunks(
+            variant_index=variant_index, sample_index=sample_index
+        ):
+            missing = dosage == MISSING_GENOTYPE
+            sample_missing += missing.sum(axis=0)
+            variant_counts[variant_position[block_index]] += _genotype_counts(dosage)
+
+        # --mind
+        sample_mask = sample_missing <= missingness_threshold * max(n_variants, 1)
+        removed_samples = np.flatnonzero(~sample_mask)
+        if len(removed_samples) > 0:
+            logging.info("%d samples removed due to missing genotype data.", len(removed_samples))
+            removed_index = removed_samples if sample_index is None else sample_index[removed_samples]
+            for block_index, dosage in reader.iter_chunks(
+                variant_index=variant_index, sample_index=removed_index
+            ):
+                variant_counts[variant_position[block_index]] -= _genotype_counts(dosage)
+
+        # --geno, --hwe, --maf
+        n_hom_a1, n_het, n_hom_a2, n_missing = variant_counts.T
+        n_called = n_hom_a1 + n_het + n_hom_a2
+        n_kept_samples = int(sample_mask.sum())
+        variant_mask = n_missing <= missingness_threshold * max(n_kept_samples, 1)
+
+        is_autosome = bim["CHR"].is_in(AUTOSOMES).to_numpy()
+        hwe_p = hwe_exact_midp(n_het, n_hom_a1, n_hom_a2)
+        variant_mask &= ~is_autosome | (hwe_p >= hwe_threshold)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            a1_freq = (2 * n_hom_a1 + n_het) / (2 * n_called)
+        maf = np.minimum(a1_freq, 1 - a1_freq)
+        variant_mask &= np.nan_to_num(maf, nan=0.0) >= maf_threshold
+
+        logging.info(
+            "%d of %d SNPs and %d of %d samples passed QC.",
+            variant_mask.sum(), n_variants, n_kept_samples, n_samples
+        )
+
+        kept_samples = np.flatnonzero(sample_mask)
+        kept_variants = variant_index[variant_mask]
+        fam[kept_samples].select("FID", "IID").write_csv(
+            f"{save_path_name}.keep", separator="\t", include_header=False
+        )
+        reader.bim[kept_variants].select("SNP").write_csv(
+            f"{save_path_name}.extract", include_header=False
+        )
+        if not make_bed:
+            logging.info("Fused quality control completed.")
+            return gender, ethnic, subset.derive(
+                save_path_name,
+                keep_path=f"{save_path_name}.keep",
+                extract_path=f"{save_path_name}.extract",
+            )
+
+        if sample_index is None and len(removed_samples) == 0:
+            kept_index = None
+        elif sample_index is None:
+            kept_index = kept_samples
+        else:
+            kept_index = sample_index[kept_samples]
+        reader.write_subset(
+            save_path_name,
+            variant_index=kept_variants,
+            sample_index=kept_index,
+            fam=fam[kept_samples],
+        )
+    except Exception as e:
+        logging.error(
+            "Unexpected error occurred: %s", e
+        )
+        return
+    logging.info("Fused quality control completed.")
+    return gender, ethnic, save_path_name
+
+
+def _genotype_counts(dosage: np.ndarray) -> np.ndarray:
+    """Count (hom A1, het, hom A2, missing) calls of every SNP of a dosage block."""
+    return np.stack(
+        [
+            np.count_nonzero(dosage == 2, axis=1),
+            np.count_nonzero(dosage == 1, axis=1),
+            np.count_nonzero(dosage == 0, axis=1),
+            np.count_nonzero(dosage == MISSING_GENOTYPE, axis=1),
+        ],
+        axis=1,
+    )
+
+
+def hwe_exact_midp(
+    n_het: np.ndarray,
+    n_hom_1: np.ndarray,
+    n_hom_2: np.ndarray,
+) -> np.ndarray:
+    """
+    Hardy-Weinberg equilibrium exact test (Wigginton et al., 2005) with mid-p
+    adjustment, as used by `plink --hwe <threshold> midp`.
+
+    Args:
+        n_het: Heterozygote counts.
+        n_hom_1: Homozygote counts of one allele.
+        n_hom_2: Homozygote counts of the other allele.
+
+    Returns:
+        np.ndarray: Mid-p values. SNPs without any genotype call get 1.
+    """
+    counts = np.stack(
+        [np.asarray(n_het), np.asarray(n_hom_1), np.asarray(n_hom_2)], axis=1
+    ).astype(np.int64)
+    # SNPs frequently share genotype counts; test each combination once.
+    unique_counts, inverse = np.unique(counts, axis=0, return_inverse=True)
+    unique_p = np.array([
+        _hwe_exact_midp_single(int(het), int(hom_1), int(hom_2))
+        for het, hom_1, hom_2 in unique_counts
+    ], dtype=np.float64)
+    return unique_p[np.asarray(inverse).reshape(-1)]
+
+
+def _hwe_exact_midp_single(n_het: int, n_hom_1: int, n_hom_2: int) -> float:
+    n_total = n_het + n_hom_1 + n_hom_2
+    if n_total == 0:
+        return 1.0
+    n_rare = 2 * min(n_hom_1, n_hom_2) + n_het
+
+    # P(het = h) for every attainable h, via P(h + 2) / P(h) in log space
+    hets = np.arange(n_rare % 2, n_rare + 1, 2, dtype=np.float64)
+    rare_homs = (n_rare - hets) / 2
+    common_homs = n_total - hets - rare_homs
+    log_ratio = np.log(4.0 * rare_homs[:-1] * common_homs[:-1]) \
+        - np.log((hets[:-1] + 1.0) * (hets[:-1] + 2.0))
+    log_p = np.concatenate([[0.0], np.cumsum(log_ratio)])
+    probs = np.exp(log_p - log_p.max())
+    probs /= probs.sum()
+
+    p_observed = probs[(n_het - n_rare % 2) // 2]
+    p_value = probs[probs <= p_observed * (1 + 1e-8)].sum() - 0.5 * p_observed
+    return float(min(1.0, max(0.0, p_value)))
+
+
 def ld_pruning(
     plink_path: str,
-    input_path_name: str,
+    input_path_name: str | VirtualSubset,
     save_path_name: str,
     window_size: int = 50,
     step_size: int = 5,
@@ -200,7 +414,8 @@ def ld_pruning(
     try:
         command = [
             plink_path,
-            "--bfile", input_path_name,
+            *bfile_args(input_path_name),
+            *plink_resource_args(),
             "--indep-pairphase", f"{window_size}.kb" if window_kb_modifier else str(window_size), str(step_size), str(r2_threshold),
             "--out", save_path_name,
         ]
@@ -0,0 +1,228 @@
+import dataclasses
+import json
+import logging
+import os
+import time
+from typing import Any, Iterable
+
+from Classes import Gender, PhenotypeColumn, VirtualSubset
+from myutil.small_tools import create_logger
+
+logger = create_logger("RunManifestLogger", level=logging.WARN)
+
+DEFAULT_MANIFEST_PATH = "./temp/run_manifest.jsonl"
+
+
+def _encode(value: Any) -> Any:
+    """Convert pipeline state to JSON values, tagging the types JSON does not have."""
+    match value:
+        case Gender():
+            return {"__gender__": value.value}
+        case VirtualSubset():
+            return {"__virtual_subset__": dataclasses.asdict(value)}
+        case PhenotypeColumn():
+            return {"__phenotype_column__": dataclasses.asdict(value)}
+        case tuple():
+            return {"__tuple__": [_encode(item) for item in value]}
+        case list():
+            return [_encode(item) for item in value]
+        case dict():
+            return {str(key): _encode(item) for key, item in value.items()}
+        case _:
+            return value
+
+
+def _decode(value: dict) -> Any:
+    """`json` object hook restoring the values tagged by `_encode`."""
+    match value:
+        case {"__gender__": str() as gender}:
+            return Gender(gender)
+        case {"__virtual_subset__": dict() as fields}:
+            return VirtualSubset(**fields)
+        case {"__phenotype_column__": dict() as fields}:
+            return PhenotypeColumn(**fields)
+        case {"__tuple__": list() as items}:
+            return tuple(items)
+        case _:
+            return value
+
+
+class RunManifest(object):
+    """
+    Journal of the finished stages of a run, so that an interrupted run can resume.
+
+    Every finished stage appends one JSON line with its state (the variables later
+    stages need, e.g. `outputs` and `snp_sums`) and the files it produced; stages made
+    of many independent items, like the association of every group and phenotype, also
+    record every finished item. Lines are flushed to disk as they are written, so a
+    killed run loses at most the stage or item in progress.
+
+    When resuming, stages are restored in order as long as they were recorded and their
+    files still exist; the first stage that cannot be restored, and every stage after
+    it, runs again. Recorded items of that first stage are kept.
+
+    Example:
+        >>> manifest = RunManifest(resume=fm.resume, run_args=vars(args))
+        >>> if (state := manifest.restore("quality_control")) is not None:
+        ...     outputs = state["outputs"]
+        ... else:
+        ...     outputs = run_quality_control()
+        ...     manifest.record("quality_control", {"outputs": outputs}, output_files)
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_MANIFEST_PATH,
+        resume: bool = False,
+        run_args: dict[str, Any] | None = None,
+    ) -> None:
+        """
+        Args:
+            path (str): Path of the journal.
+            resume (bool): Restore the stages recorded by the previous run. Otherwise the
+                journal is started afresh.
+            run_args (dict[str, Any] | None): Arguments of the run. A run only resumes
+                from a journal written with the same arguments.
+        """
+        self.path = path
+        self.run_args = _encode(run_args or {})
+        # {stage: (state, files)} and {stage: {item key: (item, files)}}
+        self._stages: dict[str, tuple[Any, list[str]]] = {}
+        self._items: dict[str, dict[str, tuple[Any, list[str]]]] = {}
+        # False once a stage could not be restored
+        self._restoring = resume
+        # stages restored so far, in order
+        self._restored: list[str] = []
+        # items of the first stage which could not be restored
+        self._pending_stage: str | None = None
+        self._pending_items: dict[str, Any] = {}
+
+        if resume:
+            self._load()
+        if not self._restoring:
+            self._stages, self._items = {}, {}
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w") as writer:
+                writer.write(json.dumps({"run": self.run_args, "time": time.time()}) + "\n")
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            logger.warning("No run manifest at %s; starting a new run.", self.path)
+            self._restoring = False
+            return
+        with open(self.path) as reader:
+            lines = reader.readlines()
+        for number, line in enumerate(lines):
+            try:
+                entry = json.loads(line, object_hook=_decode)
+            except ValueError:
+                # the line being written when the run was killed
+                logger.warning("Ignoring truncated line %d of %s.", number + 1, self.path)
+                continue
+            match entry:
+                case {"run": run_args}:
+                    if json.loads(json.dumps(self.run_args), object_hook=_decode) != run_args:
+                        logger.warning(
+                            "The arguments differ from those of the run in %s; starting a new run.",
+                            self.path,
+                        )
+                        self._restoring = False
+                        return
+                case {"stage": str() as stage, "item": str() as key, "discard": True}:
+                    self._items.get(stage, {}).pop(key, None)
+                case {"stage": str() as stage, "item": str() as key, "state": state, "files": files}:
+                    self._items.setdefault(stage, {})[key] = (state, files)
+                case {"stage": str() as stage, "state": state, "files": files}:
+                    self._stages[stage] = (state, files)
+
+    def _append(self, entry: dict) -> None:
+        with open(self.path, "a") as writer:
+            writer.write(json.dumps(_encode(entry)) + "\n")
+            writer.flush()
+            os.fsync(writer.fileno())
+
+    def restore(self, stage: str) -> Any | None:
+        """
+        State of a stage recorded by the previous run, if the run is resuming, every
+        earlier stage was restored and the files of the stage still exist.
+
+        Returns:
+            Any | None: The recorded state, or None if the stage has to run.
+        """
+        if not self._restoring:
+            return None
+        if stage not in self._stages:
+            self._stop_restoring(stage)
+            return None
+        state, files = self._stages[stage]
+        missing = [path for path in files if not os.path.exists(path)]
+        if len(missing) > 0:
+            logger.warning("Running %s again: %s no longer exists.", stage, missing[0])
+            self._stop_restoring(stage)
+            return None
+        logger.info("Restored stage %s from %s.", stage, self.path)
+        self._restored.append(stage)
+        return state
+
+    def _stop_restoring(self, stage: str) -> None:
+        """
+        Rewrite the journal with the restored stages and the items of `stage` only, as
+        the stages after them are run again and their old records are outdated.
+        """
+        self._restoring = False
+        items = {
+            key: (item, files) for key, (item, files) in self._items.get(stage, {}).items()
+            if all(os.path.exists(path) for path in files)
+        }
+        stages = {name: self._stages[name] for name in self._restored}
+        self._stages, self._items = {}, {}
+        with open(self.path, "w") as writer:
+            writer.write(json.dumps({"run": self.run_args, "time": time.time()}) + "\n")
+        for name, (state, files) in stages.items():
+            self.record(name, state, files)
+        for key, (item, files) in items.items():
+            self.record_item(stage, key, item, files)
+        # the items are kept for `restore_items`
+        self._pending_items = {key: item for key, (item, _) in items.items()}
+        self._pending_stage = stage
+
+    def restore_items(self, stage: str) -> dict[str, Any]:
+        """
+        Items of a stage recorded by the previous run, e.g. one association result per
+        group and phenotype. Only items whose files still exist are returned, and only
+        if every earlier stage was restored.
+
+        Returns:
+            dict[str, Any]: {item key: recorded item}.
+        """
+        if stage == self._pending_stage:
+            return dict(self._pending_items)
+        if not self._restoring:
+            return {}
+        return {
+            key: item for key, (item, files) in self._items.get(stage, {}).items()
+            if all(os.path.exists(path) for path in files)
+        }
+
+    def record(self, stage: str, state: Any, files: Iterable[str | os.PathLike] = ()) -> None:
+        """Record a finished stage with its state and the files it produced."""
+        files = [os.fspath(path) for path in files]
+        self._stages[stage] = (state, files)
+        self._append({"stage": stage, "state": state, "files": files, "time": time.time()})
+
+    def record_item(
+        self, stage: str, key: str, item: Any, files: Iterable[str | os.PathLike] = ()
+    ) -> None:
+        """Record a finished item of a stage with the files it produced."""
+        files = [os.fspath(path) for path in files]
+        self._items.setdefault(stage, {})[key] = (item, files)
+        self._append({"stage": stage, "item": key, "state": item, "files": files, "time": time.time()})
+
+    def discard_item(self, stage: str, key: str) -> None:
+        """Drop the record of an item which is outdated, e.g. because an item it depends on runs again."""
+        if key not in self._items.get(stage, {}):
+            return
+        del self._items[stage][key]
+        if stage == self._pending_stage:
+            self._pending_items.pop(key, None)
+        self._append({"stage": stage, "item": key, "discard": True, "time": time.time()})
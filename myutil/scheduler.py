@@ -0,0 +1,347 @@
+import inspect
+import logging
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Generator, Iterator
+
+from myutil.small_tools import available_memory, create_logger
+
+logger = create_logger("SchedulerLogger", level=logging.WARN)
+
+MEBIBYTE = 1024 * 1024
+
+PLINK_BASE_MEMORY = 256 * MEBIBYTE
+"""Memory a plink 1.9 process takes regardless of the fileset (binary, I/O buffers)."""
+
+DEFAULT_MEMORY_FRACTION = 0.8
+"""Fraction of the available memory used as budget when none is configured."""
+
+
+@dataclass(frozen=True)
+class PlinkResources:
+    """
+    Threads and memory granted to one job, passed on to every plink process it runs.
+
+    Attributes:
+        threads (int): Number of threads (`--threads`).
+        memory (int): Memory in bytes (`--memory`, which plink takes in MiB).
+    """
+    threads: int
+    memory: int
+
+    def plink_args(self) -> list[str]:
+        """plink arguments limiting the threads and memory of a plink process."""
+        return [
+            "--threads", str(self.threads),
+            "--memory", str(max(1, self.memory // MEBIBYTE)),
+        ]
+
+
+# resources of the current process, set by `MemoryAwareScheduler` in its workers
+_resources: PlinkResources | None = None
+
+
+def set_plink_resources(resources: PlinkResources | None) -> None:
+    """Set the threads and memory granted to plink processes started from this process."""
+    global _resources
+    _resources = resources
+
+
+def plink_resource_args() -> list[str]:
+    """
+    plink arguments limiting the threads and memory of a plink process.
+
+    Returns:
+        list[str]: `--threads` and `--memory` of the current job, or an empty list if no
+            resources were set, in which case plink falls back to its own defaults.
+    """
+    return [] if _resources is None else _resources.plink_args()
+
+
+def job_threads() -> int | None:
+    """Number of threads granted to the current job, None if no resources were set."""
+    return None if _resources is None else _resources.threads
+
+
+def job_memory() -> int | None:
+    """Memory granted to the current job (or to the whole run in the main process), in
+    bytes; None if no resources were set."""
+    return None if _resources is None else _resources.memory
+
+
+def estimate_plink_memory(bfile: str) -> int:
+    """
+    Estimate the memory plink needs to load a binary fileset, in bytes.
+
+    plink keeps the packed genotypes in memory and builds hash tables of the variant
+    and sample IDs, so the estimate is the `.bed` size plus twice the `.bim` and `.fam`
+    sizes on top of a fixed overhead. The `.bed` size is derived from the `.bim`/`.fam`
+    sizes if the `.bed` file does not exist yet.
+
+    Args:
+        bfile (str): Path of the plink fileset (without extension).
+
+    Returns:
+        int: Estimated peak memory.
+    """
+    bim_size = os.path.getsize(f"{bfile}.bim")
+    fam_size = os.path.getsize(f"{bfile}.fam")
+    if os.path.exists(f"{bfile}.bed"):
+        bed_size = os.path.getsize(f"{bfile}.bed")
+    else:
+        # about 30 bytes per .bim line and 25 bytes per .fam line; 4 samples per byte
+        bed_size = (bim_size // 30 + 1) * (fam_size // 25 // 4 + 1)
+    return PLINK_BASE_MEMORY + bed_size + 2 * (bim_size + fam_size)
+
+
+@dataclass
+class Job:
+    """
+    A function call to run in a worker process.
+
+    Attributes:
+        function (Callable): Picklable (module level) function.
+        args (tuple): Positional arguments.
+        kwargs (dict): Keyword arguments.
+        memory (int): Estimated peak memory of the call, in bytes.
+    """
+    function: Callable
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    memory: int = PLINK_BASE_MEMORY
+
+
+Pipeline = Generator[Any, Any, Any]
+"""
+A chain of jobs, written as a generator run in the main process.
+
+The generator yields a `Job` and receives its result, or yields a list of jobs and
+pipelines which run concurrently and receives the list of their results. Its return
+value is the result of the pipeline.
+"""
+
+
+def _single_job(job: Job) -> Pipeline:
+    return (yield job)
+
+
+class _PipelineNode(object):
+    """A running pipeline, or a branch of the list yielded by its parent."""
+
+    def __init__(self, pipeline: Pipeline, index: int, parent: "_PipelineNode | None" = None) -> None:
+        self.pipeline = pipeline
+        # index in the list of pipelines, or in the list yielded by the parent
+        self.index = index
+        self.parent = parent
+        self.branch_results: list = []
+        self.pending_branches = 0
+
+
+def _run_job(resources: PlinkResources, function: Callable, args: tuple, kwargs: dict) -> Any:
+    """Run a job in a worker process with its resources set."""
+    set_plink_resources(resources)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        set_plink_resources(None)
+
+
+class MemoryAwareScheduler(object):
+    """
+    Run jobs in a process pool so that the estimated memory of the running jobs stays
+    under a budget.
+
+    Pending jobs are started in order as soon as their memory fits into what is left of
+    the budget; a job larger than the whole budget runs on its own. Each job is granted
+    an equal share of the threads and its memory estimate, which plink receives as
+    `--threads` and `--memory`.
+
+    Example:
+        >>> scheduler = MemoryAwareScheduler(memory_budget=fm.memory_budget, max_threads=fm.threads)
+        >>> jobs = [Job(quality_control.ld_pruning, (fm.plink, prefix, save), memory=estimate_plink_memory(prefix))
+        ...         for prefix, save in filesets]
+        >>> for index, result in scheduler.run(jobs):
+        ...     print(filesets[index], result)
+    """
+
+    def __init__(self, memory_budget: int | None = None, max_threads: int | None = None) -> None:
+        """
+        Args:
+            memory_budget (int | None): Maximum total memory of the running jobs, in bytes.
+                Defaults to 80% of the currently available memory.
+            max_threads (int | None): Maximum total number of threads. Defaults to the
+                number of CPUs.
+        """
+        self.memory_budget: int = int(available_memory() * DEFAULT_MEMORY_FRACTION) \
+            if memory_budget is None else memory_budget
+        self.max_threads: int = (os.cpu_count() or 1) if max_threads is None else max_threads
+        if self.memory_budget <= 0 or self.max_threads <= 0:
+            raise ValueError(
+                f"Memory budget ({self.memory_budget}) and threads ({self.max_threads}) must be positive."
+            )
+
+    def resources(self) -> PlinkResources:
+        """Resources of a process running on its own, e.g. the main process."""
+        return PlinkResources(self.max_threads, self.memory_budget)
+
+    def run(self, jobs: list[Job]) -> Iterator[tuple[int, Any]]:
+        """
+        Run jobs and yield their results as they complete.
+
+        Args:
+            jobs (list[Job]): Jobs to run.
+
+        Yields:
+            tuple[int, Any]: (index of the job in `jobs`, return value of the job).
+                Exceptions raised by a job are re-raised here.
+        """
+        if len(jobs) == 0:
+            return
+        max_workers = min(self.max_threads, len(jobs))
+        threads = max(1, self.max_threads // max_workers)
+        for index, job in enumerate(jobs):
+            if job.memory > self.memory_budget:
+                logger.warning(
+                    "Job %d (%s) needs about %d MiB, more than the budget of %d MiB; it will run on its own.",
+                    index, job.function.__name__, job.memory // MEBIBYTE, self.memory_budget // MEBIBYTE,
+                )
+
+        pending = deque(range(len(jobs)))
+        running: dict[Future, int] = {}
+        reserved = 0
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            while pending or running:
+                # start every pending job that fits, in order
+                for index in list(pending):
+                    if len(running) >= max_workers:
+                        break
+                    memory = min(jobs[index].memory, self.memory_budget)
+                    if running and reserved + memory > self.memory_budget:
+                        continue
+                    pending.remove(index)
+                    reserved += memory
+                    job = jobs[index]
+                    future = pool.submit(
+                        _run_job, PlinkResources(threads, memory), job.function, job.args, job.kwargs
+                    )
+                    running[future] = index
+                    logger.debug(
+                        "Started job %d with %d threads and %d MiB (%d MiB reserved).",
+                        index, threads, memory // MEBIBYTE, reserved // MEBIBYTE,
+                    )
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    reserved -= min(jobs[index].memory, self.memory_budget)
+                    yield index, future.result()
+
+    def run_pipelines(self, pipelines: list[Pipeline]) -> Iterator[tuple[int, Any]]:
+        """
+        Run pipelines concurrently and yield their results as they complete.
+
+        Every pipeline advances as soon as the jobs it waits for complete, independently of
+        the other pipelines, so that e.g. every population group flows through its own
+        quality control, association and visualisation jobs and a slow group does not
+        hold the others back. Ready jobs of all pipelines start in the order they became
+        ready, within the memory budget as in `run`; each job is granted a share of the
+        threads not taken by the running jobs.
+
+        Example:
+            >>> def pipeline(prefix):
+            ...     filtered = yield Job(quality_control.filter_hwe, (fm, prefix, f"{prefix}_hwe", gender, ethnic))
+            ...     pruned, _ = yield [Job(quality_control.ld_pruning, ...), Job(vislz.hardy_weinberg, ...)]
+            ...     return pruned
+            >>> for index, result in scheduler.run_pipelines([pipeline(prefix) for prefix in prefixes]):
+            ...     print(prefixes[index], result)
+
+        Args:
+            pipelines (list[Pipeline]): Pipelines to run, see `Pipeline`.
+
+        Yields:
+            tuple[int, Any]: (index of the pipeline in `pipelines`, return value of the
+                pipeline). Exceptions raised by a job or a pipeline are re-raised here.
+        """
+        ready: deque[tuple[_PipelineNode, Job]] = deque()
+        finished: list[tuple[int, Any]] = []
+
+        def advance(node: _PipelineNode, value: Any) -> None:
+            """Send `value` to a pipeline and queue what it yields next."""
+            while True:
+                try:
+                    request = node.pipeline.send(value)
+                except StopIteration as stop:
+                    if node.parent is None:
+                        finished.append((node.index, stop.value))
+                        return
+                    parent = node.parent
+                    parent.branch_results[node.index] = stop.value
+                    parent.pending_branches -= 1
+                    if parent.pending_branches > 0:
+                        return
+                    # the last branch completed: resume the parent
+                    node, value = parent, parent.branch_results
+                    continue
+                if isinstance(request, Job):
+                    ready.append((node, request))
+                    return
+                if not isinstance(request, list):
+                    raise TypeError(f"A pipeline can only yield a Job or a list, not {request!r}.")
+                if len(request) == 0:
+                    value = []
+                    continue
+                node.branch_results = [None] * len(request)
+                node.pending_branches = len(request)
+                for index, branch in enumerate(request):
+                    advance(_PipelineNode(
+                        branch if inspect.isgenerator(branch) else _single_job(branch), index, node
+                    ), None)
+                return
+
+        for index, pipeline in enumerate(pipelines):
+            advance(_PipelineNode(pipeline, index), None)
+
+        running: dict[Future, tuple[_PipelineNode, Job, int, int]] = {}
+        reserved = 0
+        used_threads = 0
+        with ProcessPoolExecutor(max_workers=self.max_threads) as pool:
+            while True:
+                yield from finished
+                finished.clear()
+                # start every ready job that fits, in order
+                for node, job in list(ready):
+                    if len(running) >= self.max_threads:
+                        break
+                    memory = min(job.memory, self.memory_budget)
+                    if running and reserved + memory > self.memory_budget:
+                        continue
+                    if job.memory > self.memory_budget:
+                        logger.warning(
+                            "Job %s needs about %d MiB, more than the budget of %d MiB; it will run on its own.",
+                            job.function.__name__, job.memory // MEBIBYTE, self.memory_budget // MEBIBYTE,
+                        )
+                    ready.remove((node, job))
+                    # share the free threads among the jobs which may start now
+                    startable = min(len(ready) + 1, self.max_threads - len(running))
+                    threads = max(1, (self.max_threads - used_threads) // startable)
+                    reserved += memory
+                    used_threads += threads
+                    future = pool.submit(
+                        _run_job, PlinkResources(threads, memory), job.function, job.args, job.kwargs
+                    )
+                    running[future] = (node, job, threads, memory)
+                    logger.debug(
+                        "Started %s with %d threads and %d MiB (%d MiB reserved).",
+                        job.function.__name__, threads, memory // MEBIBYTE, reserved // MEBIBYTE,
+                    )
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node, job, threads, memory = running.pop(future)
+                    reserved -= memory
+                    used_threads -= threads
+                    advance(node, future.result())
@@ -1,4 +1,5 @@
 import logging
+import os
 
 def progress_bar(message: str, total: int, current: int, bar_length: int = 50, fill: str = '█', printEnd: str = "\r"):
     last_length = 0
@@ -69,3 +70,20 @@ def count_line(file_path: str) -> int:
     with open(file_path) as reader:
         return sum([1 for _ in reader])
 
+
+def available_memory() -> int:
+    """
+    Get the memory available to new processes, in bytes.
+
+    Returns:
+        int: `MemAvailable` of /proc/meminfo if readable, otherwise the number of free
+            physical pages times the page size.
+    """
+    try:
+        with open("/proc/meminfo") as reader:
+            for line in reader:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
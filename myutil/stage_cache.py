@@ -0,0 +1,294 @@
+import functools
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import subprocess
+from typing import Any, Callable, Iterable, Iterator
+
+import polars as pl
+
+from Classes import PhenotypeColumn, VirtualSubset, as_subset, group_matrix_columns
+from myutil.phenotype_store import FileDigests, content_hash
+from myutil.scheduler import Job, MemoryAwareScheduler, Pipeline
+from myutil.small_tools import create_logger
+
+logger = create_logger("StageCacheLogger", level=logging.WARN)
+
+DEFAULT_CACHE_DIR = "./temp/stage_cache"
+
+
+
+@functools.lru_cache(maxsize=None)
+def plink_version(plink_path: str) -> str:
+    """First line of `plink --version`, or "unavailable" if plink cannot be run."""
+    try:
+        process = subprocess.run(
+            [plink_path, "--version"], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unavailable"
+    return process.stdout.strip().splitlines()[0] if process.stdout.strip() else "unknown"
+
+
+def fileset_files(input_name: str | VirtualSubset) -> list[str]:
+    """Files a plink fileset or virtual subset consists of: `.bed`/`.bim`/`.fam` and its index files."""
+    subset = as_subset(input_name)
+    return [f"{subset.bfile}{extension}" for extension in (".bed", ".bim", ".fam")] + [
+        path for path in (subset.keep_path, subset.extract_path, subset.update_sex_path)
+        if path is not None
+    ]
+
+
+def prefix_files(prefix: str) -> list[str]:
+    """Files named `prefix*`, e.g. every output of a plink `--out prefix` run."""
+    return sorted(path for path in glob.glob(f"{glob.escape(prefix)}*") if os.path.isfile(path))
+
+
+def phenotype_digests(phenotype_files: list[tuple[str, str | PhenotypeColumn]]) -> dict[str, str]:
+    """
+    Digest of the values of every phenotype.
+
+    A phenotype file is hashed as a whole; a column of a phenotype matrix is hashed on
+    its own (with FID and IID), so that adding a phenotype to the matrix leaves the
+    digests of the other phenotypes unchanged. Every matrix is read once.
+
+    Args:
+        phenotype_files (list[tuple[str, str | PhenotypeColumn]]):
+            (phenotype name, phenotype file path or matrix column) of every phenotype.
+
+    Returns:
+        dict[str, str]: Digest of every phenotype, by phenotype name.
+    """
+    digests: dict[str, str] = {}
+    files, matrix_columns = group_matrix_columns([path for _, path in phenotype_files])
+    for index, path in files:
+        digests[phenotype_files[index][0]] = content_hash(path)
+    for matrix_path, columns in matrix_columns.items():
+        matrix = pl.read_csv(
+            matrix_path, separator="\t", infer_schema=False,
+            columns=["FID", "IID", *dict.fromkeys(name for _, name in columns)],
+        )
+        for index, name in columns:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(matrix.select("FID", "IID", name).write_csv().encode())
+            digests[phenotype_files[index][0]] = digest.hexdigest()
+    return digests
+
+
+class StageCache(object):
+    """
+    Cache of pipeline stage results, keyed by a hash of the stage inputs and parameters.
+
+    A key hashes the stage name, the content of its input files, its parameters and a
+    salt (e.g. the plink version). A cached result is reused as long as the files the
+    stage produced still exist unchanged; otherwise the stage runs again. File contents
+    are hashed once and remembered by path, size and modification time, so that large
+    filesets are not re-read on every run (see `FileDigests`).
+
+    Example:
+        >>> cache = StageCache(salt=plink_version(fm.plink))
+        >>> keys = [cache.key("ld_pruning", fileset_files(prefix), prefix, 500) for prefix in prefixes]
+        >>> for index, result in cache.run(scheduler, jobs, keys, lambda _, prefix: prefix_files(prefix)):
+        ...     print(prefixes[index], result)
+    """
+
+    def __init__(self, cache_dir: str | None = DEFAULT_CACHE_DIR, salt: str = "") -> None:
+        """
+        Args:
+            cache_dir (str | None): Directory of the cache entries. None disables the
+                cache: nothing is looked up or stored and every stage runs.
+            salt (str): Hashed into every key, e.g. the plink version.
+        """
+        self.cache_dir = cache_dir
+        self.salt = salt
+        # also creates the cache directory
+        self._digests = FileDigests(cache_dir)
+
+    def file_digest(self, path: str | os.PathLike) -> str:
+        """Digest of the content of a file, "missing" if it does not exist."""
+        try:
+            return self._digests.digest(path)
+        except FileNotFoundError:
+            return "missing"
+
+    def key(self, stage: str, inputs: Iterable[str | os.PathLike], *params: Any) -> str:
+        """
+        Key of a stage run.
+
+        Args:
+            stage (str): Name of the stage.
+            inputs (Iterable[str | os.PathLike]): Input files; their paths and contents are hashed.
+            *params (Any): Parameters of the stage; their `repr` is hashed, so they should
+                not contain objects whose `repr` changes between runs.
+
+        Returns:
+            str: Hexadecimal key, empty if the cache is disabled.
+        """
+        if self.cache_dir is None:
+            return ""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{stage}\0{self.salt}".encode())
+        for path in inputs:
+            digest.update(f"\0{os.fspath(path)}\0{self.file_digest(path)}".encode())
+        digest.update(f"\0{params!r}".encode())
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        assert self.cache_dir is not None
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def lookup(self, key: str) -> tuple[bool, Any]:
+        """
+        Look up a stage run.
+
+        Returns:
+            tuple[bool, Any]: (True, cached result) if the run is cached and all its
+                output files are unchanged, (False, None) otherwise.
+        """
+        if self.cache_dir is None:
+            return False, None
+        entry_path = self._entry_path(key)
+        if not os.path.exists(entry_path):
+            return False, None
+        try:
+            with open(entry_path, "rb") as reader:
+                result, outputs = pickle.load(reader)
+        except Exception as e:
+            logger.warning("Ignoring unreadable cache entry %s: %s", entry_path, e)
+            return False, None
+        for path, digest in outputs.items():
+            if self.file_digest(path) != digest:
+                logger.info("Output %s of cache entry %s changed.", path, key)
+                return False, None
+        return True, result
+
+    def store(self, key: str, result: Any, outputs: Iterable[str | os.PathLike]) -> None:
+        """Record a stage run with its (picklable) result and the files it produced."""
+        if self.cache_dir is None:
+            return
+        entry = (result, {os.fspath(path): self.file_digest(path) for path in outputs})
+        temp_path = f"{self._entry_path(key)}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as writer:
+            pickle.dump(entry, writer)
+        os.replace(temp_path, self._entry_path(key))
+
+    def save_digests(self) -> None:
+        """Write all remembered file digests to the digests file and empty the journal."""
+        self._digests.save()
+
+    def partition(self, keys: list[str]) -> tuple[dict[int, Any], list[int]]:
+        """
+        Split stage runs into cached and pending ones, e.g. the phenotypes of a batch.
+
+        Returns:
+            tuple[dict[int, Any], list[int]]: ({index: cached result}, indices of the
+                runs which are not cached).
+        """
+        cached: dict[int, Any] = {}
+        pending: list[int] = []
+        for index, key in enumerate(keys):
+            hit, result = self.lookup(key)
+            if hit:
+                cached[index] = result
+            else:
+                pending.append(index)
+        return cached, pending
+
+    def call(
+        self,
+        key: str,
+        outputs_of: Callable[[Any], Iterable[str | os.PathLike]],
+        function: Callable,
+        *args: Any,
+        allow_none: bool = False,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Call a function in this process unless its result is cached.
+
+        Args:
+            key (str): Key of the call, see `key`.
+            outputs_of (Callable): Files produced by the call, given its result.
+            function (Callable): Function to call with `args` and `kwargs`.
+            allow_none (bool): Also cache None results, for functions which return
+                nothing instead of None on failure.
+
+        Returns:
+            Any: Cached or new result. None results are not cached by default.
+        """
+        hit, result = self.lookup(key)
+        if hit:
+            logger.info("Reusing cached result of %s.", function.__name__)
+            return result
+        result = function(*args, **kwargs)
+        if result is not None or allow_none:
+            self.store(key, result, outputs_of(result))
+        return result
+
+    def job(
+        self,
+        key: str,
+        outputs_of: Callable[[Any], Iterable[str | os.PathLike]],
+        job: Job,
+        allow_none: bool = False,
+    ) -> Pipeline:
+        """
+        Pipeline step running a job unless its result is cached, see
+        `MemoryAwareScheduler.run_pipelines`.
+
+        Example:
+            >>> prefix = yield from cache.job(key, lambda prefix: prefix_files(prefix), Job(quality_control.ld_pruning, ...))
+
+        Args:
+            key (str): Key of the job, see `key`.
+            outputs_of (Callable): Files produced by the job, given its result.
+            job (Job): Job to run.
+            allow_none (bool): Also cache None results, e.g. of visualisations.
+
+        Returns:
+            Any: Cached or new result. None results are not cached by default.
+        """
+        hit, result = self.lookup(key)
+        if hit:
+            return result
+        result = yield job
+        if result is not None or allow_none:
+            self.store(key, result, outputs_of(result))
+        return result
+
+    def run(
+        self,
+        scheduler: MemoryAwareScheduler,
+        jobs: list[Job],
+        keys: list[str],
+        outputs_of: Callable[[int, Any], Iterable[str | os.PathLike]],
+        allow_none: bool = False,
+    ) -> Iterator[tuple[int, Any]]:
+        """
+        Run the jobs whose results are not cached with `scheduler`.
+
+        Args:
+            scheduler (MemoryAwareScheduler): Scheduler running the jobs.
+            jobs (list[Job]): Jobs to run.
+            keys (list[str]): Key of every job, see `key`.
+            outputs_of (Callable): Files produced by a job, given its index in `jobs`
+                and its result.
+            allow_none (bool): Also cache None results, e.g. of visualisations.
+
+        Yields:
+            tuple[int, Any]: (index of the job in `jobs`, cached or new result), cached
+                results first. None results are not cached by default.
+        """
+        if len(jobs) != len(keys):
+            raise ValueError("One key is required for every job.")
+        cached, pending = self.partition(keys)
+        yield from cached.items()
+        if len(pending) < len(jobs):
+            logger.info("Reusing %d of %d cached results.", len(jobs) - len(pending), len(jobs))
+        for pending_index, result in scheduler.run([jobs[index] for index in pending]):
+            index = pending[pending_index]
+            if result is not None or allow_none:
+                self.store(keys[index], result, outputs_of(index, result))
+            yield index, result
@@ -0,0 +1,165 @@
+import math
+
+import numpy as np
+
+_BETACF_MAX_ITERATIONS = 10_000
+_BETACF_EPSILON = 1e-15
+_BETACF_TINY = 1e-300
+
+
+def _log_beta(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Vectorised logarithm of the beta function B(a, b)."""
+    lgamma = np.frompyfunc(math.lgamma, 1, 1)
+    return (lgamma(a) + lgamma(b) - lgamma(a + b)).astype(np.float64)
+
+
+def _beta_continued_fraction(a: np.ndarray, b: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """
+    Continued fraction of the regularised incomplete beta function, evaluated with the
+    modified Lentz method. Converges fast for `x < (a + 1) / (a + b + 2)`.
+    """
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    c = np.ones_like(x)
+    d = 1.0 - qab * x / qap
+    d = np.where(np.abs(d) < _BETACF_TINY, _BETACF_TINY, d)
+    d = 1.0 / d
+    h = d.copy()
+
+    active = np.ones(x.shape, dtype=bool)
+    for m in range(1, _BETACF_MAX_ITERATIONS + 1):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        a_, b_, x_ = a[idx], b[idx], x[idx]
+        c_, d_, h_ = c[idx], d[idx], h[idx]
+        m2 = 2 * m
+        # even step
+        aa = m * (b_ - m) * x_ / ((qam[idx] + m2) * (a_ + m2))
+        d_ = 1.0 + aa * d_
+        d_ = np.where(np.abs(d_) < _BETACF_TINY, _BETACF_TINY, d_)
+        c_ = 1.0 + aa / c_
+        c_ = np.where(np.abs(c_) < _BETACF_TINY, _BETACF_TINY, c_)
+        d_ = 1.0 / d_
+        h_ = h_ * d_ * c_
+        # odd step
+        aa = -(a_ + m) * (qab[idx] + m) * x_ / ((a_ + m2) * (qap[idx] + m2))
+        d_ = 1.0 + aa * d_
+        d_ = np.where(np.abs(d_) < _BETACF_TINY, _BETACF_TINY, d_)
+        c_ = 1.0 + aa / c_
+        c_ = np.where(np.abs(c_) < _BETACF_TINY, _BETACF_TINY, c_)
+        d_ = 1.0 / d_
+        delta = d_ * c_
+        h_ = h_ * delta
+
+        c[idx], d[idx], h[idx] = c_, d_, h_
+        active[idx] = np.abs(delta - 1.0) >= _BETACF_EPSILON
+    return h
+
+
+def regularised_incomplete_beta(a, b, x) -> np.ndarray:
+    """
+    Regularised incomplete beta function I_x(a, b), element-wise.
+
+    Args:
+        a (array-like): First shape parameter (> 0).
+        b (array-like): Second shape parameter (> 0).
+        x (array-like): Upper limit of integration, in [0, 1].
+
+    Returns:
+        np.ndarray: I_x(a, b). NaN where any input is NaN.
+    """
+    a, b, x = np.broadcast_arrays(
+        np.asarray(a, dtype=np.float64),
+        np.asarray(b, dtype=np.float64),
+        np.asarray(x, dtype=np.float64),
+    )
+    result = np.full(x.shape, np.nan)
+    result[x <= 0] = 0.0
+    result[x >= 1] = 1.0
+    inner = (x > 0) & (x < 1) & (a > 0) & (b > 0)
+    if not inner.any():
+        return result
+
+    a_, b_, x_ = a[inner], b[inner], x[inner]
+    # use the symmetry I_x(a, b) = 1 - I_{1-x}(b, a) where the fraction converges faster
+    swap = x_ >= (a_ + 1.0) / (a_ + b_ + 2.0)
+    a_, b_ = np.where(swap, b_, a_), np.where(swap, a_, b_)
+    x_ = np.where(swap, 1.0 - x_, x_)
+
+    log_front = a_ * np.log(x_) + b_ * np.log1p(-x_) - _log_beta(a_, b_)
+    value = np.exp(log_front) * _beta_continued_fraction(a_, b_, x_) / a_
+    result[inner] = np.where(swap, 1.0 - value, value)
+    return result
+
+
+def t_two_sided_p(t, df) -> np.ndarray:
+    """
+    Two-sided p-value of Student's t statistics.
+
+    Args:
+        t (array-like): t statistics.
+        df (array-like): Degrees of freedom.
+
+    Returns:
+        np.ndarray: P(|T| >= |t|). NaN where `t` is NaN or `df` < 1.
+    """
+    t, df = np.broadcast_arrays(
+        np.asarray(t, dtype=np.float64), np.asarray(df, dtype=np.float64)
+    )
+    p = np.full(t.shape, np.nan)
+    valid = np.isfinite(t) & (df >= 1)
+    t_, df_ = t[valid], df[valid]
+    p[valid] = regularised_incomplete_beta(df_ / 2.0, 0.5, df_ / (df_ + t_ * t_))
+    p[np.isinf(t) & (df >= 1)] = 0.0
+    return p
+
+
+def chi2_1df_p(statistic) -> np.ndarray:
+    """
+    Upper tail probability of the chi-square distribution with one degree of freedom.
+
+    Args:
+        statistic (array-like): Chi-square statistics.
+
+    Returns:
+        np.ndarray: P(X >= statistic). NaN where `statistic` is NaN.
+    """
+    statistic = np.asarray(statistic, dtype=np.float64)
+    erfc = np.frompyfunc(math.erfc, 1, 1)
+    with np.errstate(invalid="ignore"):
+        z = np.sqrt(np.where(statistic >= 0, statistic, np.nan) / 2.0)
+    return np.where(np.isnan(z), np.nan, erfc(np.nan_to_num(z)).astype(np.float64))
+
+
+def regression_from_sums(
+    n: np.ndarray,
+    sx: np.ndarray,
+    sxx: np.ndarray,
+    sy: np.ndarray,
+    syy: np.ndarray,
+    sxy: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Simple linear regression of y on x from sample sizes and sums, element-wise.
+
+    Args:
+        n, sx, sxx, sy, syy, sxy (np.ndarray): Number of samples and sums of x, x², y, y²
+            and xy.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: (beta, se, r2, t), NaN
+            where the regression is undefined.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        xvar = sxx - sx * sx / n
+        yvar = syy - sy * sy / n
+        cov = sxy - sx * sy / n
+        valid = (n > 2) & (xvar > 0) & (yvar > 0)
+        beta = np.where(valid, cov / xvar, np.nan)
+        r2 = np.where(valid, cov * cov / (xvar * yvar), np.nan)
+        se = np.sqrt(np.maximum(yvar / xvar - beta * beta, 0.0) / (n - 2))
+        se = np.where(valid, se, np.nan)
+        t = beta / se
+    return beta, se, r2, t
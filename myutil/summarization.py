@@ -1,9 +1,14 @@
 from dataclasses import dataclass
 import logging, os
+import shutil
 import sys
+from typing import Literal
+from urllib.parse import quote
 import polars as pl
 
 from Classes import Gender
+from myutil.plink_table import read_plink_table
+from myutil.stage_cache import StageCache
 
 
 @dataclass
@@ -13,7 +18,8 @@ class QassocResult:
     Attributes:
         qassoc_path (str): Path to the `qassoc` file.
         qt_means_path (str | None): Path to the `qt_means` file.
-        mperm_path (str | None): Path to the `mperm` file.
+        mperm_path (str | None): Path to the `mperm` file, or to the `perm` file of an
+            adaptive permutation test.
         gender (Gender): Gender.
         ethnic_name (str): Ethnicity.
         phenotype_name (str): Name of the phenotype.
@@ -30,116 +36,255 @@ class QassocResult:
     bonferroni_n: int
 
 
-def generate_quantitative_summary(
-    qassoc_results: list[QassocResult],
-    alpha: float,
-    output_prefix: str,
-) -> None:
-    """Generate a summary of the quantitative association analysis, including
-    `summary-q.tsv` and `summary-qt_means.tsv` (if `qt_means_path` is not None).
+SUMMARY_PARTITION_COLUMNS = ["gender", "ethnic", "phenotype"]
+"""Columns by which Parquet summaries are partitioned, in the order of the directories."""
 
-    Args:
-        qassoc_results (list[QassocResult]): List of QassocResult objects.
-        bonferroni_n (int): Bonferroni's correction factor.
-        output_prefix (str): Prefix for the output files.
+DEFAULT_SUMMARY_ROW_GROUP_SIZE = 65_536
+"""Rows per row group of Parquet summaries. Smaller groups let scans skip more rows by
+the statistics of P, at the cost of larger files."""
+
+
+class _TsvAppender(object):
+    """A TSV file which tables are appended to, created with the header of the first one."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.header: list[str] | None = None
+        self._file = None
+        # an output of an earlier run must not be mistaken for this one
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, table: pl.DataFrame, partition: dict[str, str]) -> None:
+        # the partition is in the columns of the table, if anywhere
+        first = self._file is None
+        if first:
+            self._file = open(self.path, "w")
+            self.header = table.columns
+        elif table.columns != self.header:
+            raise ValueError(
+                f"Columns of {self.path} are {self.header}, got {table.columns}."
+            )
+        table.write_csv(self._file, separator="\t", include_header=first)
+        # the summary can be read while it grows
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _ParquetAppender(object):
     """
-    concat_qassoc_results_list: list[pl.DataFrame] = []
-    sig_concat_qassoc_results_list: list[pl.DataFrame] = []
-    concat_qassoc_header: list[str] = []
+    A Parquet dataset which tables are appended to, one file per table in a hive-style
+    directory of its partition, e.g. `gender=Male/ethnic=Han/phenotype=f.50/0.parquet`.
 
-    qt_mean_results_list: list[pl.DataFrame] = []
-    sig_qt_mean_results_list: list[pl.DataFrame] = []
+    Partition values are percent-encoded, and partition columns are not repeated in the
+    files, as `pl.scan_parquet(path, hive_partitioning=True)` restores them from the
+    directories. Rows are sorted by P (if any), so that the row group statistics of P
+    are narrow.
+    """
 
-    for qassoc_res in qassoc_results:
-        concat_qassoc_res, qt_mean_res = _concat_qassoc_mperm_mean(qassoc_res)
+    def __init__(self, path: str, row_group_size: int = DEFAULT_SUMMARY_ROW_GROUP_SIZE) -> None:
+        self.path = path
+        self.row_group_size = row_group_size
+        self.header: list[str] | None = None
+        self._count = 0
+        # an output of an earlier run must not be mistaken for this one
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def write(self, table: pl.DataFrame, partition: dict[str, str]) -> None:
+        table = table.drop(SUMMARY_PARTITION_COLUMNS, strict=False)
+        if self.header is None:
+            self.header = table.columns
+        elif table.columns != self.header:
+            raise ValueError(
+                f"Columns of {self.path} are {self.header}, got {table.columns}."
+            )
+        if "P" in table.columns:
+            table = table.sort("P", nulls_last=True)
+        directory = os.path.join(
+            self.path,
+            *(f"{column}={quote(partition[column], safe='')}" for column in SUMMARY_PARTITION_COLUMNS),
+        )
+        os.makedirs(directory, exist_ok=True)
+        table.write_parquet(
+            os.path.join(directory, f"{self._count}.parquet"),
+            statistics=True,
+            row_group_size=self.row_group_size,
+        )
+        self._count += 1
+
+    def close(self) -> None:
+        pass
+
+
+class SummaryWriter(object):
+    """
+    Incremental writer of the summary of the quantitative association analysis.
+
+    Every added result is joined, filtered and appended to the summary files at once,
+    so only one result is held in memory and the summary can be followed while the
+    association of other groups is still running. The files are:
+
+    - `{output_prefix}-q.tsv`: joined `.qassoc`, permutation and mean tables;
+    - `{output_prefix}-q-significant.tsv`: its significant SNPs;
+    - `{output_prefix}-qt_means.tsv`: `.qassoc.means` tables;
+    - `{output_prefix}-qt_means-significant.tsv`: means of the significant SNPs.
 
-        # Append `concat_qassoc_results`
-        match concat_qassoc_header:
-            case []:
-                concat_qassoc_header = concat_qassoc_res.columns
-            case list() as header:
-                assert header == concat_qassoc_res.columns
+    A file is only created once it has rows. Rows follow the order the results are added.
 
-        concat_qassoc_results_list.append(concat_qassoc_res)
+    Example:
+        >>> with SummaryWriter(0.05, "summary") as writer:
+        ...     for qassoc_result in qassoc_results:
+        ...         writer.add(qassoc_result)
+    """
+
+    def __init__(
+        self,
+        alpha: float,
+        output_prefix: str,
+        output_format: Literal["tsv", "parquet"] = "tsv",
+    ) -> None:
+        """
+        Args:
+            alpha (float): Significance level of the (corrected) p-values.
+            output_prefix (str): Prefix for the output files.
+            output_format (Literal["tsv", "parquet"]): Format of the summary files.
+        """
+        self.alpha = alpha
+        self.output_prefix = output_prefix
+        match output_format:
+            case "tsv":
+                appender = _TsvAppender
+            case "parquet":
+                appender = _ParquetAppender
+            case _:
+                raise ValueError(f"Unknown summary format: {output_format}")
+        self._qassoc = appender(f"{output_prefix}-q.{output_format}")
+        self._sig_qassoc = appender(f"{output_prefix}-q-significant.{output_format}")
+        self._qt_means = appender(f"{output_prefix}-qt_means.{output_format}")
+        self._sig_qt_means = appender(f"{output_prefix}-qt_means-significant.{output_format}")
+
+    @property
+    def outputs(self) -> list[str]:
+        """Summary files (or Parquet datasets) written so far."""
+        return [
+            appender.path
+            for appender in (self._qassoc, self._sig_qassoc, self._qt_means, self._sig_qt_means)
+            if appender.header is not None
+        ]
 
-        # Append `qt_mean_results`
+    def add(self, qassoc_res: QassocResult) -> None:
+        """Append a result to the summary."""
+        concat_qassoc_res, qt_mean_res = _concat_qassoc_mperm_mean(qassoc_res)
+
+        logging.debug("Appending %s to %s", qassoc_res.qassoc_path, self._qassoc.path)
+        partition = {
+            "gender": qassoc_res.gender.value,
+            "ethnic": qassoc_res.ethnic_name,
+            "phenotype": qassoc_res.phenotype_name,
+        }
+        self._qassoc.write(concat_qassoc_res, partition)
         if qt_mean_res is not None:
-            qt_mean_results_list.append(qt_mean_res)
+            self._qt_means.write(qt_mean_res, partition)
 
         # Find out significant SNP
         sig_concat_qassoc_res = concat_qassoc_res.filter(
-            pl.col("PERM_P_2" if "PERM_P_2" in concat_qassoc_header else "P'") < alpha
+            pl.col("PERM_P_2" if "PERM_P_2" in concat_qassoc_res.columns else "P'") < self.alpha
         )
+        if sig_concat_qassoc_res.height == 0:
+            return
+        self._sig_qassoc.write(sig_concat_qassoc_res, partition)
 
-        if sig_concat_qassoc_res.height > 0:
-            # Append `sig_concat_qassoc_results`
-            sig_concat_qassoc_results_list.append(sig_concat_qassoc_res)
+        if qt_mean_res is not None:
+            sig_qt_mean_res = qt_mean_res.join(
+                sig_concat_qassoc_res.select(["CHR", "SNP"]),
+                on=["CHR", "SNP"],
+                how="inner",
+            )
+            if sig_qt_mean_res.height > 0:
+                self._sig_qt_means.write(sig_qt_mean_res, partition)
 
-            if qt_mean_res is not None:
-                # Append `sig_qt_mean_results`
-                sig_qt_mean_res = qt_mean_res.join(
-                    sig_concat_qassoc_res.select(["CHR", "SNP"]),
-                    on=["CHR", "SNP"],
-                    how="inner",
-                )
-                if sig_qt_mean_res.height > 0:
-                    sig_qt_mean_results_list.append(sig_qt_mean_res)
+    def close(self) -> None:
+        """Close the summary files."""
+        for appender in (self._qassoc, self._sig_qassoc, self._qt_means, self._sig_qt_means):
+            if appender.header is None:
+                logging.info("No rows for %s, skipping it", appender.path)
+            appender.close()
 
-    # concat results and write to files
-    logging.info("saving qassoc summary to %s-q.tsv", output_prefix)
-    concat_qassoc_results_df = pl.concat(
-        concat_qassoc_results_list, how="vertical", rechunk=True
-    )
-    concat_qassoc_results_df.write_csv(
-        f"{output_prefix}-q.tsv", separator="\t", include_header=True
-    )
+    def __enter__(self) -> "SummaryWriter":
+        return self
 
-    logging.info(
-        "saving significant qassoc summary to %s-q-significant.tsv", output_prefix
-    )
-    if len(sig_concat_qassoc_results_list) > 0:
-        sig_concat_qassoc_results_df = pl.concat(
-            sig_concat_qassoc_results_list, how="vertical", rechunk=True
-        )
-        sig_concat_qassoc_results_df.write_csv(
-            f"{output_prefix}-q-significant.tsv", separator="\t", include_header=True
-        )
-    else:
-        logging.info(
-            "No significant results found, skipping %s-q-significant.tsv", output_prefix
-        )
+    def __exit__(self, *_) -> None:
+        self.close()
 
-    logging.info("saving qt-means summary to %s-qt_means.tsv", output_prefix)
-    if len(qt_mean_results_list) > 0:
-        concat_qt_mean_results_df = pl.concat(
-            qt_mean_results_list, how="vertical", rechunk=True
-        )
-        concat_qt_mean_results_df.write_csv(
-            f"{output_prefix}-qt_means.tsv", separator="\t", include_header=True
-        )
-    else:
-        logging.info(
-            "No qt_means results found, skipping %s-qt_means.tsv", output_prefix
-        )
 
-    logging.info(
-        "saving significant qt-means summary to %s-qt_means-significant.tsv",
-        output_prefix,
+def generate_quantitative_summary(
+    qassoc_results: list[QassocResult],
+    alpha: float,
+    output_prefix: str,
+    cache: StageCache | None = None,
+    output_format: Literal["tsv", "parquet"] = "tsv",
+) -> list[str]:
+    """Generate a summary of the quantitative association analysis, including
+    `summary-q.tsv` and `summary-qt_means.tsv` (if `qt_means_path` is not None).
+
+    The results are streamed through a `SummaryWriter` one at a time.
+
+    Args:
+        qassoc_results (list[QassocResult]): List of QassocResult objects.
+        alpha (float): Significance level of the (corrected) p-values.
+        output_prefix (str): Prefix for the output files.
+        cache (StageCache | None): Cache of the summary, so that it is only written again
+            once a result file or a parameter changed, or a summary file was modified.
+        output_format (Literal["tsv", "parquet"]): Format of the summary files.
+
+    Returns:
+        list[str]: Summary files (or Parquet datasets) written.
+    """
+    if cache is None:
+        return _write_quantitative_summary(qassoc_results, alpha, output_prefix, output_format)
+    return cache.call(
+        cache.key(
+            "summary",
+            [
+                path for qassoc_res in qassoc_results for path in (
+                    qassoc_res.qassoc_path, qassoc_res.qt_means_path, qassoc_res.mperm_path
+                ) if path is not None
+            ],
+            qassoc_results, alpha, output_prefix, output_format,
+        ),
+        _summary_files,
+        _write_quantitative_summary,
+        qassoc_results, alpha, output_prefix, output_format,
     )
-    if len(sig_qt_mean_results_list) > 0:
-        sig_qt_mean_results_df = pl.concat(
-            sig_qt_mean_results_list, how="vertical", rechunk=True
-        )
-        sig_qt_mean_results_df.write_csv(
-            f"{output_prefix}-qt_means-significant.tsv",
-            separator="\t",
-            include_header=True,
-        )
-    else:
-        logging.info(
-            "No significant qt_means results found, skipping %s-qt_means-significant.tsv",
-            output_prefix,
-        )
+
+
+def _write_quantitative_summary(
+    qassoc_results: list[QassocResult],
+    alpha: float,
+    output_prefix: str,
+    output_format: Literal["tsv", "parquet"],
+) -> list[str]:
+    with SummaryWriter(alpha, output_prefix, output_format=output_format) as writer:
+        for qassoc_res in qassoc_results:
+            writer.add(qassoc_res)
+    return writer.outputs
+
+
+def _summary_files(outputs: list[str]) -> list[str]:
+    """Files of the summary outputs, i.e. the files of every Parquet dataset."""
+    return [
+        os.path.join(root, name)
+        for output in outputs
+        for root, _, names in (os.walk(output) if os.path.isdir(output) else [("", [], [output])])
+        for name in sorted(names)
+    ]
 
 
 def _concat_qassoc_mperm_mean(
@@ -180,10 +325,20 @@ def _concat_qassoc_mperm_mean(
         print(qassoc_df)
         raise e
 
-    if qassoc_result.mperm_path is not None:
+    perm_columns: list[str] = []
+    if qassoc_result.mperm_path is not None and qassoc_result.mperm_path.endswith(".perm"):
+        # adaptive permutation: pointwise p-value and number of permutations per SNP
+        mperm_df = _parse_perm_file(qassoc_result.mperm_path).rename(
+            {"EMP1": "PERM_P_1", "NP": "PERM_N"}
+        )
+        perm_columns = ["PERM_P_1", "PERM_N"]
+    elif qassoc_result.mperm_path is not None:
         mperm_df = _parse_mperm_file(qassoc_result.mperm_path).rename(
             {"EMP1": "PERM_P_1", "EMP2": "PERM_P_2"}
         )
+        perm_columns = ["PERM_P_1", "PERM_P_2"]
+
+    if qassoc_result.mperm_path is not None:
 
         qassoc_df = qassoc_df.join(
             mperm_df,
@@ -232,8 +387,7 @@ def _concat_qassoc_mperm_mean(
                 "T",
                 "P",
                 "P'",
-                "PERM_P_1",
-                "PERM_P_2",
+                *perm_columns,
                 "gender",
                 "ethnic",
                 "phenotype",
@@ -282,8 +436,7 @@ def _concat_qassoc_mperm_mean(
                 "T",
                 "P",
                 "P'",
-                "PERM_P_1",
-                "PERM_P_2",
+                *perm_columns,
                 "gender",
                 "ethnic",
                 "phenotype",
@@ -336,38 +489,18 @@ def _parse_qassoc_file(qassoc_path: str) -> pl.DataFrame:
         logging.error("File '%s' not found.", qassoc_path)
         raise FileNotFoundError(f"File '{qassoc_path}' not found.")
 
-    qassoc_df = pl.read_csv(
+    qassoc_df = read_plink_table(
         qassoc_path,
-        has_header=False,
-        skip_rows=1,
-        new_columns=["whole_line"],
-    )
-    qassoc_df = qassoc_df.select(
-        pl.col("whole_line")
-        .str.strip_chars()
-        .str.replace_all(r"\s+", " ")
-        .str.split(" ")
-    )
-
-    assert (
-        len(qassoc_df.select(pl.col("whole_line").first()).to_series().to_list()[0])
-        == 9
-    )
-
-    headers = ["CHR", "SNP", "BP", "NMISS", "BETA", "SE", "R2", "T", "P"]
-    qassoc_df = qassoc_df.select(
-        [
-            pl.col("whole_line").list.get(i).alias(header)
-            for i, header in enumerate(headers)
-        ]
-    ).with_columns(
-        pl.col("BP").cast(pl.Int64),
-        pl.col("NMISS").cast(pl.UInt32),
-        pl.col("BETA").cast(pl.Float64, strict=False),
-        pl.col("SE").cast(pl.Float64, strict=False),
-        pl.col("R2").cast(pl.Float64, strict=False),
-        pl.col("T").cast(pl.Float64, strict=False),
-        pl.col("P").cast(pl.Float64, strict=False),
+        new_columns=["CHR", "SNP", "BP", "NMISS", "BETA", "SE", "R2", "T", "P"],
+        dtypes={
+            "BP": pl.Int64,
+            "NMISS": pl.UInt32,
+            "BETA": pl.Float64,
+            "SE": pl.Float64,
+            "R2": pl.Float64,
+            "T": pl.Float64,
+            "P": pl.Float64,
+        },
     ).drop_nulls()
 
     return qassoc_df
@@ -393,32 +526,42 @@ def _parse_mperm_file(mperm_path) -> pl.DataFrame:
         logging.error("File '%s' not found.", mperm_path)
         raise FileNotFoundError(f"File '{mperm_path}' not found.")
 
-    mperm_df = pl.read_csv(
+    mperm_df = read_plink_table(
         mperm_path,
-        has_header=False,
-        skip_rows=1,
-        new_columns=["whole_line"],
-    )
-    mperm_df = mperm_df.select(
-        pl.col("whole_line")
-        .str.strip_chars()
-        .str.replace_all(r"\s+", " ")
-        .str.split(" ")
+        new_columns=["CHR", "SNP", "EMP1", "EMP2"],
+        dtypes={"EMP1": pl.Float64, "EMP2": pl.Float64},
     )
 
-    assert (
-        len(mperm_df.select(pl.col("whole_line").first()).to_series().to_list()[0]) == 4
-    )
+    return mperm_df
 
-    headers = ["CHR", "SNP", "EMP1", "EMP2"]
-    mperm_df = mperm_df.select(
-        [
-            pl.col("whole_line").list.get(i).alias(header)
-            for i, header in enumerate(headers)
-        ]
-    ).with_columns(pl.col("EMP1").cast(pl.Float64), pl.col("EMP2").cast(pl.Float64))
 
-    return mperm_df
+def _parse_perm_file(perm_path: str) -> pl.DataFrame:
+    """
+    Parse an adaptive permutation `.qassoc.perm` file into a pl.DataFrame
+
+    Args:
+        perm_path (str): Path to the .qassoc.perm file.
+
+    Returns:
+        pl.DataFrame: Parsed DataFrame with columns:
+            - CHR: Chromosome
+            - SNP: SNP identifier
+            - EMP1: Empirical p-value (pointwise)
+            - NP: Number of permutations performed for the SNP
+    """
+    logging.debug("Parsing .perm file: %s", perm_path)
+
+    if not os.path.exists(perm_path):
+        logging.error("File '%s' not found.", perm_path)
+        raise FileNotFoundError(f"File '{perm_path}' not found.")
+
+    perm_df = read_plink_table(
+        perm_path,
+        new_columns=["CHR", "SNP", "EMP1", "NP"],
+        dtypes={"EMP1": pl.Float64, "NP": pl.Int64},
+    )
+
+    return perm_df
 
 
 def _parse_qt_means_file(qt_means_path: str) -> pl.DataFrame:
@@ -439,28 +582,9 @@ def _parse_qt_means_file(qt_means_path: str) -> pl.DataFrame:
     if not os.path.exists(qt_means_path):
         raise FileNotFoundError(f"File '{qt_means_path}' not found.")
 
-    qt_means_df = pl.read_csv(
+    return read_plink_table(
         qt_means_path,
-        has_header=False,
-        skip_rows=1,
-        new_columns=["whole_line"],
-    )
-    qt_means_df = qt_means_df.select(
-        pl.col("whole_line")
-        .str.strip_chars()
-        .str.replace_all(r"\s+", " ")
-        .str.split(" ")
-    )
-
-    assert (
-        len(qt_means_df.select(pl.col("whole_line").first()).to_series().to_list()[0])
-        == 6
-    )
-
-    headers = ["CHR", "SNP", "VALUE", "G11", "G12", "G22"]
-    return qt_means_df.select(
-        [
-            pl.col("whole_line").list.get(i).alias(header)
-            for i, header in enumerate(headers)
-        ]
+        new_columns=["CHR", "SNP", "VALUE", "G11", "G12", "G22"],
+        # the means are kept as written, "NA" included
+        null_values=[],
     )
@@ -0,0 +1,388 @@
+import bisect
+import gzip
+import logging
+import math
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+from typing import Iterator
+
+from myutil.genotype import BED_MAGIC
+from myutil.scheduler import MEBIBYTE, PLINK_BASE_MEMORY, Job, MemoryAwareScheduler, plink_resource_args
+from myutil.small_tools import create_logger
+
+logger = create_logger("VcfLogger", level=logging.WARN)
+
+DEFAULT_VCF_CHUNK_BYTES = 64 * MEBIBYTE
+"""Smallest compressed size of a chunk of a chunked VCF conversion."""
+
+CHUNKS_PER_THREAD = 4
+"""Chunks per thread of a chunked VCF conversion, so that uneven chunks balance out."""
+
+# gzip member header of a BGZF block: magic with FEXTRA, MTIME, XFL, OS, XLEN = 6, and the
+# "BC" subfield holding the block size minus one
+_BGZF_HEADER = struct.Struct("<4sIBBHBBHH")
+_BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+# bins holding index metadata instead of offsets
+_TBI_PSEUDO_BIN = 37450
+
+
+def is_bgzf(path: str) -> bool:
+    """Whether a file is block gzip compressed (as by `bgzip`), and can be split at its blocks."""
+    with open(path, "rb") as reader:
+        header = reader.read(_BGZF_HEADER.size)
+    if len(header) < _BGZF_HEADER.size:
+        return False
+    magic, _, _, _, xlen, si1, si2, _, _ = _BGZF_HEADER.unpack(header)
+    return magic == _BGZF_MAGIC and xlen == 6 and (si1, si2) == (ord("B"), ord("C"))
+
+
+def _bgzf_blocks(path: str, offset: int = 0) -> Iterator[tuple[int, bytes]]:
+    """
+    Decompress the BGZF blocks of a file from a compressed offset on.
+
+    Yields:
+        tuple[int, bytes]: (compressed offset of the block, uncompressed data).
+    """
+    with open(path, "rb") as reader:
+        reader.seek(offset)
+        while len(header := reader.read(_BGZF_HEADER.size)) == _BGZF_HEADER.size:
+            *_, block_size = _BGZF_HEADER.unpack(header)
+            block = reader.read(block_size + 1 - _BGZF_HEADER.size)
+            # deflate data without the CRC32 and ISIZE trailer
+            yield offset, zlib.decompress(block[:-8], wbits=-15)
+            offset += block_size + 1
+
+
+def _block_offsets(path: str) -> list[int]:
+    """Compressed offsets of every BGZF block, read from the block headers only."""
+    offsets = []
+    offset = 0
+    with open(path, "rb") as reader:
+        while len(header := reader.read(_BGZF_HEADER.size)) == _BGZF_HEADER.size:
+            *_, block_size = _BGZF_HEADER.unpack(header)
+            offsets.append(offset)
+            offset += block_size + 1
+            reader.seek(offset)
+    return offsets
+
+
+def _index_offsets(path: str) -> list[int] | None:
+    """
+    Virtual offsets of record starts listed in the tabix (`.tbi`) or CSI (`.csi`) index
+    of a bgzipped VCF, None if there is no up-to-date index.
+    """
+    for index_path in (f"{path}.tbi", f"{path}.csi"):
+        if os.path.exists(index_path):
+            break
+    else:
+        return None
+    if os.path.getmtime(index_path) < os.path.getmtime(path):
+        logger.warning("Ignoring %s, which is older than %s.", index_path, path)
+        return None
+
+    with gzip.open(index_path, "rb") as reader:
+        index = reader.read()
+    offsets = []
+    position = 0
+
+    def unpack(format: str) -> tuple:
+        nonlocal position
+        values = struct.unpack_from(format, index, position)
+        position += struct.calcsize(format)
+        return values
+
+    match index[:4]:
+        case b"TBI\x01":
+            position = 4
+            n_ref, *_ = unpack("<7i")
+            (names_length,) = unpack("<i")
+            position += names_length
+            pseudo_bin = _TBI_PSEUDO_BIN
+        case b"CSI\x01":
+            position = 4
+            _, depth, aux_length = unpack("<3i")
+            position += aux_length
+            (n_ref,) = unpack("<i")
+            pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+        case _:
+            logger.warning("Ignoring %s, which is not a tabix or CSI index.", index_path)
+            return None
+    for _ in range(n_ref):
+        (n_bin,) = unpack("<i")
+        for _ in range(n_bin):
+            (bin_number,) = unpack("<I")
+            if index[:4] == b"CSI\x01":
+                position += 8  # loffset
+            (n_chunk,) = unpack("<i")
+            chunks = unpack(f"<{2 * n_chunk}Q")
+            if bin_number != pseudo_bin:
+                offsets.extend(chunks[::2])
+        if index[:4] == b"TBI\x01":
+            (n_intv,) = unpack("<i")
+            offsets.extend(offset for offset in unpack(f"<{n_intv}Q") if offset > 0)
+    return sorted(set(offsets))
+
+
+def read_vcf_header(path: str) -> tuple[bytes, int | None]:
+    """
+    Read the header (meta-information and `#CHROM` lines) of a bgzipped VCF.
+
+    Returns:
+        tuple[bytes, int | None]: (header, virtual offset of the first record), the
+            offset being None if the file has no records.
+    """
+    header = bytearray()
+    at_line_start = True
+    for block_offset, data in _bgzf_blocks(path):
+        position = 0
+        while position < len(data):
+            if at_line_start and data[position:position + 1] != b"#":
+                return bytes(header), (block_offset << 16) | position
+            newline = data.find(b"\n", position)
+            if newline == -1:
+                header += data[position:]
+                at_line_start = False
+                break
+            header += data[position:newline + 1]
+            position = newline + 1
+            at_line_start = True
+    return bytes(header), None
+
+
+def split_vcf(path: str, n_chunks: int) -> list[tuple[int, int | None, bool, bool]]:
+    """
+    Split the records of a bgzipped VCF into chunks of about the same compressed size.
+
+    Chunks start at record starts listed in the tabix/CSI index of the file if there is
+    one, so that they hold whole regions. Otherwise they start at BGZF block boundaries,
+    which usually fall within a record: such a boundary belongs to the chunk before it,
+    which reads on to the end of the record, and the chunk after it starts at the next
+    record.
+
+    Args:
+        path (str): Path of the bgzipped VCF.
+        n_chunks (int): Maximum number of chunks.
+
+    Returns:
+        list[tuple[int, int | None, bool, bool]]: (start virtual offset, end virtual
+            offset or None for the end of the file, whether the start is a record start,
+            whether the end is a record start) of every chunk, in file order.
+    """
+    _, first_record = read_vcf_header(path)
+    if first_record is None:
+        return []
+    candidates = _index_offsets(path)
+    aligned = candidates is not None
+    if candidates is None:
+        candidates = [offset << 16 for offset in _block_offsets(path)]
+    candidates = [offset for offset in candidates if offset > first_record]
+
+    file_size = os.path.getsize(path)
+    boundaries = [first_record]
+    for chunk in range(1, n_chunks):
+        target = (first_record >> 16) + chunk * (file_size - (first_record >> 16)) // n_chunks
+        position = bisect.bisect_left(candidates, target << 16)
+        if position == len(candidates):
+            break
+        if candidates[position] > boundaries[-1]:
+            boundaries.append(candidates[position])
+    ends: list[int | None] = [*boundaries[1:], None]
+    return [
+        (start, end, start == first_record or aligned, end is None or aligned)
+        for start, end in zip(boundaries, ends)
+    ]
+
+
+def _chunk_data(
+    path: str, start: int, end: int | None, aligned_start: bool, aligned_end: bool
+) -> Iterator[bytes]:
+    """Uncompressed records of a chunk returned by `split_vcf`."""
+    end_block = None if end is None else end >> 16
+    # the record the start falls within belongs to the chunk before
+    skipping = not aligned_start
+    # past the end of the chunk, finishing the record the end falls within
+    finishing = False
+    for block_offset, data in _bgzf_blocks(path, start >> 16):
+        if block_offset == start >> 16:
+            data = data[start & 0xFFFF:]
+        last = False
+        if end_block is not None and block_offset >= end_block:
+            if aligned_end:
+                data = data[:end & 0xFFFF] if block_offset == end_block else b""
+                last = True
+            else:
+                finishing = True
+        if skipping:
+            newline = data.find(b"\n")
+            if newline == -1:
+                if last:
+                    return
+                continue
+            if finishing:
+                # the record also ends past the end of the chunk: the chunk is empty
+                return
+            data = data[newline + 1:]
+            skipping = False
+        if finishing:
+            newline = data.find(b"\n")
+            if newline != -1:
+                yield data[:newline + 1]
+                return
+        yield data
+        if last:
+            return
+
+
+def convert_vcf_chunk(
+    plink_path: str,
+    vcf_path: str,
+    header: bytes,
+    chunk: tuple[int, int | None, bool, bool],
+    out: str,
+) -> str | None:
+    """
+    Convert one chunk of a bgzipped VCF to a plink binary fileset.
+
+    Args:
+        plink_path (str): Path of the plink executable.
+        vcf_path (str): Path of the bgzipped VCF.
+        header (bytes): Header of the VCF, see `read_vcf_header`.
+        chunk (tuple[int, int | None, bool, bool]): Chunk returned by `split_vcf`.
+        out (str): Output prefix.
+
+    Returns:
+        str | None: `out`, "" if the chunk holds no records, None if the conversion failed.
+
+    Generate Files:
+        %(out)s.bed, %(out)s.bim, %(out)s.fam
+    """
+    chunk_path = f"{out}.vcf"
+    try:
+        records = 0
+        with open(chunk_path, "wb") as writer:
+            writer.write(header)
+            for data in _chunk_data(vcf_path, *chunk):
+                records += data.count(b"\n")
+                writer.write(data)
+        if records == 0:
+            return ""
+        subprocess.run(
+            [
+                plink_path,
+                *plink_resource_args(),
+                "--vcf", chunk_path,
+                "--make-bed",
+                "--vcf-half-call", "missing",
+                "--out", out,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+        )
+    except (subprocess.CalledProcessError, OSError) as err:
+        logger.error("An error occurred when converting %s to plink binary file: %s", chunk_path, err)
+        return None
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+    return out
+
+
+def concatenate_filesets(prefixes: list[str], out: str) -> None:
+    """
+    Concatenate plink binary filesets of the same samples holding consecutive variants.
+
+    Args:
+        prefixes (list[str]): Filesets in variant order.
+        out (str): Output prefix.
+
+    Raises:
+        ValueError: if the filesets do not have the same samples.
+
+    Generate Files:
+        %(out)s.bed, %(out)s.bim, %(out)s.fam
+    """
+    with open(f"{prefixes[0]}.fam", "rb") as reader:
+        fam = reader.read()
+    for prefix in prefixes[1:]:
+        with open(f"{prefix}.fam", "rb") as reader:
+            if reader.read() != fam:
+                raise ValueError(f"{prefix}.fam differs from {prefixes[0]}.fam.")
+    shutil.copyfile(f"{prefixes[0]}.fam", f"{out}.fam")
+    with open(f"{out}.bim", "wb") as writer:
+        for prefix in prefixes:
+            with open(f"{prefix}.bim", "rb") as reader:
+                shutil.copyfileobj(reader, writer)
+    with open(f"{out}.bed", "wb") as writer:
+        writer.write(BED_MAGIC)
+        for prefix in prefixes:
+            with open(f"{prefix}.bed", "rb") as reader:
+                if reader.read(len(BED_MAGIC)) != BED_MAGIC:
+                    raise ValueError(f"{prefix}.bed is not a SNP-major plink .bed file.")
+                shutil.copyfileobj(reader, writer)
+
+
+def chunked_vcf_conversion(
+    plink_path: str,
+    vcf_path: str,
+    out: str,
+    scheduler: MemoryAwareScheduler,
+    chunk_bytes: int = DEFAULT_VCF_CHUNK_BYTES,
+) -> bool:
+    """
+    Convert a bgzipped VCF to a plink binary fileset, converting chunks of the VCF in
+    parallel and concatenating the results.
+
+    The VCF is split with `split_vcf` into up to `CHUNKS_PER_THREAD` chunks per thread of
+    the scheduler, of at least `chunk_bytes` compressed bytes. Every chunk is decompressed
+    and converted by its own plink process, and the chunk filesets are concatenated in
+    order, which gives the same fileset as a single `plink --vcf --make-bed` call.
+
+    Args:
+        plink_path (str): Path of the plink executable.
+        vcf_path (str): Path of the bgzipped VCF.
+        out (str): Output prefix.
+        scheduler (MemoryAwareScheduler): Scheduler running the chunk conversions.
+        chunk_bytes (int): Smallest compressed size of a chunk.
+
+    Returns:
+        bool: Whether the conversion succeeded.
+
+    Generate Files:
+        %(out)s.bed, %(out)s.bim, %(out)s.fam
+    """
+    n_chunks = min(
+        CHUNKS_PER_THREAD * scheduler.max_threads,
+        max(1, math.ceil(os.path.getsize(vcf_path) / chunk_bytes)),
+    )
+    header, _ = read_vcf_header(vcf_path)
+    chunks = split_vcf(vcf_path, n_chunks)
+    if len(chunks) == 0:
+        logger.error("%s holds no records.", vcf_path)
+        return False
+    logger.info("Converting %s in %d chunks.", vcf_path, len(chunks))
+
+    chunk_dir = f"{out}_vcf_chunks"
+    os.makedirs(chunk_dir, exist_ok=True)
+    jobs = [
+        Job(
+            convert_vcf_chunk,
+            (plink_path, vcf_path, header, chunk, os.path.join(chunk_dir, f"chunk{index}")),
+            # plink holds the genotypes of the chunk, at most about 4 times its compressed size
+            memory=PLINK_BASE_MEMORY + 4 * chunk_bytes,
+        ) for index, chunk in enumerate(chunks)
+    ]
+    prefixes: list[str | None] = [None] * len(jobs)
+    for index, result in scheduler.run(jobs):
+        prefixes[index] = result
+    try:
+        if any(prefix is None for prefix in prefixes):
+            return False
+        concatenate_filesets([prefix for prefix in prefixes if prefix], out)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+    return True
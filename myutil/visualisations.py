@@ -10,8 +10,9 @@ import numpy as np
 import polars as pl
 import seaborn as sns
 
-from Classes import FileManagement, Gender
+from Classes import FileManagement, Gender, VirtualSubset, bfile_args
 from myutil import small_tools
+from myutil.scheduler import plink_resource_args
 
 # matplotlib.use('Agg')
 logger = small_tools.create_logger("MainLogger", level=logging.WARNING)
@@ -19,7 +20,7 @@ logger = small_tools.create_logger("MainLogger", level=logging.WARNING)
 
 def missing(
     fm: FileManagement,
-    input_name: str,
+    input_name: str | VirtualSubset,
     save_path_name: str,
     ethnic: str | None = None,
     gender: Literal["Men", "Women"] | None = None
@@ -52,9 +53,10 @@ def missing(
     try:
         command = [
             fm.plink,
-            "--bfile", input_name,
+            *bfile_args(input_name),
+            *plink_resource_args(),
             "--missing",
-            "--out", input_name
+            "--out", str(input_name)
         ]
         subprocess.run(
             command,
@@ -104,7 +106,7 @@ def missing(
 
 def hardy_weinberg(
     fm: FileManagement,
-    input_name: str,
+    input_name: str | VirtualSubset,
     save_path_name: str,
     ethnic: str | None = None,
     gender: Gender = Gender.UNKNOWN
@@ -127,9 +129,10 @@ def hardy_weinberg(
     try:
         command = [
             fm.plink,
-            "--bfile", input_name,
+            *bfile_args(input_name),
+            *plink_resource_args(),
             "--hardy",
-            "--out", input_name
+            "--out", str(input_name)
         ]
         subprocess.run(
             command,
@@ -167,7 +170,7 @@ def hardy_weinberg(
 
 def minor_allele_frequency(
     fm: FileManagement,
-    input_name: str,
+    input_name: str | VirtualSubset,
     save_path_name: str,
     /,
     ethnic: str | None = None,
@@ -186,9 +189,10 @@ def minor_allele_frequency(
     try:
         command = [
             fm.plink,
-            "--bfile", input_name,
+            *bfile_args(input_name),
+            *plink_resource_args(),
             "--freq",
-            "--out", input_name
+            "--out", str(input_name)
         ]
         subprocess.run(
             command,
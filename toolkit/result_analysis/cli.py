@@ -27,7 +27,8 @@ def parser_check(parser: argparse.ArgumentParser):
     args = parser.parse_args()
     # check input files
     for file in args.input:
-        if not os.path.isfile(file):
+        # Parquet summaries are folders
+        if not os.path.exists(file):
             parser.error(f"{file} is not a valid file!")
 
 
@@ -40,7 +41,7 @@ def get_parser():
         "--input", "-i",
         required=True,
         nargs='+',
-        help='List of input files'
+        help='List of input files: summary .tsv/.csv files, or .parquet summary folders'
     )
 
     _ = parser.add_argument(
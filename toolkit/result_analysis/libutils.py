@@ -1,9 +1,15 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
+import multiprocessing
+import os
 import polars as pl
+import matplotlib
 import matplotlib.pyplot as plt
+from xlsxwriter import Workbook
 # import seaborn as sns
 
-from typing import Sequence
+from typing import Callable, Literal, Sequence
 
 
 class QassocColumns(Enum):
@@ -61,78 +67,77 @@ REFERENCE_COLUMNS_SCHEMA = {
 
 NULL_VALUES = ["NA", "Na", "na", "NAN", "NaN", "Nan", "nan", "NULL", "null"]
 
+_REQUIRED_COLUMNS = [QassocColumns.SNP.value, QassocColumns.P.value]
 
-def read_gwas_results(file_paths: list[str]) -> pl.LazyFrame:
-    # results_df = pl.DataFrame(
-    #     schema=QASSOC_COLUMNS_SCHEMA,
-    # ).with_columns(
-    #     pl.col(QassocColumns.P.value).cast(
-    #         pl.Float64, strict=False).drop_nulls()
-    # )
 
-    result_df_list: list[pl.DataFrame] = []
+def _scan_gwas_result(file_path: str) -> pl.LazyFrame:
+    """Lazily scan one summary: a .tsv/.csv file, a .parquet file or a Parquet dataset folder."""
+    if os.path.isdir(file_path) or file_path.endswith(".parquet"):
+        # partitioned summaries keep gender, ethnic and phenotype in the folder names
+        return pl.scan_parquet(file_path, hive_partitioning=True)
+    return pl.scan_csv(
+        file_path,
+        separator="\t" if file_path.endswith(".tsv") else ",",
+        has_header=True,
+        null_values=NULL_VALUES,
+        # every column is cast to `QASSOC_COLUMNS_SCHEMA` anyway
+        infer_schema=False,
+    )
 
-    for file_path in file_paths:
-        result_df = pl.read_csv(
-            file_path,
-            separator="\t" if file_path.endswith(".tsv") else ",",
-            has_header=True,
-            null_values=NULL_VALUES,
-        )
-        if result_df.is_empty():
-            continue
 
-        result_df_list.append(result_df)
-
-    results_df: pl.DataFrame | None = None
-    mutual_header: list[str] | None = None
-    for result_df in result_df_list:
-        header = result_df.columns
-        match mutual_header, header:
-            case None, list():
-                mutual_header = [
-                    s for s in header
-                    if s in [
-                        column.value for column in QassocColumns
-                    ]
-                ]
-                results_df = result_df.select([
-                    pl.col(s).cast(QASSOC_COLUMNS_SCHEMA[s], strict=False)
-                    for s in mutual_header
-                ]).drop_nulls()
-
-            case list(), list():
-                assert results_df is not None
-
-                verified_header = [
-                    s for s in header
-                    if s in [
-                        column.value for column in QassocColumns
-                    ]
-                ]
-                old_mutual_header = mutual_header
-                mutual_header = [
-                    s for s in verified_header
-                    if s in old_mutual_header
-                ]
-
-                if mutual_header != old_mutual_header:
-                    results_df = results_df.select(mutual_header)
-
-                results_df.vstack(
-                    result_df.select(
-                        mutual_header
-                    ).cast(
-                        {
-                            col: QASSOC_COLUMNS_SCHEMA[col]
-                            for col in mutual_header
-                        }
-                    )
-                )
+def read_gwas_results(file_paths: list[str]) -> pl.LazyFrame:
+    """
+    Lazily scan GWAS summaries (`summary-q*.tsv` files, or `.parquet` datasets written with
+    `--output-format parquet`) into one LazyFrame.
 
-    assert results_df is not None
+    Only the headers are read here. The result has the union of the `QassocColumns` of all
+    summaries, typed by `QASSOC_COLUMNS_SCHEMA`; columns a summary lacks are null for its
+    rows. Rows whose SNP or P is missing or cannot be cast are dropped. Since nothing is
+    loaded, the projections and filters of later queries reach the files.
 
-    results_lf = results_df.rechunk().lazy()
+    Args:
+        file_paths (list[str]): Paths of the summaries.
+
+    Returns:
+        pl.LazyFrame: Rows of all summaries.
+    """
+    scans: list[tuple[pl.LazyFrame, list[str]]] = []
+    for file_path in file_paths:
+        if os.path.isfile(file_path) and os.path.getsize(file_path) == 0:
+            continue
+        lf = _scan_gwas_result(file_path)
+        columns = [
+            column for column in lf.collect_schema().names()
+            if column in QASSOC_COLUMNS_SCHEMA
+        ]
+        scans.append((lf, columns))
+
+    assert len(scans) > 0, "No GWAS results to read."
+
+    union_header = [
+        column for column in QASSOC_COLUMNS_SCHEMA
+        if any(column in columns for _, columns in scans)
+    ]
+
+    results_lf = pl.concat(
+        [
+            lf.select(
+                pl.col(column).cast(QASSOC_COLUMNS_SCHEMA[column], strict=False)
+                for column in columns
+            )
+            .drop_nulls(
+                # only these, so that queries still read just the columns they use
+                [column for column in _REQUIRED_COLUMNS if column in columns]
+            )
+            .select(
+                pl.col(column) if column in columns
+                else pl.lit(None, dtype=QASSOC_COLUMNS_SCHEMA[column]).alias(column)
+                for column in union_header
+            )
+            for lf, columns in scans
+        ],
+        how="vertical",
+    )
 
     return results_lf
 
@@ -149,20 +154,35 @@ def read_reference_data(file_path: str) -> pl.LazyFrame:
 
     return lf
 
-def concatenate_results(results_lf: pl.LazyFrame, reference_lf: pl.LazyFrame) -> tuple[pl.LazyFrame, pl.LazyFrame]:
-    """Concatenate results and reference data"""
-    merged_results =  (
+def join_reference(
+    results_lf: pl.LazyFrame, reference_lf: pl.LazyFrame, how: Literal["inner", "left"] = "inner"
+) -> pl.LazyFrame:
+    """
+    Join GWAS results with the phenotype reference data by the field id of their
+    phenotype (e.g. `21001` of `f.21001.0`).
+
+    The result keeps the `phenotype` column and adds `field_id` and `phenotype_name`;
+    results whose field id is not in the reference are dropped (or kept without a
+    `phenotype_name` with `how="left"`). Every rank is derived from this frame.
+    """
+    return (
         results_lf
             .with_columns(
                 field_id=pl.col(QassocColumns.PHENOTYPE.value).str.split(".").list.get(1)
             )
-            .rename({QassocColumns.PHENOTYPE.value: "f.id"})
             .join(
                 reference_lf,
                 left_on="field_id",
                 right_on=ReferenceColumns.FIELD_ID.value,
-                how="inner"
+                how=how
             )
+    )
+
+
+def _concatenated_results(joined_lf: pl.LazyFrame) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+    merged_results = (
+        joined_lf
+            .rename({QassocColumns.PHENOTYPE.value: "f.id"})
             .drop("field_id")
     )
     avg_lf = (
@@ -177,64 +197,99 @@ def concatenate_results(results_lf: pl.LazyFrame, reference_lf: pl.LazyFrame) ->
     )
     return merged_results, avg_lf
 
-def snp_frequency_rank(
-    result_lf: pl.LazyFrame,
-    reference_lf: pl.LazyFrame,
+
+def concatenate_results(results_lf: pl.LazyFrame, reference_lf: pl.LazyFrame) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+    """Concatenate results and reference data"""
+    return _concatenated_results(join_reference(results_lf, reference_lf))
+
+
+EXCEL_MAX_ROWS = 1_048_576
+"""Rows of an Excel worksheet, including the header row."""
+
+EXCEL_MAX_SHEETS_PER_TABLE = 8
+"""Worksheets a table may be split across before it is written to Parquet instead."""
+
+
+def _sheet_name(name: str, part: int | None = None) -> str:
+    """Worksheet name of (a part of) a table; Excel allows at most 31 characters."""
+    suffix = "" if part is None else f" ({part})"
+    return name[:31 - len(suffix)] + suffix
+
+
+def write_workbook(
+    path: str,
+    tables: dict[str, pl.DataFrame],
     *,
-    save_path: str = "results/snp_frequency_rank"
-) -> pl.LazyFrame:
+    max_sheet_rows: int = EXCEL_MAX_ROWS - 1,
+    max_sheets: int = EXCEL_MAX_SHEETS_PER_TABLE,
+) -> list[str]:
     """
-    Calculate the frequency rank of SNPs based on the occurrence frequency of related phenotypes.
+    Write tables to a workbook, one worksheet per table, streaming the rows in
+    xlsxwriter's constant memory mode.
+
+    A table longer than a worksheet is split across worksheets `name (1)`, `name (2)`,
+    ...; one that would need more than `max_sheets` worksheets is written to
+    `{path without .xlsx}-{name}.parquet` instead, and its worksheet only points to
+    that file. List values are written as text.
 
     Args:
-        result_lf (pl.LazyFrame): LazyFrame containing SNP data.
-        reference_lf (pl.LazyFrame): LazyFrame containing phenotype reference data.
-        save_path (str): Path to save the results.
+        path (str): Path of the workbook.
+        tables (dict[str, pl.DataFrame]): Tables by worksheet name.
+        max_sheet_rows (int): Rows of a worksheet, without the header.
+        max_sheets (int): Worksheets a table may be split across.
 
     Returns:
-        pl.LazyFrame: LazyFrame containing SNP frequency rank data.
+        list[str]: Paths of the Parquet files written instead of worksheets.
     """
-    RELATED_PHENO_OCCUR_FREQ = "related phenotype occurrence frequency"
+    fallbacks: list[str] = []
+    with Workbook(path, {"constant_memory": True, "nan_inf_to_errors": True}) as wb:
+        header_format = wb.add_format({"bold": True})
+        for name, df in tables.items():
+            parts = max(-(-df.height // max_sheet_rows), 1)
+            if parts > max_sheets:
+                fallback = f"{os.path.splitext(path)[0]}-{name}.parquet"
+                df.write_parquet(fallback)
+                fallbacks.append(fallback)
+                ws = wb.add_worksheet(_sheet_name(name))
+                ws.write(0, 0, f"{df.height} rows do not fit in this workbook; the table is written to:")
+                ws.write(1, 0, os.path.basename(fallback))
+                continue
+
+            for part in range(parts):
+                ws = wb.add_worksheet(_sheet_name(name, None if parts == 1 else part + 1))
+                ws.write_row(0, 0, df.columns, header_format)
+                # in constant memory mode, every row is flushed to disk once the next begins
+                for row_number, row in enumerate(
+                    df.slice(part * max_sheet_rows, max_sheet_rows).iter_rows(), start=1
+                ):
+                    ws.write_row(
+                        row_number, 0,
+                        [str(value) if isinstance(value, list) else value for value in row],
+                    )
+    return fallbacks
 
-    result_lf = result_lf.with_columns(
-        field_id=pl.col(QassocColumns.PHENOTYPE.value).str.split(".").list.get(1)
-    ).drop(QassocColumns.PHENOTYPE.value)
 
-    rank_lf = (
-        result_lf.join(
-            reference_lf,
-            left_on="field_id",
-            right_on=ReferenceColumns.FIELD_ID.value
-        )
-        .unique()
-        .with_columns(
-            pl.concat_str(
-                [
-                    pl.col(QassocColumns.ETHNIC.value),
-                    pl.col(QassocColumns.GENDER.value),
-                    pl.col(ReferenceColumns.PHENOTYPE.value)
-                ],
-                separator="-"
-            )
-                .alias("$(ethnic)-$(gender)-$(phenotype)")
-        )
-        .group_by(QassocColumns.SNP.value)
-        .agg(
-            pl.col("$(ethnic)-$(gender)-$(phenotype)"),
-            pl.col("$(ethnic)-$(gender)-$(phenotype)").count().alias(RELATED_PHENO_OCCUR_FREQ)
-        )
-        .sort(
-            by=RELATED_PHENO_OCCUR_FREQ,
-            descending=True,
-            maintain_order=True
-        )
-    )
+@dataclass(frozen=True)
+class _RankChart:
+    """Bar chart of the first 50 rows of a rank."""
+    label: str
+    count: str
+    title: str
+    xlabel: str
 
-    rank_lf.collect().write_excel(f"{save_path}.xlsx")
 
-    rank_head_df = rank_lf.head(50).select(
-        QassocColumns.SNP.value, RELATED_PHENO_OCCUR_FREQ).collect()
+CHART_STYLE = "seaborn-v0_8-whitegrid"
+"""Matplotlib style of the rank charts rendered by `analyse`."""
 
+
+def _init_chart_worker(style: str) -> None:
+    """Set up a chart rendering process: no display is needed, and the style is not inherited."""
+    matplotlib.use("Agg")
+    plt.style.use(style)
+
+
+def _plot_rank(rank_head_df: pl.DataFrame, chart: _RankChart, save_path: str) -> str:
+    """Draw the bar chart of the head of a rank to `{save_path}.png` and close it."""
     fig, ax = plt.subplots()
     fig.set_dpi(150)
     fig.set_size_inches(15, 5)
@@ -242,8 +297,8 @@ def snp_frequency_rank(
     ax.xaxis.set_tick_params(rotation=90)
 
     ax.bar(
-        rank_head_df[QassocColumns.SNP.value],
-        rank_head_df[RELATED_PHENO_OCCUR_FREQ],
+        rank_head_df[chart.label],
+        rank_head_df[chart.count],
         linewidth=1,
         width=0.6,
         align="center",
@@ -253,46 +308,98 @@ def snp_frequency_rank(
     for i in rank_head_df.iter_rows(named=False):
         ax.text(i[0], i[1], str(i[1]), ha="center", va="bottom")
 
-    ax.set_title(
-        "Frequency Rank of SNPs' Significant Association with Phenotypes")
-    ax.set_xlabel("SNP")
+    ax.set_title(chart.title)
+    ax.set_xlabel(chart.xlabel)
     ax.set_ylabel("Frequency")
 
     fig.tight_layout()
-    plt.savefig(f"{save_path}.png", dpi=300)
+    fig.savefig(f"{save_path}.png", dpi=300)
+    # figures are kept by pyplot until closed
+    plt.close(fig)
+    return f"{save_path}.png"
 
-    return rank_lf
 
+def _save_rank(rank_df: pl.DataFrame, chart: _RankChart, save_path: str) -> None:
+    """Write a rank to `{save_path}.xlsx` and its chart to `{save_path}.png`."""
+    write_workbook(f"{save_path}.xlsx", {os.path.basename(save_path): rank_df})
+    _plot_rank(rank_df.head(50).select(chart.label, chart.count), chart, save_path)
 
-def snp_phenotype_pair_rank(
+
+RELATED_PHENO_OCCUR_FREQ = "related phenotype occurrence frequency"
+
+_SNP_FREQUENCY_CHART = _RankChart(
+    QassocColumns.SNP.value,
+    RELATED_PHENO_OCCUR_FREQ,
+    "Frequency Rank of SNPs' Significant Association with Phenotypes",
+    "SNP",
+)
+
+
+def _snp_frequency_rank(joined_lf: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        joined_lf
+        .drop(QassocColumns.PHENOTYPE.value)
+        .unique()
+        .with_columns(
+            pl.concat_str(
+                [
+                    pl.col(QassocColumns.ETHNIC.value),
+                    pl.col(QassocColumns.GENDER.value),
+                    pl.col(ReferenceColumns.PHENOTYPE.value)
+                ],
+                separator="-"
+            )
+                .alias("$(ethnic)-$(gender)-$(phenotype)")
+        )
+        .group_by(QassocColumns.SNP.value)
+        .agg(
+            pl.col("$(ethnic)-$(gender)-$(phenotype)"),
+            pl.col("$(ethnic)-$(gender)-$(phenotype)").count().alias(RELATED_PHENO_OCCUR_FREQ)
+        )
+        .sort(
+            by=RELATED_PHENO_OCCUR_FREQ,
+            descending=True,
+            maintain_order=True
+        )
+    )
+
+
+def snp_frequency_rank(
     result_lf: pl.LazyFrame,
     reference_lf: pl.LazyFrame,
     *,
-    save_path: str = "results/snp_phenotype_pair_rank"
+    save_path: str = "results/snp_frequency_rank"
 ) -> pl.LazyFrame:
     """
-    Calculate the frequency ranking of SNPs' SNP-phenotype pairs (no duplication).
+    Calculate the frequency rank of SNPs based on the occurrence frequency of related phenotypes.
 
     Args:
-        result_lf (pl.LazyFrame): Input LazyFrame containing GWAS results with SNP and phenotype data.
+        result_lf (pl.LazyFrame): LazyFrame containing SNP data.
         reference_lf (pl.LazyFrame): LazyFrame containing phenotype reference data.
-        save_path (str): Output path prefix for saving results (will generate .xlsx and .png files).
+        save_path (str): Path to save the results.
 
     Returns:
-        pl.LazyFrame: Processed LazyFrame with SNPs' SNP-phenotype association frequencies ranked by count.
+        pl.LazyFrame: LazyFrame containing SNP frequency rank data.
     """
-    RELATED_PHENOTYPE_PAIRS_FRQ = "SNPs' phenotype pairs frequency"
+    rank_df = _snp_frequency_rank(join_reference(result_lf, reference_lf)).collect()
+    _save_rank(rank_df, _SNP_FREQUENCY_CHART, save_path)
+    return rank_df.lazy()
 
-    result_lf = result_lf.with_columns(
-        field_id=pl.col(QassocColumns.PHENOTYPE.value).str.split(".").list.get(1)
-    ).drop(QassocColumns.PHENOTYPE.value)
 
-    rank_lf = (
-        result_lf.join(
-            reference_lf,
-            left_on="field_id",
-            right_on=ReferenceColumns.FIELD_ID.value
-        )
+RELATED_PHENOTYPE_PAIRS_FRQ = "SNPs' phenotype pairs frequency"
+
+_SNP_PHENOTYPE_PAIR_CHART = _RankChart(
+    QassocColumns.SNP.value,
+    RELATED_PHENOTYPE_PAIRS_FRQ,
+    "Frequency Rank of SNPs' Significant Association with Phenotypes (Pairwise)",
+    "SNP",
+)
+
+
+def _snp_phenotype_pair_rank(joined_lf: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        joined_lf
+        .drop(QassocColumns.PHENOTYPE.value)
         .with_columns(
             pl.concat_str(
                 [
@@ -327,69 +434,44 @@ def snp_phenotype_pair_rank(
         )
     )
 
-    rank_lf.collect().write_excel(f"{save_path}.xlsx")
-
-    rank_head_df = rank_lf.head(50).select(
-        QassocColumns.SNP.value, RELATED_PHENOTYPE_PAIRS_FRQ).collect()
-
-    fig, ax = plt.subplots()
-    fig.set_dpi(150)
-    fig.set_size_inches(15, 5)
-    # fig.set_layout_engine("compressed")
-    ax.xaxis.set_tick_params(rotation=90)
-
-    ax.bar(
-        rank_head_df[QassocColumns.SNP.value],
-        rank_head_df[RELATED_PHENOTYPE_PAIRS_FRQ],
-        linewidth=1,
-        width=0.6,
-        align="center",
-        label="Frequency Rank"
-    )
-
-    for i in rank_head_df.iter_rows(named=False):
-        ax.text(i[0], i[1], str(i[1]), ha="center", va="bottom")
-
-    ax.set_title(
-        "Frequency Rank of SNPs' Significant Association with Phenotypes (Pairwise)")
-    ax.set_xlabel("SNP")
-    ax.set_ylabel("Frequency")
-
-    fig.tight_layout()
-    plt.savefig(f"{save_path}.png", dpi=300)
 
-    return rank_lf
-
-
-def snp_ethnicity_pair_rank(
+def snp_phenotype_pair_rank(
     result_lf: pl.LazyFrame,
     reference_lf: pl.LazyFrame,
     *,
-    save_path: str = "results/snp_ethnic_pair_rank"
+    save_path: str = "results/snp_phenotype_pair_rank"
 ) -> pl.LazyFrame:
     """
-    Calculate the frequency ranking of SNP-ethnicity pairs (no duplication).
+    Calculate the frequency ranking of SNPs' SNP-phenotype pairs (no duplication).
 
     Args:
-        result_lf (pl.LazyFrame): Input LazyFrame containing GWAS results with SNP and ethnicity data.
-        reference_lf (pl.LazyFrame): Input LazyFrame containing SNP frequency rank data.
+        result_lf (pl.LazyFrame): Input LazyFrame containing GWAS results with SNP and phenotype data.
+        reference_lf (pl.LazyFrame): LazyFrame containing phenotype reference data.
         save_path (str): Output path prefix for saving results (will generate .xlsx and .png files).
 
     Returns:
-        pl.LazyFrame: Processed LazyFrame with SNP-ethnicity association frequencies ranked by count.
+        pl.LazyFrame: Processed LazyFrame with SNPs' SNP-phenotype association frequencies ranked by count.
     """
-    RELATED_ETHNICITY_PAIRS_FRQ = "SNPs' ethnicity pairs frequency"
-    result_lf = result_lf.with_columns(
-        field_id=pl.col(QassocColumns.PHENOTYPE.value).str.split(".").list.get(1)
-    ).drop(QassocColumns.PHENOTYPE.value)
-
-    rank_lf = (
-        result_lf.join(
-            reference_lf,
-            left_on="field_id",
-            right_on=ReferenceColumns.FIELD_ID.value,
-            how="inner"
-        )
+    rank_df = _snp_phenotype_pair_rank(join_reference(result_lf, reference_lf)).collect()
+    _save_rank(rank_df, _SNP_PHENOTYPE_PAIR_CHART, save_path)
+    return rank_df.lazy()
+
+
+RELATED_ETHNICITY_PAIRS_FRQ = "SNPs' ethnicity pairs frequency"
+
+_SNP_ETHNICITY_PAIR_CHART = _RankChart(
+    QassocColumns.SNP.value,
+    RELATED_ETHNICITY_PAIRS_FRQ,
+    # 每个 SNP 在不同种族中与表型显著关联的种族计数
+    "Frequency Rank of populations with significant associations of each SNP (Pairwise)",
+    "SNP",
+)
+
+
+def _snp_ethnicity_pair_rank(joined_lf: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        joined_lf
+        .drop(QassocColumns.PHENOTYPE.value)
         .unique()
         .with_columns(
             pl.concat_str(
@@ -425,61 +507,43 @@ def snp_ethnicity_pair_rank(
         )
     )
 
-    rank_lf.collect().write_excel(f"{save_path}.xlsx")
-
-    rank_head_df = rank_lf.head(50).select(
-        QassocColumns.SNP.value, RELATED_ETHNICITY_PAIRS_FRQ).collect()
-
-    fig, ax = plt.subplots()
-    fig.set_dpi(150)
-    fig.set_size_inches(15, 5)
-    # fig.set_layout_engine("compressed")
-    ax.xaxis.set_tick_params(rotation=90)
-
-    ax.bar(
-        rank_head_df[QassocColumns.SNP.value],
-        rank_head_df[RELATED_ETHNICITY_PAIRS_FRQ],
-        linewidth=1,
-        width=0.6,
-        align="center",
-        label="Frequency Rank"
-    )
-
-    for i in rank_head_df.iter_rows(named=False):
-        ax.text(i[0], i[1], str(i[1]), ha="center", va="bottom")
-
-    ax.set_title(
-        "Frequency Rank of populations with significant associations of each SNP (Pairwise)")
-    """每个 SNP 在不同种族中与表型显著关联的种族计数"""
-    ax.set_xlabel("SNP")
-    ax.set_ylabel("Frequency")
-
-    fig.tight_layout()
-    plt.savefig(f"{save_path}.png", dpi=300)
-
-    return rank_lf
 
-
-def snp_phenotype_duplication_rank(
-    lf: pl.LazyFrame,
+def snp_ethnicity_pair_rank(
+    result_lf: pl.LazyFrame,
+    reference_lf: pl.LazyFrame,
     *,
-    save_path: str = "results/snp_phenotype_duplication_rank"):
+    save_path: str = "results/snp_ethnic_pair_rank"
+) -> pl.LazyFrame:
     """
-    Calculate the duplication frequency ranking of SNP-phenotype pairs across different ethnic groups.
+    Calculate the frequency ranking of SNP-ethnicity pairs (no duplication).
 
     Args:
-        lf (pl.LazyFrame): Input LazyFrame containing GWAS results with SNP, phenotype, and ethnicity data.
+        result_lf (pl.LazyFrame): Input LazyFrame containing GWAS results with SNP and ethnicity data.
+        reference_lf (pl.LazyFrame): Input LazyFrame containing SNP frequency rank data.
         save_path (str): Output path prefix for saving results (will generate .xlsx and .png files).
 
     Returns:
-        pl.LazyFrame: Processed LazyFrame with SNP-phenotype pairs ranked by their duplication count across ethnicities.
-
-    Note:
-        The duplication count represents the number of ethnic groups in which the SNP-phenotype association is observed.
+        pl.LazyFrame: Processed LazyFrame with SNP-ethnicity association frequencies ranked by count.
     """
-    DUPLICATION_FRQ = "SNP-phenotype duplication count"
-    rank_lf = (
+    rank_df = _snp_ethnicity_pair_rank(join_reference(result_lf, reference_lf)).collect()
+    _save_rank(rank_df, _SNP_ETHNICITY_PAIR_CHART, save_path)
+    return rank_df.lazy()
+
+
+DUPLICATION_FRQ = "SNP-phenotype duplication count"
+
+_SNP_PHENOTYPE_DUPLICATION_CHART = _RankChart(
+    "SNP-Phenotype",
+    DUPLICATION_FRQ,
+    "Frequency Rank of Significant Associations of SNP-phenotype Pair",
+    "SNP-Phenotype",
+)
+
+
+def _snp_phenotype_duplication_rank(lf: pl.LazyFrame) -> pl.LazyFrame:
+    return (
         lf
+        .select("SNP", "phenotype", "ethnic")
         .unique()
         .group_by("SNP", "phenotype")
         .agg("ethnic")
@@ -495,70 +559,43 @@ def snp_phenotype_duplication_rank(
         )
     )
 
-    rank_lf.collect().write_excel(f"{save_path}.xlsx")
-
-    rank_head_df = rank_lf.head(50).select(
-        "SNP-Phenotype", DUPLICATION_FRQ).collect()
-
-    fig, ax = plt.subplots()
-    fig.set_dpi(150)
-    fig.set_size_inches(15, 5)
-    # fig.set_layout_engine("compressed")
-    ax.xaxis.set_tick_params(rotation=90)
-
-    ax.bar(
-        rank_head_df["SNP-Phenotype"],
-        rank_head_df[DUPLICATION_FRQ],
-        linewidth=1,
-        width=0.6,
-        align="center",
-        label="Frequency Rank"
-    )
-
-    for i in rank_head_df.iter_rows(named=False):
-        ax.text(i[0], i[1], str(i[1]), ha="center", va="bottom")
-
-
-    ax.set_title(
-        "Frequency Rank of Significant Associations of SNP-phenotype Pair")
-    """"""
-    ax.set_xlabel("SNP-Phenotype")
-    ax.set_ylabel("Frequency")
-
-    fig.tight_layout()
-    plt.savefig(f"{save_path}.png", dpi=300)
 
-def phenotype_frequency_rank(
-    result_lf: pl.LazyFrame,
-    reference_lf: pl.LazyFrame,
+def snp_phenotype_duplication_rank(
+    lf: pl.LazyFrame,
     *,
-    save_path: str = "results/phenotype_frequency_rank",
-) -> pl.LazyFrame:
+    save_path: str = "results/snp_phenotype_duplication_rank"):
     """
-    Calculate the frequency rank of phenotypes based on their occurrence frequency in the GWAS analysis result.
+    Calculate the duplication frequency ranking of SNP-phenotype pairs across different ethnic groups.
 
     Args:
-        result_lf (pl.LazyFrame): The GWAS analysis result.
-        reference_lf (pl.LazyFrame): The phenotype reference data, recording phenotype f.id and corresponding phenotype name.
-        save_path (str, optional): The path to save the result. Defaults to "results/phenotype_frequency_rank".
+        lf (pl.LazyFrame): Input LazyFrame containing GWAS results with SNP, phenotype, and ethnicity data.
+        save_path (str): Output path prefix for saving results (will generate .xlsx and .png files).
 
     Returns:
-        pl.LazyFrame: LazyFrame containing the frequency rank of phenotypes.
+        pl.LazyFrame: Processed LazyFrame with SNP-phenotype pairs ranked by their duplication count across ethnicities.
+
+    Note:
+        The duplication count represents the number of ethnic groups in which the SNP-phenotype association is observed.
     """
-    RELATED_SNP_COUNT = "related SNPs count"
+    rank_df = _snp_phenotype_duplication_rank(lf).collect()
+    _save_rank(rank_df, _SNP_PHENOTYPE_DUPLICATION_CHART, save_path)
+    return rank_df.lazy()
 
-    rank_lf = (
-        result_lf
-            .with_columns(
-                field_id=pl.col(QassocColumns.PHENOTYPE.value).str.split(".").list.get(1)
-            )
+
+RELATED_SNP_COUNT = "related SNPs count"
+
+_PHENOTYPE_FREQUENCY_CHART = _RankChart(
+    ReferenceColumns.PHENOTYPE.value,
+    RELATED_SNP_COUNT,
+    "Frequency Rank of Phenotypes' Significant Associations with SNPs",
+    "Phenotype",
+)
+
+
+def _phenotype_frequency_rank(joined_lf: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        joined_lf
             .drop(QassocColumns.PHENOTYPE.value)
-            .join(
-                reference_lf,
-                left_on="field_id",
-                right_on=ReferenceColumns.FIELD_ID.value,
-                how="inner"
-            )
             .unique()
             .with_columns(
                 pl.concat_str(
@@ -582,80 +619,43 @@ def phenotype_frequency_rank(
             )
     )
 
-    rank_lf.collect().write_excel(f"{save_path}.xlsx")
-
-    # plotting
-    rank_head_df = rank_lf.head(50).select(
-        pl.col(ReferenceColumns.PHENOTYPE.value).alias("phenotype"),
-        RELATED_SNP_COUNT
-    ).collect()
-
-    fig, ax = plt.subplots()
-    fig.set_dpi(150)
-    fig.set_size_inches(15, 5)
-    ax.xaxis.set_tick_params(rotation=90)
-
-    ax.bar(
-        rank_head_df["phenotype"],
-        rank_head_df[RELATED_SNP_COUNT],
-        linewidth=1,
-        width=0.6,
-        align="center",
-        label="Frequency Rank"
-    )
-
-    for i in rank_head_df.iter_rows(named=False):
-        ax.text(i[0], i[1], str(i[1]), ha="center", va="bottom")
-
-    ax.set_title(
-        "Frequency Rank of Phenotypes' Significant Associations with SNPs"
-    )
-    ax.set_xlabel("Phenotype")
-    ax.set_ylabel("Frequency")
-
-    fig.tight_layout()
-    plt.savefig(f"{save_path}.png", dpi=300)
-
-    return rank_lf
 
-def phenotype_snp_pair_rank(
+def phenotype_frequency_rank(
     result_lf: pl.LazyFrame,
     reference_lf: pl.LazyFrame,
     *,
-    save_path: str = "results/snp_phenotype_pair_rank"
+    save_path: str = "results/phenotype_frequency_rank",
 ) -> pl.LazyFrame:
     """
-    Calculate the frequency ranking of phenotypes' SNP-phenotype pairs (no duplication)
+    Calculate the frequency rank of phenotypes based on their occurrence frequency in the GWAS analysis result.
 
     Args:
-        result_lf (pl.LazyFrame): Input LazyFrame containing GWAS calculation results
-            generated by this project.
-        reference_lf (pl.LazyFrame): LazyFrame containing phenotype reference data.
-        save_path (str): Output path prefix for saving results (will generate .xlsx and
-            .png files). Extension will be generated automatically.
+        result_lf (pl.LazyFrame): The GWAS analysis result.
+        reference_lf (pl.LazyFrame): The phenotype reference data, recording phenotype f.id and corresponding phenotype name.
+        save_path (str, optional): The path to save the result. Defaults to "results/phenotype_frequency_rank".
 
     Returns:
-        pl.LazyFrame: Processed Lazyrame with phenotypes' SNP-phenotype pair ranked count.
+        pl.LazyFrame: LazyFrame containing the frequency rank of phenotypes.
     """
-    RELATED_PAIRS_FRQ = "Phenotypes' snp pairs number"
+    rank_df = _phenotype_frequency_rank(join_reference(result_lf, reference_lf)).collect()
+    _save_rank(rank_df, _PHENOTYPE_FREQUENCY_CHART, save_path)
+    return rank_df.lazy()
 
-    rank_lf = (
-        result_lf
-            .with_columns(
-                pl.col(QassocColumns.PHENOTYPE.value)
-                    .str
-                    .split(".")
-                    .list
-                    .get(1)
-                    .alias("field_id")
-            )
+
+RELATED_PAIRS_FRQ = "Phenotypes' snp pairs number"
+
+_PHENOTYPE_SNP_PAIR_CHART = _RankChart(
+    ReferenceColumns.PHENOTYPE.value,
+    RELATED_PAIRS_FRQ,
+    "Frequency Rank of Phenotypes' Significant Association with SNPs (Pairwise)",
+    "Phenotype",
+)
+
+
+def _phenotype_snp_pair_rank(joined_lf: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        joined_lf
             .drop(QassocColumns.PHENOTYPE.value)
-            .join(
-                reference_lf,
-                left_on="field_id",
-                right_on=ReferenceColumns.FIELD_ID.value,
-                how="inner"
-            )
             .with_columns(
                 pl.concat_str(
                     [
@@ -689,76 +689,44 @@ def phenotype_snp_pair_rank(
             )
     )
 
-    rank_lf.collect().write_excel(f"{save_path}.xlsx")
-
-    # visualisation
-    rank_head_df = rank_lf.head(50).select(
-        ReferenceColumns.PHENOTYPE.value, RELATED_PAIRS_FRQ
-    ).collect()
-
-    fig, ax = plt.subplots()
-    fig.set_dpi(150)
-    fig.set_size_inches(15, 5)
-    ax.get_xaxis().set_tick_params(rotation=90)
-
-    ax.bar(
-        rank_head_df[ReferenceColumns.PHENOTYPE.value],
-        rank_head_df[RELATED_PAIRS_FRQ],
-        linewidth=1,
-        width=0.6,
-        align="center",
-        label="Frequency Rank"
-    )
-
-    for i in rank_head_df.iter_rows(named=False):
-        ax.text(i[0], i[1], str(i[1]), ha="center", va="bottom")
-
-    ax.set_title(
-        "Frequency Rank of Phenotypes' Significant Association with SNPs (Pairwise)"
-    )
-    ax.set_xlabel("Phenotype")
-    ax.set_ylabel("Frequency")
-
-    fig.tight_layout()
-    plt.savefig(f"{save_path}.png", dpi=300)
-
-    return rank_lf
 
-def phenotype_ethnicity_pair_rank(
+def phenotype_snp_pair_rank(
     result_lf: pl.LazyFrame,
     reference_lf: pl.LazyFrame,
     *,
-    save_path: str,
+    save_path: str = "results/snp_phenotype_pair_rank"
 ) -> pl.LazyFrame:
     """
-    Calculate the frequency ranking of phenotype-ethnicity pairs (no duplication).
+    Calculate the frequency ranking of phenotypes' SNP-phenotype pairs (no duplication)
 
     Args:
-        result_lf (pl.LazyFrame): Input LazyFrame containing GWAS results with SNP and ethnicity data.
-        reference_lf (pl.LazyFrame): Input LazyFrame containing SNP frequency rank data.
-        save_path (str): Output path prefix for saving results (will generate .xlsx and .png files).
+        result_lf (pl.LazyFrame): Input LazyFrame containing GWAS calculation results
+            generated by this project.
+        reference_lf (pl.LazyFrame): LazyFrame containing phenotype reference data.
+        save_path (str): Output path prefix for saving results (will generate .xlsx and
+            .png files). Extension will be generated automatically.
 
     Returns:
-        pl.LazyFrame: LazyFrame containing the frequency ranking of phenotype-ethnicity pairs.
+        pl.LazyFrame: Processed Lazyrame with phenotypes' SNP-phenotype pair ranked count.
     """
-    RELATED_PAIRS_FRQ = "phenotypes' ethnicity pairs frequency"
+    rank_df = _phenotype_snp_pair_rank(join_reference(result_lf, reference_lf)).collect()
+    _save_rank(rank_df, _PHENOTYPE_SNP_PAIR_CHART, save_path)
+    return rank_df.lazy()
 
-    rank_lf = (
-        result_lf
-            .with_columns(
-                pl.col(QassocColumns.PHENOTYPE.value)
-                    .str
-                    .split(".")
-                    .list
-                    .get(1)
-                    .alias("field_id")
-            )
-            .join(
-                reference_lf,
-                left_on="field_id",
-                right_on=ReferenceColumns.FIELD_ID.value,
-                how="inner",
-            )
+
+RELATED_ETHNICITY_PAIRS_FRQ_OF_PHENOTYPES = "phenotypes' ethnicity pairs frequency"
+
+_PHENOTYPE_ETHNICITY_PAIR_CHART = _RankChart(
+    ReferenceColumns.PHENOTYPE.value,
+    RELATED_ETHNICITY_PAIRS_FRQ_OF_PHENOTYPES,
+    "Rank of Population Group Numbers with Significant SNP-phenotype Associations",
+    "Phenotype",
+)
+
+
+def _phenotype_ethnicity_pair_rank(joined_lf: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        joined_lf
             .unique()
             .with_columns(
                 pl.concat_str(
@@ -792,49 +760,166 @@ def phenotype_ethnicity_pair_rank(
             .group_by(ReferenceColumns.PHENOTYPE.value)
             .agg(
                 pl.col("[$($(SNP),), $(ethnic)-$(gender)]"),
-                pl.col("[$($(SNP),), $(ethnic)-$(gender)]").count().alias(RELATED_PAIRS_FRQ)
+                pl.col("[$($(SNP),), $(ethnic)-$(gender)]").count().alias(RELATED_ETHNICITY_PAIRS_FRQ_OF_PHENOTYPES)
             )
             .sort(
-                by=RELATED_PAIRS_FRQ,
+                by=RELATED_ETHNICITY_PAIRS_FRQ_OF_PHENOTYPES,
                 descending=True,
                 maintain_order=True,
             )
     )
 
-    rank_lf.collect().write_excel(f"{save_path}.xlsx")
 
-    rank_head_df = rank_lf.head(50).select(
-        pl.col(ReferenceColumns.PHENOTYPE.value).alias("phenotype"),
-        pl.col(RELATED_PAIRS_FRQ)
-    ).collect()
+def phenotype_ethnicity_pair_rank(
+    result_lf: pl.LazyFrame,
+    reference_lf: pl.LazyFrame,
+    *,
+    save_path: str,
+) -> pl.LazyFrame:
+    """
+    Calculate the frequency ranking of phenotype-ethnicity pairs (no duplication).
 
-    fig, ax = plt.subplots()
-    fig.set_dpi(150)
-    fig.set_size_inches(15, 5)
+    Args:
+        result_lf (pl.LazyFrame): Input LazyFrame containing GWAS results with SNP and ethnicity data.
+        reference_lf (pl.LazyFrame): Input LazyFrame containing SNP frequency rank data.
+        save_path (str): Output path prefix for saving results (will generate .xlsx and .png files).
 
-    ax.xaxis.set_tick_params(rotation=90)
+    Returns:
+        pl.LazyFrame: LazyFrame containing the frequency ranking of phenotype-ethnicity pairs.
+    """
+    rank_df = _phenotype_ethnicity_pair_rank(join_reference(result_lf, reference_lf)).collect()
+    _save_rank(rank_df, _PHENOTYPE_ETHNICITY_PAIR_CHART, save_path)
+    return rank_df.lazy()
+
+
+RANKS = (
+    "snp_frequency_rank",
+    "snp_phenotype_pair_rank",
+    "snp_ethnicity_pair_rank",
+    "snp_phenotype_duplication_rank",
+    "phenotype_frequency_rank",
+    "phenotype_snp_pair_rank",
+    "phenotype_ethnicity_pair_rank",
+)
+"""Names of the ranks `analyse` can compute, which are also the names of their files."""
+
+_RANK_PLANS: dict[str, tuple[Callable[[pl.LazyFrame], pl.LazyFrame], bool, _RankChart]] = {
+    # name: (plan, whether it is derived from the results joined with the reference, chart)
+    "snp_frequency_rank": (_snp_frequency_rank, True, _SNP_FREQUENCY_CHART),
+    "snp_phenotype_pair_rank": (_snp_phenotype_pair_rank, True, _SNP_PHENOTYPE_PAIR_CHART),
+    "snp_ethnicity_pair_rank": (_snp_ethnicity_pair_rank, True, _SNP_ETHNICITY_PAIR_CHART),
+    "snp_phenotype_duplication_rank": (
+        _snp_phenotype_duplication_rank, False, _SNP_PHENOTYPE_DUPLICATION_CHART
+    ),
+    "phenotype_frequency_rank": (_phenotype_frequency_rank, True, _PHENOTYPE_FREQUENCY_CHART),
+    "phenotype_snp_pair_rank": (_phenotype_snp_pair_rank, True, _PHENOTYPE_SNP_PAIR_CHART),
+    "phenotype_ethnicity_pair_rank": (
+        _phenotype_ethnicity_pair_rank, True, _PHENOTYPE_ETHNICITY_PAIR_CHART
+    ),
+}
 
-    ax.bar(
-        rank_head_df["phenotype"],
-        rank_head_df[RELATED_PAIRS_FRQ],
-        linewidth=1,
-        width=0.6,
-        align="center",
-        label="Frequency Rank"
-    )
 
-    for i in rank_head_df.iter_rows(named=False):
-        ax.text(i[0], i[1], str(i[1]), ha="center", va="bottom")
+_MATCHED = "__matched"
+"""Column marking the results found in the reference, see `_analyse_plans`."""
 
-    ax.set_title(
-        "Rank of Population Group Numbers with Significant SNP-phenotype Associations"
-    )
-    ax.set_xlabel("Phenotype")
-    ax.set_ylabel("Frequency")
 
-    fig.tight_layout()
-    plt.savefig(f"{save_path}.png", dpi=300)
+def _analyse_plans(
+    results_lf: pl.LazyFrame, reference_lf: pl.LazyFrame, ranks: Sequence[str]
+) -> tuple[list[str], list[pl.LazyFrame]]:
+    """
+    Plans of the tables of `analyse`, derived from the results joined with the reference,
+    which is collected here once.
+
+    `pl.collect_all` does not share the scan and join between plans which reorder them
+    differently, so the join is materialised. It is a left join, so that the results
+    whose phenotype is not in the reference are kept for the ranks computed on the
+    results alone; the other plans only use the matched rows. Every column is kept, as
+    the concatenated table exports all of them.
+
+    Returns:
+        tuple[list[str], list[pl.LazyFrame]]: Names of the tables (`concatenated`, `mean`
+            and `ranks`) and their plans.
+    """
+    all_df = join_reference(
+        results_lf, reference_lf.with_columns(pl.lit(True).alias(_MATCHED)), how="left"
+    ).collect()
+    joined_lf = all_df.lazy().filter(pl.col(_MATCHED)).drop(_MATCHED)
+    unjoined_lf = all_df.lazy().select(results_lf.collect_schema().names())
+
+    names = ["concatenated", "mean", *ranks]
+    plans = [
+        *_concatenated_results(joined_lf),
+        *(
+            _RANK_PLANS[rank][0](joined_lf if _RANK_PLANS[rank][1] else unjoined_lf)
+            for rank in ranks
+        ),
+    ]
+    return names, plans
+
+
+def analyse(
+    results_lf: pl.LazyFrame,
+    reference_lf: pl.LazyFrame,
+    ranks: Sequence[str] = RANKS,
+    *,
+    output: str = "results",
+    chart_workers: int | None = None,
+) -> dict[str, pl.DataFrame]:
+    """
+    Export the results concatenated with the reference data and compute several ranks at
+    once, writing `{output}/concatenated_results.xlsx` and `{output}/{rank}.xlsx|.png`
+    (see `write_workbook` for tables too long for a workbook).
+
+    Unlike calling every rank function, which scans and joins the results again each
+    time, the results are scanned and joined with the reference once (see `_analyse_plans`);
+    every table is then derived from the joined frame in a single `pl.collect_all`. The
+    charts are rendered by a pool of processes (with the Agg backend) while the workbooks
+    are written.
+
+    Args:
+        results_lf (pl.LazyFrame): GWAS results, e.g. from `read_gwas_results`.
+        reference_lf (pl.LazyFrame): Phenotype reference data.
+        ranks (Sequence[str]): Names of the ranks to compute, from `RANKS`.
+        output (str): Output folder.
+        chart_workers (int | None): Number of chart rendering processes. Default is one
+            per rank, up to the number of CPUs.
+
+    Returns:
+        dict[str, pl.DataFrame]: Every rank by name, and the `concatenated` and `mean`
+            tables.
+    """
+    names, plans = _analyse_plans(results_lf, reference_lf, ranks)
+    tables = dict(zip(names, pl.collect_all(plans)))
+
+    if len(ranks) == 0:
+        chart_workers = 1
+    elif chart_workers is None:
+        chart_workers = min(len(ranks), os.cpu_count() or 1)
+    # polars runs its own threads, which a forked process would inherit in whatever state
+    with ProcessPoolExecutor(
+        max_workers=chart_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_chart_worker,
+        initargs=(CHART_STYLE,),
+    ) as pool:
+        charts = [
+            pool.submit(
+                _plot_rank,
+                tables[rank].head(50).select(_RANK_PLANS[rank][2].label, _RANK_PLANS[rank][2].count),
+                _RANK_PLANS[rank][2],
+                f"{output}/{rank}",
+            )
+            for rank in ranks
+        ]
+
+        write_workbook(
+            f"{output}/concatenated_results.xlsx",
+            {"concatenated": tables["concatenated"], "mean": tables["mean"]},
+        )
+        for rank in ranks:
+            write_workbook(f"{output}/{rank}.xlsx", {rank: tables[rank]})
 
-    return rank_lf
+        for chart in charts:
+            chart.result()
 
-    pass
+    return tables
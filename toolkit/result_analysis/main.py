@@ -1,10 +1,8 @@
 import cli
 import libutils
 import os
-import sys
 
 import matplotlib.pyplot as plt
-from xlsxwriter import Workbook
 
 if __name__ == "__main__":
     args = cli.get_parser().parse_args()
@@ -22,52 +20,14 @@ if __name__ == "__main__":
     reference_lf = libutils.read_reference_data(args.phenotype_reference)
 
     # sns.set_style("whitegrid")
-    plt.style.use("seaborn-v0_8-whitegrid")
-
-    with Workbook(f"{args.output}/concatenated_results.xlsx") as wb:
-        lfs = libutils.concatenate_results(results_lf, reference_lf)
-        lfs[0].collect().write_excel(wb, worksheet="concatenated")
-        lfs[1].collect().write_excel(wb, worksheet="mean")
+    plt.style.use(libutils.CHART_STYLE)
 
     if cli.AnalysisOption.ALL.name in args.analysis:
         print("Perform all analysis projects")
-        libutils.snp_frequency_rank(
-            results_lf, reference_lf, save_path=f"{args.output}/snp_frequency_rank")
-        libutils.snp_ethnicity_pair_rank(
-            results_lf, reference_lf, save_path=f"{args.output}/snp_ethnics_pair_rank")
-        libutils.snp_phenotype_pair_rank(
-            results_lf, reference_lf, save_path=f"{args.output}/snp_phenotype_pair_rank")
-        libutils.snp_phenotype_duplication_rank(
-            results_lf, save_path=f"{args.output}/snp_phenotype_duplication_rank")
-        libutils.phenotype_frequency_rank(
-            results_lf, reference_lf, save_path=f"{args.output}/phenotype_frequency_rank")
-        libutils.phenotype_snp_pair_rank(
-            results_lf, reference_lf, save_path=f"{args.output}/phenotype_snp_pair_rank")
-        libutils.phenotype_ethnicity_pair_rank(
-            results_lf, reference_lf, save_path=f"{args.output}/phenotype_ethnicity_pair_rank")
-
-        sys.exit(0)
+        ranks = list(libutils.RANKS)
+    else:
+        ranks = list(dict.fromkeys(project.lower() for project in args.analysis))
 
-    for project in args.analysis:
-        match cli.AnalysisOption[project]:
-            case cli.AnalysisOption.SNP_FREQUENCY_RANK:
-                libutils.snp_frequency_rank(
-                    results_lf, reference_lf, save_path=f"{args.output}/snp_frequency_rank")
-            case cli.AnalysisOption.SNP_ETHNICITY_PAIR_RANK:
-                libutils.snp_ethnicity_pair_rank(
-                    results_lf, reference_lf, save_path=f"{args.output}/snp_ethnics_pair_rank")
-            case cli.AnalysisOption.SNP_PHENOTYPE_PAIR_RANK:
-                libutils.snp_phenotype_pair_rank(
-                    results_lf, reference_lf, save_path=f"{args.output}/snp_phenotype_pair_rank")
-            case cli.AnalysisOption.SNP_PHENOTYPE_DUPLICATION_RANK:
-                libutils.snp_phenotype_duplication_rank(
-                    results_lf, save_path=f"{args.output}/snp_phenotype_duplication_rank")
-            case cli.AnalysisOption.PHENOTYPE_FREQUENCY_RANK:
-                libutils.phenotype_frequency_rank(
-                    results_lf, reference_lf, save_path=f"{args.output}/phenoype_frequency_rank")
-            case cli.AnalysisOption.PHENOTYPE_SNP_PAIR_RANK:
-                libutils.phenotype_snp_pair_rank(
-                    results_lf, reference_lf, save_path=f"{args.output}/phenotype_snp_pair_rank")
-            case cli.AnalysisOption.PHENOTYPE_ETHNICITY_PAIR_RANK:
-                libutils.phenotype_ethnicity_pair_rank(
-                    results_lf, reference_lf, save_path=f"{args.output}/phenotype_ethnicity_pair_rank")
+    # the results are scanned and joined with the reference once, and every rank is
+    # derived from the joined results in one pass
+    libutils.analyse(results_lf, reference_lf, ranks, output=args.output)
@@ -1,5 +1,6 @@
 import unittest
 import os
+import shutil
 import libutils
 import polars as pl
 
@@ -45,6 +46,161 @@ class TestReadInput(unittest.TestCase):
 
         input_lf = libutils.read_gwas_results(list(self.input_files))
 
+class TestLazyScan(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = os.path.join("test_results", "lazy_scan")
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.tsv = os.path.join(self.directory, "summary-q.tsv")
+        pl.DataFrame({
+            "CHR": [1, 2, 3], "SNP": ["rs1", "rs2", "rs3"], "BP": [10, 20, 30],
+            "P": ["0.001", "NA", "0.2"], "P'": [0.01, None, 1.0],
+            "gender": ["male"] * 3, "ethnic": ["Han"] * 3, "phenotype": ["f.21001.0"] * 3,
+            "G11": ["1.5", "NA", "2"], "EXTRA": [0, 0, 0],
+        }).write_csv(self.tsv, separator="\t")
+
+        self.parquet = os.path.join(self.directory, "summary-q.parquet")
+        partition = os.path.join(self.parquet, "gender=female", "ethnic=Han", "phenotype=f.50.0")
+        os.makedirs(partition, exist_ok=True)
+        pl.DataFrame({
+            "CHR": ["1"], "SNP": ["rs4"], "BP": [40], "P": [0.003], "P'": [0.03], "PERM_P_2": [0.04],
+        }).write_parquet(os.path.join(partition, "0.parquet"))
+
+    def test_union_schema(self):
+        input_lf = libutils.read_gwas_results([self.tsv, self.parquet])
+
+        schema = input_lf.collect_schema()
+        self.assertEqual(
+            list(schema.names()),
+            ["CHR", "SNP", "BP", "P", "P'", "PERM_P_2", "gender", "ethnic", "phenotype", "G11"],
+        )
+        self.assertTrue(all(libutils.QASSOC_COLUMNS_SCHEMA[name] == dtype for name, dtype in schema.items()))
+
+        df = input_lf.sort("SNP").collect()
+        self.assertEqual(df["SNP"].to_list(), ["rs1", "rs3", "rs4"])
+        self.assertEqual(df["gender"].to_list(), ["male", "male", "female"])
+        self.assertEqual(df["PERM_P_2"].to_list(), [None, None, 0.04])
+        self.assertEqual(df["G11"].to_list(), [1.5, 2.0, None])
+
+    def test_pushdown(self):
+        plan = libutils.read_gwas_results([self.tsv, self.parquet]) \
+            .filter(pl.col("P") < 0.05).select("SNP").explain()
+        self.assertNotIn("EXTRA", plan)
+        self.assertNotIn("G11", plan)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class TestSinglePassAnalyse(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = os.path.join("test_results", "single_pass")
+        os.makedirs(self.directory, exist_ok=True)
+
+        rows = [
+            (snp, gender, ethnic, f"f.{field}.0")
+            for snp in ("rs1", "rs2", "rs3")
+            for gender in ("male", "female")
+            for ethnic in ("Han", "Uyghur")
+            for field in ("21001", "50", "999")
+            if (int(snp[-1]) + len(gender) + len(ethnic) + len(field)) % 3 != 0
+        ]
+        self.input_lf = pl.DataFrame(
+            rows, schema=["SNP", "gender", "ethnic", "phenotype"], orient="row"
+        ).with_columns(
+            CHR=pl.lit("1"), BETA=pl.lit(0.5), SE=pl.lit(0.1), R2=pl.lit(0.01), P=pl.lit(1e-9)
+        ).lazy()
+        reference = os.path.join(self.directory, "reference.tsv")
+        with open(reference, "w") as writer:
+            writer.write("21001\tBMI\n50\theight\n")
+        self.reference_lf = libutils.read_reference_data(reference)
+
+    def test_analyse(self):
+        tables = libutils.analyse(self.input_lf, self.reference_lf, output=self.directory)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, "concatenated_results.xlsx")))
+        self.assertEqual(set(tables["concatenated"]["phenotype_name"]), {"BMI", "height"})
+
+        separate = {
+            "snp_frequency_rank": libutils.snp_frequency_rank,
+            "snp_phenotype_pair_rank": libutils.snp_phenotype_pair_rank,
+            "snp_ethnicity_pair_rank": libutils.snp_ethnicity_pair_rank,
+            "phenotype_frequency_rank": libutils.phenotype_frequency_rank,
+            "phenotype_snp_pair_rank": libutils.phenotype_snp_pair_rank,
+            "phenotype_ethnicity_pair_rank": libutils.phenotype_ethnicity_pair_rank,
+        }
+        for rank in libutils.RANKS:
+            self.assertTrue(os.path.isfile(os.path.join(self.directory, f"{rank}.png")))
+            save_path = os.path.join(self.directory, f"separate_{rank}")
+            if rank in separate:
+                expected = separate[rank](self.input_lf, self.reference_lf, save_path=save_path)
+            else:
+                expected = libutils.snp_phenotype_duplication_rank(self.input_lf, save_path=save_path)
+            chart = libutils._RANK_PLANS[rank][2]
+            self.assertEqual(
+                tables[rank].select(chart.label, chart.count).sort(chart.label).rows(),
+                expected.select(chart.label, chart.count).sort(chart.label).collect().rows(),
+            )
+        # every chart is closed once saved
+        self.assertEqual(libutils.plt.get_fignums(), [])
+
+    def test_scan_and_join_once(self):
+        results_path = os.path.join(self.directory, "results.csv")
+        self.input_lf.collect().write_csv(results_path)
+        reference_path = os.path.join(self.directory, "reference.tsv")
+
+        names, plans = libutils._analyse_plans(
+            pl.scan_csv(results_path), libutils.read_reference_data(reference_path), libutils.RANKS
+        )
+        self.assertEqual(names, ["concatenated", "mean", *libutils.RANKS])
+        # the join is collected once; no plan scans a file or joins again
+        plan = pl.explain_all(plans)
+        self.assertNotIn("SCAN", plan.upper())
+        self.assertNotIn("JOIN", plan)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class TestWriteWorkbook(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = os.path.join("test_results", "workbook")
+        os.makedirs(self.directory, exist_ok=True)
+        self.df = pl.DataFrame({
+            "SNP": [f"rs{i}" for i in range(25)],
+            "P": [float("nan") if i == 3 else i / 100 for i in range(25)],
+            "phenotypes": [["BMI", "height"][: i % 3] for i in range(25)],
+        })
+
+    def test_split_and_fallback(self):
+        import openpyxl
+
+        path = os.path.join(self.directory, "tables.xlsx")
+        fallbacks = libutils.write_workbook(
+            path, {"small": self.df.head(5), "large": self.df, "huge": self.df},
+            max_sheet_rows=10, max_sheets=3,
+        )
+        self.assertEqual(fallbacks, [])
+        wb = openpyxl.load_workbook(path, read_only=True)
+        self.assertEqual(wb.sheetnames, ["small", "large (1)", "large (2)", "large (3)", "huge (1)", "huge (2)", "huge (3)"])
+        rows = [row for name in ("large (1)", "large (2)", "large (3)") for row in wb[name].iter_rows(values_only=True)]
+        self.assertEqual(rows.count(("SNP", "P", "phenotypes")), 3)
+        self.assertEqual([row[0] for row in rows if row[0] != "SNP"], self.df["SNP"].to_list())
+        self.assertEqual(rows[2][2], "['BMI']")
+        wb.close()
+
+        fallbacks = libutils.write_workbook(path, {"small": self.df.head(5), "large": self.df}, max_sheet_rows=10, max_sheets=2)
+        self.assertEqual(fallbacks, [os.path.join(self.directory, "tables-large.parquet")])
+        self.assertTrue(pl.read_parquet(fallbacks[0]).equals(self.df))
+        wb = openpyxl.load_workbook(path, read_only=True)
+        self.assertEqual(wb.sheetnames, ["small", "large"])
+        self.assertEqual(list(wb["large"].iter_rows(values_only=True))[1], ("tables-large.parquet",))
+        wb.close()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
 class TestAnalyse(unittest.TestCase):
     def setUp(self) -> None:
         self.input_lf = libutils.read_gwas_results(list(INPUT_FILES))
@@ -82,5 +238,8 @@ if __name__ == "__main__":
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
     suite.addTests(loader.loadTestsFromTestCase(TestReadInput))
+    suite.addTests(loader.loadTestsFromTestCase(TestLazyScan))
+    suite.addTests(loader.loadTestsFromTestCase(TestSinglePassAnalyse))
+    suite.addTests(loader.loadTestsFromTestCase(TestWriteWorkbook))
     suite.addTests(loader.loadTestsFromTestCase(TestAnalyse))
     unittest.TextTestRunner(verbosity=2).run(suite)